@@ -23,77 +23,204 @@ global AD_TESTS_MAX_TRIES
 AD_TESTS_MAX_TRIES = int(2)
 global AD_MAX_CONSECUTIVE_FAILURES
 AD_MAX_CONSECUTIVE_FAILURES = int(2)
+# Upper bound on the time spent retrying AD tests (dig, dscl and the waits
+# after remediation steps), and how long to let a remediation step settle:
+global AD_TESTS_TIME_BUDGET_SECONDS, AD_REMEDIATION_SETTLE_SECONDS
+AD_TESTS_TIME_BUDGET_SECONDS = int(90)
+AD_REMEDIATION_SETTLE_SECONDS = int(5)
 
 global DEPENDENT_CONFIG_PROFILE_IDENTIFIERS
 DEPENDENT_CONFIG_PROFILE_IDENTIFIERS = ["org.sample.config.profile.active-directory","org.sample.config.profile.8021X"]
 global NTP_SERVER
 NTP_SERVER = "ntp.example.org"
+# Before stepping the clock with ntpdate, measure the offset from NTP_SERVER
+# with an SNTP query; ntpdate runs only if the clock is off by more than the
+# Kerberos tolerance (or the offset could not be measured):
+global AD_CLOCK_SKEW_TOLERANCE_SECONDS, NTP_PORT, NTP_QUERY_TIMEOUT_SECONDS, NTP_QUERY_TRIES
+AD_CLOCK_SKEW_TOLERANCE_SECONDS = int(300)
+NTP_PORT = int(123)
+NTP_QUERY_TIMEOUT_SECONDS = 1.0
+NTP_QUERY_TRIES = int(2)
 
 global AD_FAILURES_HISTORY_FILE_PATH
 AD_FAILURES_HISTORY_FILE_PATH = "/Library/Managed Installs/ActiveDirectoryFailures.plist"
+# Failure timestamps kept in that file (older ones are dropped; the count is kept):
+global AD_FAILURES_HISTORY_CAPACITY
+AD_FAILURES_HISTORY_CAPACITY = int(32)
 
+# DNS-SRV lookups: query the resolvers in /etc/resolv.conf directly (falling
+# back to dig if none answer).  Each try waits twice as long as the last.
+global AD_DNS_SRV_NATIVE, DNS_RESOLV_CONF_PATH, DNS_SERVER_PORT, DNS_QUERY_TIMEOUT_SECONDS, DNS_QUERY_TRIES
+AD_DNS_SRV_NATIVE = True
+DNS_RESOLV_CONF_PATH = "/etc/resolv.conf"
+DNS_SERVER_PORT = int(53)
+DNS_QUERY_TIMEOUT_SECONDS = 1.0
+DNS_QUERY_TRIES = int(3)
 
-import sys, plistlib, xml, subprocess, os, logging, time, datetime
+# CLDAP netlogon pings ("LDAP pings"): a quick check that a domain controller
+# for AD_FOREST or AD_DOMAIN answers, sent to up to CLDAP_PING_MAX_DCS DCs
+# at once.  dscl remains the authoritative test of the binding.
+global AD_CLDAP_PING, CLDAP_PORT, CLDAP_PING_MAX_DCS, CLDAP_PING_TIMEOUT_SECONDS
+AD_CLDAP_PING = True
+CLDAP_PORT = int(389)
+CLDAP_PING_MAX_DCS = int(8)
+CLDAP_PING_TIMEOUT_SECONDS = 2.0
+
+# Domain controller discovery cache: SRV lookups are reused for their record
+# TTL (capped), off-network results for the negative TTL, and CLDAP round
+# trip times are kept so the fastest known DCs are pinged first.  The cache
+# is discarded when /etc/resolv.conf changes.  Another network can use the
+# same resolvers (and so the same resolv.conf), so SRV answers are kept no
+# longer than off-network results.
+global AD_DC_CACHE, AD_DC_CACHE_PATH, AD_DC_CACHE_VERSION
+AD_DC_CACHE = True
+AD_DC_CACHE_PATH = "/Library/Managed Installs/ActiveDirectoryDCCache.plist"
+AD_DC_CACHE_VERSION = int(1)
+global AD_DC_CACHE_MAX_TTL_SECONDS, AD_DC_CACHE_NEGATIVE_TTL_SECONDS, AD_DC_CACHE_RTT_TTL_SECONDS
+AD_DC_CACHE_MAX_TTL_SECONDS = int(300)
+AD_DC_CACHE_NEGATIVE_TTL_SECONDS = int(300)
+AD_DC_CACHE_RTT_TTL_SECONDS = int(86400)
+
+
+import sys, plistlib, xml, subprocess, os, logging, time, socket, struct, random, select, hashlib
 this_dir = os.path.dirname(os.path.realpath(__file__))
 shared_support_dir = os.path.join(this_dir,'shared-support')
 sys.path.append(shared_support_dir)
 import conditions_common
 
-def macos_ntpdate(given_ntp_server):
+def probe_timeout(given_budget,given_tool_path):
+    '''Returns the timeout for a command run within the given
+        conditions_common.RetryBudget: its tool's usual timeout, cut to the
+        time left in the budget.'''
+    return given_budget.timeout(conditions_common.shared_command_runner().command_timeout([given_tool_path]))
+
+def macos_ntpdate(given_ntp_server,given_timeout_seconds=None):
     '''Calls ntpdate and attempts to update the system clock.
         Returns true if successful, false otherwise.'''
     try:
-        subprocess.check_call(['/usr/sbin/ntpdate',
-                                          '-u',
-                                          given_ntp_server])
+        conditions_common.shared_command_runner().check_call(['/usr/sbin/ntpdate',
+                                                              '-u',
+                                                              given_ntp_server],
+                                                             given_timeout_seconds)
         return True
     except subprocess.CalledProcessError:
         return False
 
-def remove_sys_keychain_override():
+def sntp_timestamp(given_ntp_timestamp):
+    '''Converts a 64-bit NTP timestamp (seconds since 1900) to Unix time.'''
+    return given_ntp_timestamp / float(2**32) - 2208988800
+
+def sntp_query_once(given_ntp_server,given_timeout):
+    '''Sends one SNTP (v4, client mode) request.  Returns the clock offset
+        in seconds (positive if the local clock is behind), or None if no
+        valid reply came within given_timeout.'''
+    try:
+        address_info = socket.getaddrinfo(given_ntp_server,NTP_PORT,0,socket.SOCK_DGRAM)[0]
+        udp_socket = socket.socket(address_info[0],socket.SOCK_DGRAM)
+    except socket.error:
+        return None
+    try:
+        udp_socket.settimeout(given_timeout)
+        # Random transmit timestamp; the reply must echo it as its origin.
+        request_id = random.getrandbits(64)
+        t1 = time.time()
+        udp_socket.sendto(struct.pack('!B39xQ',0x23,request_id),address_info[4])
+        deadline = t1 + given_timeout
+        while time.time() < deadline:
+            udp_socket.settimeout(max(0.001,deadline - time.time()))
+            reply = udp_socket.recv(1024)
+            t4 = time.time()
+            if len(reply) < 48:
+                continue
+            flags, stratum = struct.unpack('!BB',reply[:2])
+            origin, receive, transmit = struct.unpack('!QQQ',reply[24:48])
+            # Ignore replies to other requests, unsynchronized servers
+            # (leap indicator 3), and kiss-o'-death packets (stratum 0):
+            if origin != request_id or flags & 0x07 != 4 or flags >> 6 == 3 or stratum == 0:
+                continue
+            t2 = sntp_timestamp(receive)
+            t3 = sntp_timestamp(transmit)
+            return ((t2 - t1) + (t3 - t4)) / 2
+    except socket.error:
+        pass
+    finally:
+        udp_socket.close()
+    return None
+
+def sntp_measure_offset(given_ntp_server,given_budget=None):
+    '''Measures the local clock's offset from the given NTP server, trying
+        NTP_QUERY_TRIES times with NTP_QUERY_TIMEOUT_SECONDS each, within the
+        given conditions_common.RetryBudget (if any).  Returns the offset in
+        seconds, or None if the server did not answer.'''
+    start_time = time.time()
+    offset = None
+    t = 0
+    while t < NTP_QUERY_TRIES and offset is None:
+        timeout = NTP_QUERY_TIMEOUT_SECONDS
+        if given_budget:
+            if given_budget.expired():
+                break
+            timeout = given_budget.timeout(timeout)
+        t += 1
+        offset = sntp_query_once(given_ntp_server,timeout)
+    if given_budget:
+        given_budget.record('sntp',time.time() - start_time,t,offset is not None)
+    return offset
+
+def remove_sys_keychain_override(given_timeout_seconds=None):
     '''Attempts to remove the DefaultKeychain key from
         /Library/Preferences/com.apple.security.plist.
         Using defaults here since the plist may be a binplist.'''
     plist_path = "/Library/Preferences/com.apple.security.plist"
     try:
-        subprocess.check_call(['/usr/bin/defaults',
-                               'delete',
-                               plist_path,
-                               'DefaultKeychain'])
+        conditions_common.shared_command_runner().check_call(['/usr/bin/defaults',
+                                                              'delete',
+                                                              plist_path,
+                                                              'DefaultKeychain'],
+                                                             given_timeout_seconds)
         return True
     except subprocess.CalledProcessError:
         return False
 
-def dscl_lookup_computer_record(given_forest,given_domain,given_computer_account):
+def dscl_read_computer_record(given_computer_account,given_cancel_event=None,given_timeout_seconds=None):
+    '''Reads the given computer record with dscl (one attempt).
+        Returns a dict of its attributes, or an empty dict.'''
+    # Defaults:
+    output_dict = {}
+    # Call dscl:
+    try:
+        output = conditions_common.shared_command_runner().check_output([conditions_common.DSCL_PATH,
+                                                                         '-plist',
+                                                                         '/Search',
+                                                                         'read',
+                                                                         'Computers/%s' % given_computer_account],
+                                                                        given_timeout_seconds,
+                                                                        given_cancel_event)
+    except subprocess.CalledProcessError:
+        output = ''
+    if output:
+        try:
+            output_dict = plistlib.readPlistFromString(output)
+        except xml.parsers.expat.ExpatError:
+            pass
+    return output_dict
+
+def dscl_lookup_computer_record(given_forest,given_domain,given_computer_account,given_budget=None,given_cancel_event=None):
     '''Looks up the given computer account using dscl to test communication
         with the domain.  Returns true iff:
         1. dscl can communicate with AD, and
         2. dscl can look up and read attributes of the computer record, and
         3. the computer record's meta node location contains the
            given domain or forest.
-        Otherwise, returns false.'''
+        Otherwise, returns false.  dscl is tried up to 5 times with backoff
+        within the given conditions_common.RetryBudget; tries stop early
+        (returning false) if the given cancel event is set.'''
     # Defaults:
     record_in_domain_or_forest = False
-    # Loop:
-    t = 0
-    while t < 5:
-        t += 1
-        # Call dscl:
-        output_dict = {}
-        try:
-            output = subprocess.check_output(['/usr/bin/dscl',
-                                              '-plist',
-                                              '/Search',
-                                              'read',
-                                              'Computers/%s' % given_computer_account])
-        except subprocess.CalledProcessError:
-            output = ''
-        if output:
-            output_dict = plistlib.readPlistFromString(output)
-        if output_dict:
-            break
-        # Sleep and try again if no output:
-        time.sleep(5)
+    if given_budget is None:
+        given_budget = conditions_common.RetryBudget(AD_TESTS_TIME_BUDGET_SECONDS)
+    # Try until dscl returns the record:
+    output_dict = given_budget.run('dscl',lambda: dscl_read_computer_record(given_computer_account,given_cancel_event,probe_timeout(given_budget,conditions_common.DSCL_PATH)),5,given_cancel_event) or {}
 
     # Parse output:
     try:
@@ -121,9 +248,10 @@ def dsconfigad_get_computer_record(given_forest,given_domain):
     computer_account = ''
     # Call dsconfigad:
     try:
-        output = subprocess.check_output(['/usr/sbin/dsconfigad',
-                                          '-xml',
-                                          '-show'])
+        output = conditions_common.shared_command_runner().check_output(['/usr/sbin/dsconfigad',
+                                                                         '-show',
+                                                                         '-xml'],
+                                                                        given_memoize=True)
     except subprocess.CalledProcessError:
         output = ''
     # Try to parse output:
@@ -154,109 +282,542 @@ def dsconfigad_get_computer_record(given_forest,given_domain):
     # Otherwise, return blank string:
     return ''
 
-def dig_lookup_dns_srv(given_forest,given_domain):
-    '''Performs DNS-SRV queries to see if we have domain controllers available.
+def dig_lookup_dns_srv_once(given_forest,given_domain,given_timeout_seconds=None):
+    '''Performs one DNS-SRV query with dig.
         Returns true if dig found a DNS-SRV record for the global catalog for our domain.
         Returns false otherwise.'''
     # Defaults:
     ad_gc_available = False
-    # Loop:
-    t = 0
-    while (not ad_gc_available) and (t < 5):
-        t += 1
-        output_array = []
-        answer_section_index = -1
-        # Call dig:
+    output_array = []
+    answer_section_index = -1
+    # Call dig:
+    try:
+        output = conditions_common.shared_command_runner().check_output(['/usr/bin/dig',
+                                                                         '-t',
+                                                                         'SRV',
+                                                                         '_gc._tcp.%s' % given_forest],
+                                                                        given_timeout_seconds)
+    except subprocess.CalledProcessError:
+        output = ''
+    # Try to parse output:
+    if output:
+        output_array = output.split('\n')
+    if output_array:
         try:
-            output = subprocess.check_output(['/usr/bin/dig',
-                                              '-t',
-                                              'SRV',
-                                              '_gc._tcp.%s' % given_forest])
-        except subprocess.CalledProcessError:
-            output = ''
-        # Try to parse output:
-        if output:
-            output_array = output.split('\n')
-        if output_array:
-            try:
-                answer_section_index = output_array.index(';; ANSWER SECTION:')
-            except ValueError:
-                pass
-        # Break if answer section has our domain:
-        if answer_section_index >= 0:
-            for i in range(answer_section_index+1,len(output_array)):
-                if given_domain.lower() in output_array[i].lower():
-                    ad_gc_available = True
-                    break
-                if given_forest.lower() in output_array[i].lower():
-                    ad_gc_available = True
-                    break
-                if ';' in output_array[i]: # new section; ignore from here
-                    break
-        # Sleep:
-        time.sleep(5)
+            answer_section_index = output_array.index(';; ANSWER SECTION:')
+        except ValueError:
+            pass
+    # Look for our domain in the answer section:
+    if answer_section_index >= 0:
+        for i in range(answer_section_index+1,len(output_array)):
+            if given_domain.lower() in output_array[i].lower():
+                ad_gc_available = True
+                break
+            if given_forest.lower() in output_array[i].lower():
+                ad_gc_available = True
+                break
+            if ';' in output_array[i]: # new section; ignore from here
+                break
     # Return:
     return ad_gc_available
 
+def dig_lookup_dns_srv(given_forest,given_domain,given_budget=None):
+    '''Performs DNS-SRV queries with dig (up to 5, with backoff, within the
+        given conditions_common.RetryBudget) to see if we have domain
+        controllers available.  Returns true if dig found a DNS-SRV record
+        for the global catalog for our domain.  Returns false otherwise.'''
+    if given_budget is None:
+        given_budget = conditions_common.RetryBudget(AD_TESTS_TIME_BUDGET_SECONDS)
+    return bool(given_budget.run('dig',lambda: dig_lookup_dns_srv_once(given_forest,given_domain,probe_timeout(given_budget,'/usr/bin/dig')),5))
+
+def dns_nameservers():
+    '''Returns the list of nameserver addresses in DNS_RESOLV_CONF_PATH.'''
+    nameservers_list = []
+    try:
+        with open(DNS_RESOLV_CONF_PATH) as resolv_conf_file:
+            for line in resolv_conf_file:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    nameservers_list.append(fields[1].split('%')[0]) # drop any IPv6 scope
+    except IOError:
+        pass
+    return nameservers_list
+
+def dns_build_srv_query(given_name,given_query_id):
+    '''Builds a DNS query message (recursion desired) for SRV records of the
+        given name, with an EDNS0 OPT record allowing 4096-byte UDP replies.'''
+    message = struct.pack('!HHHHHH',given_query_id,0x0100,1,0,0,1)
+    for label in given_name.strip('.').split('.'):
+        message += struct.pack('!B',len(label)) + label
+    message += struct.pack('!BHH',0,33,1)
+    # OPT pseudo-record: root name, type 41, class = UDP payload size.
+    message += struct.pack('!BHHIH',0,41,4096,0,0)
+    return message
+
+def dns_read_name(given_message,given_offset):
+    '''Reads a (possibly compressed) domain name from a DNS message.
+        Returns the name and the offset just past it.'''
+    labels_list = []
+    end_offset = None
+    offset = given_offset
+    jumps = 0
+    while True:
+        length = ord(given_message[offset])
+        if length & 0xC0 == 0xC0:
+            # Pointer to an earlier name:
+            if end_offset is None:
+                end_offset = offset + 2
+            offset = struct.unpack('!H',given_message[offset:offset+2])[0] & 0x3FFF
+            jumps += 1
+            if jumps > 64:
+                raise ValueError('DNS name compression loop')
+            continue
+        if length == 0:
+            offset += 1
+            break
+        labels_list.append(given_message[offset+1:offset+1+length])
+        offset += 1 + length
+    if end_offset is None:
+        end_offset = offset
+    return '.'.join(labels_list), end_offset
+
+def dns_parse_srv_response(given_message,given_query_id):
+    '''Parses a DNS response.  Returns a tuple: the rcode, whether the reply
+        was truncated, and a list of SRV record dicts (name, target, port,
+        priority, weight, ttl).  Raises ValueError for replies that are
+        malformed or not for our query.'''
+    try:
+        query_id, flags, qd_count, an_count = struct.unpack('!HHHH',given_message[:8])
+        if query_id != given_query_id or not flags & 0x8000:
+            raise ValueError('DNS reply does not match the query')
+        offset = 12
+        for i in range(qd_count):
+            offset = dns_read_name(given_message,offset)[1] + 4
+        records_list = []
+        for i in range(an_count):
+            name, offset = dns_read_name(given_message,offset)
+            record_type, record_class, ttl, rdata_length = struct.unpack('!HHIH',given_message[offset:offset+10])
+            offset += 10
+            if record_type == 33:
+                priority, weight, port = struct.unpack('!HHH',given_message[offset:offset+6])
+                target = dns_read_name(given_message,offset+6)[0]
+                records_list.append({'name':name,'target':target,'port':port,
+                                     'priority':priority,'weight':weight,'ttl':ttl})
+            offset += rdata_length
+    except (struct.error,IndexError,TypeError):
+        raise ValueError('Malformed DNS reply')
+    records_list.sort(key=lambda record: (record['priority'],-record['weight'],record['target']))
+    return flags & 0x000F, bool(flags & 0x0200), records_list
+
+def dns_query_tcp(given_nameserver,given_query,given_timeout):
+    '''Sends a DNS query over TCP (for replies too large for UDP).
+        Returns the reply message.'''
+    tcp_socket = socket.create_connection((given_nameserver,DNS_SERVER_PORT),given_timeout)
+    try:
+        tcp_socket.settimeout(given_timeout)
+        tcp_socket.sendall(struct.pack('!H',len(given_query)) + given_query)
+        reply = ''
+        reply_length = None
+        while reply_length is None or len(reply) < reply_length + 2:
+            chunk = tcp_socket.recv(65537)
+            if not chunk:
+                break
+            reply += chunk
+            if reply_length is None and len(reply) >= 2:
+                reply_length = struct.unpack('!H',reply[:2])[0]
+        return reply[2:]
+    finally:
+        tcp_socket.close()
+
+def dns_query_srv(given_name,given_nameservers_list=None,given_timeout_seconds=None):
+    '''Queries the given nameservers (default: dns_nameservers()) for SRV
+        records of the given name over UDP.  Each try sends to every
+        nameserver and waits up to DNS_QUERY_TIMEOUT_SECONDS, doubling the
+        wait on each retransmission; no wait runs past given_timeout_seconds
+        (if given) from the start of the query.  Returns a list of SRV
+        record dicts (empty if the name has none), or None if no nameserver
+        answered.'''
+    if given_nameservers_list is None:
+        given_nameservers_list = dns_nameservers()
+    if not given_nameservers_list:
+        return None
+    query_deadline = None
+    if given_timeout_seconds is not None:
+        query_deadline = time.time() + given_timeout_seconds
+    query_id = random.randint(0,0xFFFF)
+    query = dns_build_srv_query(given_name,query_id)
+    sockets_dict = {}
+    try:
+        for nameserver in given_nameservers_list:
+            try:
+                family = socket.getaddrinfo(nameserver,DNS_SERVER_PORT,0,socket.SOCK_DGRAM)[0][0]
+                udp_socket = socket.socket(family,socket.SOCK_DGRAM)
+                udp_socket.connect((nameserver,DNS_SERVER_PORT))
+                sockets_dict[udp_socket] = nameserver
+            except socket.error:
+                continue
+        timeout = DNS_QUERY_TIMEOUT_SECONDS
+        for t in range(DNS_QUERY_TRIES):
+            if query_deadline is not None:
+                timeout = min(timeout,query_deadline - time.time())
+                if timeout <= 0:
+                    break
+            for udp_socket in sockets_dict:
+                try:
+                    udp_socket.send(query)
+                except socket.error:
+                    pass
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                readable_list = select.select(list(sockets_dict),[],[],max(0,deadline - time.time()))[0]
+                for udp_socket in readable_list:
+                    try:
+                        reply = udp_socket.recv(65535)
+                        rcode, truncated, records_list = dns_parse_srv_response(reply,query_id)
+                        if truncated:
+                            tcp_timeout = timeout
+                            if query_deadline is not None:
+                                tcp_timeout = max(0.001,query_deadline - time.time())
+                            rcode, truncated, records_list = dns_parse_srv_response(dns_query_tcp(sockets_dict[udp_socket],query,tcp_timeout),query_id)
+                    except (socket.error,ValueError):
+                        continue
+                    # NOERROR or NXDOMAIN are answers; other rcodes: wait for another server.
+                    if rcode in [0,3]:
+                        return records_list
+            timeout *= 2
+    finally:
+        for udp_socket in sockets_dict:
+            udp_socket.close()
+    return None
+
+def lookup_dns_srv(given_forest,given_domain,given_budget=None):
+    '''Looks up the global catalog DNS-SRV records for the forest to see if
+        we have domain controllers available.  Uses dns_query_srv() if
+        AD_DNS_SRV_NATIVE, falling back to dig (within the given
+        conditions_common.RetryBudget) if no nameserver answered.
+        The native query is also bounded by the budget (step dns-srv).
+        Returns a tuple: true/false for GC availability, and the list of SRV
+        record dicts (empty when dig was used).'''
+    if given_budget is None:
+        given_budget = conditions_common.RetryBudget(AD_TESTS_TIME_BUDGET_SECONDS)
+    if AD_DNS_SRV_NATIVE and not given_budget.expired():
+        start_time = time.time()
+        records_list = dns_query_srv('_gc._tcp.%s' % given_forest,None,given_budget.remaining())
+        given_budget.record('dns-srv',time.time() - start_time,1,records_list is not None)
+        if records_list is not None:
+            ad_gc_available = False
+            for record in records_list:
+                for name in [record['name'].lower(),record['target'].lower()]:
+                    if given_domain.lower() in name or given_forest.lower() in name:
+                        ad_gc_available = True
+            return ad_gc_available, records_list
+        logging.error('No DNS server answered; falling back to dig.')
+    return dig_lookup_dns_srv(given_forest,given_domain,given_budget), []
+
+def dns_network_signature():
+    '''Returns a hash of the resolver configuration, which changes when the
+        network (nameservers, search domains) does.'''
+    try:
+        resolv_conf_file = open(DNS_RESOLV_CONF_PATH,'rb')
+        try:
+            return hashlib.sha1(resolv_conf_file.read()).hexdigest()
+        finally:
+            resolv_conf_file.close()
+    except IOError:
+        return ''
+
+def srv_records_ttl(given_srv_records_list):
+    '''Returns how long the given SRV records may be cached: their lowest
+        TTL, capped at AD_DC_CACHE_MAX_TTL_SECONDS.'''
+    ttl = AD_DC_CACHE_MAX_TTL_SECONDS
+    for record in given_srv_records_list:
+        ttl = min(ttl,record['ttl'])
+    return ttl
+
+def lookup_dns_srv_cached(given_forest,given_domain,given_budget=None,given_dc_cache=None):
+    '''Like lookup_dns_srv(), but answers from the given
+        conditions_common.PlistTTLCache while its entry is fresh.  Native
+        lookups are cached for the records' TTL; off-network results are
+        cached for AD_DC_CACHE_NEGATIVE_TTL_SECONDS.'''
+    if given_dc_cache is None:
+        return lookup_dns_srv(given_forest,given_domain,given_budget)
+    cache_key = 'srv:_gc._tcp.%s' % given_forest.lower()
+    entry_dict = given_dc_cache.get(cache_key)
+    if entry_dict:
+        if entry_dict['negative']:
+            logging.info('DC cache: off network (cached).')
+            return False, []
+        logging.info('DC cache: %d global catalog records (cached).' % len(entry_dict['value']))
+        return True, entry_dict['value']
+    start_time = time.time()
+    ad_gc_available, records_list = lookup_dns_srv(given_forest,given_domain,given_budget)
+    lookup_seconds = time.time() - start_time
+    if not ad_gc_available:
+        given_dc_cache.put_negative(cache_key,AD_DC_CACHE_NEGATIVE_TTL_SECONDS,lookup_seconds)
+    elif records_list:
+        # (dig results carry no records or TTLs, so are not cached.)
+        given_dc_cache.put(cache_key,records_list,srv_records_ttl(records_list),lookup_seconds)
+    return ad_gc_available, records_list
+
+def cldap_build_netlogon_ping(given_domain,given_message_id):
+    '''Builds a CLDAP search request for the Netlogon attribute of the
+        rootDSE, filtered on (&(DnsDomain=given_domain)(NtVer=0x00000006))
+        so that DCs reply with a NETLOGON_SAM_LOGON_RESPONSE_EX.'''
+    ber = conditions_common
+    ldap_filter = ber.ber_encode_sequence([
+        ber.ber_encode_sequence([ber.ber_encode_string('DnsDomain'),ber.ber_encode_string(given_domain)],0xA3),
+        ber.ber_encode_sequence([ber.ber_encode_string('NtVer'),ber.ber_encode_string('\x06\x00\x00\x00')],0xA3),
+        ],0xA0)
+    search_request = ber.ber_encode_sequence([
+        ber.ber_encode_string(''),          # baseObject: rootDSE
+        ber.ber_encode_integer(0,0x0A),     # scope: baseObject
+        ber.ber_encode_integer(0,0x0A),     # derefAliases: never
+        ber.ber_encode_integer(0),          # sizeLimit
+        ber.ber_encode_integer(0),          # timeLimit
+        ber.ber_encode_boolean(False),      # typesOnly
+        ldap_filter,
+        ber.ber_encode_sequence([ber.ber_encode_string('Netlogon')]),
+        ],0x63)
+    return ber.ber_encode_sequence([ber.ber_encode_integer(given_message_id),search_request])
+
+def cldap_parse_netlogon_response(given_message,given_message_id):
+    '''Parses a CLDAP reply to cldap_build_netlogon_ping().  Returns the
+        Netlogon attribute value (bytes), or None if the reply has none.
+        Raises ValueError for replies that are malformed or not ours.'''
+    try:
+        return cldap_find_netlogon_value(given_message,given_message_id)
+    except IndexError:
+        raise ValueError('Malformed CLDAP reply')
+
+def cldap_find_netlogon_value(given_message,given_message_id):
+    ber = conditions_common
+    netlogon_value = None
+    for tag, ldap_message in ber.ber_decode_all(given_message):
+        if tag != 0x30:
+            raise ValueError('Not an LDAP message')
+        elements_list = ber.ber_decode_all(ldap_message)
+        if len(elements_list) < 2 or ber.ber_decode_integer(elements_list[0][1]) != given_message_id:
+            raise ValueError('CLDAP reply does not match the request')
+        protocol_tag, protocol_op = elements_list[1]
+        if protocol_tag != 0x64: # searchResEntry; searchResDone carries nothing we need
+            continue
+        attributes = ber.ber_decode_all(protocol_op)[1][1]
+        for attribute_tag, attribute in ber.ber_decode_all(attributes):
+            attribute_type, attribute_values = [value for value_tag, value in ber.ber_decode_all(attribute)][:2]
+            if attribute_type.lower() == 'netlogon':
+                values_list = ber.ber_decode_all(attribute_values)
+                if values_list:
+                    netlogon_value = values_list[0][1]
+    return netlogon_value
+
+def cldap_parse_netlogon(given_netlogon_value):
+    '''Parses a NETLOGON_SAM_LOGON_RESPONSE_EX structure.  Returns a dict
+        (flags, forest, domain, host, netbios_domain, netbios_host, site,
+        client_site), or raises ValueError if malformed.'''
+    try:
+        opcode, sbz, flags = struct.unpack('<HHI',given_netlogon_value[:8])
+        if opcode not in [23,25]: # SAM logon response (ex), user unknown (ex)
+            raise ValueError('Unexpected netlogon opcode %d' % opcode)
+        offset = 24 # past the DomainGuid
+        names_list = []
+        for i in range(8):
+            name, offset = dns_read_name(given_netlogon_value,offset)
+            names_list.append(name)
+    except (struct.error,IndexError,TypeError):
+        raise ValueError('Malformed netlogon response')
+    return {'flags':flags,
+            'forest':names_list[0],
+            'domain':names_list[1],
+            'host':names_list[2],
+            'netbios_domain':names_list[3],
+            'netbios_host':names_list[4],
+            'site':names_list[6],
+            'client_site':names_list[7],
+            }
+
+def cldap_resolve_dc(given_dc_host):
+    '''Returns the first socket address of the given DC for CLDAP, or None.'''
+    try:
+        address_info = socket.getaddrinfo(given_dc_host,CLDAP_PORT,0,socket.SOCK_DGRAM)[0]
+    except socket.error:
+        return None
+    return address_info[0], address_info[4]
+
+def cldap_ping_domain_controllers(given_dc_hosts_list,given_forest,given_domain,given_timeout=None):
+    '''Sends a CLDAP netlogon ping to each of the given DC hosts (names
+        resolved in parallel) at once, then waits up to given_timeout
+        (default: CLDAP_PING_TIMEOUT_SECONDS) for the first valid reply from
+        a DC of the given forest or domain.  Returns that reply's parsed
+        netlogon dict, plus the responding dc_host and rtt_seconds, or None
+        if no DC answered.'''
+    if given_timeout is None:
+        given_timeout = CLDAP_PING_TIMEOUT_SECONDS
+    given_dc_hosts_list = given_dc_hosts_list[:CLDAP_PING_MAX_DCS]
+    if not given_dc_hosts_list:
+        return None
+    addresses_list = conditions_common.run_in_pool(cldap_resolve_dc,given_dc_hosts_list,len(given_dc_hosts_list))
+    message_id = random.randint(1,0x7FFFFFFF)
+    ping = cldap_build_netlogon_ping(given_domain,message_id)
+    sockets_dict = {}
+    try:
+        for dc_host, address in zip(given_dc_hosts_list,addresses_list):
+            if address is None:
+                continue
+            try:
+                udp_socket = socket.socket(address[0],socket.SOCK_DGRAM)
+                udp_socket.connect(address[1])
+                udp_socket.send(ping)
+                sockets_dict[udp_socket] = (dc_host,time.time())
+            except socket.error:
+                continue
+        deadline = time.time() + given_timeout
+        while sockets_dict and time.time() < deadline:
+            readable_list = select.select(list(sockets_dict),[],[],max(0,deadline - time.time()))[0]
+            for udp_socket in readable_list:
+                dc_host, sent_time = sockets_dict[udp_socket]
+                try:
+                    reply = udp_socket.recv(65535)
+                    rtt_seconds = time.time() - sent_time
+                    netlogon_value = cldap_parse_netlogon_response(reply,message_id)
+                    if netlogon_value is None:
+                        continue
+                    netlogon_dict = cldap_parse_netlogon(netlogon_value)
+                except (socket.error,ValueError):
+                    # e.g. ICMP port unreachable; nothing more from this DC.
+                    del sockets_dict[udp_socket]
+                    udp_socket.close()
+                    continue
+                if (netlogon_dict['forest'].lower() == given_forest.lower() or
+                    netlogon_dict['domain'].lower() == given_domain.lower()):
+                    netlogon_dict['dc_host'] = dc_host
+                    netlogon_dict['rtt_seconds'] = rtt_seconds
+                    return netlogon_dict
+                logging.error('CLDAP: %s answered for %s, not %s.' % (dc_host,netlogon_dict['domain'],given_domain))
+    finally:
+        for udp_socket in sockets_dict:
+            udp_socket.close()
+    return None
+
+def cldap_dc_hosts(given_domain,given_srv_records_list,given_dc_cache=None,given_budget=None):
+    '''Returns DC host names to ping: targets of the given (GC) SRV records,
+        or else of the _ldap._tcp SRV records for the given domain (looked
+        up within the given conditions_common.RetryBudget, if any).  With a
+        conditions_common.PlistTTLCache, the _ldap._tcp lookup is cached and
+        DCs with a known round trip time come first, fastest first.'''
+    rtt_seconds_dict = {}
+    if not given_srv_records_list:
+        cache_key = 'srv:_ldap._tcp.%s' % given_domain.lower()
+        entry_dict = given_dc_cache and given_dc_cache.get(cache_key)
+        if entry_dict:
+            given_srv_records_list = entry_dict.get('value',[])
+        elif given_budget is None or not given_budget.expired():
+            start_time = time.time()
+            given_srv_records_list = dns_query_srv('_ldap._tcp.%s' % given_domain,None,given_budget and given_budget.remaining()) or []
+            if given_budget:
+                given_budget.record('dns-srv-ldap',time.time() - start_time,1,bool(given_srv_records_list))
+            if given_dc_cache and given_srv_records_list:
+                given_dc_cache.put(cache_key,given_srv_records_list,srv_records_ttl(given_srv_records_list),time.time() - start_time)
+    if given_dc_cache:
+        entry_dict = given_dc_cache.get('dc_rtt_seconds',False,False)
+        if entry_dict:
+            rtt_seconds_dict = entry_dict['value']
+    dc_hosts_list = []
+    for record in given_srv_records_list:
+        if record['target'] and record['target'] not in dc_hosts_list:
+            dc_hosts_list.append(record['target'])
+    # Known-good DCs (by round trip time) first; the rest keep SRV order:
+    return sorted(dc_hosts_list,key=lambda dc_host: rtt_seconds_dict.get(dc_host,float('inf')))
+
+def record_dc_rtt(given_dc_cache,given_dc_host,given_rtt_seconds):
+    '''Records the round trip time of a DC that answered a CLDAP ping.'''
+    rtt_seconds_dict = {}
+    entry_dict = given_dc_cache.get('dc_rtt_seconds',True,False)
+    if entry_dict and not entry_dict['stale']:
+        rtt_seconds_dict = dict(entry_dict['value'])
+    rtt_seconds_dict[given_dc_host] = given_rtt_seconds
+    given_dc_cache.put('dc_rtt_seconds',rtt_seconds_dict,AD_DC_CACHE_RTT_TTL_SECONDS)
+
+def dscl_failures_from_legacy_plist(given_dscl_failures_dict):
+    '''Converts failure data written by earlier versions of this script
+        (failure_count and an unbounded failure_timestamps array) for
+        conditions_common.HistoryStore.'''
+    return ({'failure_count':given_dscl_failures_dict['failure_count']},
+            given_dscl_failures_dict.get('failure_timestamps',[]))
+
+def dscl_failures_history():
+    return conditions_common.HistoryStore(AD_FAILURES_HISTORY_FILE_PATH,AD_FAILURES_HISTORY_CAPACITY,dscl_failures_from_legacy_plist)
+
 def increment_dscl_failure_count():
     '''Sets or increments a counter and timestamp to track
         Active Directory communications errors.
         Returns a failure count (of at least 1).'''
-    # Defaults:
-    dscl_failures_dict = {"failure_count":0,
-                        "failure_timestamps":[]}
-    read_dscl_failures_dict = {}
-    # Try to read existing failure data:
-    if os.path.exists(AD_FAILURES_HISTORY_FILE_PATH):
-        try:
-            read_dscl_failures_dict = plistlib.readPlist(AD_FAILURES_HISTORY_FILE_PATH)
-        except xml.parsers.expat.ExpatError:
-            pass
-    dscl_failures_dict.update(read_dscl_failures_dict)
-    # Note this failure:
-    dscl_failures_dict['failure_count'] += 1
-    dscl_failures_dict['failure_timestamps'].append(datetime.datetime.utcnow())
-    # Write failure data:
-    try:
-        plistlib.writePlist(dscl_failures_dict,AD_FAILURES_HISTORY_FILE_PATH)
-    except TypeError:
-        logging.error("Failed to write AD failure history to: %s" % AD_FAILURES_HISTORY_FILE_PATH)
-    except IOError:
-        logging.error("Failed to write AD failure history to: %s" % AD_FAILURES_HISTORY_FILE_PATH)
-    # Return failure count:
-    return dscl_failures_dict['failure_count']
+    return dscl_failures_history().record('failure_count')
 
 def remove_dscl_failure_data():
     '''Removes the file tracking AD connectivity failures.'''
-    # Try to read existing failure data:
     if os.path.exists(AD_FAILURES_HISTORY_FILE_PATH):
-        try:
-            os.unlink(AD_FAILURES_HISTORY_FILE_PATH)
-        except IOError:
-            logging.error("Failed to remove AD failure history: %s" % AD_FAILURES_HISTORY_FILE_PATH)
+        dscl_failures_history().clear()
 
-def main():
-    '''Main logic for this script'''
+def run_condition(given_context):
+    '''Main logic for this script.  Queues conditions on the given
+        conditions_common.ConditionsContext.'''
     # Assume not on network unless we prove otherwise.
     ad_status = "not-on-network"
     # Assume failure count is zero unless we prove otherwise.
     dscl_failure_count = 0
     # Assume dscl lookup is false unless network and dsconfigad tests pass:
     ad_dscl_tests_pass = False
+    # Assume no DC answered a CLDAP ping unless we prove otherwise:
+    ad_dc_reachable = False
+    ad_dc_responder = ''
+    # Clock offset from NTP_SERVER, if measured during remediation:
+    ad_clock_offset_seconds = None
+    # All retries and waits share one time budget:
+    budget = conditions_common.RetryBudget(AD_TESTS_TIME_BUDGET_SECONDS)
+    # Discovered DCs from earlier runs on this network:
+    dc_cache = None
+    if AD_DC_CACHE:
+        dc_cache = conditions_common.PlistTTLCache(AD_DC_CACHE_PATH,AD_DC_CACHE_VERSION,dns_network_signature())
+
+    # Start the independent probes together:
+    # Network test and basic info from macOS.
+    logging.info('Looking for DNS-SRV records and getting information from dsconfigad...')
+    srv_probe = conditions_common.BackgroundProbe(lookup_dns_srv_cached,(AD_FOREST,AD_DOMAIN,budget,dc_cache),given_default=(False,[]))
+    dsconfigad_probe = conditions_common.BackgroundProbe(dsconfigad_get_computer_record,(AD_FOREST,AD_DOMAIN),given_default='')
+    dsconfigad_computer_record = dsconfigad_probe.result()
+    # If macOS thinks it is bound, start the first dscl test without waiting for DNS:
+    dscl_probe = None
+    if dsconfigad_computer_record:
+        dscl_probe = conditions_common.BackgroundProbe(dscl_lookup_computer_record,(AD_FOREST,AD_DOMAIN,dsconfigad_computer_record,budget),True,False)
+    on_network, gc_srv_records = srv_probe.result()
+    # Off network, the dscl result is not needed:
+    if dscl_probe and not on_network:
+        dscl_probe.cancel()
+        dscl_probe.result() # returns promptly; reaps the killed dscl
+        dscl_probe = None
+    logging.info('Probes: DNS-SRV %.2fs, dsconfigad %.2fs.' % (srv_probe.seconds,dsconfigad_probe.seconds))
+
+    # Quick DC reachability check while the first dscl test runs:
+    if on_network and AD_CLDAP_PING:
+        dc_hosts_list = cldap_dc_hosts(AD_DOMAIN,gc_srv_records,dc_cache,budget)
+        netlogon_dict = cldap_ping_domain_controllers(dc_hosts_list,AD_FOREST,AD_DOMAIN,budget.timeout(CLDAP_PING_TIMEOUT_SECONDS))
+        if netlogon_dict:
+            ad_dc_reachable = True
+            ad_dc_responder = netlogon_dict['dc_host']
+            logging.info('CLDAP: %s answered in %.3fs (site %s).' % (ad_dc_responder,netlogon_dict['rtt_seconds'],netlogon_dict['site']))
+            if dc_cache:
+                record_dc_rtt(dc_cache,ad_dc_responder,netlogon_dict['rtt_seconds'])
+        else:
+            # Only a hint: UDP 389 may be filtered while LDAP and Kerberos
+            # work, so dscl is still tried (and retried) as usual.
+            logging.error('CLDAP: none of %d domain controllers answered.' % len(dc_hosts_list))
 
-    # Network test:
-    logging.info('Looking for DNS-SRV records...')
-    on_network = dig_lookup_dns_srv(AD_FOREST,AD_DOMAIN)
-    # Basic info from macOS:
-    logging.info('Getting information from dsconfigad...')
-    dsconfigad_computer_record = dsconfigad_get_computer_record(AD_FOREST,AD_DOMAIN)
-    
     # On-network tests loop:
     # Condition necessity and sufficiency Venn Diagram:
     # ( not dsconfigad_computer_record          )( dsconfigad_computer_record )
     # ( not ad_dscl_tests_pass                          )( ad_dscl_tests_pass )
     t = 0
-    while on_network and (t < AD_TESTS_MAX_TRIES) and (ad_status != "on-network-communicating"):
+    while on_network and (t < AD_TESTS_MAX_TRIES) and (ad_status != "on-network-communicating") and not budget.expired():
         # Counter:
         t += 1
         logging.info('On network: DNS-SRV records found.  Performing other tests...')
@@ -264,7 +825,12 @@ def main():
         if dsconfigad_computer_record:
             logging.info('dsconfigad indicates system bound using %s' % dsconfigad_computer_record)
             logging.info('Testing connectivity using dscl...')
-            ad_dscl_tests_pass = dscl_lookup_computer_record(AD_FOREST,AD_DOMAIN,dsconfigad_computer_record)
+            if dscl_probe:
+                # First try: the dscl test already in flight.
+                ad_dscl_tests_pass = dscl_probe.result()
+                dscl_probe = None
+            else:
+                ad_dscl_tests_pass = dscl_lookup_computer_record(AD_FOREST,AD_DOMAIN,dsconfigad_computer_record,budget)
             if ad_dscl_tests_pass:
                 ad_status = "on-network-communicating"
                 logging.info('The dscl tests passed.')
@@ -279,23 +845,36 @@ def main():
         # Special subset of dscl tests failing; system thinks it's bound, so
         # try a couple of things that might correct a transitory communications error.
         if not ad_dscl_tests_pass and dsconfigad_computer_record:
-            # 1 - Update system clock.
-            logging.error('Attempting to update system clock...')
-            if not macos_ntpdate(NTP_SERVER):
-                logging.error('...NTP update against %s failed!' % NTP_SERVER)
+            # 1 - Update system clock if it is off by more than Kerberos allows.
+            ad_clock_offset_seconds = sntp_measure_offset(NTP_SERVER,budget)
+            if ad_clock_offset_seconds is not None and abs(ad_clock_offset_seconds) <= AD_CLOCK_SKEW_TOLERANCE_SECONDS:
+                logging.info('System clock is within %ss of %s (offset %.3fs); not updating it.' % (AD_CLOCK_SKEW_TOLERANCE_SECONDS,NTP_SERVER,ad_clock_offset_seconds))
             else:
-                logging.error('...NTP update complete.')
-            time.sleep(5)
+                if ad_clock_offset_seconds is None:
+                    logging.error('Could not measure clock offset from %s.' % NTP_SERVER)
+                else:
+                    logging.error('System clock is off by %.3fs.' % ad_clock_offset_seconds)
+                logging.error('Attempting to update system clock...')
+                # One attempt, skipped if the budget is spent:
+                if not budget.run('ntpdate',lambda: macos_ntpdate(NTP_SERVER,probe_timeout(budget,'/usr/sbin/ntpdate')),1):
+                    logging.error('...NTP update against %s failed!' % NTP_SERVER)
+                else:
+                    logging.error('...NTP update complete.')
+                budget.wait('ntp-settle',AD_REMEDIATION_SETTLE_SECONDS)
             # 2 - Remove DefaultKeychain key from com.apple.security.plist.
             logging.error('Removing DefaultKeychain key from com.apple.security.plist if necessary...')
             # This can fix a situation where macOS tries sourcing the computer (trust)
             # account password from a keychain other than the System.keychain.
-            if not remove_sys_keychain_override():
+            if not budget.run('defaults',lambda: remove_sys_keychain_override(probe_timeout(budget,'/usr/bin/defaults')),1):
                 logging.error('...removing DefaultKeychain key failed (perhaps not present).')
             else:
                 logging.error('...removed DefaultKeychain key.')
-            time.sleep(5)
-            
+            budget.wait('keychain-settle',AD_REMEDIATION_SETTLE_SECONDS)
+    logging.info(budget.report())
+    if dc_cache:
+        logging.info(dc_cache.report())
+        dc_cache.save()
+
     # If unbound, increment the failure count:
     if ad_status == "on-network-unbound":
         dscl_failure_count = increment_dscl_failure_count()
@@ -307,12 +886,23 @@ def main():
         for profile_identifier in DEPENDENT_CONFIG_PROFILE_IDENTIFIERS:
             conditions_common.remove_profile(profile_identifier)
 
-    # Write Conditions:
-    conditions_common.write_conditions({"ad_on_network":on_network,
-                                       "ad_computer_record":dsconfigad_computer_record,
-                                       "ad_dscl_tests_pass":ad_dscl_tests_pass,
-                                       "ad_status":ad_status,
-                     })
+    # Queue Conditions:
+    conditions_dict = {"ad_on_network":on_network,
+                       "ad_computer_record":dsconfigad_computer_record,
+                       "ad_dscl_tests_pass":ad_dscl_tests_pass,
+                       "ad_status":ad_status,
+                       "ad_dc_reachable":ad_dc_reachable,
+                       "ad_dc_responder":ad_dc_responder,
+                       # None (not measured this run) removes an earlier offset:
+                       "ad_clock_offset_seconds":ad_clock_offset_seconds,
+                       }
+    given_context.write_conditions(conditions_dict)
+
+def main():
+    '''Runs this condition stand-alone.'''
+    context = conditions_common.ConditionsContext()
+    run_condition(context)
+    context.flush()
     # Finish:
     sys.exit(0)
 
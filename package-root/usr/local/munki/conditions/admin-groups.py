@@ -16,83 +16,86 @@
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 
-# Location of munki manifests on the client:
-global MUNKI_MANIFESTS_PATH
-MUNKI_MANIFESTS_PATH = "/Library/Managed Installs/manifests"
-
 # Directory node from which we reference groups to nest.
 # Node path is what dscl reports.
 global DIRECTORY_SEARCH_NODE
 DIRECTORY_SEARCH_NODE = "/Active Directory/YOURDOMAIN/All Domains"
+# dscl arguments reading the groups nested in the local admin group.  Its
+# output is remembered for the run until the admin group is changed.
+global ADMIN_GROUP_READ_ARGUMENTS
+ADMIN_GROUP_READ_ARGUMENTS = ['-plist','/Local/Default','read','Groups/admin','NestedGroups']
+
+# Cache of group GUIDs looked up in DIRECTORY_SEARCH_NODE.  Groups not found
+# are cached for the (shorter) negative TTL.  If the directory cannot be
+# reached, entries expired up to GUID_CACHE_MAX_STALE_SECONDS ago are used.
+global GUID_CACHE, GUID_CACHE_PATH, GUID_CACHE_VERSION
+GUID_CACHE = True
+GUID_CACHE_PATH = "/Library/Managed Installs/AdminGroupsGUIDCache.plist"
+GUID_CACHE_VERSION = int(1)
+global GUID_CACHE_TTL_SECONDS, GUID_CACHE_NEGATIVE_TTL_SECONDS, GUID_CACHE_MAX_STALE_SECONDS
+GUID_CACHE_TTL_SECONDS = int(604800)
+GUID_CACHE_NEGATIVE_TTL_SECONDS = int(3600)
+GUID_CACHE_MAX_STALE_SECONDS = int(2592000)
 
-import sys, plistlib, xml, subprocess, os, logging
+# Optionally, look up group GUIDs (objectGUID) directly with LDAP, in batches
+# of up to LDAP_GUID_BATCH_SIZE names per search, before falling back to dscl
+# for any group LDAP could not resolve.  Leave the bind DN blank for an
+# anonymous bind.  ldaps:// servers must present a certificate for their host
+# name signed by a CA in LDAP_CA_CERT_PATH (a PEM file; blank for the
+# system's CAs).  A password is only sent over ldap:// (in the clear) if
+# LDAP_ALLOW_CLEARTEXT_BIND.
+global LDAP_GUID_RESOLVER, LDAP_URI, LDAP_BIND_DN, LDAP_BIND_PASSWORD, LDAP_BASE_DN
+LDAP_GUID_RESOLVER = False
+LDAP_URI = "ldaps://domain.example.org"
+LDAP_BIND_DN = ""
+LDAP_BIND_PASSWORD = ""
+LDAP_BASE_DN = "DC=domain,DC=example,DC=org"
+global LDAP_CA_CERT_PATH, LDAP_ALLOW_CLEARTEXT_BIND
+LDAP_CA_CERT_PATH = ""
+LDAP_ALLOW_CLEARTEXT_BIND = False
+global LDAP_GUID_BATCH_SIZE, LDAP_PAGE_SIZE, LDAP_TIMEOUT_SECONDS
+LDAP_GUID_BATCH_SIZE = int(200)
+LDAP_PAGE_SIZE = int(500)
+LDAP_TIMEOUT_SECONDS = int(10)
+
+import sys, plistlib, xml, subprocess, os, logging, time, uuid
 this_dir = os.path.dirname(os.path.realpath(__file__))
 shared_support_dir = os.path.join(this_dir,'shared-support')
 sys.path.append(shared_support_dir)
 import conditions_common
 
-def make_list_of_admin_groups(given_manifest_names_list):
-    '''Given a list of manifest names, examine their metadata, looking for nested_admin_groups keys.
+def make_list_of_admin_groups(given_effective_metadata_dict,given_guid_resolver):
+    '''Given the effective (merged) manifest metadata, look up the nested_admin_groups
+        (GUIDs from the given GroupGUIDResolver).
         Build a list of dictionaries from that information.'''
     # Defaults:
-    admin_group_names_list = []
     admin_group_dicts_list = []
-    exclude_admins_from_dsconfigad = False
-    # Read each manifest's _metadata:print_nested_admin_groups key,
-    # creating a list of unique group names.
-    for manifest_name in given_manifest_names_list:
-        # Determine the manifest path:
-        manifest_path = os.path.join(MUNKI_MANIFESTS_PATH,manifest_name)
-        # Defaults:
-        manifest_dict = {}
-        manifest_metadata_dict = {}
-        manifest_admin_group_names_list = []
-        if os.path.exists(manifest_path):
-            try:
-                manifest_dict = plistlib.readPlist(manifest_path)
-            except xml.parsers.expat.ExpatError:
-                pass
-            if manifest_dict:
-                try:
-                    manifest_metadata_dict = manifest_dict['_metadata']
-                except KeyError:
-                    pass
-            if manifest_metadata_dict:
-                try:
-                    manifest_admin_group_names_list = manifest_metadata_dict['nested_admin_groups']
-                except KeyError:
-                    pass
-                try:
-                    # One true flips this parameter; cannot be flipped back with a false:
-                    if manifest_metadata_dict['exclude_admins_from_dsconfigad']:
-                        exclude_admins_from_dsconfigad = True
-                except KeyError:
-                    pass
-        # Build up the list of admin group names:
-        for group_name in manifest_admin_group_names_list:
-            if group_name not in admin_group_names_list:
-                admin_group_names_list.append(group_name)
+    # Unique group names and the exclude flag, merged across all applicable manifests:
+    admin_group_names_list = given_effective_metadata_dict['nested_admin_groups']
+    exclude_admins_from_dsconfigad = given_effective_metadata_dict['exclude_admins_from_dsconfigad']
     # Build list of dicts describing groups:
+    given_guid_resolver.prefetch(admin_group_names_list)
     for group_name in admin_group_names_list:
-        the_group_dict = {}
-        the_group_dict['name'] = group_name
-        the_group_dict['guid'] = osx_dscl_get_guid(group_name)
+        the_group_dict = given_guid_resolver.group_dict(group_name)
         if the_group_dict['guid']:
             admin_group_dicts_list.append(the_group_dict)
     # Return the filtered list:
     return admin_group_dicts_list, exclude_admins_from_dsconfigad
 
-def get_list_of_admin_groups_from_dsconfigad():
+def get_list_of_admin_groups_from_dsconfigad(given_guid_resolver):
     '''Read dsconfigad/AD binding prefs to get a list of admin groups that were specified there.
-        Build a list of dictionaries from that information.'''
+        Build a list of dictionaries from that information (GUIDs from the given GroupGUIDResolver).'''
     # Defaults:
+    output = ''
+    output_dict = {}
     admin_group_names_list = []
     admin_group_dicts_list = []
-    # Run dsconfigad and parse output.
+    # Run dsconfigad and parse output (shared with ad-status).
     try:
-        output = subprocess.check_output(['/usr/sbin/dsconfigad',
-                                          '-show',
-                                          '-xml'])
+        output = conditions_common.shared_command_runner().check_output(['/usr/sbin/dsconfigad',
+                                                                         '-show',
+                                                                         '-xml'],
+                                                                        given_memoize=True)
     except subprocess.CalledProcessError:
         print "Unable to obtain AD config from dsconfigad."
     if output:
@@ -106,19 +109,138 @@ def get_list_of_admin_groups_from_dsconfigad():
         except KeyError:
             pass
     # Build list of dicts describing groups:
+    given_guid_resolver.prefetch(admin_group_names_list)
     for group_name in admin_group_names_list:
-        the_group_dict = {}
-        the_group_dict['name'] = group_name
-        the_group_dict['guid'] = osx_dscl_get_guid(group_name)
+        the_group_dict = given_guid_resolver.group_dict(group_name)
         if the_group_dict['guid']:
             admin_group_dicts_list.append(the_group_dict)
     # Return the filtered list:
     return admin_group_dicts_list
 
-def osx_dscl_get_guid(given_group_name):
+def ldap_guid_to_generated_uid(given_object_guid):
+    '''Converts a binary objectGUID to the GeneratedUID form dscl reports.'''
+    return str(uuid.UUID(bytes_le=given_object_guid)).upper()
+
+def ldap_lookup_group_guids(given_group_names_list):
+    '''Looks up the objectGUIDs of the given groups (by sAMAccountName) with
+        LDAP, one search per LDAP_GUID_BATCH_SIZE names, each paged by
+        LDAP_PAGE_SIZE.  Returns a dict mapping the lowercase names of the
+        groups found to their GUIDs (as GeneratedUIDs).
+        Raises conditions_common.LDAPError if LDAP fails.'''
+    guids_dict = {}
+    ldap_connection = conditions_common.LDAPConnection(LDAP_URI,LDAP_TIMEOUT_SECONDS,LDAP_CA_CERT_PATH)
+    try:
+        if LDAP_BIND_DN:
+            ldap_connection.simple_bind(LDAP_BIND_DN,LDAP_BIND_PASSWORD,LDAP_ALLOW_CLEARTEXT_BIND)
+        for i in range(0,len(given_group_names_list),LDAP_GUID_BATCH_SIZE):
+            names_filter = conditions_common.ldap_filter_or([conditions_common.ldap_filter_equal('sAMAccountName',group_name)
+                                                              for group_name in given_group_names_list[i:i+LDAP_GUID_BATCH_SIZE]])
+            ldap_filter = conditions_common.ldap_filter_and([conditions_common.ldap_filter_equal('objectClass','group'),names_filter])
+            for dn, attributes_dict in ldap_connection.search(LDAP_BASE_DN,ldap_filter,['sAMAccountName','objectGUID'],LDAP_PAGE_SIZE):
+                try:
+                    object_guid = attributes_dict['objectguid'][0]
+                    group_name = attributes_dict['samaccountname'][0].decode('utf-8').lower()
+                    guids_dict[group_name] = ldap_guid_to_generated_uid(object_guid)
+                except (KeyError,IndexError,ValueError):
+                    pass
+    finally:
+        ldap_connection.close()
+    return guids_dict
+
+class GroupGUIDResolver(object):
+    '''Looks up group GUIDs (in batches with LDAP via prefetch(), if
+        enabled, then one by one with osx_dscl_read_guid()), through the given
+        conditions_common.PlistTTLCache (if any).  A group the directory
+        reports as missing is cached as a negative entry.  If the directory
+        cannot be reached, a stale entry is used if there is one (the group
+        dict is marked guid_stale); otherwise the group is noted in
+        unresolved_names_list.'''
+    def __init__(self,given_cache=None):
+        self.cache = given_cache
+        self.unresolved_names_list = []
+        self.dscl_lookups = 0
+        self.ldap_resolved = 0
+        self.group_dicts_dict = {}
+
+    def prefetch(self,given_group_names_list):
+        '''If LDAP_GUID_RESOLVER, resolves the given groups not already
+            known (or fresh in the cache) with one batched LDAP lookup.
+            Groups LDAP does not find, or all of them if LDAP fails, are
+            left for dscl.'''
+        if not LDAP_GUID_RESOLVER:
+            return
+        pending_names_list = []
+        for group_name in given_group_names_list:
+            if group_name in self.group_dicts_dict or group_name in pending_names_list:
+                continue
+            entry_dict = self.cache and self.cache.get(self.cache_key(group_name),False,False)
+            if not entry_dict:
+                pending_names_list.append(group_name)
+        if not pending_names_list:
+            return
+        start_time = time.time()
+        try:
+            guids_dict = ldap_lookup_group_guids(pending_names_list)
+        except conditions_common.LDAPError, error:
+            logging.error('LDAP GUID lookup failed (%s); using dscl.' % error)
+            return
+        lookup_seconds = time.time() - start_time
+        self.ldap_resolved += len(guids_dict)
+        logging.info('LDAP: resolved %d of %d groups in %.2fs.' % (len(guids_dict),len(pending_names_list),lookup_seconds))
+        for group_name in pending_names_list:
+            guid = guids_dict.get(group_name.lower())
+            if not guid:
+                continue
+            if self.cache:
+                self.cache.put(self.cache_key(group_name),guid,GUID_CACHE_TTL_SECONDS,lookup_seconds / len(pending_names_list))
+            self.group_dicts_dict[group_name] = {'name':group_name,'guid':guid,'guid_stale':False}
+
+    def cache_key(self,given_group_name):
+        return '%s/Groups/%s' % (DIRECTORY_SEARCH_NODE,given_group_name)
+
+    def group_dict(self,given_group_name):
+        '''Returns a dict (name, guid, guid_stale) for the given group;
+            guid is None if unknown.'''
+        if given_group_name not in self.group_dicts_dict:
+            guid, guid_stale = self.resolve(given_group_name)
+            self.group_dicts_dict[given_group_name] = {'name':given_group_name,'guid':guid,'guid_stale':guid_stale}
+        return dict(self.group_dicts_dict[given_group_name])
+
+    def resolve(self,given_group_name):
+        '''Returns a tuple: the GUID of the given group (or None), and
+            whether it came from a stale cache entry.'''
+        cache_key = self.cache_key(given_group_name)
+        entry_dict = None
+        if self.cache:
+            entry_dict = self.cache.get(cache_key,True)
+            if entry_dict and not entry_dict['stale']:
+                return entry_dict.get('value'), False
+        start_time = time.time()
+        self.dscl_lookups += 1
+        guid, found = osx_dscl_read_guid(given_group_name)
+        lookup_seconds = time.time() - start_time
+        if guid:
+            if self.cache:
+                self.cache.put(cache_key,guid,GUID_CACHE_TTL_SECONDS,lookup_seconds)
+            return guid, False
+        if found is False:
+            # The directory answered: no such group.
+            if self.cache:
+                self.cache.put_negative(cache_key,GUID_CACHE_NEGATIVE_TTL_SECONDS,lookup_seconds)
+            return None, False
+        # The directory could not be reached; fall back to a stale entry:
+        if entry_dict and entry_dict.get('value'):
+            logging.error('Using cached GUID for %s (directory unreachable).' % given_group_name)
+            return entry_dict['value'], True
+        self.unresolved_names_list.append(given_group_name)
+        return None, False
+
+def osx_dscl_read_guid(given_group_name):
     '''Calls dscl to get the GUID of the given named group.
         Searches in DIRECTORY_SEARCH_NODE.
-        Returns None if anything bad happens.'''
+        Returns a tuple: the GUID (or None), and whether the group was found:
+        true, false if dscl reported eDSRecordNotFound, or None if anything
+        else went wrong (e.g. the directory is unreachable).'''
     # Defaults:
     output = ''
     output_dict = {}
@@ -126,14 +248,20 @@ def osx_dscl_get_guid(given_group_name):
     guid = None
     # Run dscl and parse output - try to get the GeneratedUID attribute.
     try:
-        output = subprocess.check_output(['/usr/bin/dscl',
-                                          '-plist',
-                                          DIRECTORY_SEARCH_NODE,
-                                          'read',
-                                          'Groups/%s' % given_group_name,
-                                          'GeneratedUID'])
-    except subprocess.CalledProcessError:
+        output = conditions_common.shared_command_runner().check_output([conditions_common.DSCL_PATH,
+                                                                         '-plist',
+                                                                         DIRECTORY_SEARCH_NODE,
+                                                                         'read',
+                                                                         'Groups/%s' % given_group_name,
+                                                                         'GeneratedUID'],
+                                                                        given_memoize=True)
+    except OSError:
+        return None, None
+    except subprocess.CalledProcessError, error:
         print "Unable to read GeneratedUID for %s with dscl." % given_group_name
+        if 'eDSRecordNotFound' in (error.output or ''):
+            return None, False
+        return None, None
     if output:
         try:
             output_dict = plistlib.readPlistFromString(output)
@@ -150,7 +278,13 @@ def osx_dscl_get_guid(given_group_name):
         except KeyError, NameError:
             pass
     # Return:
-    return guid
+    return guid, bool(guid) or None
+
+def osx_dscl_get_guid(given_group_name):
+    '''Calls dscl to get the GUID of the given named group.
+        Searches in DIRECTORY_SEARCH_NODE.
+        Returns None if anything bad happens.'''
+    return osx_dscl_read_guid(given_group_name)[0]
 
 def osx_dscl_list_nested_admin_groups():
     '''Returns an array of GUIDs from the NestedGroups attribute of the admin group.'''
@@ -160,12 +294,8 @@ def osx_dscl_list_nested_admin_groups():
     nested_groups_array = []
     # Run dscl to get the NestedGroups key for the admin group:
     try:
-        output = subprocess.check_output(['/usr/bin/dscl',
-                                          '-plist',
-                                          '/Local/Default',
-                                          'read',
-                                          'Groups/admin',
-                                          'NestedGroups'])
+        output = conditions_common.shared_command_runner().check_output([conditions_common.DSCL_PATH] + ADMIN_GROUP_READ_ARGUMENTS,
+                                                                        given_memoize=True)
     except subprocess.CalledProcessError:
         print "Unable to read NestedGroups for the admin group with dscl."
     if output:
@@ -185,14 +315,15 @@ def osx_dseditgroup_add_group_to_admin_group(given_group_dict):
     '''Calls dseditgroup to nest the given group in the local admin group.'''
     # Try to nest:
     try:
-        subprocess.check_call(['/usr/sbin/dseditgroup',
-                               '-o',
-                               'edit',
-                               '-a',
-                               given_group_dict['name'],
-                               '-t',
-                               'group',
-                               'admin'])
+        conditions_common.shared_command_runner().check_call(['/usr/sbin/dseditgroup',
+                                                              '-o',
+                                                              'edit',
+                                                              '-a',
+                                                              given_group_dict['name'],
+                                                              '-t',
+                                                              'group',
+                                                              'admin'],
+                                                             given_invalidates=[[conditions_common.DSCL_PATH] + ADMIN_GROUP_READ_ARGUMENTS])
         return True
     except subprocess.CalledProcessError:
         return False
@@ -201,67 +332,157 @@ def osx_dscl_remove_nested_admin_group(given_group_guid):
     '''Removes the given GUID from the NestedGroups attribute of the admin group.
         Returns true/false.'''
     try:
-        subprocess.check_call(['/usr/bin/dscl',
-                               '/Local/Default',
-                               'delete',
-                               'Groups/admin',
-                               'NestedGroups',
-                               given_group_guid])
+        conditions_common.shared_command_runner().check_call([conditions_common.DSCL_PATH,
+                                                              '/Local/Default',
+                                                              'delete',
+                                                              'Groups/admin',
+                                                              'NestedGroups',
+                                                              given_group_guid],
+                                                             given_invalidates=[[conditions_common.DSCL_PATH] + ADMIN_GROUP_READ_ARGUMENTS])
         return True
     except subprocess.CalledProcessError:
         return False
 
-def create_attr_difference_list(given_minuend_list_of_attrs,given_subtrahend_list_of_dicts,given_subtrahend_dict_key):
-    '''Given a minuend array of attrs and a subtrahend array of dicts, for each dict
-        in the subtrahend, if its attribute is in the minuend, remove it.
-        Return any remaining elements of the minuend.'''
-    for dict in given_subtrahend_list_of_dicts:
-        try:
-            given_minuend_list_of_attrs.remove(dict[given_subtrahend_dict_key])
-        except ValueError:
-            pass
-    return given_minuend_list_of_attrs
+class LocalAdminGroupDirectory(object):
+    '''Directory adapter for AdminGroupReconciler: the NestedGroups of the
+        local admin group, read and changed with dscl and dseditgroup.'''
+    def list_nested_guids(self):
+        return osx_dscl_list_nested_admin_groups()
 
-def main():
-    '''Main logic for this script'''
-    # Results array: A list of true/false values we'll use to look for errors
-    # Starts with one true so we don't have an empty list. We will compare against
-    # an intersection of its elements, so adding a true does not throw off that logic.
-    results_array = [True]
-    overall_result = False
-    # Get names of group manifests to which this computer is a member:
-    group_manifest_names = conditions_common.make_list_of_applicable_manifests()
+    def add_group(self,given_group_dict):
+        return osx_dseditgroup_add_group_to_admin_group(given_group_dict)
+
+    def remove_guid(self,given_group_guid):
+        return osx_dscl_remove_nested_admin_group(given_group_guid)
+
+class AdminGroupReconciler(object):
+    '''Brings the groups nested in the admin group in line with the
+        requested groups.  measure() reads the nested group GUIDs once;
+        plan() works out additions and removals with set operations;
+        apply() carries them out, updating the in-memory model from each
+        result and timing each mutation; verify() reads the nested groups
+        again only if anything was changed.  The directory is any object
+        with list_nested_guids(), add_group(group_dict) and
+        remove_guid(guid) (see LocalAdminGroupDirectory).'''
+    def __init__(self,given_directory):
+        self.directory = given_directory
+        self.nested_guids_list = []
+        self.additions_list = []
+        self.removals_list = []
+        self.mutations_list = []
+        self.reads = 0
+
+    def measure(self):
+        self.nested_guids_list = list(self.directory.list_nested_guids())
+        self.reads += 1
+        return self.nested_guids_list
+
+    def plan(self,given_requested_group_dicts_list,given_allow_removals=True):
+        '''Plans additions (requested groups not nested, except those known
+            only from stale GUIDs) and, if allowed, removals (nested GUIDs
+            not requested).  Returns the plan as a dict of lists: add (group
+            names) and remove (GUIDs).'''
+        nested_guids_set = set(self.nested_guids_list)
+        requested_guids_set = set()
+        self.additions_list = []
+        for group_dict in given_requested_group_dicts_list:
+            if group_dict['guid'] in requested_guids_set:
+                continue
+            requested_guids_set.add(group_dict['guid'])
+            if group_dict['guid'] not in nested_guids_set and not group_dict.get('guid_stale'):
+                self.additions_list.append(group_dict)
+        self.removals_list = []
+        if given_allow_removals:
+            self.removals_list = [guid for guid in self.nested_guids_list if guid not in requested_guids_set]
+        return {'add':[group_dict['name'] for group_dict in self.additions_list],
+                'remove':list(self.removals_list)}
+
+    def mutate(self,given_action,given_name,given_guid,given_function,given_argument):
+        start_time = time.time()
+        success = bool(given_function(given_argument))
+        self.mutations_list.append({'action':given_action,'name':given_name,'guid':given_guid,
+                                    'success':success,'seconds':time.time() - start_time})
+        return success
+
+    def apply(self):
+        '''Applies the plan.  Returns true iff every mutation succeeded.'''
+        for group_dict in self.additions_list:
+            if self.mutate('add',group_dict['name'],group_dict['guid'],self.directory.add_group,group_dict):
+                self.nested_guids_list.append(group_dict['guid'])
+        for group_guid in self.removals_list:
+            if self.mutate('remove','',group_guid,self.directory.remove_guid,group_guid):
+                self.nested_guids_list.remove(group_guid)
+        return False not in [mutation_dict['success'] for mutation_dict in self.mutations_list]
+
+    def verify(self):
+        '''Returns the nested group GUIDs, read again if anything was changed.'''
+        if self.mutations_list:
+            expected_guids_set = set(self.nested_guids_list)
+            self.measure()
+            if set(self.nested_guids_list) != expected_guids_set:
+                logging.error('Nested admin groups differ from those expected after changes.')
+        return self.nested_guids_list
+
+    def applied_guids(self,given_action):
+        return [mutation_dict['guid'] for mutation_dict in self.mutations_list
+                if mutation_dict['action'] == given_action and mutation_dict['success']]
+
+    def report(self):
+        '''Returns log lines describing the plan and each mutation.'''
+        lines_list = ['Admin groups plan: add %d, remove %d; %d reads of NestedGroups.' % (len(self.additions_list),len(self.removals_list),self.reads)]
+        for mutation_dict in self.mutations_list:
+            lines_list.append('  %s %s %s: %s in %.3fs' % (mutation_dict['action'],mutation_dict['name'],mutation_dict['guid'],
+                                                       'ok' if mutation_dict['success'] else 'FAILED',mutation_dict['seconds']))
+        return '\n'.join(lines_list)
+
+def run_condition(given_context):
+    '''Main logic for this script.  Queues conditions on the given
+        conditions_common.ConditionsContext.'''
+    overall_result = True
+    # Merge metadata of the group manifests to which this computer is a member:
+    effective_metadata_dict = given_context.effective_manifest_metadata
+    # Group GUIDs, from the cache where possible:
+    guid_cache = None
+    if GUID_CACHE:
+        guid_cache = conditions_common.PlistTTLCache(GUID_CACHE_PATH,GUID_CACHE_VERSION,'',GUID_CACHE_MAX_STALE_SECONDS)
+    guid_resolver = GroupGUIDResolver(guid_cache)
     # Construct list of admin groups that should be present:
-    requested_admin_group_dicts_list, exclude_dsconfigad_admin_groups = make_list_of_admin_groups(group_manifest_names)
+    requested_admin_group_dicts_list, exclude_dsconfigad_admin_groups = make_list_of_admin_groups(effective_metadata_dict,guid_resolver)
     # Enumerate existing nested groups:
-    measured_admin_group_guids_list = osx_dscl_list_nested_admin_groups()
+    reconciler = AdminGroupReconciler(LocalAdminGroupDirectory())
+    reconciler.measure()
 
     # Manage admin groups iff we have a list:
     # When off network, we expect this list to be empty (because GUIDs could not be resolved).
     if requested_admin_group_dicts_list:
         # Add groups from dsconfigad to the requested list if appropriate:
         if not exclude_dsconfigad_admin_groups:
-            dsconfigad_admin_group_dicts_list = get_list_of_admin_groups_from_dsconfigad()
-            for group_dict in dsconfigad_admin_group_dicts_list:
-                if group_dict not in requested_admin_group_dicts_list:
-                    requested_admin_group_dicts_list.append(group_dict)
-        # Add groups to the admin group:
-        for group_dict in requested_admin_group_dicts_list:
-            if group_dict['guid'] not in measured_admin_group_guids_list:
-                results_array.append(osx_dseditgroup_add_group_to_admin_group(group_dict))
-        # Measure nested admin groups again (after additions):
-        measured_admin_group_guids_list = osx_dscl_list_nested_admin_groups()
-        # Take desired away from measured:
-        difference_list = create_attr_difference_list(measured_admin_group_guids_list,requested_admin_group_dicts_list,'guid')
-        # If anything is left, remove it:
-        if difference_list:
-            for group_guid in difference_list:
-                results_array.append(osx_dscl_remove_nested_admin_group(group_guid))
-
-    # Assemble and write Conditions:
-    if False not in results_array:
-        overall_result = True
-    conditions_common.write_conditions({"admin_groups_success":overall_result,"nested_admin_group_guids":osx_dscl_list_nested_admin_groups()})
+            requested_admin_group_dicts_list.extend(get_list_of_admin_groups_from_dsconfigad(guid_resolver))
+        # Add missing groups and remove others, unless some requested group
+        # could not be resolved, in which case its GUID may be among the others:
+        if guid_resolver.unresolved_names_list:
+            logging.error('Not removing nested admin groups; could not resolve: %s' % ', '.join(guid_resolver.unresolved_names_list))
+        reconciler.plan(requested_admin_group_dicts_list,not guid_resolver.unresolved_names_list)
+        overall_result = reconciler.apply()
+    nested_admin_group_guids_list = reconciler.verify()
+    logging.info(reconciler.report())
+
+    if guid_cache:
+        logging.info('GUID lookups: %d with dscl, %d with LDAP.  %s' % (guid_resolver.dscl_lookups,guid_resolver.ldap_resolved,guid_cache.report()))
+        guid_cache.save()
+
+    # Assemble and queue Conditions:
+    given_context.write_conditions({"admin_groups_success":overall_result,
+                                    "nested_admin_group_guids":nested_admin_group_guids_list,
+                                    "admin_groups_added_guids":reconciler.applied_guids('add'),
+                                    "admin_groups_removed_guids":reconciler.applied_guids('remove'),
+                                    })
+
+def main():
+    '''Runs this condition stand-alone.'''
+    context = conditions_common.ConditionsContext()
+    run_condition(context)
+    context.flush()
     # Finish:
     sys.exit(0)
 
@@ -17,103 +17,232 @@
 global HW_BUNDLE_MIN_DATE_STR
 HW_BUNDLE_MIN_DATE_STR = "2013-10-23"
 
-import sys, plistlib, xml, subprocess, os, logging
+# Cache of the serial-derived results (they never change for a given Mac).
+# Bump the version when the meaning of the cached values changes.
+global HW_BUNDLE_CACHE_PATH, HW_BUNDLE_CACHE_VERSION
+HW_BUNDLE_CACHE_PATH = "/Library/Managed Installs/HardwareBundleCache.plist"
+HW_BUNDLE_CACHE_VERSION = int(1)
+
+import sys, plistlib, xml, subprocess, os, logging, csv
 from datetime import datetime
+
+# Serial decoding tables (12-digit serials, 2010 and later).
+# The fourth character encodes the year and half-year; the fifth the week within that half.
+global SERIAL_YEAR_CODES, SERIAL_WEEK_CODES, SERIAL_WEEK_START_DATES
+SERIAL_YEAR_CODES = dict((year_letter, (2010 + year_index, 0)) for year_index, year_letter in enumerate("CFHKMPRTWY"))
+SERIAL_YEAR_CODES.update((year_letter, (2010 + year_index, 27)) for year_index, year_letter in enumerate("DGJLNQSVXZ"))
+SERIAL_WEEK_CODES = dict((week_code, week_index) for week_index, week_code in enumerate("123456789CDFGHJKLMNPQRTVWXY"))
+SERIAL_WEEK_START_DATES = {}
+
 this_dir = os.path.dirname(os.path.realpath(__file__))
 shared_support_dir = os.path.join(this_dir,'shared-support')
 sys.path.append(shared_support_dir)
 import conditions_common
 
-def system_profiler_fetch_serial():
-    '''Calls System Profiler to get the computer's hardware serial number.
-        Returns None if something bad happened.'''
+def system_profiler_fetch_serial(given_host_facts):
+    '''Gets the computer's hardware serial number from the given
+        conditions_common.HostFacts (backed by System Profiler).
+        Returns a blank string if something bad happened.'''
+    return given_host_facts.serial_number
+
+def serial_week_start_date(given_year,given_week):
+    '''Returns the Sunday that starts the given week of the given year
+        (strptime %W week numbering).  Results are cached.'''
+    try:
+        return SERIAL_WEEK_START_DATES[(given_year,given_week)]
+    except KeyError:
+        pass
+    birthday_str = "%(y)s-W%(w)s-0" % {"y":given_year,"w":given_week}
+    birthday = datetime.strptime(birthday_str,"%Y-W%W-%w")
+    SERIAL_WEEK_START_DATES[(given_year,given_week)] = birthday
+    return birthday
+
+def decode_serial(given_serial):
+    '''Given a serial, determine the date of production for this Mac.
+        Only works for the 12-digit serial format.
+        Returns a dict with serial, manufacture_date (a date or None) and
+        error (None, or a string saying why the serial could not be decoded).'''
+    result_dict = {'serial':given_serial,'manufacture_date':None,'error':None}
+    # Catch old Apple serials:
+    if len(given_serial) != 12:
+        result_dict['error'] = 'unsupported-serial-length'
+        return result_dict
+    # 2010 and later format:
+    try:
+        year, week_base = SERIAL_YEAR_CODES[given_serial[3]]
+    except KeyError:
+        result_dict['error'] = 'unknown-year-code'
+        return result_dict
+    try:
+        week = SERIAL_WEEK_CODES[given_serial[4]] + week_base
+    except KeyError:
+        result_dict['error'] = 'unknown-week-code'
+        return result_dict
+    # Make approximate manufacture date:
+    try:
+        result_dict['manufacture_date'] = serial_week_start_date(year,week)
+    except ValueError:
+        result_dict['error'] = 'invalid-week'
+    return result_dict
+
+def manufacture_date_from_serial(given_serial):
+    '''Given a serial, return the date of production for this Mac.
+        Only works for the 12-digit serial format.
+        Returns a date or None.'''
+    return decode_serial(given_serial)['manufacture_date']
+
+def hw_bundle_min_date():
+    '''Returns HW_BUNDLE_MIN_DATE_STR as a date.'''
+    return datetime.strptime(HW_BUNDLE_MIN_DATE_STR,"%Y-%m-%d")
+
+def decode_serials(given_serials_iterable):
+    '''Decodes serials in bulk, for example from a fleet inventory.
+        Yields one dict per serial (see decode_serial) with an added
+        hw_bundle_eligible key.  Blank entries are skipped; whitespace and
+        case are normalized.'''
+    bundle_eligible_date = hw_bundle_min_date()
+    for serial in given_serials_iterable:
+        serial = serial.strip().upper()
+        if not serial:
+            continue
+        result_dict = decode_serial(serial)
+        result_dict['hw_bundle_eligible'] = bool(result_dict['manufacture_date'] and result_dict['manufacture_date'] >= bundle_eligible_date)
+        yield result_dict
+
+def decode_serials_from_csv(given_csv_file,given_serial_column='serial'):
+    '''Streams serials from the named column of a CSV file (with a header
+        row) through decode_serials().'''
+    return decode_serials(row.get(given_serial_column) or '' for row in csv.DictReader(given_csv_file))
+
+def write_decoded_serials_csv(given_results_iterable,given_csv_file):
+    '''Writes decode_serials() results as CSV rows.'''
+    csv_writer = csv.writer(given_csv_file)
+    csv_writer.writerow(['serial','manufacture_date','hw_bundle_eligible','error'])
+    for result_dict in given_results_iterable:
+        manufacture_date_str = ''
+        if result_dict['manufacture_date']:
+            manufacture_date_str = result_dict['manufacture_date'].strftime("%Y-%m-%d")
+        csv_writer.writerow([result_dict['serial'],manufacture_date_str,result_dict['hw_bundle_eligible'],result_dict['error'] or ''])
+
+def ioreg_platform_uuid():
+    '''Calls ioreg to get the hardware UUID of this Mac (IOPlatformUUID).
+        Much cheaper than System Profiler; used to validate the cache.
+        Returns a blank string if something bad happened.'''
     # Defaults:
-    output = None
-    output_dict = {}
-    serial_number= ''
+    output = ''
+    output_array = []
+    platform_uuid = ''
     # Run command:
     try:
-        output = subprocess.check_output(['/usr/sbin/system_profiler',
-                                          'SPHardwareDataType',
-                                          '-xml'])
+        output = conditions_common.shared_command_runner().check_output(['/usr/sbin/ioreg',
+                                                                         '-a',
+                                                                         '-r',
+                                                                         '-d',
+                                                                         '1',
+                                                                         '-c',
+                                                                         'IOPlatformExpertDevice'],
+                                                                        given_memoize=True)
     except subprocess.CalledProcessError:
         pass
-    # Try to get serial_number key:
+    except OSError:
+        pass
+    # Try to get IOPlatformUUID key:
     if output:
         try:
-            output_dict = plistlib.readPlistFromString(output)
+            output_array = plistlib.readPlistFromString(output)
         except xml.parsers.expat.ExpatError:
             pass
-    if output_dict:
+    if output_array:
         try:
-            serial_number = output_dict[0]['_items'][0]['serial_number']
-        except KeyError:
-            pass
-        except IndexError:
+            platform_uuid = output_array[0]['IOPlatformUUID']
+        except (IndexError,KeyError,TypeError):
             pass
     # Return:
-    return serial_number
+    return platform_uuid
 
-def manufacture_date_from_serial(given_serial):
-    '''Given a serial, return the date of production for this Mac.
-        Only works for the 12-digit serial format.
-        Returns a date or None.'''
-    # Constants:
-    year_letters_array_1 = ["C","F","H","K","M","P","R","T","W","Y"]
-    year_letters_array_2 = ["D","G","J","L","N","Q","S","V","X","Z"]
-    week_codes_array = ["1","2","3","4","5","6","7","8","9","C",
-                        "D","F","G","H","J","K","L","M","N","P",
-                        "Q","R","T","V","W","X","Y"]
+def read_hw_bundle_cache(given_platform_uuid):
+    '''Reads the hardware bundle cache.  Returns its dict if it was written
+        by this cache version, with this HW_BUNDLE_MIN_DATE_STR, on this Mac.
+        Otherwise returns an empty dict.'''
     # Defaults:
-    year_base = 2010
-    week_base = 0
-    year_index = -1
-    week_index = -1
-    # Catch old Apple serials:
-    if len(given_serial) != 12:
-        return None
-    else: # 2010 and later format:
-        year_letter = given_serial[3]
-        week_code = given_serial[4]
-        # Get year index and adjust week base if required:
-        try:
-            year_index = year_letters_array_1.index(year_letter)
-        except ValueError:
-            pass
+    cache_dict = {}
+    if not given_platform_uuid:
+        return {}
+    # Try reading the cache:
+    if os.path.exists(HW_BUNDLE_CACHE_PATH):
         try:
-            year_index = year_letters_array_2.index(year_letter)
-            week_base = 27
-        except ValueError:
+            cache_dict = plistlib.readPlist(HW_BUNDLE_CACHE_PATH)
+        except xml.parsers.expat.ExpatError:
             pass
-        # Get week index:
-        try:
-            week_index = week_codes_array.index(week_code)
-        except ValueError:
+        except IOError:
             pass
-        # Year:
-        year = year_index + year_base
-        # Week:
-        week = week_index + week_base
-        # Catch indices that could not be determined:
-        if (year < year_base) or (week < week_base):
-            return None
-        # Make approximate manufacture date:
-        birthday_str = "%(y)s-W%(w)s-0" % {"y":year,"w":week}
-        birthday = datetime.strptime(birthday_str,"%Y-W%W-%w")
-        return birthday
+    # Validate:
+    try:
+        if cache_dict['cache_version'] == HW_BUNDLE_CACHE_VERSION \
+            and cache_dict['hw_bundle_min_date_str'] == HW_BUNDLE_MIN_DATE_STR \
+            and cache_dict['platform_uuid'] == given_platform_uuid \
+            and 'system_hw_bundle_oct_2013' in cache_dict:
+            return cache_dict
+    except (KeyError,TypeError):
+        pass
+    return {}
+
+def write_hw_bundle_cache(given_platform_uuid,given_serial,given_manufacture_date,given_hw_bundle_eligible):
+    '''Writes the hardware bundle cache for this Mac.'''
+    if not given_platform_uuid:
+        return
+    cache_dict = {'cache_version':HW_BUNDLE_CACHE_VERSION,
+                  'hw_bundle_min_date_str':HW_BUNDLE_MIN_DATE_STR,
+                  'platform_uuid':given_platform_uuid,
+                  'serial_number':given_serial,
+                  'system_hw_bundle_oct_2013':given_hw_bundle_eligible}
+    if given_manufacture_date:
+        cache_dict['system_manufacture_date'] = given_manufacture_date
+    try:
+        conditions_common.write_plist_atomically(cache_dict,HW_BUNDLE_CACHE_PATH)
+    except (TypeError,IOError,OSError):
+        logging.error("Failed to write hardware bundle cache: %s" % HW_BUNDLE_CACHE_PATH)
+
+def run_condition(given_context):
+    '''Main logic for this script.  Queues conditions on the given
+        conditions_common.ConditionsContext.'''
+    # Use cached results if they are for this Mac:
+    platform_uuid = ioreg_platform_uuid()
+    cache_dict = read_hw_bundle_cache(platform_uuid)
+    if cache_dict:
+        system_manufacture_date = cache_dict.get('system_manufacture_date')
+        system_hw_bundle_oct_2013 = cache_dict['system_hw_bundle_oct_2013']
+    else:
+        # Get hardware serial and manufacture date:
+        system_serial = system_profiler_fetch_serial(given_context.host_facts)
+        system_manufacture_date = manufacture_date_from_serial(system_serial)
+        # Get HW Bundle eligibility (not for a serial that cannot be decoded):
+        bundle_eligible_date = hw_bundle_min_date()
+        system_hw_bundle_oct_2013 = bool(system_manufacture_date and system_manufacture_date >= bundle_eligible_date)
+        # Cache only results from a serial we could read:
+        if system_serial:
+            write_hw_bundle_cache(platform_uuid,system_serial,system_manufacture_date,system_hw_bundle_oct_2013)
+    # Queue Conditions:
+    conditions_dict = {"system_hw_bundle_oct_2013":system_hw_bundle_oct_2013}
+    if system_manufacture_date: # plists cannot hold None
+        conditions_dict["system_manufacture_date"] = system_manufacture_date
+    given_context.write_conditions(conditions_dict)
 
 def main():
-    '''Main logic for this script'''
-    # Get hardware serial and manufacture date:
-    system_serial = system_profiler_fetch_serial()
-    system_manufacture_date = manufacture_date_from_serial(system_serial)
-    # Get HW Bundle eligibility:
-    system_hw_bundle_oct_2013 = False
-    bundle_eligible_date = datetime.strptime(HW_BUNDLE_MIN_DATE_STR,"%Y-%m-%d")
-    if system_manufacture_date >= bundle_eligible_date:
-        system_hw_bundle_oct_2013 = True
-    # Write Conditions:
-    conditions_common.write_conditions({"system_manufacture_date":system_manufacture_date,"system_hw_bundle_oct_2013":system_hw_bundle_oct_2013})
+    '''Runs this condition stand-alone.  Offline use for inventories:
+        hw-bundle.py --decode-csv <file.csv> [serial column name]
+        writes decoded serials as CSV to stdout.'''
+    if len(sys.argv) > 2 and sys.argv[1] == '--decode-csv':
+        serial_column = 'serial'
+        if len(sys.argv) > 3:
+            serial_column = sys.argv[3]
+        with open(sys.argv[2],'rb') as csv_file:
+            write_decoded_serials_csv(decode_serials_from_csv(csv_file,serial_column),sys.stdout)
+        sys.exit(0)
+    # On its own, fetch only the system_profiler data this condition reads:
+    context = conditions_common.ConditionsContext([])
+    run_condition(context)
+    context.flush()
     # Finish:
     sys.exit(0)
 
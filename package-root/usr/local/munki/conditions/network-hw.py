@@ -13,7 +13,7 @@
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 
-import sys, plistlib, xml, subprocess, os, logging, time
+import sys, os, logging, time
 this_dir = os.path.dirname(os.path.realpath(__file__))
 shared_support_dir = os.path.join(this_dir,'shared-support')
 sys.path.append(shared_support_dir)
@@ -26,34 +26,14 @@ NETWORK_INTERFACES_TYPES_LIST.append('ethernet')
 NETWORK_INTERFACES_TYPES_LIST.append('airport')
 NETWORK_INTERFACES_TYPES_LIST.append('wi-fi')
 
-def system_profiler_get_ethernet_and_wifi_info():
-    '''Runs system_profiler SPNetworkDataType and parses output.
-        Returns an array of dictionaries containing attributes
-        for the network interface types on which we should report.'''
+def system_profiler_get_ethernet_and_wifi_info(given_host_facts):
+    '''Reads the SPNetworkDataType items from the given conditions_common.HostFacts
+        (backed by System Profiler).  Returns an array of dictionaries containing
+        attributes for the network interface types on which we should report.'''
     # Defaults:
-    output_dict = {}
-    net_items_array = []
     filtered_net_items_array = []
-    # Run system_profiler:
-    try:
-        output = subprocess.check_output(['/usr/sbin/system_profiler',
-                                          'SPNetworkDataType',
-                                          '-xml'])
-    except subprocess.CalledProcessError:
-        output = ''
-    # Parse output:
-    if output:
-        try:
-            output_dict = plistlib.readPlistFromString(output)
-        except xml.parsers.expat.ExpatError:
-            pass
-    if output_dict:
-        try:
-            net_items_array = output_dict[0]['_items']
-        except IndexError:
-            pass
-        except KeyError:
-            pass
+    # Network items from system_profiler:
+    net_items_array = given_host_facts.network_interfaces
     for net_item in net_items_array:
         should_include_item = False
         try:
@@ -103,13 +83,21 @@ def system_has_wifi(given_interface_array):
             break
     return wifi_present
 
-def main():
-    '''Main logic for this script'''
-    ethernet_and_wifi_interfaces = system_profiler_get_ethernet_and_wifi_info()
+def run_condition(given_context):
+    '''Main logic for this script.  Queues conditions on the given
+        conditions_common.ConditionsContext.'''
+    ethernet_and_wifi_interfaces = system_profiler_get_ethernet_and_wifi_info(given_context.host_facts)
     has_wi_fi = system_has_wifi(ethernet_and_wifi_interfaces)
-    # Write Conditions:
-    conditions_common.write_conditions({"ethernet_and_wifi_interfaces":ethernet_and_wifi_interfaces,
+    # Queue Conditions:
+    given_context.write_conditions({"ethernet_and_wifi_interfaces":ethernet_and_wifi_interfaces,
                                        "has_wi_fi":has_wi_fi})
+
+def main():
+    '''Runs this condition stand-alone.'''
+    # On its own, fetch only the system_profiler data this condition reads:
+    context = conditions_common.ConditionsContext([])
+    run_condition(context)
+    context.flush()
     # Finish:
     sys.exit(0)
 
@@ -14,51 +14,46 @@
 # Copyright Georgia State University.
 # This script uses publicly-documented methods known to those skilled in the art.
 
-# Location of munki manifests on the client:
-global MUNKI_MANIFESTS_PATH
-MUNKI_MANIFESTS_PATH = "/Library/Managed Installs/manifests"
+# Talk IPP to the local CUPS scheduler: read all queues with one
+# CUPS-Get-Printers request, and add or modify queues with
+# CUPS-Add-Modify-Printer.  lpadmin is used instead for queues with
+# additional_cups_opts, or if IPP fails.  CUPS is reached through its domain
+# socket if present, else on CUPS_HOST:CUPS_PORT.
+global PRINT_QUEUES_USE_IPP, CUPS_DOMAIN_SOCKET_PATH, CUPS_HOST, CUPS_PORT, CUPS_LOCAL_CERT_PATH, IPP_TIMEOUT_SECONDS
+PRINT_QUEUES_USE_IPP = True
+CUPS_DOMAIN_SOCKET_PATH = "/private/var/run/cupsd"
+CUPS_HOST = "localhost"
+CUPS_PORT = int(631)
+CUPS_LOCAL_CERT_PATH = "/private/var/run/cups/certs/0"
+IPP_TIMEOUT_SECONDS = int(30)
 
-import sys, plistlib, xml, subprocess, os, logging
-from datetime import datetime
+# Fingerprints of the settings last applied to each queue.  Existing queues
+# whose settings (and PPD) have not changed are left alone, except that all
+# are re-applied after PRINT_QUEUES_FORCE_REFRESH_SECONDS (0: never).
+global PRINT_QUEUES_STATE_PATH, PRINT_QUEUES_STATE_VERSION, PRINT_QUEUES_FORCE_REFRESH_SECONDS
+PRINT_QUEUES_STATE_PATH = "/Library/Managed Installs/PrintQueuesState.plist"
+PRINT_QUEUES_STATE_VERSION = int(1)
+PRINT_QUEUES_FORCE_REFRESH_SECONDS = int(604800)
+
+# Queues to add or update at once (each is an IPP request or lpadmin run
+# handled by cupsd):
+global PRINT_QUEUES_MAX_WORKERS
+PRINT_QUEUES_MAX_WORKERS = int(4)
+
+import sys, plistlib, xml, subprocess, os, logging, struct, socket, httplib, random, hashlib
+from datetime import datetime, timedelta
 this_dir = os.path.dirname(os.path.realpath(__file__))
 shared_support_dir = os.path.join(this_dir,'shared-support')
 sys.path.append(shared_support_dir)
 import conditions_common
 
-def make_list_of_print_queues(given_manifest_names_list):
-    '''Given a list of manifest names, examine their metadata, looking for print_queues keys.
+def make_list_of_print_queues(given_effective_metadata_dict):
+    '''Given the effective (merged) manifest metadata, look up the print_queues.
         Build a list of print queue dictionaries from that information.'''
     # Defaults:
-    print_queue_dicts_list = []
     filtered_print_queue_dicts_list = []
-    # Read each manifest's _metadata:print_queues key, adding print queue
-    # dicts to the overall print queue array of dicts if not there already.
-    for manifest_name in given_manifest_names_list:
-        # Determine the manifest path:
-        manifest_path = os.path.join(MUNKI_MANIFESTS_PATH,manifest_name)
-        # Defaults:
-        manifest_dict = {}
-        manifest_metadata_dict = {}
-        manifest_print_queue_dicts_list = []
-        if os.path.exists(manifest_path):
-            try:
-                manifest_dict = plistlib.readPlist(manifest_path)
-            except xml.parsers.expat.ExpatError:
-                pass
-            if manifest_dict:
-                try:
-                    manifest_metadata_dict = manifest_dict['_metadata']
-                except KeyError:
-                    pass
-            if manifest_metadata_dict:
-                try:
-                    manifest_print_queue_dicts_list = manifest_metadata_dict['print_queues']
-                except KeyError:
-                    pass
-        # Build up the list of print queues:
-        for print_queue_dict in manifest_print_queue_dicts_list:
-            if print_queue_dict not in print_queue_dicts_list:
-                print_queue_dicts_list.append(print_queue_dict)
+    # Print queue dicts merged across all applicable manifests (unique by name):
+    print_queue_dicts_list = given_effective_metadata_dict['print_queues']
     # Filter print queue list:
     for print_queue_dict in print_queue_dicts_list:
         # Defaults: assume false.
@@ -77,10 +72,206 @@ def make_list_of_print_queues(given_manifest_names_list):
             queue_ppd_installed = os.path.exists(print_queue_dict['ppd_path'])
         # Filter:
         if queue_has_required_attributes and queue_ppd_installed:
-            filtered_print_queue_dicts_list.append(print_queue_dict)
+            filtered_print_queue_dicts_list.append(dict(print_queue_dict)) # copy; results are added to it later
     # Return the filtered list:
     return filtered_print_queue_dicts_list
 
+class IPPError(Exception):
+    '''An IPP request to CUPS failed.'''
+    pass
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    '''HTTP over a Unix domain socket (e.g. the cupsd socket).'''
+    def __init__(self,given_socket_path,given_timeout):
+        httplib.HTTPConnection.__init__(self,'localhost',timeout=given_timeout)
+        self.socket_path = given_socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def ipp_encode_attribute(given_value_tag,given_name,given_values_list):
+    '''Encodes an IPP attribute with one or more values.  Integers and enums
+        (tags 0x21, 0x23) are packed; booleans (0x22) are one byte; other
+        values are strings.'''
+    encoded = ''
+    name = given_name
+    for value in given_values_list:
+        if given_value_tag in [0x21,0x23]:
+            value = struct.pack('!i',value)
+        elif given_value_tag == 0x22:
+            value = chr(1 if value else 0)
+        elif isinstance(value,unicode):
+            value = value.encode('utf-8')
+        encoded += struct.pack('!BH',given_value_tag,len(name)) + name + struct.pack('!H',len(value)) + value
+        name = '' # additional values have no name
+    return encoded
+
+def ipp_build_request(given_operation_id,given_groups_list):
+    '''Builds an IPP/2.0 request.  given_groups_list is a list of tuples:
+        group tag and a list of (value tag, name, values list) tuples.
+        The operation attributes group should come first.'''
+    request = struct.pack('!BBHI',2,0,given_operation_id,random.randint(1,0x7FFFFFFF))
+    for group_tag, attributes_list in given_groups_list:
+        request += chr(group_tag)
+        for value_tag, name, values_list in attributes_list:
+            request += ipp_encode_attribute(value_tag,name,values_list)
+    return request + chr(0x03) # end-of-attributes
+
+def ipp_parse_response(given_response):
+    '''Parses an IPP response.  Returns a tuple: the status code, and a list
+        of (group tag, attributes dict) tuples; each attributes dict maps
+        names to lists of values.  Raises IPPError if malformed.'''
+    try:
+        status_code = struct.unpack('!H',given_response[2:4])[0]
+        groups_list = []
+        attributes_dict = None
+        name = ''
+        offset = 8
+        while True:
+            tag = ord(given_response[offset])
+            offset += 1
+            if tag == 0x03: # end-of-attributes
+                break
+            if tag < 0x10: # a new group
+                attributes_dict = {}
+                groups_list.append((tag,attributes_dict))
+                continue
+            name_length = struct.unpack('!H',given_response[offset:offset+2])[0]
+            offset += 2
+            if name_length:
+                name = given_response[offset:offset+name_length]
+                offset += name_length
+            value_length = struct.unpack('!H',given_response[offset:offset+2])[0]
+            offset += 2
+            value = given_response[offset:offset+value_length]
+            offset += value_length
+            if len(value) != value_length:
+                raise IPPError('Truncated IPP response')
+            if tag in [0x21,0x23] and value_length == 4:
+                value = struct.unpack('!i',value)[0]
+            elif tag == 0x22 and value_length == 1:
+                value = value != chr(0)
+            if attributes_dict is None:
+                raise IPPError('IPP attribute outside a group')
+            if name_length:
+                attributes_dict[name] = [value]
+            else:
+                attributes_dict.setdefault(name,[]).append(value)
+    except (struct.error,IndexError):
+        raise IPPError('Malformed IPP response')
+    return status_code, groups_list
+
+def cups_local_authorization():
+    '''Returns the CUPS "Local" authorization header value (root's
+        certificate), or None if it cannot be read.'''
+    try:
+        cert_file = open(CUPS_LOCAL_CERT_PATH)
+        try:
+            return 'Local %s' % cert_file.read().strip()
+        finally:
+            cert_file.close()
+    except IOError:
+        return None
+
+def cups_ipp_request(given_path,given_request,given_document=''):
+    '''POSTs an IPP request (and optional document data) to the local CUPS
+        scheduler.  Returns the parsed response, as from ipp_parse_response().
+        Raises IPPError if CUPS cannot be reached or reports an error.'''
+    if os.path.exists(CUPS_DOMAIN_SOCKET_PATH):
+        connection = UnixHTTPConnection(CUPS_DOMAIN_SOCKET_PATH,IPP_TIMEOUT_SECONDS)
+    else:
+        connection = httplib.HTTPConnection(CUPS_HOST,CUPS_PORT,timeout=IPP_TIMEOUT_SECONDS)
+    headers_dict = {'Content-Type':'application/ipp'}
+    authorization = cups_local_authorization()
+    if authorization:
+        headers_dict['Authorization'] = authorization
+    try:
+        connection.request('POST',given_path,given_request + given_document,headers_dict)
+        response = connection.getresponse()
+        response_body = response.read()
+    except (socket.error,httplib.HTTPException), error:
+        raise IPPError('Cannot reach CUPS: %s' % error)
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise IPPError('CUPS returned HTTP %d' % response.status)
+    status_code, groups_list = ipp_parse_response(response_body)
+    # client-error-not-found just means no printers; other >= 0x0400 are errors:
+    if status_code >= 0x0400 and status_code != 0x0406:
+        raise IPPError('CUPS returned IPP status 0x%04x' % status_code)
+    return status_code, groups_list
+
+def ipp_operation_attributes(given_printer_uri=None):
+    attributes_list = [(0x47,'attributes-charset',['utf-8']),
+                       (0x48,'attributes-natural-language',['en'])]
+    if given_printer_uri:
+        attributes_list.append((0x45,'printer-uri',[given_printer_uri]))
+    attributes_list.append((0x42,'requesting-user-name',['root']))
+    return attributes_list
+
+def cups_get_printers():
+    '''Gets every local queue with one CUPS-Get-Printers request.  Returns a
+        dict mapping queue names to their attributes dicts.'''
+    operation_attributes_list = ipp_operation_attributes()
+    operation_attributes_list.append((0x44,'requested-attributes',['printer-name','device-uri','printer-info',
+                                                                    'printer-is-shared','auth-info-required']))
+    status_code, groups_list = cups_ipp_request('/',ipp_build_request(0x4002,[(0x01,operation_attributes_list)]))
+    printers_dict = {}
+    for group_tag, attributes_dict in groups_list:
+        if group_tag == 0x04 and 'printer-name' in attributes_dict:
+            printers_dict[attributes_dict['printer-name'][0]] = attributes_dict
+    return printers_dict
+
+def ipp_print_queue_present(given_print_queue_dict,given_printers_dict):
+    '''Returns true if the given queue is among the queues from
+        cups_get_printers() with the correct device URI, false otherwise.'''
+    try:
+        measured_device_uri = given_printers_dict[given_print_queue_dict['name']]['device-uri'][0]
+    except (KeyError,IndexError):
+        return False
+    return measured_device_uri.lower() == given_print_queue_dict['device_uri'].lower()
+
+def cups_add_modify_printer(given_print_queue_dict,set_attrs_only):
+    '''Adds the given print queue, or just sets its attributes, with a
+        CUPS-Add-Modify-Printer request carrying the PPD; the equivalent of
+        osx_lpadmin_add_printer() for queues without additional_cups_opts.
+        The queue is enabled, accepting jobs, and not shared.
+        Returns true, or raises IPPError.'''
+    printer_attributes_list = [(0x41,'printer-info',[given_print_queue_dict.get('display_name',given_print_queue_dict['name'])]),
+                               (0x22,'printer-is-shared',[False]),
+                               (0x22,'printer-is-accepting-jobs',[True]),
+                               (0x23,'printer-state',[3])] # idle, i.e. enabled
+    if not set_attrs_only:
+        printer_attributes_list.append((0x45,'device-uri',[given_print_queue_dict['device_uri']]))
+    if given_print_queue_dict.get('kerberos_auth_required'):
+        printer_attributes_list.append((0x44,'auth-info-required',['negotiate']))
+    try:
+        ppd_file = open(given_print_queue_dict['ppd_path'],'rb')
+        try:
+            ppd_data = ppd_file.read()
+        finally:
+            ppd_file.close()
+    except IOError, error:
+        raise IPPError('Cannot read PPD: %s' % error)
+    printer_uri = 'ipp://localhost/printers/%s' % given_print_queue_dict['name']
+    request = ipp_build_request(0x4003,[(0x01,ipp_operation_attributes(printer_uri)),
+                                        (0x04,printer_attributes_list)])
+    cups_ipp_request('/admin/',request,ppd_data)
+    return True
+
+def add_or_modify_print_queue(given_print_queue_dict,set_attrs_only,given_use_ipp):
+    '''Adds the given print queue or just sets its attributes, with IPP if
+        given_use_ipp and the queue has no additional_cups_opts, falling
+        back to lpadmin.  Returns true/false.'''
+    if given_use_ipp and not given_print_queue_dict.get('additional_cups_opts'):
+        try:
+            return cups_add_modify_printer(given_print_queue_dict,set_attrs_only)
+        except IPPError, error:
+            logging.error('IPP add/modify of %s failed (%s); using lpadmin.' % (given_print_queue_dict['name'],error))
+    return osx_lpadmin_add_printer(given_print_queue_dict,set_attrs_only)
+
 def osx_lpoptions_print_queue_present(given_print_queue_dict):
     '''Calls lpoptions determine if the given print queue is present
         as determined by the presence of a queue with the correct device URI.
@@ -92,9 +283,10 @@ def osx_lpoptions_print_queue_present(given_print_queue_dict):
     queue_present = False
     # Run lpoptions to attributes:
     try:
-        output = subprocess.check_output(['/usr/bin/lpoptions',
-                                          '-d',
-                                          given_print_queue_dict['name']])
+        output = conditions_common.shared_command_runner().check_output(['/usr/bin/lpoptions',
+                                                                         '-p',
+                                                                         given_print_queue_dict['name']],
+                                                                        given_memoize=True)
     except subprocess.CalledProcessError:
         print "Unable to get attributes for queue %s with lpoptions." % given_print_queue_dict['name']
     output_array = output.split(' ')
@@ -156,32 +348,159 @@ def osx_lpadmin_add_printer(given_print_queue_dict,set_attrs_only):
         lpadmin_cmd.extend(['-v',given_print_queue_dict['device_uri']])
     lpadmin_cmd.extend(lpadmin_cups_options_array)
     try:
-        subprocess.check_call(lpadmin_cmd)
+        conditions_common.shared_command_runner().check_call(lpadmin_cmd,
+                                                             given_invalidates=[['/usr/bin/lpoptions','-p',given_print_queue_dict['name']]])
         lpadmin_success = True
     except subprocess.CalledProcessError:
         pass
     # Return:
     return lpadmin_success
 
-def main():
-    '''Main logic for this script'''
-    # Get names of group manifests to which this computer is a member:
-    group_manifest_names = conditions_common.make_list_of_applicable_manifests()
+def print_queue_fingerprint(given_print_queue_dict):
+    '''Returns a hash of the settings applied to the given queue: name,
+        display name, device URI, PPD path and modification time, Kerberos
+        flag, and additional CUPS options.'''
+    try:
+        ppd_mtime = os.stat(given_print_queue_dict['ppd_path']).st_mtime
+    except OSError:
+        ppd_mtime = 0
+    settings_dict = {'name':given_print_queue_dict['name'],
+                     'display_name':given_print_queue_dict.get('display_name',given_print_queue_dict['name']),
+                     'device_uri':given_print_queue_dict['device_uri'],
+                     'ppd_path':given_print_queue_dict['ppd_path'],
+                     'ppd_mtime':repr(ppd_mtime),
+                     'kerberos_auth_required':bool(given_print_queue_dict.get('kerberos_auth_required')),
+                     'additional_cups_opts':list(given_print_queue_dict.get('additional_cups_opts',[]))}
+    # plistlib writes dict keys sorted, so this is stable:
+    return hashlib.sha1(plistlib.writePlistToString(settings_dict)).hexdigest()
+
+def read_print_queues_state():
+    '''Reads the print queues state file.  Returns its dict of queue
+        states (fingerprint and applied date, by queue name), or an empty
+        dict if missing, unreadable, or written by another version.'''
+    # Defaults:
+    state_dict = {}
+    # Try reading the state file:
+    if os.path.exists(PRINT_QUEUES_STATE_PATH):
+        try:
+            state_dict = plistlib.readPlist(PRINT_QUEUES_STATE_PATH)
+        except xml.parsers.expat.ExpatError:
+            pass
+        except IOError:
+            pass
+    # Validate:
+    try:
+        if state_dict['state_version'] == PRINT_QUEUES_STATE_VERSION:
+            return state_dict['queues']
+    except (KeyError,TypeError):
+        pass
+    return {}
+
+def write_print_queues_state(given_queue_states_dict):
+    '''Writes the print queues state file.'''
+    try:
+        conditions_common.write_plist_atomically({'state_version':PRINT_QUEUES_STATE_VERSION,
+                                                  'queues':given_queue_states_dict},PRINT_QUEUES_STATE_PATH)
+    except (TypeError,IOError,OSError):
+        logging.error("Failed to write print queues state: %s" % PRINT_QUEUES_STATE_PATH)
+
+def print_queue_state_current(given_queue_state_dict,given_fingerprint):
+    '''Returns true if the given recorded queue state has the given
+        fingerprint and is not due for a forced refresh.'''
+    try:
+        if given_queue_state_dict['fingerprint'] != given_fingerprint:
+            return False
+        if PRINT_QUEUES_FORCE_REFRESH_SECONDS:
+            return datetime.utcnow() - given_queue_state_dict['applied'] < timedelta(seconds=PRINT_QUEUES_FORCE_REFRESH_SECONDS)
+        return True
+    except (KeyError,TypeError):
+        return False
+
+def provision_print_queue(given_arguments_tuple):
+    '''Adds the given print queue, updates it, or skips it if present and
+        unchanged (see print_queue_state_current()).  given_arguments_tuple
+        holds the queue dict, the queues from cups_get_printers() (None to
+        use lpoptions and lpadmin), and the queue's recorded state.  Adds
+        queue_action and result and timestamp keys to the queue dict (for a
+        skipped queue, those of an update at the recorded applied date).  Returns a tuple:
+        the queue dict and its new state dict (None if nothing was applied).
+        Errors are logged and reported as a failed add or update.'''
+    print_queue_dict, printers_dict, queue_state_dict = given_arguments_tuple
+    use_ipp = printers_dict is not None
+    try:
+        fingerprint = print_queue_fingerprint(print_queue_dict)
+        if use_ipp:
+            queue_present = ipp_print_queue_present(print_queue_dict,printers_dict)
+        else:
+            queue_present = osx_lpoptions_print_queue_present(print_queue_dict)
+    except Exception, error:
+        logging.error('Unable to check print queue %s: %s' % (print_queue_dict['name'],error))
+        fingerprint = None
+        queue_present = False
+    if queue_present and print_queue_state_current(queue_state_dict,fingerprint):
+        # Present and unchanged since last applied; report the last time
+        # its attributes were set:
+        print_queue_dict['queue_action'] = 'skipped'
+        print_queue_dict['queue_attributes_set'] = True
+        print_queue_dict['queue_attributes_set_timestamp'] = queue_state_dict['applied']
+        return print_queue_dict, queue_state_dict
+    try:
+        queue_applied = add_or_modify_print_queue(print_queue_dict,queue_present,use_ipp)
+    except Exception, error:
+        logging.error('Unable to add or update print queue %s: %s' % (print_queue_dict['name'],error))
+        queue_applied = False
+    if not queue_present:
+        print_queue_dict['queue_action'] = 'added'
+        print_queue_dict['queue_added'] = queue_applied
+        print_queue_dict['queue_added_timestamp'] = datetime.utcnow()
+    else: # just set attributes:
+        print_queue_dict['queue_action'] = 'updated'
+        print_queue_dict['queue_attributes_set'] = queue_applied
+        print_queue_dict['queue_attributes_set_timestamp'] = datetime.utcnow()
+    if queue_applied and fingerprint:
+        return print_queue_dict, {'fingerprint':fingerprint,'applied':datetime.utcnow()}
+    return print_queue_dict, None
+
+def run_condition(given_context):
+    '''Main logic for this script.  Queues conditions on the given
+        conditions_common.ConditionsContext.'''
+    # Merge metadata of the group manifests to which this computer is a member:
+    effective_metadata_dict = given_context.effective_manifest_metadata
     # Construct list of print queues that should be present:
-    print_queues_array = make_list_of_print_queues(group_manifest_names)
-    # Add the print queues if necessary:
-    for print_queue_dict in print_queues_array:
-        if not osx_lpoptions_print_queue_present(print_queue_dict):
-            queue_added = osx_lpadmin_add_printer(print_queue_dict,False)
-            print_queue_dict['queue_added'] = queue_added
-            print_queue_dict['queue_added_timestamp'] = datetime.utcnow()
-        else: # just set attributes:
-            queue_attributes_set = osx_lpadmin_add_printer(print_queue_dict,True)
-            print_queue_dict['queue_attributes_set'] = queue_attributes_set
-            print_queue_dict['queue_attributes_set_timestamp'] = datetime.utcnow()
-
-    # Write Conditions:
-    conditions_common.write_conditions({"managed_print_queues":print_queues_array})
+    print_queues_array = make_list_of_print_queues(effective_metadata_dict)
+    # Get all existing queues at once (or, failing that, ask lpoptions per queue):
+    printers_dict = None
+    if PRINT_QUEUES_USE_IPP and print_queues_array:
+        try:
+            printers_dict = cups_get_printers()
+        except IPPError, error:
+            logging.error('Unable to get print queues with IPP (%s); using lpoptions and lpadmin.' % error)
+    # Settings last applied to each queue:
+    queue_states_dict = read_print_queues_state()
+    # Add the print queues if necessary, several at a time:
+    provision_arguments_list = [(print_queue_dict,printers_dict,queue_states_dict.get(print_queue_dict['name']))
+                                for print_queue_dict in print_queues_array]
+    state_changed = False
+    for print_queue_dict, queue_state_dict in conditions_common.run_in_pool(provision_print_queue,provision_arguments_list,PRINT_QUEUES_MAX_WORKERS):
+        if print_queue_dict['queue_action'] == 'skipped':
+            continue
+        # Record what was applied (or forget it, so it is tried again):
+        if queue_state_dict:
+            queue_states_dict[print_queue_dict['name']] = queue_state_dict
+        else:
+            queue_states_dict.pop(print_queue_dict['name'],None)
+        state_changed = True
+    if state_changed:
+        write_print_queues_state(queue_states_dict)
+
+    # Queue Conditions:
+    given_context.write_conditions({"managed_print_queues":print_queues_array})
+
+def main():
+    '''Runs this condition stand-alone.'''
+    context = conditions_common.ConditionsContext()
+    run_condition(context)
+    context.flush()
     # Finish:
     sys.exit(0)
 
@@ -15,121 +15,1740 @@
 # Location of Munki plists:
 global MUNKI_CONDITIONS_PATH
 MUNKI_CONDITIONS_PATH = "/Library/Managed Installs/ConditionalItems.plist"
+# Flush the conditions file to disk (fsync) when it is written:
+global CONDITIONS_WRITE_FSYNC
+CONDITIONS_WRITE_FSYNC = True
+# system_profiler data types fetched together by HostFacts:
+global HOST_FACTS_DATA_TYPES
+HOST_FACTS_DATA_TYPES = ['SPHardwareDataType','SPNetworkDataType']
+# How often waits on background probes and cancellable commands check in:
+global PROBE_POLL_INTERVAL_SECONDS
+PROBE_POLL_INTERVAL_SECONDS = 0.1
+# Default first and longest waits between attempts of a RetryBudget step:
+global RETRY_INITIAL_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS
+RETRY_INITIAL_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 8.0
+# Longest wait for the results of a worker pool (see run_in_pool):
+global POOL_RESULT_TIMEOUT_SECONDS
+POOL_RESULT_TIMEOUT_SECONDS = int(3600)
+# dscl: keep one interactive dscl running for all reads and changes, instead
+# of starting dscl for each (DSCL_USE_SESSION; off until the interactive
+# protocol has been checked against the dscl of each macOS release in use).
+# A command taking longer than DSCL_COMMAND_TIMEOUT_SECONDS fails.  If the
+# session times out or dies, it is turned off for the rest of the run and
+# the command is run again as a separate dscl.
+global DSCL_PATH, DSCL_USE_SESSION, DSCL_COMMAND_TIMEOUT_SECONDS
+DSCL_PATH = "/usr/bin/dscl"
+DSCL_USE_SESSION = False
+DSCL_COMMAND_TIMEOUT_SECONDS = int(30)
+
+# Commands run with CommandRunner time out after COMMAND_TIMEOUT_SECONDS,
+# or after the time given here for their tool:
+global COMMAND_TIMEOUT_SECONDS, COMMAND_TOOL_TIMEOUTS_SECONDS
+COMMAND_TIMEOUT_SECONDS = int(60)
+COMMAND_TOOL_TIMEOUTS_SECONDS = {}
+COMMAND_TOOL_TIMEOUTS_SECONDS['/usr/bin/defaults'] = int(10)
+COMMAND_TOOL_TIMEOUTS_SECONDS['/usr/sbin/ioreg'] = int(10)
+COMMAND_TOOL_TIMEOUTS_SECONDS['/usr/bin/lpoptions'] = int(10)
+COMMAND_TOOL_TIMEOUTS_SECONDS['/usr/bin/dig'] = int(15)
+COMMAND_TOOL_TIMEOUTS_SECONDS['/usr/sbin/dsconfigad'] = int(30)
+COMMAND_TOOL_TIMEOUTS_SECONDS['/usr/sbin/ntpdate'] = int(30)
+COMMAND_TOOL_TIMEOUTS_SECONDS['/usr/sbin/system_profiler'] = int(180)
+# HistoryStore file format version, and events kept per store (oldest dropped first):
+global HISTORY_STORE_VERSION, HISTORY_STORE_CAPACITY
+HISTORY_STORE_VERSION = int(1)
+HISTORY_STORE_CAPACITY = int(64)
 # Location of munki manifests on the client:
 global MUNKI_MANIFESTS_PATH
 MUNKI_MANIFESTS_PATH = "/Library/Managed Installs/manifests"
+# Deepest level of included_manifests to follow (root manifest is level 0):
+global MANIFEST_INCLUDE_MAX_DEPTH
+MANIFEST_INCLUDE_MAX_DEPTH = int(32)
+# Index of manifest keys used by conditions, rebuilt per manifest when it changes:
+global MANIFEST_METADATA_INDEX_PATH, MANIFEST_METADATA_INDEX_VERSION
+MANIFEST_METADATA_INDEX_PATH = "/Library/Managed Installs/ConditionsManifestIndex.plist"
+MANIFEST_METADATA_INDEX_VERSION = int(1)
+global MANIFEST_INDEXED_KEYS, MANIFEST_METADATA_KEYS
+MANIFEST_INDEXED_KEYS = ['included_manifests','_metadata']
+MANIFEST_METADATA_KEYS = ['nested_admin_groups','exclude_admins_from_dsconfigad','print_queues']
+# Bytes read per step when streaming keys from a manifest:
+global PLIST_STREAM_CHUNK_SIZE
+PLIST_STREAM_CHUNK_SIZE = int(65536)
 # Munki ManagedInstalls.plist search paths:
-global MUNKI_PREFS_PATHS, TEMP_PREF_PATH
-TEMP_PREF_PATH = "/Library/Managed Installs/munki_ManagedInstalls_temp.plist"
+global MUNKI_PREFS_PATHS
 MUNKI_PREFS_PATHS = []
 MUNKI_PREFS_PATHS.append("/Library/Managed Preferences/ManagedInstalls.plist") # MCX or config profile
 MUNKI_PREFS_PATHS.append("/private/var/root/Library/Preferences/ManagedInstalls.plist") # root user domain
 MUNKI_PREFS_PATHS.append("/Library/Preferences/ManagedInstalls.plist") # local system domain
 
-import plistlib, xml, subprocess, os, shutil, logging
+import plistlib, xml, subprocess, os, sys, logging, collections, datetime, base64, tempfile, threading, time, random, socket, ssl, urlparse, Queue, atexit, mmap, struct
+import multiprocessing.pool
+import xml.parsers.expat
+
+class PlistFormatError(ValueError):
+    '''A plist file is malformed.'''
+    pass
+
+class BinaryPlistReader(object):
+    '''Parses a binary (bplist00) property list from a string or mmap.
+        Values map to the types plistlib uses for XML plists (dict, list,
+        unicode/str, int, float, bool, datetime, plistlib.Data).'''
+    EPOCH = datetime.datetime(2001,1,1)
+
+    def __init__(self,given_data):
+        self.data = given_data
+        try:
+            trailer = self.data[-32:]
+            self.offset_size, self.ref_size, object_count, self.top_object, offset_table_offset = struct.unpack('>6xBBQQQ',trailer)
+        except struct.error:
+            raise PlistFormatError('Truncated binary plist')
+        if not self.offset_size or not self.ref_size or self.top_object >= object_count \
+            or offset_table_offset + object_count * self.offset_size > len(self.data) - 32:
+            raise PlistFormatError('Invalid binary plist trailer')
+        self.offsets_list = [self.read_uint(offset_table_offset + i * self.offset_size,self.offset_size) for i in range(object_count)]
+        self.in_progress_set = set()
+
+    def read_uint(self,given_offset,given_size):
+        value = 0
+        for byte in self.data[given_offset:given_offset+given_size]:
+            value = (value << 8) | ord(byte)
+        return value
+
+    def parse(self):
+        return self.read_object(self.top_object)
+
+    def read_length(self,given_offset,given_info):
+        '''Returns the length (from the marker, or the int object after it)
+            and the offset of the contents.'''
+        if given_info != 0x0F:
+            return given_info, given_offset + 1
+        marker = ord(self.data[given_offset+1])
+        if marker & 0xF0 != 0x10:
+            raise PlistFormatError('Invalid length in binary plist')
+        size = 1 << (marker & 0x0F)
+        return self.read_uint(given_offset+2,size), given_offset + 2 + size
 
-def plutil_convert_to_xml(given_path):
-    '''Converts a binary plist to an XML plist
-    suitable for pllistlib to use.'''
-    # Call plutil:
+    def read_refs(self,given_offset,given_count):
+        return [self.read_uint(given_offset + i * self.ref_size,self.ref_size) for i in range(given_count)]
+
+    def read_object(self,given_ref):
+        try:
+            offset = self.offsets_list[given_ref]
+            marker = ord(self.data[offset])
+        except IndexError:
+            raise PlistFormatError('Invalid object reference in binary plist')
+        kind, info = marker >> 4, marker & 0x0F
+        if marker == 0x00:
+            return None
+        if marker in [0x08,0x09]:
+            return marker == 0x09
+        if kind == 0x1: # int
+            size = 1 << info
+            value = self.read_uint(offset+1,size)
+            # 8- and 16-byte ints are signed (16 bytes hold 2**63 to 2**64-1):
+            if size >= 8 and value >= 1 << (8 * size - 1):
+                value -= 1 << (8 * size)
+            return value
+        if kind == 0x2: # real
+            if info == 2:
+                return struct.unpack('>f',self.data[offset+1:offset+5])[0]
+            if info == 3:
+                return struct.unpack('>d',self.data[offset+1:offset+9])[0]
+            raise PlistFormatError('Invalid real in binary plist')
+        if marker == 0x33: # date
+            return self.EPOCH + datetime.timedelta(seconds=struct.unpack('>d',self.data[offset+1:offset+9])[0])
+        if kind in [0x4,0x5,0x6,0xA,0xC,0xD]:
+            length, start = self.read_length(offset,info)
+            if kind == 0x4:
+                return plistlib.Data(self.data[start:start+length])
+            if kind == 0x5:
+                return self.data[start:start+length].decode('ascii')
+            if kind == 0x6:
+                return self.data[start:start+2*length].decode('utf-16-be')
+            # Containers; refuse cycles:
+            if given_ref in self.in_progress_set:
+                raise PlistFormatError('Cycle in binary plist')
+            self.in_progress_set.add(given_ref)
+            try:
+                if kind == 0xD:
+                    keys_list = [self.read_object(r) for r in self.read_refs(start,length)]
+                    values_list = [self.read_object(r) for r in self.read_refs(start + length * self.ref_size,length)]
+                    return dict(zip(keys_list,values_list))
+                return [self.read_object(r) for r in self.read_refs(start,length)]
+            finally:
+                self.in_progress_set.discard(given_ref)
+        if kind == 0x8: # UID (keyed archives)
+            return {'CF$UID':self.read_uint(offset+1,info+1)}
+        raise PlistFormatError('Unknown object type 0x%02x in binary plist' % marker)
+
+def read_plist(given_path):
+    '''Reads a binary or XML property list file.  Binary plists are parsed
+        in-process from an mmap of the file.  Raises PlistFormatError (or
+        xml.parsers.expat.ExpatError for bad XML) if malformed, and IOError
+        if unreadable.'''
+    plist_file = open(given_path,'rb')
     try:
-        subprocess.check_call(['/usr/bin/plutil',
-                               '-convert',
-                               'xml1',
-                               given_path])
-        return True
-    except subprocess.CalledProcessError:
-        return False
+        if plist_file.read(8) != 'bplist00':
+            plist_file.seek(0)
+            return plistlib.readPlist(plist_file)
+        plist_map = mmap.mmap(plist_file.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            return BinaryPlistReader(plist_map).parse()
+        except (IndexError,UnicodeDecodeError,struct.error,OverflowError):
+            raise PlistFormatError('Malformed binary plist: %s' % given_path)
+        finally:
+            plist_map.close()
+    finally:
+        plist_file.close()
 
 def remove_profile(given_profile_identifier):
     '''Removes specified Apple Config Profiles.'''
     # Call profiles:
     try:
-        subprocess.check_call(['/usr/bin/profiles',
-                               '-R',
-                               '-p',
-                               given_profile_identifier])
+        shared_command_runner().check_call(['/usr/bin/profiles',
+                                            '-R',
+                                            '-p',
+                                            given_profile_identifier],
+                                           given_invalidates=[['/usr/bin/profiles']])
         return True
     except subprocess.CalledProcessError:
         return False
 
+class ProbeCancelledError(subprocess.CalledProcessError):
+    '''Raised by check_output_cancellable() when its command was cancelled.
+        A CalledProcessError, so callers treat it like a failed command.'''
+    pass
+
+class CommandTimeoutError(subprocess.CalledProcessError):
+    '''Raised when a command runs longer than its timeout and is killed.'''
+    pass
+
+def check_output_cancellable(given_command_list,given_cancel_event=None,given_capture_stderr=False,given_timeout_seconds=None,given_capture_output=True):
+    '''Like subprocess.check_output(), but kills the command and raises
+        ProbeCancelledError if given_cancel_event is set while it runs, or
+        CommandTimeoutError if it runs longer than given_timeout_seconds.
+        With given_capture_stderr, the command's standard error is captured
+        and included in the output of a CalledProcessError.  Without
+        given_capture_output, the command's output is not captured but
+        passed through (like subprocess.check_call()), and '' is returned.'''
+    process = subprocess.Popen(given_command_list,stdout=subprocess.PIPE if given_capture_output else None,stderr=subprocess.PIPE if given_capture_stderr else None)
+    output_list = []
+    error_output_list = []
+    def communicate():
+        output, error_output = process.communicate()
+        output_list.append(output or '')
+        error_output_list.append(error_output or '')
+    reader = threading.Thread(target=communicate)
+    reader.daemon = True
+    reader.start()
+    deadline = None
+    if given_timeout_seconds:
+        deadline = time.time() + given_timeout_seconds
+    while reader.is_alive():
+        reader.join(PROBE_POLL_INTERVAL_SECONDS)
+        cancelled = given_cancel_event is not None and given_cancel_event.is_set()
+        timed_out = deadline is not None and time.time() > deadline
+        if (cancelled or timed_out) and reader.is_alive():
+            try:
+                process.kill()
+            except OSError:
+                pass
+            # Children of the command may keep its output open; do not
+            # wait for them.
+            reader.join(PROBE_POLL_INTERVAL_SECONDS)
+            if cancelled:
+                raise ProbeCancelledError(-9,given_command_list)
+            raise CommandTimeoutError(-9,given_command_list,'timed out after %ss' % given_timeout_seconds)
+    output = ''.join(output_list)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode,given_command_list,output + ''.join(error_output_list))
+    return output
+
+class DsclSessionError(Exception):
+    '''The interactive dscl could not be started or kept running.'''
+    pass
+
+class DsclSession(object):
+    '''One interactive dscl (dscl -plist, reading commands from a pipe)
+        used for many commands.  After each command a marker command is
+        sent; dscl's complaint about it delimits the command's output.
+        Commands time out after given_timeout seconds.  If dscl exits or
+        times out, it is started again for the next command.'''
+    def __init__(self,given_dscl_path=None,given_timeout=None):
+        self.dscl_path = given_dscl_path or DSCL_PATH
+        self.timeout = given_timeout or DSCL_COMMAND_TIMEOUT_SECONDS
+        self.process = None
+        self.lines_queue = None
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.starts = 0
+        self.disabled = False
+
+    def start(self):
+        try:
+            self.process = subprocess.Popen([self.dscl_path,'-plist'],stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,stderr=subprocess.STDOUT,bufsize=0)
+        except OSError, error:
+            self.process = None
+            raise DsclSessionError('Cannot start %s: %s' % (self.dscl_path,error))
+        self.starts += 1
+        self.lines_queue = Queue.Queue()
+        reader = threading.Thread(target=self.read_lines,args=(self.process.stdout,self.lines_queue))
+        reader.daemon = True
+        reader.start()
+
+    def read_lines(self,given_stdout,given_lines_queue):
+        for line in iter(given_stdout.readline,''):
+            given_lines_queue.put(line)
+        given_lines_queue.put(None)
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+            self.process.wait()
+            self.process = None
+
+    def close(self):
+        '''Asks dscl to quit.'''
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                try:
+                    self.process.stdin.write('quit\n')
+                    self.process.stdin.close()
+                    self.process.wait()
+                except (IOError,OSError):
+                    pass
+            self.stop()
+
+    def disable(self):
+        '''Stops dscl and turns the session off; dscl_check_output() then
+            runs each command as a separate dscl.'''
+        with self.lock:
+            self.disabled = True
+            self.stop()
+
+    def command_line(self,given_arguments_list):
+        '''Converts one-shot dscl arguments (e.g. -plist /Search read
+            Computers/name) to an interactive command with absolute paths.'''
+        arguments_list = [a for a in given_arguments_list if a != '-plist']
+        words_list = [arguments_list[1]]
+        if len(arguments_list) > 2:
+            words_list.append(arguments_list[0].rstrip('/') + '/' + arguments_list[2])
+        else:
+            words_list.append(arguments_list[0])
+        words_list.extend(arguments_list[3:])
+        return ' '.join([w.replace('\\','\\\\').replace(' ','\\ ') for w in words_list])
+
+    def run(self,given_arguments_list,given_cancel_event=None,given_timeout_seconds=None):
+        '''Runs a command.  Returns a tuple: its plist output (or '') and any
+            other output (e.g. DS Error messages).  Raises DsclSessionError
+            if dscl dies twice, CommandTimeoutError if it takes longer than
+            given_timeout_seconds (default: the session's timeout), and
+            ProbeCancelledError if given_cancel_event is set meanwhile.'''
+        with self.lock:
+            for attempt in range(2):
+                if self.process is None or self.process.poll() is not None:
+                    self.stop()
+                    self.start()
+                try:
+                    return self.run_once(given_arguments_list,given_cancel_event,given_timeout_seconds or self.timeout)
+                except DsclSessionError:
+                    self.stop()
+                    if attempt:
+                        raise
+
+    def run_once(self,given_arguments_list,given_cancel_event,given_timeout_seconds):
+        self.commands += 1
+        marker = 'conditions-end-%d-%d' % (self.commands,random.randint(0,0x7FFFFFFF))
+        try:
+            self.process.stdin.write('%s\n%s\n' % (self.command_line(given_arguments_list),marker))
+        except (IOError,OSError), error:
+            raise DsclSessionError('dscl is not accepting commands: %s' % error)
+        lines_list = []
+        deadline = time.time() + given_timeout_seconds
+        while True:
+            if given_cancel_event is not None and given_cancel_event.is_set():
+                self.stop()
+                raise ProbeCancelledError(-9,[self.dscl_path] + given_arguments_list)
+            if time.time() > deadline:
+                self.stop()
+                raise CommandTimeoutError(-9,[self.dscl_path] + given_arguments_list,'dscl timed out')
+            try:
+                line = self.lines_queue.get(True,PROBE_POLL_INTERVAL_SECONDS)
+            except Queue.Empty:
+                continue
+            if line is None:
+                raise DsclSessionError('dscl exited')
+            if marker in line:
+                break
+            lines_list.append(line)
+        # Strip interactive prompts, then separate the plist from messages:
+        output = ''.join(lines_list)
+        while output.startswith('> '):
+            output = output[2:]
+        output = output.replace('\n> ','\n')
+        plist_start = output.find('<?xml')
+        plist_end = output.find('</plist>')
+        if plist_start >= 0 and plist_end > plist_start:
+            plist_end += len('</plist>')
+            return output[plist_start:plist_end] + '\n', (output[:plist_start] + output[plist_end:]).strip()
+        return '', output.strip()
+
+dscl_session = None
+dscl_session_lock = threading.Lock()
+
+def shared_dscl_session():
+    '''Returns the DsclSession shared by this process, creating it if needed.'''
+    global dscl_session
+    with dscl_session_lock:
+        if dscl_session is None:
+            dscl_session = DsclSession()
+            atexit.register(dscl_session.close)
+        return dscl_session
+
+def dscl_check_output(given_arguments_list,given_cancel_event=None,given_use_session=None,given_timeout_seconds=None):
+    '''Runs dscl with the given (command line) arguments, in the shared
+        DsclSession if given_use_session (default: DSCL_USE_SESSION), or else
+        as a separate process.  Like check_output_cancellable(): returns the
+        output, and raises CalledProcessError (whose output includes dscl's
+        error messages) if dscl reports an error.  Commands time out after
+        given_timeout_seconds (default: DSCL_COMMAND_TIMEOUT_SECONDS).
+        In the session, which has no exit status, any output besides the
+        plist (one-shot dscl prints nothing else on success) is taken as
+        an error.  If the session times out or dies, it is turned off and
+        the command is run again as a separate dscl.'''
+    if given_use_session is None:
+        given_use_session = DSCL_USE_SESSION
+    if not given_timeout_seconds:
+        given_timeout_seconds = DSCL_COMMAND_TIMEOUT_SECONDS
+    if given_use_session and not shared_dscl_session().disabled:
+        session = shared_dscl_session()
+        try:
+            output, messages = session.run(given_arguments_list,given_cancel_event,given_timeout_seconds)
+        except (DsclSessionError,CommandTimeoutError), error:
+            logging.error('dscl session failed (%s); turning it off and running dscl directly.' % error)
+            session.disable()
+        else:
+            if messages:
+                raise subprocess.CalledProcessError(1,[DSCL_PATH] + given_arguments_list,output + messages)
+            return output
+    return check_output_cancellable([DSCL_PATH] + given_arguments_list,given_cancel_event,True,given_timeout_seconds)
+
+class CommandRunner(object):
+    '''Runs the external commands of the conditions in one run.
+        * Every command has a timeout: given_timeout_seconds, or else the
+          one in COMMAND_TOOL_TIMEOUTS_SECONDS for its tool, or else
+          DSCL_COMMAND_TIMEOUT_SECONDS for dscl and COMMAND_TIMEOUT_SECONDS
+          for other tools.  dscl commands go through dscl_check_output()
+          (and so the shared DsclSession, if used).
+        * Read-only commands run with given_memoize are run once; later runs
+          of the same command line (by any condition) get the same output,
+          or the same CalledProcessError.  Timeouts and cancellations are
+          not remembered.
+        * Commands that change state pass given_invalidates: a list of
+          command prefixes (lists) whose remembered output they make stale.
+        * Calls, remembered results used, time and exit statuses are counted
+          per command line; see report().
+        * substitute_tool() replaces a tool with another executable, or with
+          a function that is given the command list and returns its output
+          (raising CalledProcessError on failure), e.g. to try conditions
+          with stand-in tools.'''
+    def __init__(self,given_timeout_seconds=None,given_tools_dict=None):
+        self.timeout_seconds = given_timeout_seconds
+        self.tools_dict = dict(given_tools_dict or {})
+        self.memo_dict = {}
+        self.stats_dict = {}
+        self.invalidated = 0
+        self.lock = threading.Lock()
+        self.command_locks_dict = {}
+
+    def substitute_tool(self,given_tool_path,given_substitute):
+        '''Runs given_substitute (a path or a function) instead of the
+            given tool.  Forgets the tool's remembered output.'''
+        with self.lock:
+            self.tools_dict[given_tool_path] = given_substitute
+        self.invalidate([[given_tool_path]])
+
+    def command_timeout(self,given_command_list):
+        if self.timeout_seconds:
+            return self.timeout_seconds
+        try:
+            return COMMAND_TOOL_TIMEOUTS_SECONDS[given_command_list[0]]
+        except KeyError:
+            pass
+        if given_command_list[0] == DSCL_PATH:
+            return DSCL_COMMAND_TIMEOUT_SECONDS
+        return COMMAND_TIMEOUT_SECONDS
+
+    def execute(self,given_command_list,given_timeout_seconds,given_cancel_event,given_capture_stderr,given_capture_output=True):
+        '''Runs one command, or its substitute.  Returns its output.
+            Without given_capture_output, the output is passed through to
+            this process\'s standard output instead.'''
+        tool_path = given_command_list[0]
+        with self.lock:
+            substitute = self.tools_dict.get(tool_path)
+        if substitute and not callable(substitute):
+            return check_output_cancellable([substitute] + given_command_list[1:],given_cancel_event,given_capture_stderr,given_timeout_seconds,given_capture_output)
+        if not substitute and tool_path != DSCL_PATH:
+            return check_output_cancellable(given_command_list,given_cancel_event,given_capture_stderr,given_timeout_seconds,given_capture_output)
+        # Functions and dscl always return their output; pass it on if asked:
+        try:
+            if substitute:
+                output = substitute(list(given_command_list))
+            else:
+                output = dscl_check_output(given_command_list[1:],given_cancel_event,None,given_timeout_seconds)
+        except subprocess.CalledProcessError, error:
+            if not given_capture_output and error.output:
+                sys.stdout.write(error.output)
+            raise
+        if not given_capture_output and output:
+            sys.stdout.write(output)
+        return output
+
+    def record(self,given_command_list,given_seconds,given_exit_status,given_memoized=False):
+        '''Adds one run (or use of a remembered result) to the accounting.'''
+        with self.lock:
+            stats = self.stats_dict.setdefault(' '.join(given_command_list),{'calls':0,'memoized':0,'seconds':0.0,'exit_statuses':{}})
+            stats['calls'] += 1
+            if given_memoized:
+                stats['memoized'] += 1
+            stats['seconds'] += given_seconds
+            stats['exit_statuses'][given_exit_status] = stats['exit_statuses'].get(given_exit_status,0) + 1
+
+    def run_and_record(self,given_command_list,given_timeout_seconds,given_cancel_event,given_capture_stderr,given_capture_output=True):
+        if not given_timeout_seconds:
+            given_timeout_seconds = self.command_timeout(given_command_list)
+        start_time = time.time()
+        exit_status = 'error'
+        try:
+            output = self.execute(given_command_list,given_timeout_seconds,given_cancel_event,given_capture_stderr,given_capture_output)
+            exit_status = 0
+            return output
+        except ProbeCancelledError:
+            exit_status = 'cancelled'
+            raise
+        except CommandTimeoutError:
+            exit_status = 'timeout'
+            raise
+        except subprocess.CalledProcessError, error:
+            exit_status = error.returncode
+            raise
+        finally:
+            self.record(given_command_list,time.time() - start_time,exit_status)
+
+    def check_output(self,given_command_list,given_timeout_seconds=None,given_cancel_event=None,given_memoize=False,given_invalidates=None,given_capture_stderr=False):
+        '''Like check_output_cancellable(), with a timeout (see the class).
+            Returns the output; raises CalledProcessError or OSError.'''
+        command_list = list(given_command_list)
+        if not given_memoize:
+            try:
+                return self.run_and_record(command_list,given_timeout_seconds,given_cancel_event,given_capture_stderr)
+            finally:
+                if given_invalidates:
+                    self.invalidate(given_invalidates)
+        command_tuple = tuple(command_list)
+        # One lock per command line, so concurrent callers run it once:
+        with self.lock:
+            command_lock = self.command_locks_dict.setdefault(command_tuple,threading.Lock())
+        with command_lock:
+            with self.lock:
+                memo = self.memo_dict.get(command_tuple)
+            if memo is not None:
+                output, error = memo
+                self.record(command_list,0.0,error.returncode if error else 0,True)
+                if error:
+                    raise error
+                return output
+            try:
+                output = self.run_and_record(command_list,given_timeout_seconds,given_cancel_event,given_capture_stderr)
+            except (ProbeCancelledError,CommandTimeoutError):
+                raise
+            except subprocess.CalledProcessError, error:
+                with self.lock:
+                    self.memo_dict[command_tuple] = (None,error)
+                raise
+            with self.lock:
+                self.memo_dict[command_tuple] = (output,None)
+            return output
+
+    def check_call(self,given_command_list,given_timeout_seconds=None,given_cancel_event=None,given_invalidates=None):
+        '''Like subprocess.check_call(): runs a command (never remembered),
+            passing its output through (e.g. to the Munki log), and returns
+            0, or raises CalledProcessError.'''
+        try:
+            self.run_and_record(list(given_command_list),given_timeout_seconds,given_cancel_event,False,False)
+        finally:
+            if given_invalidates:
+                self.invalidate(given_invalidates)
+        return 0
+
+    def invalidate(self,given_prefixes_list=None):
+        '''Forgets remembered output of commands starting with any of the
+            given prefixes (lists), or of all commands.'''
+        with self.lock:
+            for command_tuple in self.memo_dict.keys():
+                if given_prefixes_list is None or [p for p in given_prefixes_list if command_tuple[:len(p)] == tuple(p)]:
+                    del self.memo_dict[command_tuple]
+                    self.invalidated += 1
+
+    def report(self):
+        '''Returns a summary of the commands run, slowest first.'''
+        with self.lock:
+            stats_list = sorted(self.stats_dict.items(),key=lambda item: item[1]['seconds'],reverse=True)
+            lines_list = ['Commands: %d runs, %d remembered results used, %d invalidated.' % (sum([s['calls'] - s['memoized'] for c, s in stats_list]),
+                                                                                              sum([s['memoized'] for c, s in stats_list]),
+                                                                                              self.invalidated)]
+            for command_line, stats in stats_list:
+                statuses = ', '.join(['%s x%d' % (status,count) for status, count in sorted(stats['exit_statuses'].items())])
+                lines_list.append('  %s: %d calls (%d remembered), %.2fs, exit %s' % (command_line,stats['calls'],stats['memoized'],stats['seconds'],statuses))
+        return '\n'.join(lines_list)
+
+command_runner = None
+command_runner_lock = threading.Lock()
+
+def shared_command_runner():
+    '''Returns the CommandRunner shared by the conditions run in this
+        process, creating it if needed.'''
+    global command_runner
+    with command_runner_lock:
+        if command_runner is None:
+            command_runner = CommandRunner()
+        return command_runner
+
+class BackgroundProbe(object):
+    '''Runs given_function(*given_args_tuple) in a daemon thread as soon as
+        it is created, so several probes can be in flight together.  If
+        given_cancellable, the function is also passed
+        given_cancel_event=<threading.Event>, which cancel() sets; the
+        function should stop early when it is set.  result() waits for and
+        returns the function\'s value (given_default if it raised).'''
+    def __init__(self,given_function,given_args_tuple=(),given_cancellable=False,given_default=None):
+        self.function = given_function
+        self.args_tuple = given_args_tuple
+        self.cancellable = given_cancellable
+        self.value = given_default
+        self.cancel_event = threading.Event()
+        self.start_time = time.time()
+        self.seconds = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            if self.cancellable:
+                self.value = self.function(*self.args_tuple,given_cancel_event=self.cancel_event)
+            else:
+                self.value = self.function(*self.args_tuple)
+        except Exception:
+            logging.exception("Probe %s failed." % self.function.__name__)
+        self.seconds = time.time() - self.start_time
+
+    def cancel(self):
+        '''Asks the probe to stop early (cancellable probes only).'''
+        self.cancel_event.set()
+
+    def result(self):
+        '''Waits for the probe to finish; returns its value.'''
+        while self.thread.is_alive():
+            self.thread.join(PROBE_POLL_INTERVAL_SECONDS)
+        return self.value
+
+class RetryBudget(object):
+    '''An overall time budget shared by the retried steps of a condition.
+        run() calls a probe until it returns a true value, waiting between
+        attempts with exponential backoff plus jitter.  Waits never run past
+        the budget and end early if a given cancel event is set.  Time and
+        attempts used by each named step are recorded in steps_dict.
+        Safe to share between threads.'''
+    def __init__(self,given_total_seconds,given_initial_delay=RETRY_INITIAL_DELAY_SECONDS,given_max_delay=RETRY_MAX_DELAY_SECONDS,given_multiplier=2.0,given_jitter=0.25):
+        self.total_seconds = given_total_seconds
+        self.start_time = time.time()
+        self.deadline = self.start_time + given_total_seconds
+        self.initial_delay = given_initial_delay
+        self.max_delay = given_max_delay
+        self.multiplier = given_multiplier
+        self.jitter = given_jitter
+        self.steps_dict = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        '''Returns the seconds left in the budget (never negative).'''
+        return max(0.0,self.deadline - time.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self,given_seconds):
+        '''Returns given_seconds cut to the time left in the budget, for use
+            as the timeout of a command run within it.  Never zero, which
+            would mean no timeout.'''
+        return max(0.001,min(given_seconds,self.remaining()))
+
+    def record(self,given_step_name,given_seconds,given_attempts,given_succeeded):
+        '''Adds usage to the named step.'''
+        with self.lock:
+            step_dict = self.steps_dict.setdefault(given_step_name,{'seconds':0.0,'attempts':0,'succeeded':False})
+            step_dict['seconds'] += given_seconds
+            step_dict['attempts'] += given_attempts
+            step_dict['succeeded'] = step_dict['succeeded'] or given_succeeded
+
+    def run(self,given_step_name,given_probe_function,given_max_attempts=None,given_cancel_event=None):
+        '''Calls given_probe_function() until it returns a true value, the
+            attempts or the budget run out, or the cancel event is set.  No
+            attempt is started once the budget has run out.  Returns the
+            probe\'s last value (None if it was never called).'''
+        if given_cancel_event is None:
+            given_cancel_event = threading.Event()
+        start_time = time.time()
+        delay = self.initial_delay
+        attempts = 0
+        value = None
+        while not given_cancel_event.is_set() and not self.expired():
+            attempts += 1
+            value = given_probe_function()
+            if value:
+                break
+            if given_max_attempts and attempts >= given_max_attempts:
+                break
+            wait_seconds = min(delay * random.uniform(1 - self.jitter,1 + self.jitter),self.max_delay,self.remaining())
+            if wait_seconds <= 0:
+                break
+            given_cancel_event.wait(wait_seconds)
+            delay *= self.multiplier
+        self.record(given_step_name,time.time() - start_time,attempts,bool(value))
+        return value
+
+    def wait(self,given_step_name,given_seconds,given_cancel_event=None):
+        '''Waits the given seconds (e.g. to let a change settle), but never
+            past the budget.'''
+        if given_cancel_event is None:
+            given_cancel_event = threading.Event()
+        start_time = time.time()
+        wait_seconds = min(given_seconds,self.remaining())
+        if wait_seconds > 0:
+            given_cancel_event.wait(wait_seconds)
+        self.record(given_step_name,time.time() - start_time,0,True)
+
+    def report(self):
+        '''Returns a one-line summary of the budget use by step.'''
+        with self.lock:
+            steps_str = ', '.join([ '%s %.2fs/%s tries%s' % (name,step['seconds'],step['attempts'],'' if step['succeeded'] else ' (failed)') for name, step in self.steps_dict.items() ])
+        return 'Used %.2fs of %.2fs budget: %s' % (time.time() - self.start_time,self.total_seconds,steps_str or 'no steps')
+
+def ber_encode(given_tag,given_value):
+    '''Encodes one BER element (tag, definite length, value bytes).'''
+    length = len(given_value)
+    if length < 0x80:
+        length_bytes = chr(length)
+    else:
+        length_bytes = ''
+        while length:
+            length_bytes = chr(length & 0xFF) + length_bytes
+            length >>= 8
+        length_bytes = chr(0x80 | len(length_bytes)) + length_bytes
+    return chr(given_tag) + length_bytes + given_value
+
+def ber_encode_integer(given_integer,given_tag=0x02):
+    '''Encodes a BER INTEGER (or ENUMERATED, with tag 0x0A).'''
+    value = ''
+    while True:
+        value = chr(given_integer & 0xFF) + value
+        given_integer >>= 8
+        if given_integer in [0,-1] and (ord(value[0]) & 0x80) == (0x80 if given_integer == -1 else 0):
+            break
+    return ber_encode(given_tag,value)
+
+def ber_encode_string(given_string,given_tag=0x04):
+    '''Encodes a BER OCTET STRING (UTF-8 for unicode input).'''
+    if isinstance(given_string,unicode):
+        given_string = given_string.encode('utf-8')
+    return ber_encode(given_tag,given_string)
+
+def ber_encode_boolean(given_boolean):
+    return ber_encode(0x01,'\xff' if given_boolean else '\x00')
+
+def ber_encode_sequence(given_elements_list,given_tag=0x30):
+    '''Encodes a constructed element (SEQUENCE by default) from encoded elements.'''
+    return ber_encode(given_tag,''.join(given_elements_list))
+
+def ber_decode(given_data,given_offset=0):
+    '''Decodes the BER element at given_offset.  Returns a tuple: tag,
+        value bytes, and the offset just past the element.  Raises ValueError
+        for truncated or unsupported (indefinite length) data.'''
+    try:
+        tag = ord(given_data[given_offset])
+        length = ord(given_data[given_offset+1])
+        offset = given_offset + 2
+        if length & 0x80:
+            length_size = length & 0x7F
+            if not length_size or length_size > 4:
+                raise ValueError('Unsupported BER length')
+            length = 0
+            for length_byte in given_data[offset:offset+length_size]:
+                length = (length << 8) | ord(length_byte)
+            offset += length_size
+    except IndexError:
+        raise ValueError('Truncated BER element')
+    if offset + length > len(given_data):
+        raise ValueError('Truncated BER element')
+    return tag, given_data[offset:offset+length], offset + length
+
+def ber_decode_all(given_data):
+    '''Decodes consecutive BER elements.  Returns a list of (tag, value bytes) tuples.'''
+    elements_list = []
+    offset = 0
+    while offset < len(given_data):
+        tag, value, offset = ber_decode(given_data,offset)
+        elements_list.append((tag,value))
+    return elements_list
+
+def ber_decode_integer(given_value):
+    '''Decodes the value bytes of a BER INTEGER or ENUMERATED.'''
+    integer = 0
+    for value_byte in given_value:
+        integer = (integer << 8) | ord(value_byte)
+    if given_value and ord(given_value[0]) & 0x80:
+        integer -= 1 << (8 * len(given_value))
+    return integer
+
+def ldap_filter_equal(given_attribute,given_value):
+    '''Returns an encoded LDAP equalityMatch filter (attribute=value).'''
+    return ber_encode_sequence([ber_encode_string(given_attribute),ber_encode_string(given_value)],0xA3)
+
+def ldap_filter_and(given_filters_list):
+    return ber_encode_sequence(given_filters_list,0xA0)
+
+def ldap_filter_or(given_filters_list):
+    return ber_encode_sequence(given_filters_list,0xA1)
+
+class LDAPError(Exception):
+    '''An LDAP operation failed (result_code is 0 for protocol errors).'''
+    def __init__(self,given_message,given_result_code=0):
+        Exception.__init__(self,given_message)
+        self.result_code = given_result_code
+
+class LDAPConnection(object):
+    '''Minimal LDAPv3 client: simple bind and (paged) search over one TCP
+        connection to the server in the given ldap:// or ldaps:// URI.
+        For ldaps://, the server's certificate must be signed by a trusted
+        CA (those in given_ca_path, a PEM file, if given; otherwise the
+        system's) and match the host name.  Socket errors, certificate
+        problems and unexpected replies raise LDAPError.'''
+    PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+
+    def __init__(self,given_uri,given_timeout,given_ca_path=None):
+        uri = urlparse.urlparse(given_uri)
+        port = uri.port or (636 if uri.scheme == 'ldaps' else 389)
+        self.message_id = 0
+        self.buffer = ''
+        self.encrypted = uri.scheme == 'ldaps'
+        try:
+            self.socket = socket.create_connection((uri.hostname,port),given_timeout)
+            self.socket.settimeout(given_timeout)
+            if self.encrypted:
+                ssl_context = ssl.create_default_context(cafile=given_ca_path or None)
+                self.socket = ssl_context.wrap_socket(self.socket,server_hostname=uri.hostname)
+        except (socket.error,ssl.SSLError,ssl.CertificateError,IOError), error:
+            raise LDAPError('Cannot connect to %s: %s' % (given_uri,error))
+
+    def send(self,given_protocol_op,given_controls_list=None):
+        '''Sends an LDAP message; returns its message ID.'''
+        self.message_id += 1
+        elements_list = [ber_encode_integer(self.message_id),given_protocol_op]
+        if given_controls_list:
+            elements_list.append(ber_encode_sequence(given_controls_list,0xA0))
+        try:
+            self.socket.sendall(ber_encode_sequence(elements_list))
+        except (socket.error,ssl.SSLError), error:
+            raise LDAPError('LDAP send failed: %s' % error)
+        return self.message_id
+
+    def receive(self):
+        '''Returns the next LDAP message as a tuple: protocol op tag, its
+            value bytes, and the controls value bytes (or '').'''
+        while True:
+            try:
+                tag, ldap_message, offset = ber_decode(self.buffer)
+                self.buffer = self.buffer[offset:]
+                break
+            except ValueError:
+                pass
+            try:
+                chunk = self.socket.recv(65536)
+            except (socket.error,ssl.SSLError), error:
+                raise LDAPError('LDAP receive failed: %s' % error)
+            if not chunk:
+                raise LDAPError('LDAP server closed the connection')
+            self.buffer += chunk
+        try:
+            elements_list = ber_decode_all(ldap_message)
+            if ber_decode_integer(elements_list[0][1]) != self.message_id:
+                raise LDAPError('LDAP reply does not match the request')
+            controls = ''
+            if len(elements_list) > 2 and elements_list[2][0] == 0xA0:
+                controls = elements_list[2][1]
+            return elements_list[1][0], elements_list[1][1], controls
+        except (ValueError,IndexError):
+            raise LDAPError('Malformed LDAP reply')
+
+    def check_result(self,given_result_value):
+        '''Raises LDAPError unless the given LDAPResult is success.'''
+        try:
+            elements_list = ber_decode_all(given_result_value)
+            result_code = ber_decode_integer(elements_list[0][1])
+            diagnostic_message = elements_list[2][1]
+        except (ValueError,IndexError):
+            raise LDAPError('Malformed LDAP result')
+        if result_code != 0:
+            raise LDAPError('LDAP error %d: %s' % (result_code,diagnostic_message),result_code)
+
+    def simple_bind(self,given_bind_dn,given_password,given_allow_cleartext=False):
+        '''Binds with the given DN and password.  Refuses (LDAPError) to send
+            a password over an unencrypted (ldap://) connection unless
+            given_allow_cleartext.'''
+        if given_password and not self.encrypted and not given_allow_cleartext:
+            raise LDAPError('Refusing to send a password over an unencrypted connection; use ldaps://')
+        self.send(ber_encode_sequence([ber_encode_integer(3),
+                                       ber_encode_string(given_bind_dn),
+                                       ber_encode_string(given_password,0x80)],0x60))
+        tag, value, controls = self.receive()
+        if tag != 0x61:
+            raise LDAPError('Unexpected reply to bind')
+        self.check_result(value)
+
+    def search(self,given_base_dn,given_filter,given_attributes_list,given_page_size=0):
+        '''Searches the subtree under given_base_dn with the given encoded
+            filter, in pages of given_page_size entries (if non-zero) using
+            the paged results control.  Yields a tuple per entry: its DN and
+            a dict of attribute values lists, keyed by lowercase name.'''
+        cookie = ''
+        while True:
+            controls_list = []
+            if given_page_size:
+                controls_list.append(ber_encode_sequence([ber_encode_string(self.PAGED_RESULTS_OID),
+                                                          ber_encode_string(ber_encode_sequence([ber_encode_integer(given_page_size),
+                                                                                                 ber_encode_string(cookie)]))]))
+            self.send(ber_encode_sequence([ber_encode_string(given_base_dn),
+                                           ber_encode_integer(2,0x0A),    # scope: wholeSubtree
+                                           ber_encode_integer(0,0x0A),    # derefAliases: never
+                                           ber_encode_integer(0),         # sizeLimit
+                                           ber_encode_integer(0),         # timeLimit
+                                           ber_encode_boolean(False),     # typesOnly
+                                           given_filter,
+                                           ber_encode_sequence([ber_encode_string(a) for a in given_attributes_list])],0x63),controls_list)
+            while True:
+                tag, value, controls = self.receive()
+                if tag == 0x64: # searchResEntry
+                    try:
+                        elements_list = ber_decode_all(value)
+                        attributes_dict = {}
+                        for attribute_tag, attribute in ber_decode_all(elements_list[1][1]):
+                            attribute_type, attribute_values = [v for t, v in ber_decode_all(attribute)][:2]
+                            attributes_dict[attribute_type.lower()] = [v for t, v in ber_decode_all(attribute_values)]
+                    except (ValueError,IndexError):
+                        raise LDAPError('Malformed LDAP search entry')
+                    yield elements_list[0][1], attributes_dict
+                elif tag == 0x65: # searchResDone
+                    self.check_result(value)
+                    break
+                # (searchResRef and anything else: ignored.)
+            cookie = self.paged_results_cookie(controls)
+            if not cookie:
+                return
+
+    def paged_results_cookie(self,given_controls):
+        '''Returns the cookie from the paged results control in the given
+            controls value, or '' when there are no more pages.'''
+        try:
+            for tag, control in ber_decode_all(given_controls):
+                elements_list = ber_decode_all(control)
+                if elements_list[0][1] == self.PAGED_RESULTS_OID:
+                    return ber_decode_all(ber_decode_all(elements_list[-1][1])[0][1])[1][1]
+        except (ValueError,IndexError):
+            raise LDAPError('Malformed paged results control')
+        return ''
+
+    def close(self):
+        '''Sends an unbind request and closes the connection.'''
+        try:
+            self.send(ber_encode(0x42,''))
+        except LDAPError:
+            pass
+        self.socket.close()
+
+def write_file_atomically(given_data,given_path,given_fsync=False):
+    '''Writes the given data to a temporary file next to given_path, then
+        renames it into place, so readers see either the old or the new file.
+        If given_fsync, the data (and the directory entry) are flushed to disk
+        before returning.  Raises IOError or OSError on failure.'''
+    target_dir = os.path.dirname(given_path) or '.'
+    temp_fd, temp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(given_path),dir=target_dir)
+    try:
+        with os.fdopen(temp_fd,'wb') as temp_file:
+            temp_file.write(given_data)
+            if given_fsync:
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+        os.chmod(temp_path,0644)
+        os.rename(temp_path,given_path)
+    except (IOError,OSError):
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    if given_fsync:
+        dir_fd = os.open(target_dir,os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def write_plist_atomically(given_object,given_path,given_fsync=False):
+    '''Serializes the given object as an XML plist and writes it with
+        write_file_atomically().  Raises TypeError if the object cannot be
+        serialized, IOError or OSError if it cannot be written.'''
+    write_file_atomically(plistlib.writePlistToString(given_object),given_path,given_fsync)
+
+class PlistTTLCache(object):
+    '''Small on-disk cache of plist-serializable values with per-entry
+        expiry.  Entries are keyed by string and may be negative (a cached
+        "not found").  The file is discarded if its version or signature
+        (e.g. a hash of the network configuration) differs from the given
+        ones.  Expired entries are kept for up to given_max_stale_seconds so
+        callers can fall back to them.  Each entry may record the seconds
+        the lookup cost; hits add that to stats_dict['seconds_saved'].
+        Call save() to persist changes.'''
+    def __init__(self,given_path,given_version,given_signature='',given_max_stale_seconds=0):
+        self.path = given_path
+        self.version = given_version
+        self.signature = given_signature
+        self.max_stale_seconds = given_max_stale_seconds
+        self.entries_dict = {}
+        self.stats_dict = {'hits':0,'negative_hits':0,'stale_hits':0,'misses':0,'seconds_saved':0.0,'invalidated':False}
+        self.changed = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        '''Reads the cache file, discarding it if unreadable or from another
+            version or signature.'''
+        cache_dict = {}
+        if os.path.exists(self.path):
+            try:
+                cache_dict = plistlib.readPlist(self.path)
+            except xml.parsers.expat.ExpatError:
+                pass
+            except IOError:
+                pass
+        try:
+            if cache_dict['cache_version'] == self.version and cache_dict['signature'] == self.signature:
+                self.entries_dict = cache_dict['entries']
+            else:
+                self.stats_dict['invalidated'] = True
+                self.changed = True
+        except (KeyError,TypeError):
+            pass
+
+    def get(self,given_key,given_allow_stale=False,given_count=True):
+        '''Returns a copy of the entry for the given key (a dict with value,
+            negative, expires, and stale), or None if there is no unexpired
+            entry.  With given_allow_stale, expired entries are returned too,
+            marked stale.  Lookups count toward stats_dict unless given_count
+            is false.'''
+        with self.lock:
+            entry_dict = self.entries_dict.get(given_key)
+            try:
+                stale = entry_dict['expires'] <= time.time()
+            except (KeyError,TypeError):
+                entry_dict = None
+            if entry_dict is None or (stale and not given_allow_stale):
+                if given_count:
+                    self.stats_dict['misses'] += 1
+                return None
+            entry_dict = dict(entry_dict)
+            entry_dict['stale'] = stale
+            if not given_count:
+                return entry_dict
+            if stale:
+                self.stats_dict['stale_hits'] += 1
+            elif entry_dict.get('negative'):
+                self.stats_dict['negative_hits'] += 1
+            else:
+                self.stats_dict['hits'] += 1
+            if not stale:
+                self.stats_dict['seconds_saved'] += entry_dict.get('cost_seconds',0.0)
+            return entry_dict
+
+    def put(self,given_key,given_value,given_ttl_seconds,given_cost_seconds=0.0,given_negative=False):
+        '''Stores the given value for given_ttl_seconds.'''
+        entry_dict = {'expires':time.time() + given_ttl_seconds,
+                      'negative':given_negative,
+                      'cost_seconds':float(given_cost_seconds)}
+        if given_value is not None:
+            entry_dict['value'] = given_value
+        with self.lock:
+            self.entries_dict[given_key] = entry_dict
+            self.changed = True
+
+    def put_negative(self,given_key,given_ttl_seconds,given_cost_seconds=0.0,given_value=None):
+        '''Stores a negative ("not found") entry for given_ttl_seconds.'''
+        self.put(given_key,given_value,given_ttl_seconds,given_cost_seconds,True)
+
+    def invalidate(self,given_key=None):
+        '''Removes the entry for the given key, or all entries.'''
+        with self.lock:
+            if given_key is None:
+                if self.entries_dict:
+                    self.entries_dict = {}
+                    self.changed = True
+            elif given_key in self.entries_dict:
+                del self.entries_dict[given_key]
+                self.changed = True
+
+    def hit_rate(self):
+        lookups = self.stats_dict['hits'] + self.stats_dict['negative_hits'] + self.stats_dict['misses']
+        if not lookups:
+            return 0.0
+        return float(lookups - self.stats_dict['misses']) / lookups
+
+    def report(self):
+        '''Returns a one-line summary of cache use for the log.'''
+        return '%s: %d hits (%d negative), %d misses, %d stale; hit rate %.0f%%, saved %.2fs%s.' % (
+            os.path.basename(self.path),self.stats_dict['hits'] + self.stats_dict['negative_hits'],
+            self.stats_dict['negative_hits'],self.stats_dict['misses'],self.stats_dict['stale_hits'],
+            100 * self.hit_rate(),self.stats_dict['seconds_saved'],
+            ' (discarded: version or signature changed)' if self.stats_dict['invalidated'] else '')
+
+    def save(self):
+        '''Writes the cache (atomically) if it changed, dropping entries
+            expired for longer than max_stale_seconds.'''
+        with self.lock:
+            oldest_expires = time.time() - self.max_stale_seconds
+            for key in list(self.entries_dict):
+                try:
+                    if self.entries_dict[key]['expires'] < oldest_expires:
+                        del self.entries_dict[key]
+                        self.changed = True
+                except (KeyError,TypeError):
+                    del self.entries_dict[key]
+            if not self.changed:
+                return
+            try:
+                write_plist_atomically({'cache_version':self.version,
+                                        'signature':self.signature,
+                                        'entries':self.entries_dict},self.path)
+                self.changed = False
+            except (TypeError,IOError,OSError):
+                logging.error("Failed to write cache: %s" % self.path)
+
+class HistoryStore(object):
+    '''Bounded event history kept in a plist: named counters, the times of
+        the first and last events, and the times of the most recent events
+        in a ring buffer of fixed capacity.  Recording an event rewrites the
+        file (atomically) at a cost independent of how many events came
+        before.  given_legacy_function, if given, converts a dict read from
+        a file in an older format into a tuple of (counters dict, list of
+        event times); the next save() writes the current format.'''
+    def __init__(self,given_path,given_capacity=None,given_legacy_function=None):
+        self.path = given_path
+        self.capacity = max(1,given_capacity or HISTORY_STORE_CAPACITY)
+        self.legacy_function = given_legacy_function
+        self.clear_state()
+        self.load()
+
+    def clear_state(self):
+        self.counters_dict = {}
+        self.events_list = []
+        self.next_index = 0
+        self.first_event = None
+        self.last_event = None
+
+    def load(self):
+        '''Reads the history file, converting it if in a legacy format.'''
+        history_dict = {}
+        if os.path.exists(self.path):
+            try:
+                history_dict = plistlib.readPlist(self.path)
+            except xml.parsers.expat.ExpatError:
+                pass
+            except IOError:
+                pass
+        try:
+            if history_dict.get('history_version') == HISTORY_STORE_VERSION:
+                self.counters_dict = history_dict['counters']
+                events_list = history_dict['events']
+                next_index = history_dict['next_index']
+                stored_capacity = history_dict.get('capacity',len(events_list))
+                self.first_event = history_dict.get('first_event')
+                self.last_event = history_dict.get('last_event')
+                # A full ring was written from next_index on; put it back in
+                # order, then keep as many events as our capacity allows:
+                events_in_stored_order = list(events_list)
+                if len(events_list) == stored_capacity and next_index != 0:
+                    events_in_stored_order = events_list[next_index:] + events_list[:next_index]
+                self.set_events(events_in_stored_order)
+            elif history_dict and self.legacy_function:
+                counters_dict, events_list = self.legacy_function(history_dict)
+                self.counters_dict = dict(counters_dict)
+                if events_list:
+                    self.first_event = events_list[0]
+                    self.last_event = events_list[-1]
+                self.set_events(events_list)
+        except (KeyError,TypeError,ValueError,AttributeError):
+            self.clear_state()
+
+    def set_events(self,given_events_list):
+        self.events_list = list(given_events_list[-self.capacity:])
+        self.next_index = len(self.events_list) % self.capacity
+
+    def events(self):
+        '''Returns the retained event times, oldest first.'''
+        if len(self.events_list) < self.capacity:
+            return list(self.events_list)
+        return self.events_list[self.next_index:] + self.events_list[:self.next_index]
+
+    def count(self,given_counter_name):
+        return self.counters_dict.get(given_counter_name,0)
+
+    def record(self,given_counter_name,given_event_time=None):
+        '''Records an event: increments the given counter, stores the event
+            time (default: now, UTC), and saves.  Returns the new count.'''
+        if given_event_time is None:
+            given_event_time = datetime.datetime.utcnow()
+        self.counters_dict[given_counter_name] = self.count(given_counter_name) + 1
+        if len(self.events_list) < self.capacity:
+            self.events_list.append(given_event_time)
+        else:
+            self.events_list[self.next_index] = given_event_time
+        self.next_index = (self.next_index + 1) % self.capacity
+        if self.first_event is None:
+            self.first_event = given_event_time
+        self.last_event = given_event_time
+        self.save()
+        return self.counters_dict[given_counter_name]
+
+    def save(self):
+        history_dict = {'history_version':HISTORY_STORE_VERSION,
+                        'counters':self.counters_dict,
+                        'events':self.events_list,
+                        'next_index':self.next_index,
+                        'capacity':self.capacity}
+        if self.first_event is not None:
+            history_dict['first_event'] = self.first_event
+            history_dict['last_event'] = self.last_event
+        try:
+            write_plist_atomically(history_dict,self.path)
+        except (TypeError,IOError,OSError):
+            logging.error("Failed to write history to: %s" % self.path)
+
+    def clear(self):
+        '''Forgets all events and removes the history file.'''
+        self.clear_state()
+        if os.path.exists(self.path):
+            try:
+                os.unlink(self.path)
+            except OSError:
+                logging.error("Failed to remove history: %s" % self.path)
+
+def valid_condition(given_key,given_value):
+    '''Returns true if the given key-value pair can be written to the
+        Munki Conditions file (a string key and a value plistlib can write).'''
+    if not isinstance(given_key,basestring):
+        return False
+    try:
+        plistlib.writePlistToString({given_key:given_value})
+    except (TypeError,ValueError,AttributeError):
+        return False
+    return True
+
+class ConditionsWriter(object):
+    '''Accumulates key-value pairs for the Munki Conditions file in memory.
+        flush() merges them into the file with a single atomic write, and
+        skips the write if the merged content is unchanged.  A key queued
+        with the value None is removed from the file.'''
+    def __init__(self,given_path=None,given_fsync=None):
+        self.path = given_path or MUNKI_CONDITIONS_PATH
+        self.fsync = CONDITIONS_WRITE_FSYNC if given_fsync is None else given_fsync
+        self.pending_dict = {}
+        self.lock = threading.Lock()
+
+    def update(self,given_dict):
+        '''Queues key-value pairs.'''
+        with self.lock:
+            try:
+                self.pending_dict.update(given_dict)
+            except TypeError:
+                pass
+
+    def flush(self):
+        '''Merges queued pairs into the conditions file.
+            Returns true if the file was written.'''
+        with self.lock:
+            return self.flush_pending()
+
+    def flush_pending(self):
+        '''Does the work of flush(); the caller holds the lock.'''
+        # Defaults:
+        existing_data = ''
+        conditions_dict = {}
+        if not self.pending_dict:
+            return False
+        # Try reading file to dict:
+        if os.path.exists(self.path):
+            try:
+                with open(self.path,'rb') as conditions_file:
+                    existing_data = conditions_file.read()
+                conditions_dict = plistlib.readPlistFromString(existing_data)
+            except xml.parsers.expat.ExpatError:
+                pass
+            except IOError:
+                pass
+        if not isinstance(conditions_dict,dict):
+            conditions_dict = {}
+        # Update, dropping any pair plistlib cannot write so that one bad
+        # value does not cost the other conditions their keys:
+        pending_dict = self.pending_dict
+        self.pending_dict = {}
+        for key, value in pending_dict.items():
+            if value is None:
+                conditions_dict.pop(key,None)
+                continue
+            if not valid_condition(key,value):
+                logging.error("Skipping Munki Condition that cannot be written: %s = %s" % (repr(key),repr(value)))
+                continue
+            conditions_dict[key] = value
+        # Write plist if changed:
+        try:
+            conditions_data = plistlib.writePlistToString(conditions_dict)
+        except TypeError:
+            # Only an unwritable value already in the file gets here.
+            logging.error("Failed to write Munki Conditions: %s" % str(pending_dict))
+            return False
+        if conditions_data == existing_data:
+            return False
+        try:
+            write_file_atomically(conditions_data,self.path,self.fsync)
+        except (IOError,OSError):
+            logging.error("Failed to write Munki Conditions: %s" % str(pending_dict))
+            return False
+        return True
+
 def write_conditions(given_dict):
     '''Writes key-value pairs to the Munki Conditions file.'''
+    conditions_writer = ConditionsWriter()
+    conditions_writer.update(given_dict)
+    conditions_writer.flush()
+
+def run_in_pool(given_function,given_items_list,given_max_workers,given_use_processes=False):
+    '''Calls given_function on each item using a pool of at most
+        given_max_workers threads (or processes).  Returns the results in
+        the order of given_items_list.  given_function should handle its own
+        errors; with processes, it and its results must be picklable.'''
+    worker_count = max(1,min(int(given_max_workers),len(given_items_list)))
+    if worker_count == 1:
+        return [ given_function(item) for item in given_items_list ]
+    if given_use_processes:
+        pool = multiprocessing.Pool(worker_count)
+    else:
+        pool = multiprocessing.pool.ThreadPool(worker_count)
+    try:
+        # map_async().get() with a timeout keeps the pool interruptible:
+        return pool.map_async(given_function,given_items_list,1).get(POOL_RESULT_TIMEOUT_SECONDS)
+    finally:
+        pool.terminate()
+        pool.join()
+
+class PlistKeysFound(Exception):
+    '''Raised from StreamingPlistKeyReader callbacks to stop parsing early.'''
+    pass
+
+class StreamingPlistKeyReader(object):
+    '''Incremental (expat) reader for selected top-level keys of an XML plist
+        whose root object is a dict.  Values of other top-level keys are
+        skipped without building them, and parsing stops as soon as every
+        wanted key has been read.  Values are returned as plistlib would.
+        Malformed XML raises xml.parsers.expat.ExpatError.'''
+    def __init__(self,given_keys_list):
+        self.wanted_keys_set = set(given_keys_list)
+        self.found_dict = {}
+        self.depth = 0
+        self.top_is_dict = False
+        self.top_key = None
+        self.text_list = None
+        # Stack of [element name, container, pending dict key] while building a wanted value:
+        self.build_stack = None
+
+    def read_file(self,given_file,given_chunk_size=PLIST_STREAM_CHUNK_SIZE):
+        '''Parses the given file object.  Returns a dict of the wanted keys found.'''
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.character_data
+        try:
+            while True:
+                chunk = given_file.read(given_chunk_size)
+                if not chunk:
+                    break
+                parser.Parse(chunk,False)
+            parser.Parse('',True)
+        except PlistKeysFound:
+            pass
+        return self.found_dict
+
+    def start_element(self,name,attrs):
+        self.depth += 1
+        if self.build_stack is not None:
+            self.start_value(name)
+        elif self.depth == 2:
+            self.top_is_dict = (name == 'dict')
+        elif self.depth == 3 and self.top_is_dict:
+            if name == 'key':
+                self.text_list = []
+            elif self.top_key in self.wanted_keys_set:
+                self.build_stack = []
+                self.start_value(name)
+
+    def end_element(self,name):
+        self.depth -= 1
+        if self.build_stack is not None:
+            value = self.end_value(name)
+            if not self.build_stack:
+                self.build_stack = None
+                self.found_dict[self.top_key] = value
+                self.top_key = None
+                if len(self.found_dict) == len(self.wanted_keys_set):
+                    raise PlistKeysFound()
+        elif self.depth == 2 and self.top_is_dict and name == 'key':
+            self.top_key = self.text_data()
+
+    def character_data(self,data):
+        if self.text_list is not None:
+            self.text_list.append(data)
+
+    def text_data(self):
+        data = ''.join(self.text_list or [])
+        self.text_list = None
+        try:
+            data = data.encode('ascii')
+        except UnicodeError:
+            pass
+        return data
+
+    def start_value(self,name):
+        if name == 'dict':
+            self.build_stack.append([name,{},None])
+        elif name == 'array':
+            self.build_stack.append([name,[],None])
+        else:
+            self.build_stack.append([name,None,None])
+            self.text_list = []
+
+    def end_value(self,name):
+        '''Finishes the innermost value being built and adds it to its parent.
+            Returns the finished value.'''
+        value_name, value, pending_key = self.build_stack.pop()
+        if value_name not in ['dict','array']:
+            value = self.scalar_value(value_name,self.text_data())
+        if self.build_stack:
+            parent = self.build_stack[-1]
+            if parent[0] == 'array':
+                parent[1].append(value)
+            elif value_name == 'key':
+                parent[2] = value
+            else:
+                parent[1][parent[2]] = value
+        return value
+
+    def scalar_value(self,given_name,given_text):
+        if given_name == 'integer':
+            return int(given_text)
+        if given_name == 'real':
+            return float(given_text)
+        if given_name == 'true':
+            return True
+        if given_name == 'false':
+            return False
+        if given_name == 'date':
+            return datetime.datetime.strptime(given_text,'%Y-%m-%dT%H:%M:%SZ')
+        if given_name == 'data':
+            return plistlib.Data(base64.b64decode(given_text))
+        return given_text
+
+def read_manifest_keys(given_manifest_name,given_keys_list=MANIFEST_INDEXED_KEYS):
+    '''Reads the given manifest and returns a dict with only the given
+        top-level keys (those present).  Returns an empty dict if the
+        manifest is missing or cannot be parsed.'''
     # Defaults:
-    conditions_dict = {}
-    # Try reading file to dict:
-    if os.path.exists(MUNKI_CONDITIONS_PATH):
+    manifest_keys_dict = {}
+    # Try streaming the wanted keys from the manifest file:
+    given_manifest_path = os.path.join(MUNKI_MANIFESTS_PATH,given_manifest_name)
+    if os.path.isfile(given_manifest_path):
         try:
-            conditions_dict = plistlib.readPlist(MUNKI_CONDITIONS_PATH)
+            with open(given_manifest_path,'rb') as manifest_file:
+                manifest_keys_dict = StreamingPlistKeyReader(given_keys_list).read_file(manifest_file)
         except xml.parsers.expat.ExpatError:
             pass
-    # Update:
-    try:
-        conditions_dict.update(given_dict)
-    except TypeError:
-        pass
-    # Write plist:
-    if conditions_dict:
-        try:
-            plistlib.writePlist(conditions_dict,MUNKI_CONDITIONS_PATH)
-        except TypeError:
-            logging.error("Failed to write Munki Conditions: %s" % str(given_dict))
+        except ValueError:
+            pass
         except IOError:
-            logging.error("Failed to write Munki Conditions: %s" % str(given_dict))
+            pass
+    # Return:
+    return manifest_keys_dict
 
 def get_included_manifest_names_from_manifest(given_manifest_name):
     '''Reads the given manifest's included_manifests array.  Returns a list
         of included ones.'''
     # Defaults:
-    given_manifest_dict = {}
     included_manifests_list = []
-    # Try reading input manifest file to dict:
-    given_manifest_path = os.path.join(MUNKI_MANIFESTS_PATH,given_manifest_name)
-    if os.path.exists(given_manifest_path):
+    # Try reading the included_manifests key from the manifest:
+    try:
+        included_manifests_list = read_manifest_keys(given_manifest_name,['included_manifests'])['included_manifests']
+    except KeyError:
+        pass
+    # Return:
+    return included_manifests_list
+
+class ManifestMetadataIndex(object):
+    '''On-disk index of the included_manifests array and the _metadata keys
+        used by conditions (MANIFEST_METADATA_KEYS) for each cached manifest.
+        Entries are keyed by manifest name and carry the manifest's mtime and
+        size; a manifest is parsed again only if either has changed.  Call
+        save() to persist entries for the manifests used this run.'''
+    def __init__(self,given_index_path=None):
+        self.index_path = given_index_path or MANIFEST_METADATA_INDEX_PATH
+        self.entries_dict = {}
+        self.used_entries_dict = {}
+        self.stats_dict = {'reused':0,'parsed':0,'missing':0}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        '''Reads the index file, discarding it if unreadable or from another version.'''
+        index_dict = {}
+        if os.path.exists(self.index_path):
+            try:
+                index_dict = plistlib.readPlist(self.index_path)
+            except xml.parsers.expat.ExpatError:
+                pass
+            except IOError:
+                pass
         try:
-            given_manifest_dict = plistlib.readPlist(given_manifest_path)
-        except xml.parsers.expat.ExpatError:
+            if index_dict['index_version'] == MANIFEST_METADATA_INDEX_VERSION and index_dict['manifests_path'] == MUNKI_MANIFESTS_PATH:
+                self.entries_dict = index_dict['manifests']
+        except KeyError:
+            pass
+        except TypeError:
             pass
-    # Try reading the included_manifests key from the given_manifest_dict:
-    if given_manifest_dict:
+
+    def entry(self,given_manifest_name):
+        '''Returns the index entry for the given manifest, re-reading the
+            manifest only if its mtime or size changed since it was indexed.'''
+        if given_manifest_name in self.used_entries_dict:
+            return self.used_entries_dict[given_manifest_name]
+        manifest_path = os.path.join(MUNKI_MANIFESTS_PATH,given_manifest_name)
         try:
-            included_manifests_list = given_manifest_dict['included_manifests']
-        except KeyError:
+            manifest_stat = os.stat(manifest_path)
+        except OSError:
+            manifest_stat = None
+        if manifest_stat is None or not os.path.isfile(manifest_path):
+            self.stats_dict['missing'] += 1
+            manifest_entry_dict = {'included_manifests':[],'_metadata':{}}
+            if given_manifest_name in self.entries_dict:
+                self.changed = True
+            self.used_entries_dict[given_manifest_name] = manifest_entry_dict
+            return manifest_entry_dict
+        manifest_entry_dict = self.entries_dict.get(given_manifest_name)
+        try:
+            if manifest_entry_dict['mtime'] == manifest_stat.st_mtime and manifest_entry_dict['size'] == manifest_stat.st_size:
+                self.stats_dict['reused'] += 1
+                self.used_entries_dict[given_manifest_name] = manifest_entry_dict
+                return manifest_entry_dict
+        except (KeyError,TypeError):
             pass
-    # Return:
-    return included_manifests_list
+        # New or changed; parse it:
+        self.stats_dict['parsed'] += 1
+        self.changed = True
+        manifest_keys_dict = read_manifest_keys(given_manifest_name)
+        manifest_entry_dict = {'mtime':manifest_stat.st_mtime,
+                               'size':manifest_stat.st_size,
+                               'included_manifests':[],
+                               '_metadata':{}}
+        if isinstance(manifest_keys_dict.get('included_manifests'),list):
+            manifest_entry_dict['included_manifests'] = manifest_keys_dict['included_manifests']
+        if isinstance(manifest_keys_dict.get('_metadata'),dict):
+            for key in MANIFEST_METADATA_KEYS:
+                if key in manifest_keys_dict['_metadata']:
+                    manifest_entry_dict['_metadata'][key] = manifest_keys_dict['_metadata'][key]
+        self.used_entries_dict[given_manifest_name] = manifest_entry_dict
+        return manifest_entry_dict
+
+    def get_included_manifest_names(self,given_manifest_name):
+        '''Returns the included_manifests array of the given manifest.'''
+        return self.entry(given_manifest_name)['included_manifests']
+
+    def get_metadata(self,given_manifest_name):
+        '''Returns the indexed _metadata keys of the given manifest.'''
+        return self.entry(given_manifest_name)['_metadata']
+
+    def effective_metadata(self,given_manifest_graph):
+        '''Merges the indexed _metadata of every manifest in the given graph,
+            in breadth-first order.  Returns a dict with:
+            nested_admin_groups: list of unique group names
+            exclude_admins_from_dsconfigad: true if any manifest sets it
+            print_queues: list of queue dicts, de-duplicated by queue name
+            (the first definition found wins).'''
+        admin_group_names_list = []
+        admin_group_names_set = set()
+        exclude_admins_from_dsconfigad = False
+        print_queue_dicts_list = []
+        print_queue_names_set = set()
+        for manifest_name in given_manifest_graph.manifest_names:
+            manifest_metadata_dict = self.get_metadata(manifest_name)
+            for group_name in manifest_metadata_dict.get('nested_admin_groups',[]):
+                if group_name not in admin_group_names_set:
+                    admin_group_names_set.add(group_name)
+                    admin_group_names_list.append(group_name)
+            # One true flips this parameter; cannot be flipped back with a false:
+            if manifest_metadata_dict.get('exclude_admins_from_dsconfigad'):
+                exclude_admins_from_dsconfigad = True
+            for print_queue_dict in manifest_metadata_dict.get('print_queues',[]):
+                try:
+                    print_queue_name = print_queue_dict['name']
+                except (KeyError,TypeError):
+                    continue
+                if print_queue_name not in print_queue_names_set:
+                    print_queue_names_set.add(print_queue_name)
+                    print_queue_dicts_list.append(print_queue_dict)
+        return {'nested_admin_groups':admin_group_names_list,
+                'exclude_admins_from_dsconfigad':exclude_admins_from_dsconfigad,
+                'print_queues':print_queue_dicts_list}
+
+    def save(self):
+        '''Writes entries for the manifests used this run to the index file
+            (if anything changed).'''
+        if not self.changed:
+            return
+        index_dict = {'index_version':MANIFEST_METADATA_INDEX_VERSION,
+                      'manifests_path':MUNKI_MANIFESTS_PATH,
+                      'manifests':dict((name,entry) for name, entry in self.used_entries_dict.items() if 'mtime' in entry)}
+        try:
+            write_plist_atomically(index_dict,self.index_path)
+            self.changed = False
+        except TypeError:
+            logging.error("Failed to write manifest metadata index: %s" % self.index_path)
+        except (IOError,OSError):
+            logging.error("Failed to write manifest metadata index: %s" % self.index_path)
+
+class ManifestIncludeGraph(object):
+    '''Resolved graph of manifests reachable from a root manifest via
+        included_manifests.  Manifests are visited breadth-first, in the order
+        they are listed, so manifest_names is deterministic.  Each manifest is
+        read at most once.  Attributes:
+        manifest_names: list of reachable manifests in breadth-first order
+        depths: dict of manifest name to depth (root is 0)
+        edges: list of (including, included) manifest name tuples
+        cycles: list of (including, included) edges that point back to an ancestor
+        truncated: list of manifests whose includes were not followed (max depth)'''
+    def __init__(self,given_root_manifest_name,given_max_depth=MANIFEST_INCLUDE_MAX_DEPTH,given_includes_function=None):
+        self.root_manifest_name = given_root_manifest_name
+        self.max_depth = given_max_depth
+        self.includes_function = given_includes_function or get_included_manifest_names_from_manifest
+        self.manifest_names = []
+        self.depths = {}
+        self.edges = []
+        self.cycles = []
+        self.truncated = []
+        self.resolve()
+
+    def resolve(self):
+        '''Walks the include graph breadth-first from the root manifest.'''
+        if not self.root_manifest_name:
+            return
+        children_dict = {}
+        queue = collections.deque([self.root_manifest_name])
+        self.depths[self.root_manifest_name] = 0
+        while queue:
+            manifest_name = queue.popleft()
+            self.manifest_names.append(manifest_name)
+            depth = self.depths[manifest_name]
+            if depth >= self.max_depth:
+                self.truncated.append(manifest_name)
+                logging.warning("Not following includes of %s: max depth %s reached." % (manifest_name,self.max_depth))
+                continue
+            children_list = []
+            for included_name in self.includes_function(manifest_name):
+                # Ignore junk entries and repeats within one manifest:
+                if not isinstance(included_name,basestring) or not included_name:
+                    continue
+                if included_name in children_list:
+                    continue
+                children_list.append(included_name)
+                self.edges.append((manifest_name,included_name))
+                if included_name not in self.depths:
+                    self.depths[included_name] = depth + 1
+                    queue.append(included_name)
+            children_dict[manifest_name] = children_list
+        self.cycles = self.find_cycles(children_dict)
+        for including_name, included_name in self.cycles:
+            logging.warning("Manifest include cycle: %s includes its ancestor %s." % (including_name,included_name))
+
+    def find_cycles(self,given_children_dict):
+        '''Depth-first search (iterative) for back edges in the include graph.
+            Returns a list of (including, included) tuples closing a cycle.'''
+        back_edges_list = []
+        # 1: on the current DFS path; 2: finished.
+        state_dict = {}
+        stack = [(self.root_manifest_name,iter(given_children_dict.get(self.root_manifest_name,[])))]
+        state_dict[self.root_manifest_name] = 1
+        while stack:
+            manifest_name, children_iter = stack[-1]
+            for child_name in children_iter:
+                child_state = state_dict.get(child_name)
+                if child_state == 1:
+                    back_edges_list.append((manifest_name,child_name))
+                elif child_state is None:
+                    state_dict[child_name] = 1
+                    stack.append((child_name,iter(given_children_dict.get(child_name,[]))))
+                    break
+            else:
+                state_dict[manifest_name] = 2
+                stack.pop()
+        return back_edges_list
+
+    def included_by(self,given_manifest_name):
+        '''Returns the names of manifests that include the given one.'''
+        return [ edge[0] for edge in self.edges if edge[1] == given_manifest_name ]
+
+def resolve_manifest_include_graph(given_root_manifest_name=None,given_manifest_index=None):
+    '''Returns a ManifestIncludeGraph for this computer\'s manifest (or the given one).
+        If a ManifestMetadataIndex is given, includes are read through it.'''
+    if given_root_manifest_name is None:
+        given_root_manifest_name = determine_computer_manifest_name()
+    if given_manifest_index is not None:
+        return ManifestIncludeGraph(given_root_manifest_name,given_includes_function=given_manifest_index.get_included_manifest_names)
+    return ManifestIncludeGraph(given_root_manifest_name)
+
+def get_effective_manifest_metadata(given_root_manifest_name=None):
+    '''Resolves this computer\'s manifest include graph (or the given
+        manifest\'s) through the on-disk manifest metadata index and returns
+        the merged _metadata for it (see ManifestMetadataIndex.effective_metadata).'''
+    manifest_index = ManifestMetadataIndex()
+    manifest_graph = resolve_manifest_include_graph(given_root_manifest_name,manifest_index)
+    effective_metadata_dict = manifest_index.effective_metadata(manifest_graph)
+    manifest_index.save()
+    logging.info("Manifest metadata index: %(reused)s reused, %(parsed)s parsed, %(missing)s missing." % manifest_index.stats_dict)
+    return effective_metadata_dict
 
 def make_list_of_applicable_manifests():
     '''Produces a flat list of manifests which are relevant to this computer.'''
-    # Defaults:
-    processed_manifest_names_list = []
-    queued_manifest_names_list = [determine_computer_manifest_name()]
-    # Loop:
-    while True:
-        # Init:
-        new_manifests_list = []
-        for manifest_name in queued_manifest_names_list:
-            new_manifests_list_from_this_manifest_name = get_included_manifest_names_from_manifest(manifest_name)
-            # This new manifest list can contain duplicates (we filter them when adding to the queue in the next for loop).
-            new_manifests_list.extend(new_manifests_list_from_this_manifest_name)
-            # Mark as processed (but prevent duplicates):
-            if manifest_name not in processed_manifest_names_list:
-                processed_manifest_names_list.append(manifest_name)
-        # Break if new manifests list is empty:
-        if not new_manifests_list:
-            break
-        # Add any new ones to queue:
-        for manifest_name in new_manifests_list:
-            if manifest_name not in queued_manifest_names_list:
-                queued_manifest_names_list.append(manifest_name)
-        # Remove processed manifests from queue:
-        for manifest_name in queued_manifest_names_list:
-            if manifest_name in processed_manifest_names_list:
-                queued_manifest_names_list.remove(manifest_name)
+    return resolve_manifest_include_graph().manifest_names
 
-    # Return:
-    return processed_manifest_names_list
-    
 def determine_computer_manifest_name():
     '''Method determines the computer manifest name or sub-path
     relative to MUNKI_MANIFESTS_PATH.'''
@@ -158,27 +1777,144 @@ def get_client_identifier_key_from_munki_prefs():
         prefs_dict = {}
         if not os.path.exists(pref_path):
             continue
-        # If the pref file is present,
-        # make a copy and convert to text.
+        # If the pref file is present, read it (binary or XML):
         try:
-            shutil.copy(pref_path,TEMP_PREF_PATH)
-            plutil_convert_to_xml(TEMP_PREF_PATH)
-        except shutil.Error:
-            continue
-        try:
-            prefs_dict = plistlib.readPlist(TEMP_PREF_PATH)
+            prefs_dict = read_plist(pref_path)
         except xml.parsers.expat.ExpatError:
             pass
-        if prefs_dict:
+        except (PlistFormatError,IOError):
+            pass
+        if isinstance(prefs_dict,dict):
             try:
                 client_identifier = prefs_dict['ClientIdentifier']
             except KeyError:
                 pass
         if client_identifier:
             break
-    if os.path.exists(TEMP_PREF_PATH):
-        try:
-            os.unlink(TEMP_PREF_PATH)
-        except IOError:
-            pass
     return client_identifier
+
+class HostFacts(object):
+    '''Facts about this computer from system_profiler.  The first read of
+        any fact fetches all of the data types in given_data_types_list with a
+        single system_profiler call and parses the output once; later reads
+        are served from memory; a data type not in the list (all of them, if
+        it is empty) is fetched on its own when first read.
+        given_profiler_output may carry recorded system_profiler -xml output
+        to use instead of running it.'''
+    def __init__(self,given_data_types_list=None,given_profiler_output=None):
+        if given_data_types_list is None:
+            given_data_types_list = HOST_FACTS_DATA_TYPES
+        self.data_types_list = list(given_data_types_list)
+        self.profiler_output = given_profiler_output
+        self.items_dict = None
+        self.lock = threading.Lock()
+
+    def fetch(self,given_data_types_list):
+        '''Runs system_profiler (or parses the recorded output) for the given
+            data types.  Returns a dict of data type to its _items array.'''
+        # Defaults:
+        output = self.profiler_output
+        output_array = []
+        items_dict = dict((data_type,[]) for data_type in given_data_types_list)
+        # Run system_profiler:
+        if output is None:
+            try:
+                output = shared_command_runner().check_output(['/usr/sbin/system_profiler','-xml'] + given_data_types_list,given_memoize=True)
+            except subprocess.CalledProcessError:
+                output = ''
+            except OSError:
+                output = ''
+        # Parse output:
+        if output:
+            try:
+                output_array = plistlib.readPlistFromString(output)
+            except xml.parsers.expat.ExpatError:
+                pass
+        for data_type_dict in output_array:
+            try:
+                items_dict[data_type_dict['_dataType']] = data_type_dict['_items']
+            except (KeyError,TypeError):
+                pass
+        return items_dict
+
+    def items(self,given_data_type):
+        '''Returns the _items array for the given data type.'''
+        with self.lock:
+            if self.items_dict is None:
+                self.items_dict = {}
+                if self.data_types_list:
+                    self.items_dict = self.fetch(self.data_types_list)
+            if given_data_type not in self.items_dict:
+                # Not requested up front; fetch it on its own.
+                self.items_dict.update(self.fetch([given_data_type]))
+            return self.items_dict[given_data_type]
+
+    def hardware_value(self,given_key):
+        '''Returns the given key from the SPHardwareDataType item, or a blank string.'''
+        try:
+            return self.items('SPHardwareDataType')[0][given_key]
+        except (IndexError,KeyError,TypeError):
+            return ''
+
+    @property
+    def serial_number(self):
+        return self.hardware_value('serial_number')
+
+    @property
+    def hardware_uuid(self):
+        return self.hardware_value('platform_UUID')
+
+    @property
+    def model(self):
+        return self.hardware_value('machine_model')
+
+    @property
+    def network_interfaces(self):
+        return self.items('SPNetworkDataType')
+
+class ConditionsContext(object):
+    '''State shared by the conditions run in one process: the client
+        identifier (computer manifest name), the effective manifest metadata,
+        the host facts and the conditions waiting to be written.  Values are computed on
+        first use.  Conditions call write_conditions() on the context; the
+        caller writes them out once with flush().
+        given_host_facts_data_types_list is passed to HostFacts: by default,
+        the system_profiler data types of all conditions are fetched
+        together; a condition run on its own passes an empty list so that
+        only the data type it reads is fetched.'''
+    def __init__(self,given_host_facts_data_types_list=None):
+        self.host_facts_data_types_list = given_host_facts_data_types_list
+        self.conditions_writer = ConditionsWriter()
+        self.computed_dict = {}
+        self.lock = threading.Lock()
+        self.value_locks_dict = {}
+
+    def lazy_value(self,given_name,given_function):
+        '''Returns the named value, calling given_function to compute it once.
+            Safe to call from several threads; each value has its own lock.'''
+        with self.lock:
+            value_lock = self.value_locks_dict.setdefault(given_name,threading.Lock())
+        with value_lock:
+            if given_name not in self.computed_dict:
+                self.computed_dict[given_name] = given_function()
+        return self.computed_dict[given_name]
+
+    @property
+    def client_identifier(self):
+        return self.lazy_value('client_identifier',determine_computer_manifest_name)
+
+    @property
+    def host_facts(self):
+        return self.lazy_value('host_facts',lambda: HostFacts(self.host_facts_data_types_list))
+
+    @property
+    def effective_manifest_metadata(self):
+        return self.lazy_value('effective_manifest_metadata',lambda: get_effective_manifest_metadata(self.client_identifier))
+
+    def write_conditions(self,given_dict):
+        '''Queues key-value pairs for the Munki Conditions file.'''
+        self.conditions_writer.update(given_dict)
+
+    def flush(self):
+        '''Writes queued key-value pairs to the Munki Conditions file.'''
+        self.conditions_writer.flush()
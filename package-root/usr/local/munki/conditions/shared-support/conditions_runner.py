@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# conditions_runner.py
+# Runs the condition scripts in a single interpreter.  Each condition
+# script is imported as a module and its run_condition() is called
+# with one shared ConditionsContext, so the client identifier and
+# manifest metadata are resolved once and the Munki Conditions file
+# is written once.  A condition that fails does not stop the others.
+# References: Refer to the markdown files in the source tree
+# (ReadMe.md and those in the Documentation folder).
+
+# Written by Gerrit DeWitt (gdewitt@gsu.edu)
+# Copyright Georgia State University.
+# This script uses publicly-documented methods known to those skilled in the art.
+
+import sys, os, imp, logging, time
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(this_dir)
+import conditions_common
+
+# Directory containing the condition scripts:
+global CONDITIONS_SCRIPTS_DIR
+CONDITIONS_SCRIPTS_DIR = os.path.dirname(this_dir)
+# Condition scripts to run, in order:
+global CONDITION_SCRIPT_NAMES
+CONDITION_SCRIPT_NAMES = []
+CONDITION_SCRIPT_NAMES.append('ad-status.py')
+CONDITION_SCRIPT_NAMES.append('admin-groups.py')
+CONDITION_SCRIPT_NAMES.append('hw-bundle.py')
+CONDITION_SCRIPT_NAMES.append('network-hw.py')
+CONDITION_SCRIPT_NAMES.append('print-queues.py')
+# Conditions that must finish before a condition starts.  admin-groups and
+# print-queues rely on the AD binding that ad-status checks and repairs.
+global CONDITION_DEPENDENCIES
+CONDITION_DEPENDENCIES = {}
+CONDITION_DEPENDENCIES['admin-groups.py'] = ['ad-status.py']
+CONDITION_DEPENDENCIES['print-queues.py'] = ['ad-status.py']
+# Otherwise, conditions run concurrently on a bounded pool.
+# Threads share one context; processes each build their own.
+global CONDITIONS_RUNNER_MAX_WORKERS, CONDITIONS_RUNNER_USE_PROCESSES
+CONDITIONS_RUNNER_MAX_WORKERS = int(5)
+CONDITIONS_RUNNER_USE_PROCESSES = False
+
+def load_condition_module(given_script_name):
+    '''Imports the named condition script as a module.
+        Returns the module.'''
+    script_path = os.path.join(CONDITIONS_SCRIPTS_DIR,given_script_name)
+    module_name = 'condition_%s' % os.path.splitext(given_script_name)[0].replace('-','_')
+    return imp.load_source(module_name,script_path)
+
+def run_condition_script(given_script_name,given_context,given_condition_module=None):
+    '''Loads (unless given) and runs one condition with the given context.
+        Returns a dict describing the result.'''
+    result_dict = {'name':given_script_name,'success':False,'seconds':0.0}
+    start_time = time.time()
+    try:
+        condition_module = given_condition_module or load_condition_module(given_script_name)
+        condition_module.run_condition(given_context)
+        result_dict['success'] = True
+    except SystemExit:
+        logging.error("Condition %s exited instead of returning." % given_script_name)
+    except Exception:
+        logging.exception("Condition %s failed." % given_script_name)
+    result_dict['seconds'] = time.time() - start_time
+    return result_dict
+
+def run_imported_condition_script(given_script_name,given_context,given_condition_modules_dict):
+    '''Runs one condition imported by run_conditions() before the pool
+        started.  A condition that could not be imported is recorded as
+        failed rather than imported again from a pool thread.'''
+    try:
+        condition_module = given_condition_modules_dict[given_script_name]
+    except KeyError:
+        return {'name':given_script_name,'success':False,'seconds':0.0}
+    return run_condition_script(given_script_name,given_context,condition_module)
+
+def run_condition_script_in_process(given_script_name):
+    '''Runs one condition in a worker process with its own context.
+        Returns the result dict and the conditions it queued.'''
+    # Only this condition uses the context, so fetch only the host facts it reads:
+    context = conditions_common.ConditionsContext([])
+    result_dict = run_condition_script(given_script_name,context)
+    logging.info(conditions_common.shared_command_runner().report())
+    return result_dict, context.conditions_writer.pending_dict
+
+def schedule_conditions(given_script_names_list,given_dependencies_dict=None):
+    '''Splits the given condition scripts into stages, each run after the
+        stages before it, so that every script runs after the given scripts
+        it depends on (default: CONDITION_DEPENDENCIES).  Returns a list of
+        lists of names.  Scripts caught in a dependency cycle form the last
+        stage.'''
+    if given_dependencies_dict is None:
+        given_dependencies_dict = CONDITION_DEPENDENCIES
+    stages_list = []
+    done_set = set()
+    waiting_list = list(given_script_names_list)
+    while waiting_list:
+        stage_list = []
+        for script_name in waiting_list:
+            try:
+                dependencies_list = given_dependencies_dict[script_name]
+            except KeyError:
+                dependencies_list = []
+            if not [d for d in dependencies_list if d in given_script_names_list and d not in done_set and d != script_name]:
+                stage_list.append(script_name)
+        if not stage_list:
+            logging.error("Conditions with circular dependencies: %s" % ', '.join(waiting_list))
+            stage_list = list(waiting_list)
+        stages_list.append(stage_list)
+        done_set.update(stage_list)
+        waiting_list = [s for s in waiting_list if s not in done_set]
+    return stages_list
+
+def run_conditions(given_script_names_list,given_context,given_max_workers=None,given_use_processes=None):
+    '''Runs the given condition scripts on a bounded pool of threads (or
+        processes), all queueing conditions on the given context.  Scripts
+        run concurrently, except that each waits for the scripts it depends
+        on (see schedule_conditions()).  Returns a list of result dicts in
+        the order of the given names.'''
+    if given_max_workers is None:
+        given_max_workers = CONDITIONS_RUNNER_MAX_WORKERS
+    if given_use_processes is None:
+        given_use_processes = CONDITIONS_RUNNER_USE_PROCESSES
+    start_time = time.time()
+    results_dict = {}
+    if not given_use_processes:
+        # Import the modules up front; imports from several threads can deadlock.
+        condition_modules_dict = {}
+        for script_name in given_script_names_list:
+            try:
+                condition_modules_dict[script_name] = load_condition_module(script_name)
+            except Exception:
+                logging.exception("Condition %s could not be loaded." % script_name)
+    for stage_list in schedule_conditions(given_script_names_list):
+        if given_use_processes:
+            # Each process has its own context; merge what they queued:
+            for result_dict, pending_dict in conditions_common.run_in_pool(run_condition_script_in_process,stage_list,given_max_workers,True):
+                given_context.write_conditions(pending_dict)
+                results_dict[result_dict['name']] = result_dict
+        else:
+            for result_dict in conditions_common.run_in_pool(lambda script_name: run_imported_condition_script(script_name,given_context,condition_modules_dict),stage_list,given_max_workers):
+                results_dict[result_dict['name']] = result_dict
+    results_list = [results_dict[script_name] for script_name in given_script_names_list]
+    wall_seconds = time.time() - start_time
+    for result_dict in results_list:
+        logging.info("Condition %(name)s: success=%(success)s in %(seconds).2fs." % result_dict)
+    logging.info("Ran %s conditions in %.2fs wall-clock (%.2fs summed across conditions)." % (len(results_list),wall_seconds,sum([ r['seconds'] for r in results_list ])))
+    if not given_use_processes:
+        logging.info(conditions_common.shared_command_runner().report())
+    return results_list
+
+def main():
+    '''Main logic for this script'''
+    context = conditions_common.ConditionsContext()
+    run_conditions(CONDITION_SCRIPT_NAMES,context)
+    # Write Conditions once for all scripts:
+    context.flush()
+    # Finish:
+    sys.exit(0)
+
+# Run main.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# dscl-stand-in.py
+# Stand-in for dscl -plist, used by test_dscl_session.py.  Run as
+# "dscl-stand-in.py -plist", it reads interactive commands from standard
+# input (paths absolute, spaces escaped with backslashes), printing a prompt
+# before each; with more arguments it runs one command, one-shot dscl style
+# (dscl-stand-in.py -plist <node> <command> <record path> ...).
+# Records are read from records.plist in the folder named by
+# DSCL_STAND_IN_DIR: a dict of record path (e.g. /Local/Default/Groups/admin)
+# to a dict of attributes (e.g. dsAttrTypeStandard:NestedGroups) to lists of
+# values.  Each command received is appended to commands.log in that folder,
+# as the process ID and the command's words separated by tabs.
+# Commands:
+#   read <record path> [attribute ...]
+#   delete <record path> <attribute> <value>
+#   hang <record path> [attribute ...]
+#                          interactive: stops answering; one-shot: read
+#   exit-once <record path> [attribute ...]
+#                          interactive: exits without answering if
+#                          exit-once.flag is in the folder (removing it);
+#                          otherwise read
+#   exit                   interactive: exits without answering
+
+import sys, os, plistlib, time
+
+STAND_IN_DIR = os.environ['DSCL_STAND_IN_DIR']
+RECORDS_PATH = os.path.join(STAND_IN_DIR,'records.plist')
+LOG_PATH = os.path.join(STAND_IN_DIR,'commands.log')
+EXIT_ONCE_FLAG_PATH = os.path.join(STAND_IN_DIR,'exit-once.flag')
+
+class StandInError(Exception):
+    pass
+
+def split_words(given_line):
+    '''Splits an interactive command line at spaces not escaped with a
+        backslash.'''
+    words_list = []
+    word = ''
+    escaped = False
+    for character in given_line:
+        if escaped:
+            word += character
+            escaped = False
+        elif character == '\\':
+            escaped = True
+        elif character == ' ':
+            if word:
+                words_list.append(word)
+            word = ''
+        else:
+            word += character
+    if word:
+        words_list.append(word)
+    return words_list
+
+def log_command(given_words_list):
+    with open(LOG_PATH,'a') as log_file:
+        log_file.write('%d\t%s\n' % (os.getpid(),'\t'.join(given_words_list)))
+
+def run_command(given_words_list,given_interactive):
+    '''Returns the output of the given command; raises StandInError.'''
+    log_command(given_words_list)
+    command = given_words_list[0]
+    if given_interactive and command == 'hang':
+        time.sleep(3600)
+    if given_interactive and command == 'exit':
+        sys.exit(0)
+    if given_interactive and command == 'exit-once' and os.path.exists(EXIT_ONCE_FLAG_PATH):
+        os.remove(EXIT_ONCE_FLAG_PATH)
+        sys.exit(0)
+    if command in ['hang','exit-once']:
+        command = 'read'
+    if command not in ['read','delete'] or len(given_words_list) < 2:
+        raise StandInError('Unrecognized command: %s' % command)
+    records_dict = plistlib.readPlist(RECORDS_PATH)
+    record_dict = records_dict.get(given_words_list[1])
+    if record_dict is None:
+        raise StandInError('DS Error: -14136 (eDSRecordNotFound)')
+    if command == 'read':
+        attributes_list = given_words_list[2:]
+        if attributes_list:
+            record_dict = dict([(k,v) for k, v in record_dict.items() if k.split(':')[-1] in attributes_list])
+        return plistlib.writePlistToString(record_dict)
+    attribute, value = given_words_list[2:4]
+    for key in record_dict:
+        if key.split(':')[-1] == attribute and value in record_dict[key]:
+            record_dict[key].remove(value)
+            plistlib.writePlist(records_dict,RECORDS_PATH)
+            return ''
+    raise StandInError('DS Error: -14134 (eDSAttributeValueNotFound)')
+
+def main():
+    arguments_list = [a for a in sys.argv[1:] if a != '-plist']
+    if arguments_list:
+        # One-shot: node, command, record path relative to the node, ...
+        words_list = [arguments_list[1],arguments_list[0].rstrip('/') + '/' + arguments_list[2]] + arguments_list[3:]
+        try:
+            sys.stdout.write(run_command(words_list,False))
+        except StandInError, error:
+            sys.stderr.write('%s\n' % error)
+            sys.exit(56)
+        sys.exit(0)
+    while True:
+        sys.stdout.write('> ')
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+        if not line or line.strip() == 'quit':
+            break
+        words_list = split_words(line.rstrip('\n'))
+        if not words_list:
+            continue
+        try:
+            sys.stdout.write(run_command(words_list,True))
+        except StandInError, error:
+            sys.stdout.write('%s\n' % error)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+# make_corpus.py
+# Writes the plist conformance corpus used by test_plist_reader.py: each
+# case as a binary plist (<case>.bplist) and as an XML plist (<case>.xml),
+# both with Python 3's plistlib (whose binary writer follows the
+# CoreFoundation format).  Run with Python 3 from this folder.  On a Mac,
+# "plutil -convert binary1" of the XML files gives equivalent binaries.
+
+import datetime, os, plistlib
+
+CASES = {
+    'managed_installs': {'ClientIdentifier':'lab-mac-042',
+                         'SoftwareRepoURL':'https://munki.example.org/repo',
+                         'InstallAppleSoftwareUpdates':True,
+                         'DaysBetweenNotifications':1,
+                         'LastCheckDate':datetime.datetime(2017,3,8,15,4,11),
+                         'LastCheckResult':0,
+                         'PendingUpdateCount':3},
+    'scalars': {'true':True,'false':False,'empty_string':'','unicode':'café ☃ 日本',
+                'real':0.1,'negative_real':-1234.5625,'huge_real':1.5e300,'tiny_real':5e-324,
+                'date':datetime.datetime(1999,12,31,23,59,59),'old_date':datetime.datetime(1970,1,1),
+                'data':b'\x00\x01\x02binary\xff','empty_data':b''},
+    'integers': {'values':[0,1,-1,127,128,255,256,32767,65535,65536,2**31 - 1,2**31,2**32 - 1,2**32,
+                           2**62,2**63 - 1,-2**63,2**63,2**64 - 1]},
+    'containers': {'empty_dict':{},'empty_array':[],'nested':{'a':[{'b':[[1,2],[3]]},{'c':{}}]},
+                   'long_array':list(range(40)),'long_string':'x' * 300,
+                   'long_unicode':'é' * 40},
+    'many_objects': {('key%04d' % i):['value%04d' % i,i,{'i':i}] for i in range(400)},
+    'uids': {'$archiver':'NSKeyedArchiver','$top':{'root':plistlib.UID(1)},'$objects':['$null',plistlib.UID(0)]},
+    'top_level_array': ['one',2,3.0,True,{'five':[5]}],
+}
+
+def xml_value(given_value):
+    '''plistlib cannot write UIDs as XML; write them as CoreFoundation does.'''
+    if isinstance(given_value,plistlib.UID):
+        return {'CF$UID':given_value.data}
+    if isinstance(given_value,dict):
+        return dict((key,xml_value(value)) for key, value in given_value.items())
+    if isinstance(given_value,list):
+        return [xml_value(value) for value in given_value]
+    return given_value
+
+for name, value in sorted(CASES.items()):
+    with open('%s.bplist' % name,'wb') as plist_file:
+        plistlib.dump(value,plist_file,fmt=plistlib.FMT_BINARY,sort_keys=True)
+    with open('%s.xml' % name,'wb') as plist_file:
+        plistlib.dump(xml_value(value),plist_file,fmt=plistlib.FMT_XML,sort_keys=True)
@@ -0,0 +1,126 @@
+# support.py
+# Paths and loaders shared by the tests.  The tests use only the Python 2
+# standard library; run them from the top of the source tree with:
+#   python -m unittest discover -s tests
+
+import sys, os, imp, time, threading, SocketServer
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+FIXTURES_DIR = os.path.join(TESTS_DIR,'fixtures')
+CONDITIONS_DIR = os.path.join(os.path.dirname(TESTS_DIR),'package-root','usr','local','munki','conditions')
+sys.path.insert(0,os.path.join(CONDITIONS_DIR,'shared-support'))
+import conditions_common
+
+# Benchmarks run at a small size with the other tests, checking only how
+# cost scales; with CONDITIONS_BENCHMARK=1 in the environment they run at
+# full size and print their timings.
+BENCHMARK = bool(os.environ.get('CONDITIONS_BENCHMARK'))
+
+def benchmark_size(given_small_size,given_full_size):
+    return given_full_size if BENCHMARK else given_small_size
+
+def best_time(given_function,given_repeat=3):
+    '''Returns the shortest of given_repeat timings of given_function().'''
+    times_list = []
+    for r in range(given_repeat):
+        start_time = time.time()
+        given_function()
+        times_list.append(time.time() - start_time)
+    return min(times_list)
+
+def benchmark_report(given_title,given_rows_list):
+    '''Prints a benchmark's rows of (label, seconds) if CONDITIONS_BENCHMARK.
+        A row may add a unit to use instead of seconds: (label, value, unit).'''
+    if not BENCHMARK:
+        return
+    sys.stderr.write('\n%s:\n' % given_title)
+    for row in given_rows_list:
+        if len(row) == 2:
+            sys.stderr.write('  %-48s %10.4fs\n' % row)
+        else:
+            sys.stderr.write('  %-48s %10.4f %s\n' % row)
+
+def fixture_path(given_name):
+    return os.path.join(FIXTURES_DIR,given_name)
+
+def read_fixture(given_name):
+    with open(fixture_path(given_name),'rb') as fixture_file:
+        return fixture_file.read()
+
+def load_condition(given_script_name):
+    '''Imports the named condition script as a module.'''
+    module_name = 'condition_%s' % os.path.splitext(given_script_name)[0].replace('-','_')
+    return imp.load_source(module_name,os.path.join(CONDITIONS_DIR,given_script_name))
+
+def fresh_command_runner():
+    '''Replaces the shared CommandRunner with a new one and returns it.'''
+    conditions_common.command_runner = conditions_common.CommandRunner()
+    return conditions_common.command_runner
+
+def stand_in_tool(given_dir,given_name,given_output='',given_delay_seconds=0,given_exit_status=0):
+    '''Writes an executable stand-in for a command line tool to given_dir:
+        it waits given_delay_seconds, prints given_output and exits with
+        given_exit_status.  Returns its path, for
+        CommandRunner.substitute_tool() (which can then time it out or
+        cancel it like the real tool).'''
+    output_path = os.path.join(given_dir,'%s.output' % given_name)
+    with open(output_path,'wb') as output_file:
+        output_file.write(given_output)
+    tool_path = os.path.join(given_dir,given_name)
+    with open(tool_path,'wb') as tool_file:
+        tool_file.write("#!/bin/sh\nsleep %s\ncat '%s'\nexit %d\n" % (given_delay_seconds,output_path,given_exit_status))
+    os.chmod(tool_path,0755)
+    return tool_path
+
+class StandInUDPServer(SocketServer.UDPServer):
+    allow_reuse_address = True
+
+class StandInTCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def serve_in_thread(given_server):
+    '''Runs the given SocketServer server on a daemon thread.  Returns the
+        server, with its loopback port (if any) in .port.'''
+    if isinstance(given_server.server_address,tuple):
+        given_server.port = given_server.server_address[1]
+    server_thread = threading.Thread(target=given_server.serve_forever,kwargs={'poll_interval':0.05})
+    server_thread.daemon = True
+    server_thread.start()
+    return given_server
+
+def udp_stand_in(given_reply_function,given_port=0):
+    '''Starts a loopback UDP server that answers each datagram with the
+        datagrams in the list given_reply_function(request) returns (None: no
+        reply).  Requests received are kept in .requests_list.'''
+    class Handler(SocketServer.BaseRequestHandler):
+        def handle(self):
+            request, server_socket = self.request
+            self.server.requests_list.append(request)
+            for reply in given_reply_function(request) or []:
+                server_socket.sendto(reply,self.client_address)
+    server = StandInUDPServer(('127.0.0.1',given_port),Handler)
+    server.requests_list = []
+    return serve_in_thread(server)
+
+def tcp_stand_in(given_connection_function,given_port=0):
+    '''Starts a loopback TCP server that calls
+        given_connection_function(connection_socket) for each connection, on
+        a thread of its own.'''
+    class Handler(SocketServer.BaseRequestHandler):
+        def handle(self):
+            given_connection_function(self.request)
+    return serve_in_thread(StandInTCPServer(('127.0.0.1',given_port),Handler))
+
+def stop_stand_in(given_server):
+    given_server.shutdown()
+    given_server.server_close()
+
+def recv_exactly(given_socket,given_length):
+    '''Reads given_length bytes from a socket, or fewer if it closes.'''
+    data = ''
+    while len(data) < given_length:
+        chunk = given_socket.recv(given_length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
@@ -0,0 +1,178 @@
+# Tests for ad-status.py's run_condition(): the DNS-SRV, dsconfigad and
+# dscl probes run against slow stand-in tools, checking each ad_status
+# outcome, that the probes overlap, and that the speculative dscl probe is
+# cancelled off network.
+
+import unittest, os, tempfile, shutil, time, plistlib
+import support
+from support import conditions_common
+
+ad_status = support.load_condition('ad-status.py')
+
+COMPUTER_ACCOUNT = 'lab-mac-01$'
+DIG_ANSWER = (';; QUESTION SECTION:\n'
+              ';_gc._tcp.example.org.\t\tIN\tSRV\n'
+              '\n'
+              ';; ANSWER SECTION:\n'
+              '_gc._tcp.example.org.\t600\tIN\tSRV\t0 100 3268 dc1.domain.example.org.\n'
+              '\n'
+              ';; Query time: 4 msec\n')
+DSCONFIGAD_BOUND = plistlib.writePlistToString({'General Info':{'Active Directory Forest':'example.org',
+                                                                'Active Directory Domain':'domain.example.org',
+                                                                'Computer Account':COMPUTER_ACCOUNT}})
+DSCL_COMPUTER_RECORD = plistlib.writePlistToString({'dsAttrTypeStandard:AppleMetaNodeLocation':['/Active Directory/EXAMPLE/domain.example.org'],
+                                                    'dsAttrTypeStandard:RecordName':[COMPUTER_ACCOUNT]})
+DSCL_NOT_FOUND = 'DS Error: -14136 (eDSRecordNotFound)\n'
+
+# Tool latencies: small with the other tests, closer to a real network
+# with CONDITIONS_BENCHMARK.
+DELAYS_DICT = support.benchmark_size({'dig':0.2,'dsconfigad':0.05,'dscl':0.2},
+                                     {'dig':1.0,'dsconfigad':0.5,'dscl':1.5})
+
+def fast_retry_budget(given_total_seconds):
+    '''A RetryBudget with short backoff, so retried probes do not make the
+        tests slow.'''
+    return SAVED_RETRY_BUDGET(given_total_seconds,0.02,0.1)
+SAVED_RETRY_BUDGET = conditions_common.RetryBudget
+
+class ADStatusTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_settings = (ad_status.AD_DNS_SRV_NATIVE,ad_status.AD_DC_CACHE,ad_status.AD_CLDAP_PING,
+                               ad_status.AD_FAILURES_HISTORY_FILE_PATH,ad_status.NTP_SERVER,ad_status.NTP_PORT,
+                               ad_status.NTP_QUERY_TIMEOUT_SECONDS,ad_status.NTP_QUERY_TRIES,ad_status.AD_REMEDIATION_SETTLE_SECONDS,
+                               conditions_common.RetryBudget)
+        ad_status.AD_DNS_SRV_NATIVE = False
+        ad_status.AD_DC_CACHE = False
+        ad_status.AD_CLDAP_PING = False
+        ad_status.AD_FAILURES_HISTORY_FILE_PATH = os.path.join(self.temp_dir,'ActiveDirectoryFailures.plist')
+        # Nothing answers SNTP here:
+        ad_status.NTP_SERVER = '127.0.0.1'
+        ad_status.NTP_PORT = 9
+        ad_status.NTP_QUERY_TIMEOUT_SECONDS = 0.1
+        ad_status.NTP_QUERY_TRIES = 1
+        ad_status.AD_REMEDIATION_SETTLE_SECONDS = 0
+        conditions_common.RetryBudget = fast_retry_budget
+        self.commands_list = []
+
+    def tearDown(self):
+        (ad_status.AD_DNS_SRV_NATIVE,ad_status.AD_DC_CACHE,ad_status.AD_CLDAP_PING,
+         ad_status.AD_FAILURES_HISTORY_FILE_PATH,ad_status.NTP_SERVER,ad_status.NTP_PORT,
+         ad_status.NTP_QUERY_TIMEOUT_SECONDS,ad_status.NTP_QUERY_TRIES,ad_status.AD_REMEDIATION_SETTLE_SECONDS,
+         conditions_common.RetryBudget) = self.saved_settings
+        shutil.rmtree(self.temp_dir)
+
+    def record_command(self,given_command_list):
+        self.commands_list.append(given_command_list)
+        return ''
+
+    def run_condition(self,given_tools_dict):
+        '''Runs ad-status with stand-ins for the given tools: a dict of tool
+            name to (output, delay_seconds, exit_status).  Returns the queued
+            conditions, the seconds taken and the CommandRunner used.'''
+        runner = support.fresh_command_runner()
+        for tool_path in ['/usr/bin/dig','/usr/sbin/dsconfigad',conditions_common.DSCL_PATH]:
+            tool_name = os.path.basename(tool_path)
+            output, delay_seconds, exit_status = given_tools_dict[tool_name]
+            runner.substitute_tool(tool_path,support.stand_in_tool(self.temp_dir,tool_name,output,delay_seconds,exit_status))
+        for tool_path in ['/usr/sbin/ntpdate','/usr/bin/defaults','/usr/bin/profiles']:
+            runner.substitute_tool(tool_path,self.record_command)
+        context = conditions_common.ConditionsContext([])
+        start_time = time.time()
+        ad_status.run_condition(context)
+        return context.conditions_writer.pending_dict, time.time() - start_time, runner
+
+    def dscl_exit_statuses(self,given_runner):
+        statuses_dict = {}
+        for command_line, stats in given_runner.stats_dict.items():
+            if command_line.startswith(conditions_common.DSCL_PATH):
+                for status, count in stats['exit_statuses'].items():
+                    statuses_dict[status] = statuses_dict.get(status,0) + count
+        return statuses_dict
+
+    def command_seconds(self,given_runner):
+        '''Returns the seconds the commands took, one after another.'''
+        return sum([stats['seconds'] for stats in given_runner.stats_dict.values()])
+
+    def test_on_network_communicating(self):
+        conditions_dict, seconds, runner = self.run_condition({'dig':(DIG_ANSWER,DELAYS_DICT['dig'],0),
+                                                               'dsconfigad':(DSCONFIGAD_BOUND,DELAYS_DICT['dsconfigad'],0),
+                                                               'dscl':(DSCL_COMPUTER_RECORD,DELAYS_DICT['dscl'],0)})
+        self.assertEqual(conditions_dict,{'ad_on_network':True,
+                                          'ad_computer_record':COMPUTER_ACCOUNT,
+                                          'ad_dscl_tests_pass':True,
+                                          'ad_status':'on-network-communicating',
+                                          'ad_dc_reachable':False,
+                                          'ad_dc_responder':'',
+                                          'ad_clock_offset_seconds':None})
+        self.assertEqual(self.dscl_exit_statuses(runner),{0:1})
+        # The dscl test ran alongside the DNS-SRV lookup:
+        self.assertTrue(seconds < self.command_seconds(runner) - min(DELAYS_DICT['dig'],DELAYS_DICT['dscl']) / 2)
+        self.assertEqual(self.commands_list,[])
+
+    def test_on_network_unbound(self):
+        conditions_dict, seconds, runner = self.run_condition({'dig':(DIG_ANSWER,DELAYS_DICT['dig'],0),
+                                                               'dsconfigad':('',DELAYS_DICT['dsconfigad'],0),
+                                                               'dscl':(DSCL_COMPUTER_RECORD,DELAYS_DICT['dscl'],0)})
+        self.assertEqual((conditions_dict['ad_status'],conditions_dict['ad_on_network'],conditions_dict['ad_computer_record']),
+                         ('on-network-unbound',True,''))
+        # Not bound: no dscl test, no remediation, one failure recorded:
+        self.assertEqual(self.dscl_exit_statuses(runner),{})
+        self.assertEqual(self.commands_list,[])
+        self.assertEqual(ad_status.dscl_failures_history().count('failure_count'),1)
+        self.assertTrue(seconds < self.command_seconds(runner))
+
+    def test_bound_but_not_communicating(self):
+        # The second failure in a row removes the dependent profiles:
+        ad_status.increment_dscl_failure_count()
+        conditions_dict, seconds, runner = self.run_condition({'dig':(DIG_ANSWER,DELAYS_DICT['dig'],0),
+                                                               'dsconfigad':(DSCONFIGAD_BOUND,DELAYS_DICT['dsconfigad'],0),
+                                                               'dscl':(DSCL_NOT_FOUND,0,56)})
+        self.assertEqual((conditions_dict['ad_status'],conditions_dict['ad_dscl_tests_pass']),('on-network-unbound',False))
+        # dscl is retried (5 tries per pass, AD_TESTS_MAX_TRIES passes):
+        self.assertEqual(self.dscl_exit_statuses(runner),{56:5 * ad_status.AD_TESTS_MAX_TRIES})
+        self.assertEqual([command_list[0] for command_list in self.commands_list],
+                         ['/usr/sbin/ntpdate','/usr/bin/defaults'] * ad_status.AD_TESTS_MAX_TRIES +
+                         ['/usr/bin/profiles'] * len(ad_status.DEPENDENT_CONFIG_PROFILE_IDENTIFIERS))
+        self.assertEqual(ad_status.dscl_failures_history().count('failure_count'),2)
+
+    def test_off_network_cancels_dscl(self):
+        # A dscl that would take far longer than the whole DNS-SRV lookup:
+        dscl_delay_seconds = 10
+        conditions_dict, seconds, runner = self.run_condition({'dig':('',DELAYS_DICT['dig'],9),
+                                                               'dsconfigad':(DSCONFIGAD_BOUND,DELAYS_DICT['dsconfigad'],0),
+                                                               'dscl':(DSCL_COMPUTER_RECORD,dscl_delay_seconds,0)})
+        self.assertEqual(conditions_dict,{'ad_on_network':False,
+                                          'ad_computer_record':COMPUTER_ACCOUNT,
+                                          'ad_dscl_tests_pass':False,
+                                          'ad_status':'not-on-network',
+                                          'ad_dc_reachable':False,
+                                          'ad_dc_responder':'',
+                                          'ad_clock_offset_seconds':None})
+        self.assertEqual(self.dscl_exit_statuses(runner),{'cancelled':1})
+        self.assertTrue(seconds < dscl_delay_seconds)
+        self.assertEqual(self.commands_list,[])
+        self.assertFalse(os.path.exists(ad_status.AD_FAILURES_HISTORY_FILE_PATH))
+
+    def test_timings(self):
+        '''Typical (bound and communicating) and worst case (bound, but
+            dscl fails every try and remediation runs) timings.'''
+        rows_list = []
+        sequential_seconds = sum(DELAYS_DICT.values())
+        for label, tools_dict in [('on-network-communicating',{'dig':(DIG_ANSWER,DELAYS_DICT['dig'],0),
+                                                               'dsconfigad':(DSCONFIGAD_BOUND,DELAYS_DICT['dsconfigad'],0),
+                                                               'dscl':(DSCL_COMPUTER_RECORD,DELAYS_DICT['dscl'],0)}),
+                                  ('not-on-network',{'dig':('',DELAYS_DICT['dig'],9),
+                                                     'dsconfigad':(DSCONFIGAD_BOUND,DELAYS_DICT['dsconfigad'],0),
+                                                     'dscl':(DSCL_COMPUTER_RECORD,DELAYS_DICT['dscl'],0)}),
+                                  ('on-network-unbound, dscl failing',{'dig':(DIG_ANSWER,DELAYS_DICT['dig'],0),
+                                                                       'dsconfigad':(DSCONFIGAD_BOUND,DELAYS_DICT['dsconfigad'],0),
+                                                                       'dscl':(DSCL_NOT_FOUND,DELAYS_DICT['dscl'],56)})]:
+            conditions_dict, seconds, runner = self.run_condition(tools_dict)
+            self.assertEqual(conditions_dict['ad_status'],label.split(',')[0])
+            rows_list.append((label,seconds))
+        support.benchmark_report('ad-status with dig %(dig)ss, dsconfigad %(dsconfigad)ss, dscl %(dscl)ss (one of each in sequence: %(total)ss)' % dict(DELAYS_DICT,total=sequential_seconds),
+                                 rows_list)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+# Tests for admin-groups.py: GroupGUIDResolver looking up group GUIDs
+# through its PlistTTLCache, with dscl replaced by a stand-in function, and
+# AdminGroupReconciler against an in-memory admin group.
+
+import unittest, os, tempfile, shutil, time, subprocess, plistlib
+import support
+from support import conditions_common
+
+admin_groups = support.load_condition('admin-groups.py')
+
+LAB_ADMINS_GUID = 'A5C2F7E0-1D3B-4E5F-8A9B-0C1D2E3F4A5B'
+PRINTER_ADMINS_GUID = 'C7E4B9A2-3F5D-4A71-8CBD-2E3F4A5B6C7D'
+OLD_ADMINS_GUID = 'D8F5CAB3-4A6E-4B82-9DCE-3F4A5B6C7D8E'
+STALE_GROUP_GUID = 'E9A6DBC4-5B7F-4C93-AEDF-4A5B6C7D8E9F'
+
+class StandInDscl(object):
+    '''Stand-in for dscl reading group GeneratedUIDs: answers from
+        groups_dict (name to GUID, or None for a group the directory does
+        not have), or fails as if the directory were unreachable if
+        unreachable.  Counts the commands it is given.'''
+    def __init__(self,given_groups_dict):
+        self.groups_dict = given_groups_dict
+        self.unreachable = False
+        self.commands_list = []
+
+    def __call__(self,given_command_list):
+        self.commands_list.append(given_command_list)
+        group_name = given_command_list[4][len('Groups/'):]
+        if self.unreachable:
+            raise subprocess.CalledProcessError(74,given_command_list,'DS Error: -14140 (eDSInvalidSession)\n')
+        if self.groups_dict.get(group_name) is None:
+            raise subprocess.CalledProcessError(56,given_command_list,'DS Error: -14136 (eDSRecordNotFound)\n')
+        return plistlib.writePlistToString({'dsAttrTypeStandard:GeneratedUID':[self.groups_dict[group_name]]})
+
+class GroupGUIDResolverTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir,'AdminGroupsGUIDCache.plist')
+        self.dscl = StandInDscl({'Lab Admins':LAB_ADMINS_GUID,'Removed Group':None})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def resolver(self,given_cache=None):
+        '''Returns a resolver for a new run: a fresh CommandRunner (nothing
+            remembered) using the stand-in dscl, and the cache as saved.'''
+        support.fresh_command_runner().substitute_tool(conditions_common.DSCL_PATH,self.dscl)
+        if given_cache is None:
+            given_cache = conditions_common.PlistTTLCache(self.cache_path,admin_groups.GUID_CACHE_VERSION,'',admin_groups.GUID_CACHE_MAX_STALE_SECONDS)
+        return admin_groups.GroupGUIDResolver(given_cache)
+
+    def cache_entry(self,given_resolver,given_group_name):
+        return given_resolver.cache.entries_dict[given_resolver.cache_key(given_group_name)]
+
+    def test_cache_hits_run_no_dscl(self):
+        resolver = self.resolver()
+        self.assertEqual(resolver.resolve('Lab Admins'),(LAB_ADMINS_GUID,False))
+        self.assertEqual(resolver.dscl_lookups,1)
+        self.assertEqual(self.dscl.commands_list,[[conditions_common.DSCL_PATH,'-plist',admin_groups.DIRECTORY_SEARCH_NODE,
+                                                   'read','Groups/Lab Admins','GeneratedUID']])
+        self.assertTrue(self.cache_entry(resolver,'Lab Admins')['expires'] > time.time() + admin_groups.GUID_CACHE_TTL_SECONDS - 60)
+        resolver.cache.save()
+        # The next run answers from the cache file:
+        resolver = self.resolver()
+        self.assertEqual(resolver.group_dict('Lab Admins'),{'name':'Lab Admins','guid':LAB_ADMINS_GUID,'guid_stale':False})
+        self.assertEqual(resolver.dscl_lookups,0)
+        self.assertEqual(len(self.dscl.commands_list),1)
+        self.assertEqual(resolver.cache.stats_dict['hits'],1)
+
+    def test_ttl_expiry(self):
+        resolver = self.resolver()
+        resolver.resolve('Lab Admins')
+        self.cache_entry(resolver,'Lab Admins')['expires'] = time.time() - 1
+        self.dscl.groups_dict['Lab Admins'] = 'B6D3A8F1-2E4C-4F60-9BAC-1D2E3F4A5B6C'
+        resolver = self.resolver(resolver.cache)
+        self.assertEqual(resolver.resolve('Lab Admins'),('B6D3A8F1-2E4C-4F60-9BAC-1D2E3F4A5B6C',False))
+        self.assertEqual(len(self.dscl.commands_list),2)
+
+    def test_negative_entries(self):
+        resolver = self.resolver()
+        self.assertEqual(resolver.resolve('Removed Group'),(None,False))
+        entry_dict = self.cache_entry(resolver,'Removed Group')
+        self.assertTrue(entry_dict['negative'])
+        self.assertTrue(time.time() + admin_groups.GUID_CACHE_NEGATIVE_TTL_SECONDS - 60 < entry_dict['expires'] <= time.time() + admin_groups.GUID_CACHE_NEGATIVE_TTL_SECONDS)
+        self.assertEqual(resolver.unresolved_names_list,[])
+        resolver.cache.save()
+        resolver = self.resolver()
+        self.assertEqual(resolver.resolve('Removed Group'),(None,False))
+        self.assertEqual(len(self.dscl.commands_list),1)
+        self.assertEqual(resolver.cache.stats_dict['negative_hits'],1)
+
+    def test_stale_entry_used_only_when_directory_unreachable(self):
+        resolver = self.resolver()
+        resolver.resolve('Lab Admins')
+        self.cache_entry(resolver,'Lab Admins')['expires'] = time.time() - 86400
+        resolver.cache.save()
+        # Unreachable (dscl found is None): the stale GUID is used.
+        self.dscl.unreachable = True
+        resolver = self.resolver()
+        self.assertEqual(resolver.group_dict('Lab Admins'),{'name':'Lab Admins','guid':LAB_ADMINS_GUID,'guid_stale':True})
+        self.assertEqual(resolver.unresolved_names_list,[])
+        # Reachable, and the group is gone (found is False): not used.
+        self.dscl.unreachable = False
+        self.dscl.groups_dict['Lab Admins'] = None
+        resolver = self.resolver()
+        self.assertEqual(resolver.resolve('Lab Admins'),(None,False))
+        self.assertTrue(self.cache_entry(resolver,'Lab Admins')['negative'])
+        self.assertEqual(resolver.unresolved_names_list,[])
+
+    def test_unresolved_without_cache_entry(self):
+        self.dscl.unreachable = True
+        resolver = self.resolver()
+        self.assertEqual(resolver.resolve('Lab Admins'),(None,False))
+        self.assertEqual(resolver.unresolved_names_list,['Lab Admins'])
+        self.assertEqual(resolver.cache.entries_dict,{})
+
+    def test_version_change_discards_cache(self):
+        resolver = self.resolver()
+        resolver.resolve('Lab Admins')
+        resolver.cache.save()
+        support.fresh_command_runner().substitute_tool(conditions_common.DSCL_PATH,self.dscl)
+        resolver = admin_groups.GroupGUIDResolver(conditions_common.PlistTTLCache(self.cache_path,admin_groups.GUID_CACHE_VERSION + 1))
+        self.assertEqual(resolver.resolve('Lab Admins'),(LAB_ADMINS_GUID,False))
+        self.assertEqual(len(self.dscl.commands_list),2)
+
+    def test_without_cache(self):
+        support.fresh_command_runner().substitute_tool(conditions_common.DSCL_PATH,self.dscl)
+        resolver = admin_groups.GroupGUIDResolver()
+        self.assertEqual(resolver.resolve('Lab Admins'),(LAB_ADMINS_GUID,False))
+        self.assertEqual(resolver.resolve('Removed Group'),(None,False))
+        self.assertEqual(resolver.dscl_lookups,2)
+
+class InMemoryAdminGroup(object):
+    '''Directory for AdminGroupReconciler: the nested group GUIDs of an
+        admin group, in memory.  Changes to the groups named in
+        failing_names_list (or GUIDs in failing_guids_list) fail.  Counts
+        reads.'''
+    def __init__(self,given_nested_guids_list):
+        self.nested_guids_list = list(given_nested_guids_list)
+        self.failing_names_list = []
+        self.failing_guids_list = []
+        self.reads = 0
+
+    def list_nested_guids(self):
+        self.reads += 1
+        return list(self.nested_guids_list)
+
+    def add_group(self,given_group_dict):
+        if given_group_dict['name'] in self.failing_names_list:
+            return False
+        self.nested_guids_list.append(given_group_dict['guid'])
+        return True
+
+    def remove_guid(self,given_group_guid):
+        if given_group_guid in self.failing_guids_list:
+            return False
+        self.nested_guids_list.remove(given_group_guid)
+        return True
+
+def group(given_name,given_guid,given_guid_stale=False):
+    return {'name':given_name,'guid':given_guid,'guid_stale':given_guid_stale}
+
+class AdminGroupReconcilerTests(unittest.TestCase):
+    def reconciler(self,given_nested_guids_list):
+        directory = InMemoryAdminGroup(given_nested_guids_list)
+        reconciler = admin_groups.AdminGroupReconciler(directory)
+        reconciler.measure()
+        return reconciler, directory
+
+    def test_plan_with_duplicate_requests(self):
+        reconciler, directory = self.reconciler([PRINTER_ADMINS_GUID,OLD_ADMINS_GUID])
+        # (dsconfigad admin groups can repeat manifest groups)
+        plan_dict = reconciler.plan([group('Lab Admins',LAB_ADMINS_GUID),group('Printer Admins',PRINTER_ADMINS_GUID),
+                                     group('lab admins',LAB_ADMINS_GUID),group('Printer Admins',PRINTER_ADMINS_GUID)])
+        self.assertEqual(plan_dict,{'add':['Lab Admins'],'remove':[OLD_ADMINS_GUID]})
+        self.assertTrue(reconciler.apply())
+        self.assertEqual(directory.nested_guids_list,[PRINTER_ADMINS_GUID,LAB_ADMINS_GUID])
+        self.assertEqual(reconciler.applied_guids('add'),[LAB_ADMINS_GUID])
+        self.assertEqual(reconciler.applied_guids('remove'),[OLD_ADMINS_GUID])
+
+    def test_stale_guids_neither_added_nor_removed(self):
+        reconciler, directory = self.reconciler([STALE_GROUP_GUID])
+        plan_dict = reconciler.plan([group('Stale Group',STALE_GROUP_GUID,True),group('Old Stale Group',OLD_ADMINS_GUID,True)])
+        # A stale GUID may be out of date: not added, but kept if nested.
+        self.assertEqual(plan_dict,{'add':[],'remove':[]})
+        self.assertTrue(reconciler.apply())
+        self.assertEqual(reconciler.mutations_list,[])
+
+    def test_no_removals_when_not_allowed(self):
+        reconciler, directory = self.reconciler([OLD_ADMINS_GUID])
+        plan_dict = reconciler.plan([group('Lab Admins',LAB_ADMINS_GUID)],False)
+        self.assertEqual(plan_dict,{'add':['Lab Admins'],'remove':[]})
+        reconciler.apply()
+        self.assertEqual(directory.nested_guids_list,[OLD_ADMINS_GUID,LAB_ADMINS_GUID])
+
+    def test_failed_mutations_leave_model_unchanged(self):
+        reconciler, directory = self.reconciler([OLD_ADMINS_GUID,STALE_GROUP_GUID])
+        directory.failing_names_list = ['Lab Admins']
+        directory.failing_guids_list = [OLD_ADMINS_GUID]
+        reconciler.plan([group('Lab Admins',LAB_ADMINS_GUID),group('Printer Admins',PRINTER_ADMINS_GUID)])
+        self.assertFalse(reconciler.apply())
+        self.assertEqual(reconciler.nested_guids_list,[OLD_ADMINS_GUID,PRINTER_ADMINS_GUID])
+        self.assertEqual(reconciler.applied_guids('add'),[PRINTER_ADMINS_GUID])
+        self.assertEqual(reconciler.applied_guids('remove'),[STALE_GROUP_GUID])
+        self.assertEqual([(m['action'],m['guid'],m['success']) for m in reconciler.mutations_list],
+                         [('add',LAB_ADMINS_GUID,False),('add',PRINTER_ADMINS_GUID,True),
+                          ('remove',OLD_ADMINS_GUID,False),('remove',STALE_GROUP_GUID,True)])
+        # The model matches the directory, so verify() agrees with it:
+        self.assertEqual(reconciler.verify(),directory.nested_guids_list)
+        self.assertTrue('FAILED' in reconciler.report())
+
+    def test_verify_reads_again_only_after_changes(self):
+        reconciler, directory = self.reconciler([LAB_ADMINS_GUID])
+        reconciler.plan([group('Lab Admins',LAB_ADMINS_GUID)])
+        self.assertTrue(reconciler.apply())
+        self.assertEqual(reconciler.verify(),[LAB_ADMINS_GUID])
+        self.assertEqual(directory.reads,1)
+        reconciler, directory = self.reconciler([OLD_ADMINS_GUID])
+        reconciler.plan([group('Lab Admins',LAB_ADMINS_GUID)])
+        reconciler.apply()
+        self.assertEqual(reconciler.verify(),[LAB_ADMINS_GUID])
+        self.assertEqual(directory.reads,2)
+        self.assertEqual(reconciler.reads,2)
+
+class StandInAdminGroupTools(StandInDscl):
+    '''Stand-in for dscl and dseditgroup: reads group GUIDs like
+        StandInDscl (failing as if unreachable for the groups in
+        unreachable_names_list), and reads and changes the admin group kept
+        in an InMemoryAdminGroup.'''
+    def __init__(self,given_groups_dict,given_admin_group):
+        StandInDscl.__init__(self,given_groups_dict)
+        self.admin_group = given_admin_group
+        self.unreachable_names_list = []
+
+    def __call__(self,given_command_list):
+        if given_command_list[0] == '/usr/sbin/dseditgroup':
+            group_name = given_command_list[4]
+            self.admin_group.add_group(group(group_name,self.groups_dict[group_name]))
+            return ''
+        if given_command_list[1:] == admin_groups.ADMIN_GROUP_READ_ARGUMENTS:
+            return plistlib.writePlistToString({'dsAttrTypeStandard:NestedGroups':self.admin_group.list_nested_guids()})
+        if given_command_list[2] == 'delete':
+            self.admin_group.remove_guid(given_command_list[-1])
+            return ''
+        if given_command_list[4][len('Groups/'):] in self.unreachable_names_list:
+            raise subprocess.CalledProcessError(74,given_command_list,'DS Error: -14140 (eDSInvalidSession)\n')
+        return StandInDscl.__call__(self,given_command_list)
+
+class RunConditionTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_guid_cache = admin_groups.GUID_CACHE
+        admin_groups.GUID_CACHE = False
+        self.admin_group = InMemoryAdminGroup([OLD_ADMINS_GUID])
+        self.tools = StandInAdminGroupTools({'Lab Admins':LAB_ADMINS_GUID,'Printer Admins':PRINTER_ADMINS_GUID},self.admin_group)
+        runner = support.fresh_command_runner()
+        runner.substitute_tool(conditions_common.DSCL_PATH,self.tools)
+        runner.substitute_tool('/usr/sbin/dseditgroup',self.tools)
+
+    def tearDown(self):
+        admin_groups.GUID_CACHE = self.saved_guid_cache
+
+    def run_condition(self,given_group_names_list):
+        context = conditions_common.ConditionsContext([])
+        context.computed_dict['effective_manifest_metadata'] = {'nested_admin_groups':given_group_names_list,
+                                                                'exclude_admins_from_dsconfigad':True}
+        admin_groups.run_condition(context)
+        return context.conditions_writer.pending_dict
+
+    def test_reconciles(self):
+        conditions_dict = self.run_condition(['Lab Admins','Printer Admins'])
+        self.assertEqual(conditions_dict,{'admin_groups_success':True,
+                                          'nested_admin_group_guids':[LAB_ADMINS_GUID,PRINTER_ADMINS_GUID],
+                                          'admin_groups_added_guids':[LAB_ADMINS_GUID,PRINTER_ADMINS_GUID],
+                                          'admin_groups_removed_guids':[OLD_ADMINS_GUID]})
+        # One read before the changes, one after:
+        self.assertEqual(self.admin_group.reads,2)
+
+    def test_unresolved_names_prevent_removals(self):
+        self.tools.unreachable_names_list = ['Printer Admins']
+        conditions_dict = self.run_condition(['Lab Admins','Printer Admins'])
+        # Printer Admins' GUID could be the nested one; nothing is removed.
+        self.assertEqual(conditions_dict['admin_groups_removed_guids'],[])
+        self.assertEqual(conditions_dict['admin_groups_added_guids'],[LAB_ADMINS_GUID])
+        self.assertEqual(self.admin_group.nested_guids_list,[OLD_ADMINS_GUID,LAB_ADMINS_GUID])
+
+if __name__ == '__main__':
+    unittest.main()
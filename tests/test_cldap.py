@@ -0,0 +1,118 @@
+# Tests for the CLDAP netlogon ping in ad-status.py: request building,
+# reply parsing, and pings to a stand-in domain controller on the loopback.
+
+import unittest, struct, socket, time
+import support
+from support import conditions_common as ber
+
+ad_status = support.load_condition('ad-status.py')
+
+def netlogon_value(given_forest='example.org',given_domain='domain.example.org',given_host='dc1.domain.example.org',given_opcode=23):
+    '''Builds a NETLOGON_SAM_LOGON_RESPONSE_EX whose domain and host names
+        end in compression pointers to the forest name.'''
+    value = struct.pack('<HHI',given_opcode,0,0x000003FD) + '\x11' * 16
+    forest_offset = len(value)
+    value += ''.join([struct.pack('!B',len(label)) + label for label in given_forest.split('.')]) + '\x00'
+    for name in [given_domain,given_host]:
+        labels_list = [label for label in name[:-len(given_forest)].split('.') if label]
+        value += ''.join([struct.pack('!B',len(label)) + label for label in labels_list]) + struct.pack('!H',0xC000 | forest_offset)
+    for name in ['DOMAIN','DC1','','Main-Site','Main-Site']:
+        value += (struct.pack('!B',len(name)) + name if name else '') + '\x00'
+    return value
+
+def cldap_reply(given_message_id,given_netlogon_value):
+    '''Builds a searchResEntry carrying the Netlogon attribute, followed by
+        searchResDone, in one datagram as domain controllers send them.'''
+    entry = ber.ber_encode_sequence([ber.ber_encode_string(''),
+                                     ber.ber_encode_sequence([
+                                         ber.ber_encode_sequence([ber.ber_encode_string('Netlogon'),
+                                                                  ber.ber_encode_sequence([ber.ber_encode_string(given_netlogon_value)],0x31)])])],0x64)
+    done = ber.ber_encode_sequence([ber.ber_encode_integer(0,0x0A),ber.ber_encode_string(''),ber.ber_encode_string('')],0x65)
+    return ber.ber_encode_sequence([ber.ber_encode_integer(given_message_id),entry]) + \
+        ber.ber_encode_sequence([ber.ber_encode_integer(given_message_id),done])
+
+def ping_message_id(given_ping):
+    return ber.ber_decode_integer(ber.ber_decode_all(ber.ber_decode(given_ping)[1])[0][1])
+
+class CLDAPMessageTests(unittest.TestCase):
+    def test_build_ping(self):
+        ping = ad_status.cldap_build_netlogon_ping('domain.example.org',42)
+        tag, ldap_message, offset = ber.ber_decode(ping)
+        self.assertEqual((tag,offset),(0x30,len(ping)))
+        elements_list = ber.ber_decode_all(ldap_message)
+        self.assertEqual(ber.ber_decode_integer(elements_list[0][1]),42)
+        self.assertEqual(elements_list[1][0],0x63)
+        request_list = ber.ber_decode_all(elements_list[1][1])
+        self.assertEqual(request_list[0],(0x04,''))
+        filters_list = [[value for value_tag, value in ber.ber_decode_all(item)] for item_tag, item in ber.ber_decode_all(request_list[6][1])]
+        self.assertEqual(filters_list,[['DnsDomain','domain.example.org'],['NtVer','\x06\x00\x00\x00']])
+        self.assertEqual(ber.ber_decode_all(request_list[7][1]),[(0x04,'Netlogon')])
+
+    def test_parse_reply(self):
+        value = netlogon_value()
+        self.assertEqual(ad_status.cldap_parse_netlogon_response(cldap_reply(42,value),42),value)
+        netlogon_dict = ad_status.cldap_parse_netlogon(value)
+        self.assertEqual(netlogon_dict,{'flags':0x000003FD,
+                                        'forest':'example.org',
+                                        'domain':'domain.example.org',
+                                        'host':'dc1.domain.example.org',
+                                        'netbios_domain':'DOMAIN',
+                                        'netbios_host':'DC1',
+                                        'site':'Main-Site',
+                                        'client_site':'Main-Site'})
+
+    def test_parse_rejects_bad_replies(self):
+        reply = cldap_reply(42,netlogon_value())
+        self.assertRaises(ValueError,ad_status.cldap_parse_netlogon_response,reply,43)
+        self.assertRaises(ValueError,ad_status.cldap_parse_netlogon_response,reply[:-10],42)
+        self.assertRaises(ValueError,ad_status.cldap_parse_netlogon_response,'\x04\x00',42)
+        self.assertRaises(ValueError,ad_status.cldap_parse_netlogon,netlogon_value(given_opcode=19))
+        self.assertRaises(ValueError,ad_status.cldap_parse_netlogon,netlogon_value()[:30])
+
+    def test_reply_without_netlogon(self):
+        done = ber.ber_encode_sequence([ber.ber_encode_integer(42),
+                                        ber.ber_encode_sequence([ber.ber_encode_integer(0,0x0A),ber.ber_encode_string(''),ber.ber_encode_string('')],0x65)])
+        self.assertEqual(ad_status.cldap_parse_netlogon_response(done,42),None)
+
+class CLDAPPingTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_port = ad_status.CLDAP_PORT
+        self.server = None
+
+    def tearDown(self):
+        ad_status.CLDAP_PORT = self.saved_port
+        if self.server:
+            support.stop_stand_in(self.server)
+
+    def domain_controller(self,given_netlogon_value):
+        self.server = support.udp_stand_in(lambda ping: [cldap_reply(ping_message_id(ping),given_netlogon_value)])
+        ad_status.CLDAP_PORT = self.server.port
+
+    def test_ping(self):
+        self.domain_controller(netlogon_value())
+        netlogon_dict = ad_status.cldap_ping_domain_controllers(['127.0.0.1'],'example.org','domain.example.org',1.0)
+        self.assertEqual(netlogon_dict['host'],'dc1.domain.example.org')
+        self.assertEqual(netlogon_dict['site'],'Main-Site')
+        self.assertEqual(netlogon_dict['dc_host'],'127.0.0.1')
+        self.assertTrue(0 <= netlogon_dict['rtt_seconds'] < 1.0)
+        self.assertEqual(len(self.server.requests_list),1)
+
+    def test_dc_of_another_domain(self):
+        self.domain_controller(netlogon_value('other.org','other.org','dc1.other.org'))
+        start_time = time.time()
+        self.assertEqual(ad_status.cldap_ping_domain_controllers(['127.0.0.1'],'example.org','domain.example.org',0.3),None)
+        self.assertTrue(time.time() - start_time < 1.0)
+
+    def test_no_domain_controller(self):
+        # A closed port; waits no longer than the timeout.
+        closed_socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        closed_socket.bind(('127.0.0.1',0))
+        ad_status.CLDAP_PORT = closed_socket.getsockname()[1]
+        closed_socket.close()
+        start_time = time.time()
+        self.assertEqual(ad_status.cldap_ping_domain_controllers(['127.0.0.1'],'example.org','domain.example.org',0.3),None)
+        self.assertTrue(time.time() - start_time < 1.0)
+        self.assertEqual(ad_status.cldap_ping_domain_controllers([],'example.org','domain.example.org',0.3),None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+# Tests for conditions_common.CommandRunner: remembered output and
+# failures, one run of a command line at a time, timeouts, invalidation by
+# command prefix, substituted tools, and report().  Tools are replaced by
+# stand-in functions (or, to be timed out, a stand-in executable).
+
+import unittest, os, tempfile, shutil, time, threading, subprocess
+import support
+from support import conditions_common
+
+LPOPTIONS = '/usr/bin/lpoptions'
+IOREG = '/usr/sbin/ioreg'
+
+class StandInTool(object):
+    '''Stand-in tool function: after delay_seconds, returns output, or
+        raises CalledProcessError with exit_status if it is not 0.  Keeps the
+        commands it is given in commands_list, and the most it ran at once
+        in most_running.'''
+    def __init__(self,given_output='',given_delay_seconds=0,given_exit_status=0):
+        self.output = given_output
+        self.delay_seconds = given_delay_seconds
+        self.exit_status = given_exit_status
+        self.commands_list = []
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self,given_command_list):
+        with self.lock:
+            self.commands_list.append(given_command_list)
+            self.running += 1
+            self.most_running = max(self.most_running,self.running)
+        try:
+            time.sleep(self.delay_seconds)
+            if self.exit_status:
+                raise subprocess.CalledProcessError(self.exit_status,given_command_list,'%s: failed\n' % given_command_list[0])
+            return self.output
+        finally:
+            with self.lock:
+                self.running -= 1
+
+def run_in_threads(given_function,given_count):
+    '''Calls given_function() on given_count threads at once.  Returns the
+        results (or exceptions raised) in thread order.'''
+    results_list = [None] * given_count
+    def run(i):
+        try:
+            results_list[i] = given_function()
+        except Exception, error:
+            results_list[i] = error
+    threads_list = [threading.Thread(target=run,args=(i,)) for i in range(given_count)]
+    for thread in threads_list:
+        thread.start()
+    for thread in threads_list:
+        thread.join()
+    return results_list
+
+class CommandRunnerTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.runner = conditions_common.CommandRunner()
+        self.lpoptions = StandInTool('device-uri=lpd://10.0.0.5/queue\n')
+        self.runner.substitute_tool(LPOPTIONS,self.lpoptions)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_memoized(self):
+        for i in range(3):
+            self.assertEqual(self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True),self.lpoptions.output)
+        self.runner.check_output([LPOPTIONS,'-p','b'],given_memoize=True)
+        self.assertEqual(self.lpoptions.commands_list,[[LPOPTIONS,'-p','a'],[LPOPTIONS,'-p','b']])
+        stats = self.runner.stats_dict['%s -p a' % LPOPTIONS]
+        self.assertEqual((stats['calls'],stats['memoized'],stats['exit_statuses']),(3,2,{0:3}))
+        # Without given_memoize, the command runs every time:
+        self.runner.check_output([LPOPTIONS,'-p','a'])
+        self.runner.check_output([LPOPTIONS,'-p','a'])
+        self.assertEqual(len(self.lpoptions.commands_list),4)
+
+    def test_memoized_output_kept(self):
+        # Callers get the first output until it is invalidated:
+        self.lpoptions.output = 'first\n'
+        self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True)
+        self.lpoptions.output = 'second\n'
+        self.assertEqual(self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True),'first\n')
+        self.assertEqual(self.runner.check_output([LPOPTIONS,'-p','a']),'second\n')
+
+    def test_memoized_failure(self):
+        self.lpoptions.exit_status = 1
+        errors_list = []
+        for i in range(2):
+            with self.assertRaises(subprocess.CalledProcessError) as context:
+                self.runner.check_output([LPOPTIONS,'-p','missing'],given_memoize=True)
+            errors_list.append(context.exception)
+        self.assertTrue(errors_list[0] is errors_list[1])
+        self.assertEqual((errors_list[0].returncode,errors_list[0].output),(1,'%s: failed\n' % LPOPTIONS))
+        self.assertEqual(len(self.lpoptions.commands_list),1)
+        stats = self.runner.stats_dict['%s -p missing' % LPOPTIONS]
+        self.assertEqual((stats['calls'],stats['memoized'],stats['exit_statuses']),(2,1,{1:2}))
+
+    def test_one_run_per_command_line(self):
+        self.lpoptions.delay_seconds = 0.2
+        start_time = time.time()
+        results_list = run_in_threads(lambda: self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True),8)
+        self.assertEqual(results_list,[self.lpoptions.output] * 8)
+        self.assertEqual(len(self.lpoptions.commands_list),1)
+        self.assertEqual(self.runner.stats_dict['%s -p a' % LPOPTIONS]['memoized'],7)
+        self.assertTrue(time.time() - start_time < 1)
+        # Different command lines do not wait for each other:
+        names_list = list('bcdefgh')
+        start_time = time.time()
+        run_in_threads(lambda: self.runner.check_output([LPOPTIONS,'-p',names_list.pop()],given_memoize=True),len(names_list))
+        self.assertEqual(len(self.lpoptions.commands_list),8)
+        self.assertTrue(self.lpoptions.most_running > 1)
+        self.assertTrue(time.time() - start_time < 7 * self.lpoptions.delay_seconds)
+
+    def test_timeout(self):
+        slow_tool_path = support.stand_in_tool(self.temp_dir,'ioreg','never printed',10)
+        self.runner.substitute_tool(IOREG,slow_tool_path)
+        for i in range(2):
+            start_time = time.time()
+            with self.assertRaises(conditions_common.CommandTimeoutError) as context:
+                self.runner.check_output([IOREG,'-l'],0.2,given_memoize=True)
+            self.assertTrue(time.time() - start_time < 5)
+            self.assertEqual(context.exception.cmd,[slow_tool_path,'-l'])
+        # Timeouts are not remembered; each try ran (and timed out):
+        self.assertEqual(self.runner.stats_dict['%s -l' % IOREG]['exit_statuses'],{'timeout':2})
+        self.assertEqual(self.runner.stats_dict['%s -l' % IOREG]['memoized'],0)
+        # The runner's own timeout applies when none is given:
+        runner = conditions_common.CommandRunner(0.2)
+        runner.substitute_tool(IOREG,slow_tool_path)
+        self.assertRaises(conditions_common.CommandTimeoutError,runner.check_output,[IOREG,'-l'])
+
+    def test_command_timeouts(self):
+        runner = conditions_common.CommandRunner()
+        self.assertEqual(runner.command_timeout([IOREG,'-l']),conditions_common.COMMAND_TOOL_TIMEOUTS_SECONDS[IOREG])
+        self.assertEqual(runner.command_timeout([conditions_common.DSCL_PATH,'-plist','/Search','read','Users/root']),
+                         conditions_common.DSCL_COMMAND_TIMEOUT_SECONDS)
+        self.assertEqual(runner.command_timeout(['/usr/bin/true']),conditions_common.COMMAND_TIMEOUT_SECONDS)
+        self.assertEqual(conditions_common.CommandRunner(5).command_timeout([IOREG,'-l']),5)
+
+    def test_invalidate(self):
+        for name in ['a','ab','b']:
+            self.runner.check_output([LPOPTIONS,'-p',name],given_memoize=True)
+        # A prefix matches whole arguments (not -p ab for -p a):
+        self.runner.invalidate([[LPOPTIONS,'-p','a']])
+        self.assertEqual(self.runner.invalidated,1)
+        for name in ['a','ab','b']:
+            self.runner.check_output([LPOPTIONS,'-p',name],given_memoize=True)
+        self.assertEqual([command_list[2] for command_list in self.lpoptions.commands_list],['a','ab','b','a'])
+        self.runner.invalidate([[LPOPTIONS,'-p','b'],['/usr/bin/other']])
+        self.assertEqual(self.runner.invalidated,2)
+        self.runner.invalidate([[LPOPTIONS]])
+        self.assertEqual(self.runner.invalidated,4)
+        self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True)
+        self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True)
+        self.runner.invalidate()
+        self.assertEqual((self.runner.invalidated,self.runner.memo_dict),(5,{}))
+
+    def test_commands_invalidate(self):
+        lpadmin = StandInTool()
+        self.runner.substitute_tool('/usr/sbin/lpadmin',lpadmin)
+        self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True)
+        self.runner.check_output([LPOPTIONS,'-p','b'],given_memoize=True)
+        self.runner.check_call(['/usr/sbin/lpadmin','-p','a','-E'],given_invalidates=[[LPOPTIONS,'-p','a']])
+        self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True)
+        self.runner.check_output([LPOPTIONS,'-p','b'],given_memoize=True)
+        self.assertEqual([command_list[2] for command_list in self.lpoptions.commands_list],['a','b','a'])
+        # Even if the command fails:
+        lpadmin.exit_status = 1
+        self.assertRaises(subprocess.CalledProcessError,self.runner.check_call,['/usr/sbin/lpadmin','-p','b','-E'],
+                          None,None,[[LPOPTIONS,'-p','b']])
+        self.runner.check_output([LPOPTIONS,'-p','b'],given_memoize=True)
+        self.assertEqual(len(self.lpoptions.commands_list),4)
+
+    def test_substitute_tool(self):
+        self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True)
+        # A new substitute forgets the tool's remembered output:
+        other_lpoptions = StandInTool('device-uri=lpd://10.0.0.6/queue\n')
+        self.runner.substitute_tool(LPOPTIONS,other_lpoptions)
+        self.assertEqual(self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True),other_lpoptions.output)
+        self.assertEqual(other_lpoptions.commands_list,[[LPOPTIONS,'-p','a']])
+        # An executable substitute is given the command's arguments:
+        tool_path = support.stand_in_tool(self.temp_dir,'lpoptions','device-uri=ipp://10.0.0.7/queue\n')
+        self.runner.substitute_tool(LPOPTIONS,tool_path)
+        self.assertEqual(self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True),'device-uri=ipp://10.0.0.7/queue\n')
+        self.assertEqual(self.runner.stats_dict['%s -p a' % LPOPTIONS]['calls'],3)
+        # So is dscl's (instead of running it in the session):
+        dscl = StandInTool('<plist/>\n')
+        self.runner.substitute_tool(conditions_common.DSCL_PATH,dscl)
+        self.runner.check_output([conditions_common.DSCL_PATH,'-plist','/Search','read','Users/root'])
+        self.assertEqual(dscl.commands_list,[[conditions_common.DSCL_PATH,'-plist','/Search','read','Users/root']])
+
+    def test_report(self):
+        self.lpoptions.delay_seconds = 0.05
+        self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True)
+        self.runner.check_output([LPOPTIONS,'-p','a'],given_memoize=True)
+        self.lpoptions.exit_status = 2
+        self.lpoptions.delay_seconds = 0
+        self.assertRaises(subprocess.CalledProcessError,self.runner.check_output,[LPOPTIONS,'-p','b'])
+        self.runner.invalidate()
+        lines_list = self.runner.report().split('\n')
+        self.assertEqual(lines_list[0],'Commands: 2 runs, 1 remembered results used, 1 invalidated.')
+        # Slowest first:
+        self.assertTrue(lines_list[1].startswith('  %s -p a: 2 calls (1 remembered), 0.' % LPOPTIONS))
+        self.assertTrue(lines_list[1].endswith('exit 0 x2'))
+        self.assertTrue(lines_list[2].startswith('  %s -p b: 1 calls (0 remembered), ' % LPOPTIONS))
+        self.assertTrue(lines_list[2].endswith('exit 2 x1'))
+        self.assertEqual(len(lines_list),3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# Tests for conditions_runner.py: running condition scripts from a
+# temporary conditions directory on a pool of threads.
+
+import unittest, os, tempfile, shutil, threading
+import support
+import conditions_runner
+
+GOOD_CONDITION = '''
+import time
+def run_condition(given_context):
+    time.sleep(0.05)
+    given_context.write_conditions({%(key)r:True})
+'''
+
+FAILING_CONDITION = '''
+def run_condition(given_context):
+    raise RuntimeError('condition failed')
+'''
+
+BROKEN_CONDITION = '''
+def run_condition(given_context)
+    pass
+'''
+
+class ConditionsRunnerTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_settings = (conditions_runner.CONDITIONS_SCRIPTS_DIR,conditions_runner.load_condition_module)
+        conditions_runner.CONDITIONS_SCRIPTS_DIR = self.temp_dir
+        self.loads_list = []
+        def counting_load(given_script_name):
+            self.loads_list.append((given_script_name,threading.current_thread().name))
+            return self.saved_settings[1](given_script_name)
+        conditions_runner.load_condition_module = counting_load
+        support.fresh_command_runner()
+
+    def tearDown(self):
+        conditions_runner.CONDITIONS_SCRIPTS_DIR, conditions_runner.load_condition_module = self.saved_settings
+        shutil.rmtree(self.temp_dir)
+
+    def write_script(self,given_script_name,given_source):
+        with open(os.path.join(self.temp_dir,given_script_name),'w') as script_file:
+            script_file.write(given_source)
+
+    def test_threads(self):
+        self.write_script('first.py',GOOD_CONDITION % {'key':'first_ran'})
+        self.write_script('second.py',GOOD_CONDITION % {'key':'second_ran'})
+        self.write_script('failing.py',FAILING_CONDITION)
+        self.write_script('broken.py',BROKEN_CONDITION)
+        context = support.conditions_common.ConditionsContext([])
+        script_names_list = ['first.py','broken.py','second.py','failing.py','missing.py']
+        results_list = conditions_runner.run_conditions(script_names_list,context,4,False)
+        self.assertEqual([(r['name'],r['success']) for r in results_list],[('first.py',True),('broken.py',False),('second.py',True),
+                                                                           ('failing.py',False),('missing.py',False)])
+        self.assertEqual(context.conditions_writer.pending_dict,{'first_ran':True,'second_ran':True})
+        # Each script is imported once, before the pool starts; the ones
+        # that failed to import are not tried again from pool threads:
+        self.assertEqual(sorted(self.loads_list),sorted([(script_name,threading.current_thread().name) for script_name in script_names_list]))
+
+    def test_dependencies_run_first(self):
+        self.write_script('base.py',GOOD_CONDITION % {'key':'base_ran'})
+        self.write_script('dependent.py','def run_condition(given_context):\n    given_context.write_conditions({"saw_base":"base_ran" in given_context.conditions_writer.pending_dict})\n')
+        saved_dependencies_dict = conditions_runner.CONDITION_DEPENDENCIES
+        conditions_runner.CONDITION_DEPENDENCIES = {'dependent.py':['base.py']}
+        try:
+            context = support.conditions_common.ConditionsContext([])
+            conditions_runner.run_conditions(['dependent.py','base.py'],context,2,False)
+        finally:
+            conditions_runner.CONDITION_DEPENDENCIES = saved_dependencies_dict
+        self.assertEqual(context.conditions_writer.pending_dict,{'base_ran':True,'saw_base':True})
+
+if __name__ == '__main__':
+    unittest.main()
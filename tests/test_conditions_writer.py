@@ -0,0 +1,132 @@
+# Tests for conditions_common.ConditionsWriter and write_conditions(), and
+# a benchmark of writing conditions one key at a time against one batched
+# flush.
+
+import unittest, os, tempfile, shutil, datetime, plistlib
+import support
+from support import conditions_common
+
+class ConditionsWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir,'ConditionalItems.plist')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def flush(self,given_dict):
+        conditions_writer = conditions_common.ConditionsWriter(self.path,False)
+        conditions_writer.update(given_dict)
+        return conditions_writer.flush()
+
+    def read_conditions(self):
+        return plistlib.readPlist(self.path)
+
+    def test_merges_into_the_file(self):
+        plistlib.writePlist({'munki_key':'kept','ad_status':'not-on-network'},self.path)
+        self.assertTrue(self.flush({'ad_status':'on-network-communicating','ad_on_network':True}))
+        self.assertEqual(self.read_conditions(),{'munki_key':'kept','ad_status':'on-network-communicating','ad_on_network':True})
+
+    def test_unchanged_content_is_not_written(self):
+        self.assertTrue(self.flush({'ad_status':'on-network-communicating','admin_groups_added_guids':[]}))
+        os.utime(self.path,(1000000000,1000000000))
+        self.assertFalse(self.flush({'admin_groups_added_guids':[],'ad_status':'on-network-communicating'}))
+        self.assertEqual(os.stat(self.path).st_mtime,1000000000)
+        # Nothing queued, nothing written:
+        self.assertFalse(conditions_common.ConditionsWriter(self.path,False).flush())
+
+    def test_replaced_atomically(self):
+        self.flush({'ad_status':'not-on-network'})
+        old_inode = os.stat(self.path).st_ino
+        with open(self.path,'rb') as old_file:
+            self.assertTrue(self.flush({'ad_status':'on-network-unbound'}))
+            # A reader of the old file still sees the whole old file:
+            self.assertEqual(plistlib.readPlist(old_file),{'ad_status':'not-on-network'})
+        self.assertNotEqual(os.stat(self.path).st_ino,old_inode)
+        self.assertEqual(self.read_conditions(),{'ad_status':'on-network-unbound'})
+        # No temporary files are left behind:
+        self.assertEqual(os.listdir(self.temp_dir),['ConditionalItems.plist'])
+
+    def test_none_removes_the_key(self):
+        self.flush({'ad_status':'on-network-unbound','ad_clock_offset_seconds':412.5})
+        self.assertTrue(self.flush({'ad_status':'on-network-communicating','ad_clock_offset_seconds':None}))
+        self.assertEqual(self.read_conditions(),{'ad_status':'on-network-communicating'})
+        # Removing a key that is not there changes nothing:
+        self.assertFalse(self.flush({'ad_clock_offset_seconds':None}))
+
+    def test_unwritable_value_is_dropped(self):
+        self.flush({'system_hw_bundle_oct_2013':True})
+        self.assertTrue(self.flush({'ad_status':'on-network-communicating',
+                                    'managed_print_queues':[{'name':'lab_printer','bad':object()}],
+                                    7:'not a string key',
+                                    'system_manufacture_date':datetime.datetime(2014,3,2)}))
+        self.assertEqual(self.read_conditions(),{'system_hw_bundle_oct_2013':True,
+                                                 'ad_status':'on-network-communicating',
+                                                 'system_manufacture_date':datetime.datetime(2014,3,2)})
+
+    def test_corrupt_existing_file(self):
+        for existing_data in ['<?xml version="1.0"?><plist><dict><key>ad_status</key>',
+                              plistlib.writePlistToString(['not','a','dict']),
+                              '']:
+            with open(self.path,'wb') as conditions_file:
+                conditions_file.write(existing_data)
+            self.assertTrue(self.flush({'ad_status':'not-on-network'}))
+            self.assertEqual(self.read_conditions(),{'ad_status':'not-on-network'})
+
+    def test_write_conditions(self):
+        saved_settings = (conditions_common.MUNKI_CONDITIONS_PATH,conditions_common.CONDITIONS_WRITE_FSYNC)
+        conditions_common.MUNKI_CONDITIONS_PATH = self.path
+        conditions_common.CONDITIONS_WRITE_FSYNC = True
+        try:
+            conditions_common.write_conditions({'ad_status':'not-on-network'})
+            conditions_common.write_conditions({'ad_on_network':False})
+        finally:
+            conditions_common.MUNKI_CONDITIONS_PATH, conditions_common.CONDITIONS_WRITE_FSYNC = saved_settings
+        self.assertEqual(self.read_conditions(),{'ad_status':'not-on-network','ad_on_network':False})
+
+class ConditionsWriterBenchmark(unittest.TestCase):
+    '''Writing each key as it is produced rewrites the whole file each time;
+        a batched flush writes it once.'''
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_settings = (conditions_common.MUNKI_CONDITIONS_PATH,conditions_common.CONDITIONS_WRITE_FSYNC)
+        conditions_common.MUNKI_CONDITIONS_PATH = os.path.join(self.temp_dir,'ConditionalItems.plist')
+        conditions_common.CONDITIONS_WRITE_FSYNC = False
+
+    def tearDown(self):
+        conditions_common.MUNKI_CONDITIONS_PATH, conditions_common.CONDITIONS_WRITE_FSYNC = self.saved_settings
+        shutil.rmtree(self.temp_dir)
+
+    def conditions(self,given_count):
+        return [('condition_%04d' % i,{'value':i,'names':['a','b','c']}) for i in range(given_count)]
+
+    def per_key_seconds(self,given_count):
+        def write_each():
+            os.unlink(conditions_common.MUNKI_CONDITIONS_PATH)
+            for key, value in self.conditions(given_count):
+                conditions_common.write_conditions({key:value})
+        conditions_common.write_conditions({'start':True})
+        return support.best_time(write_each,1)
+
+    def batched_seconds(self,given_count):
+        def write_batch():
+            os.unlink(conditions_common.MUNKI_CONDITIONS_PATH)
+            conditions_writer = conditions_common.ConditionsWriter()
+            for key, value in self.conditions(given_count):
+                conditions_writer.update({key:value})
+            conditions_writer.flush()
+        conditions_common.write_conditions({'start':True})
+        return support.best_time(write_batch)
+
+    def test_batched_flush(self):
+        count = support.benchmark_size(50,300)
+        per_key_seconds = self.per_key_seconds(count)
+        batched_seconds = self.batched_seconds(count)
+        self.assertEqual(len(plistlib.readPlist(conditions_common.MUNKI_CONDITIONS_PATH)),count)
+        self.assertTrue(batched_seconds < per_key_seconds)
+        support.benchmark_report('Writing %d conditions (no fsync)' % count,
+                                 [('write_conditions() per key',per_key_seconds),
+                                  ('ConditionsWriter, one flush',batched_seconds)])
+
+if __name__ == '__main__':
+    unittest.main()
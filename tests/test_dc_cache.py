@@ -0,0 +1,176 @@
+# Tests for ad-status.py's domain controller cache: lookup_dns_srv_cached()
+# and cldap_dc_hosts() with a conditions_common.PlistTTLCache in a
+# temporary directory, and the DC ordering kept by record_dc_rtt().
+
+import unittest, os, tempfile, shutil, time
+import support
+from support import conditions_common
+
+ad_status = support.load_condition('ad-status.py')
+
+FOREST = 'example.org'
+DOMAIN = 'domain.example.org'
+
+def srv_record(given_target,given_ttl):
+    return {'name':'_gc._tcp.%s' % FOREST,'target':given_target,'port':3268,'priority':0,'weight':100,'ttl':given_ttl}
+
+class DCCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir,'ActiveDirectoryDCCache.plist')
+        self.saved_settings = (ad_status.DNS_RESOLV_CONF_PATH,ad_status.lookup_dns_srv,ad_status.dns_query_srv)
+        ad_status.DNS_RESOLV_CONF_PATH = os.path.join(self.temp_dir,'resolv.conf')
+        self.write_resolv_conf('search example.org\nnameserver 10.0.0.53\n')
+        # Stand-in lookups, counting their calls:
+        self.lookup_result = (True,[srv_record('dc1.%s' % DOMAIN,600),srv_record('dc2.%s' % DOMAIN,300)])
+        self.lookups = 0
+        def counting_lookup_dns_srv(given_forest,given_domain,given_budget=None):
+            self.lookups += 1
+            return self.lookup_result
+        ad_status.lookup_dns_srv = counting_lookup_dns_srv
+        self.ldap_queries_list = []
+        def counting_dns_query_srv(given_name,given_nameservers_list=None,given_timeout_seconds=None):
+            self.ldap_queries_list.append(given_name)
+            return [srv_record('dc3.%s' % DOMAIN,900)]
+        ad_status.dns_query_srv = counting_dns_query_srv
+
+    def tearDown(self):
+        ad_status.DNS_RESOLV_CONF_PATH, ad_status.lookup_dns_srv, ad_status.dns_query_srv = self.saved_settings
+        shutil.rmtree(self.temp_dir)
+
+    def write_resolv_conf(self,given_data):
+        with open(ad_status.DNS_RESOLV_CONF_PATH,'w') as resolv_conf_file:
+            resolv_conf_file.write(given_data)
+
+    def dc_cache(self):
+        return conditions_common.PlistTTLCache(self.cache_path,ad_status.AD_DC_CACHE_VERSION,ad_status.dns_network_signature())
+
+    def lookup(self,given_dc_cache):
+        return ad_status.lookup_dns_srv_cached(FOREST,DOMAIN,None,given_dc_cache)
+
+    def gc_entry(self,given_dc_cache):
+        return given_dc_cache.entries_dict['srv:_gc._tcp.%s' % FOREST]
+
+    def test_cached_for_the_lowest_record_ttl(self):
+        self.lookup_result = (True,[srv_record('dc1.%s' % DOMAIN,240),srv_record('dc2.%s' % DOMAIN,120)])
+        dc_cache = self.dc_cache()
+        before_time = time.time()
+        self.assertEqual(self.lookup(dc_cache),self.lookup_result)
+        self.assertTrue(before_time + 120 <= self.gc_entry(dc_cache)['expires'] <= time.time() + 120)
+        self.assertEqual(self.lookup(dc_cache),self.lookup_result)
+        self.assertEqual(self.lookups,1)
+        # Once the records' TTL has passed, DNS is asked again:
+        self.gc_entry(dc_cache)['expires'] = time.time() - 1
+        self.assertEqual(self.lookup(dc_cache),self.lookup_result)
+        self.assertEqual(self.lookups,2)
+        self.assertEqual(dc_cache.stats_dict['hits'],1)
+
+    def test_ttl_capped(self):
+        self.lookup_result = (True,[srv_record('dc1.%s' % DOMAIN,86400)])
+        dc_cache = self.dc_cache()
+        self.lookup(dc_cache)
+        self.assertTrue(self.gc_entry(dc_cache)['expires'] <= time.time() + ad_status.AD_DC_CACHE_MAX_TTL_SECONDS)
+        self.assertTrue(self.gc_entry(dc_cache)['expires'] > time.time() + ad_status.AD_DC_CACHE_MAX_TTL_SECONDS - 60)
+        # No longer than an off-network result:
+        self.assertEqual(ad_status.AD_DC_CACHE_MAX_TTL_SECONDS,ad_status.AD_DC_CACHE_NEGATIVE_TTL_SECONDS)
+
+    def test_same_resolvers_on_another_network(self):
+        # A positive answer cannot be told apart from one for another network
+        # with the same resolv.conf (e.g. a VPN or site using the same DNS
+        # servers), so it is reused only for the capped TTL:
+        self.lookup_result = (True,[srv_record('dc1.%s' % DOMAIN,86400)])
+        dc_cache = self.dc_cache()
+        self.lookup(dc_cache)
+        dc_cache.save()
+        # Moved to another network with the same resolvers, now off the
+        # domain's network:
+        self.lookup_result = (False,[])
+        dc_cache = self.dc_cache()
+        self.assertFalse(dc_cache.stats_dict['invalidated'])
+        self.assertEqual(self.lookup(dc_cache)[0],True)
+        self.assertEqual(self.lookups,1)
+        # Once the capped TTL has passed, DNS is asked again:
+        self.assertTrue(self.gc_entry(dc_cache)['expires'] <= time.time() + ad_status.AD_DC_CACHE_NEGATIVE_TTL_SECONDS)
+        self.gc_entry(dc_cache)['expires'] = time.time() - 1
+        self.assertEqual(self.lookup(dc_cache),(False,[]))
+        self.assertEqual(self.lookups,2)
+        self.assertTrue(self.gc_entry(dc_cache)['negative'])
+
+    def test_off_network_cached_briefly(self):
+        self.lookup_result = (False,[])
+        dc_cache = self.dc_cache()
+        self.assertEqual(self.lookup(dc_cache),(False,[]))
+        entry_dict = self.gc_entry(dc_cache)
+        self.assertTrue(entry_dict['negative'])
+        self.assertEqual(ad_status.AD_DC_CACHE_NEGATIVE_TTL_SECONDS,300)
+        self.assertTrue(time.time() + 290 < entry_dict['expires'] <= time.time() + 300)
+        # Kept across runs on the same network:
+        dc_cache.save()
+        dc_cache = self.dc_cache()
+        self.lookup_result = (True,[srv_record('dc1.%s' % DOMAIN,600)])
+        self.assertEqual(self.lookup(dc_cache),(False,[]))
+        self.assertEqual(self.lookups,1)
+        self.assertEqual(dc_cache.stats_dict['negative_hits'],1)
+        # After 300 seconds, DNS is asked again:
+        self.gc_entry(dc_cache)['expires'] = time.time() - 1
+        self.assertEqual(self.lookup(dc_cache),self.lookup_result)
+        self.assertEqual(self.lookups,2)
+
+    def test_dig_results_not_cached(self):
+        self.lookup_result = (True,[])
+        dc_cache = self.dc_cache()
+        self.lookup(dc_cache)
+        self.lookup(dc_cache)
+        self.assertEqual(self.lookups,2)
+        self.assertEqual(dc_cache.entries_dict,{})
+
+    def test_network_change_discards_cache(self):
+        dc_cache = self.dc_cache()
+        self.lookup(dc_cache)
+        dc_cache.save()
+        # Same network: answered from the file.
+        dc_cache = self.dc_cache()
+        self.assertEqual(self.lookup(dc_cache),self.lookup_result)
+        self.assertEqual(self.lookups,1)
+        # Another network (different nameservers): the cache is discarded.
+        self.write_resolv_conf('search example.org\nnameserver 192.168.1.1\n')
+        dc_cache = self.dc_cache()
+        self.assertTrue(dc_cache.stats_dict['invalidated'])
+        self.assertEqual(self.lookup(dc_cache),self.lookup_result)
+        self.assertEqual(self.lookups,2)
+        self.assertTrue('discarded' in dc_cache.report())
+
+    def test_no_cache(self):
+        self.lookup(None)
+        self.lookup(None)
+        self.assertEqual(self.lookups,2)
+
+    def test_fastest_known_good_dc_first(self):
+        dc_cache = self.dc_cache()
+        srv_records_list = [srv_record('dc%d.%s' % (i,DOMAIN),600) for i in range(1,5)]
+        # No round trip times yet: SRV order.
+        self.assertEqual(ad_status.cldap_dc_hosts(DOMAIN,srv_records_list,dc_cache),['dc%d.%s' % (i,DOMAIN) for i in [1,2,3,4]])
+        ad_status.record_dc_rtt(dc_cache,'dc3.%s' % DOMAIN,0.05)
+        ad_status.record_dc_rtt(dc_cache,'dc4.%s' % DOMAIN,0.01)
+        self.assertEqual(ad_status.cldap_dc_hosts(DOMAIN,srv_records_list,dc_cache),['dc%d.%s' % (i,DOMAIN) for i in [4,3,1,2]])
+        # A newer time replaces the old one; kept across runs:
+        ad_status.record_dc_rtt(dc_cache,'dc3.%s' % DOMAIN,0.002)
+        dc_cache.save()
+        dc_cache = self.dc_cache()
+        self.assertEqual(ad_status.cldap_dc_hosts(DOMAIN,srv_records_list,dc_cache),['dc%d.%s' % (i,DOMAIN) for i in [3,4,1,2]])
+        # Expired times are forgotten when the next one is recorded:
+        dc_cache.entries_dict['dc_rtt_seconds']['expires'] = time.time() - 1
+        self.assertEqual(ad_status.cldap_dc_hosts(DOMAIN,srv_records_list,dc_cache),['dc%d.%s' % (i,DOMAIN) for i in [1,2,3,4]])
+        ad_status.record_dc_rtt(dc_cache,'dc2.%s' % DOMAIN,0.03)
+        self.assertEqual(dc_cache.get('dc_rtt_seconds')['value'],{'dc2.%s' % DOMAIN:0.03})
+        self.assertEqual(ad_status.cldap_dc_hosts(DOMAIN,srv_records_list,dc_cache),['dc%d.%s' % (i,DOMAIN) for i in [2,1,3,4]])
+
+    def test_ldap_srv_lookup_cached(self):
+        dc_cache = self.dc_cache()
+        self.assertEqual(ad_status.cldap_dc_hosts(DOMAIN,[],dc_cache),['dc3.%s' % DOMAIN])
+        self.assertEqual(ad_status.cldap_dc_hosts(DOMAIN,[],dc_cache),['dc3.%s' % DOMAIN])
+        self.assertEqual(self.ldap_queries_list,['_ldap._tcp.%s' % DOMAIN])
+        self.assertTrue(dc_cache.entries_dict['srv:_ldap._tcp.%s' % DOMAIN]['expires'] <= time.time() + ad_status.AD_DC_CACHE_MAX_TTL_SECONDS)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# Tests for the DNS SRV client in ad-status.py: message building and
+# parsing, and queries against a stand-in nameserver on the loopback.
+
+import unittest, struct, socket, time, os, tempfile, shutil
+import support
+
+ad_status = support.load_condition('ad-status.py')
+
+def dns_name(given_name,given_pointer=None):
+    '''Encodes a domain name, ending in a compression pointer if given.'''
+    encoded_name = ''.join([struct.pack('!B',len(label)) + label for label in given_name.split('.') if label])
+    if given_pointer is None:
+        return encoded_name + '\x00'
+    return encoded_name + struct.pack('!H',0xC000 | given_pointer)
+
+def srv_reply(given_query,given_records_list,given_rcode=0,given_truncated=False,given_query_id=None):
+    '''Builds a reply to the given query.  Records are tuples of priority,
+        weight, port, target host label and TTL; each record's owner name
+        points at the question and its target at the question's forest.'''
+    query_id = struct.unpack('!H',given_query[:2])[0]
+    if given_query_id is not None:
+        query_id = given_query_id
+    question = given_query[12:given_query.index('\x00',12) + 5]
+    flags = 0x8180 | given_rcode
+    if given_truncated:
+        flags |= 0x0200
+    message = struct.pack('!HHHHHH',query_id,flags,1,len(given_records_list),0,0) + question
+    forest_offset = 12 + 1 + len('_gc') + 1 + len('_tcp')
+    for priority, weight, port, target, ttl in given_records_list:
+        rdata = struct.pack('!HHH',priority,weight,port) + dns_name(target,forest_offset)
+        message += dns_name('',12) + struct.pack('!HHIH',33,1,ttl,len(rdata)) + rdata
+    return message
+
+GC_NAME = '_gc._tcp.example.org'
+GC_RECORDS_LIST = [(10,50,3268,'dc2',600),(0,100,3268,'dc1',300),(10,100,3268,'dc3',900)]
+
+class DNSMessageTests(unittest.TestCase):
+    def test_build_query(self):
+        query = ad_status.dns_build_srv_query(GC_NAME,0x1234)
+        query_id, flags, qd_count, an_count, ns_count, ar_count = struct.unpack('!HHHHHH',query[:12])
+        self.assertEqual((query_id,flags,qd_count,an_count,ns_count,ar_count),(0x1234,0x0100,1,0,0,1))
+        name, offset = ad_status.dns_read_name(query,12)
+        self.assertEqual(name,GC_NAME)
+        self.assertEqual(struct.unpack('!HH',query[offset:offset+4]),(33,1))
+        # EDNS0 OPT record advertising 4096-byte replies:
+        self.assertEqual(struct.unpack('!BHH',query[offset+4:offset+9]),(0,41,4096))
+
+    def test_parse_compressed_reply(self):
+        query = ad_status.dns_build_srv_query(GC_NAME,7)
+        rcode, truncated, records_list = ad_status.dns_parse_srv_response(srv_reply(query,GC_RECORDS_LIST),7)
+        self.assertEqual((rcode,truncated),(0,False))
+        self.assertEqual([record['target'] for record in records_list],['dc1.example.org','dc3.example.org','dc2.example.org'])
+        self.assertEqual(records_list[0],{'name':GC_NAME,'target':'dc1.example.org','port':3268,
+                                          'priority':0,'weight':100,'ttl':300})
+
+    def test_parse_flags(self):
+        query = ad_status.dns_build_srv_query(GC_NAME,7)
+        self.assertEqual(ad_status.dns_parse_srv_response(srv_reply(query,[],3),7),(3,False,[]))
+        self.assertEqual(ad_status.dns_parse_srv_response(srv_reply(query,[],0,True),7),(0,True,[]))
+
+    def test_parse_rejects_bad_replies(self):
+        query = ad_status.dns_build_srv_query(GC_NAME,7)
+        reply = srv_reply(query,GC_RECORDS_LIST)
+        self.assertRaises(ValueError,ad_status.dns_parse_srv_response,reply,8)
+        self.assertRaises(ValueError,ad_status.dns_parse_srv_response,query,7) # not a response
+        self.assertRaises(ValueError,ad_status.dns_parse_srv_response,reply[:-5],7)
+        self.assertRaises(ValueError,ad_status.dns_parse_srv_response,reply[:6],7)
+
+    def test_compression_loop(self):
+        message = '\x00' * 12 + '\xc0\x0c'
+        self.assertRaises(ValueError,ad_status.dns_read_name,message,12)
+
+class DNSQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_settings = (ad_status.DNS_SERVER_PORT,ad_status.DNS_QUERY_TIMEOUT_SECONDS,ad_status.DNS_QUERY_TRIES)
+        ad_status.DNS_QUERY_TIMEOUT_SECONDS = 0.2
+        ad_status.DNS_QUERY_TRIES = 2
+        self.servers_list = []
+
+    def tearDown(self):
+        ad_status.DNS_SERVER_PORT, ad_status.DNS_QUERY_TIMEOUT_SECONDS, ad_status.DNS_QUERY_TRIES = self.saved_settings
+        for server in self.servers_list:
+            support.stop_stand_in(server)
+
+    def nameserver(self,given_reply_function):
+        server = support.udp_stand_in(given_reply_function)
+        self.servers_list.append(server)
+        ad_status.DNS_SERVER_PORT = server.port
+        return server
+
+    def test_answer(self):
+        self.nameserver(lambda query: [srv_reply(query,GC_RECORDS_LIST)])
+        records_list = ad_status.dns_query_srv(GC_NAME,['127.0.0.1'])
+        self.assertEqual([record['target'] for record in records_list],['dc1.example.org','dc3.example.org','dc2.example.org'])
+
+    def test_nxdomain_is_an_answer(self):
+        self.nameserver(lambda query: [srv_reply(query,[],3)])
+        self.assertEqual(ad_status.dns_query_srv(GC_NAME,['127.0.0.1']),[])
+
+    def test_ignores_replies_to_other_queries(self):
+        self.nameserver(lambda query: [srv_reply(query,[],0,False,struct.unpack('!H',query[:2])[0] ^ 1),
+                                       srv_reply(query,GC_RECORDS_LIST[:1])])
+        records_list = ad_status.dns_query_srv(GC_NAME,['127.0.0.1'])
+        self.assertEqual([record['target'] for record in records_list],['dc2.example.org'])
+
+    def test_retransmits(self):
+        server = self.nameserver(lambda query: len(server.requests_list) > 1 and [srv_reply(query,GC_RECORDS_LIST)] or None)
+        self.assertEqual(len(ad_status.dns_query_srv(GC_NAME,['127.0.0.1'])),3)
+        self.assertEqual(len(server.requests_list),2)
+
+    def test_no_answer(self):
+        server = self.nameserver(lambda query: [srv_reply(query,[],2)]) # SERVFAIL
+        self.assertEqual(ad_status.dns_query_srv(GC_NAME,['127.0.0.1']),None)
+        self.assertEqual(len(server.requests_list),2)
+        self.assertEqual(ad_status.dns_query_srv(GC_NAME,[]),None)
+
+    def test_truncated_reply_retried_over_tcp(self):
+        server = self.nameserver(lambda query: [srv_reply(query,[],0,True)])
+        def answer_over_tcp(given_socket):
+            query = support.recv_exactly(given_socket,struct.unpack('!H',support.recv_exactly(given_socket,2))[0])
+            reply = srv_reply(query,GC_RECORDS_LIST)
+            given_socket.sendall(struct.pack('!H',len(reply)) + reply)
+        try:
+            self.servers_list.append(support.tcp_stand_in(answer_over_tcp,server.port))
+        except socket.error:
+            self.skipTest('TCP port %d is in use' % server.port)
+        records_list = ad_status.dns_query_srv(GC_NAME,['127.0.0.1'])
+        self.assertEqual(len(records_list),3)
+
+    def test_timeout_bounds_retransmissions(self):
+        server = self.nameserver(lambda query: None)
+        start_time = time.time()
+        self.assertEqual(ad_status.dns_query_srv(GC_NAME,['127.0.0.1'],0.25),None)
+        # Without the timeout, the two tries would wait 0.2s and 0.4s:
+        self.assertTrue(time.time() - start_time < 0.45)
+        self.assertEqual(len(server.requests_list),2)
+
+class LookupDNSSRVTests(unittest.TestCase):
+    '''lookup_dns_srv() against a nameserver that never answers: the
+        native query and the dig fallback share the given budget.'''
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_settings = (ad_status.AD_DNS_SRV_NATIVE,ad_status.DNS_RESOLV_CONF_PATH,ad_status.DNS_SERVER_PORT,
+                               ad_status.DNS_QUERY_TIMEOUT_SECONDS,ad_status.DNS_QUERY_TRIES)
+        ad_status.AD_DNS_SRV_NATIVE = True
+        ad_status.DNS_RESOLV_CONF_PATH = os.path.join(self.temp_dir,'resolv.conf')
+        with open(ad_status.DNS_RESOLV_CONF_PATH,'w') as resolv_conf_file:
+            resolv_conf_file.write('nameserver 127.0.0.1\n')
+        ad_status.DNS_QUERY_TIMEOUT_SECONDS = 1.0
+        ad_status.DNS_QUERY_TRIES = 3
+        self.server = support.udp_stand_in(lambda query: None)
+        ad_status.DNS_SERVER_PORT = self.server.port
+        self.dig_commands_list = []
+        support.fresh_command_runner().substitute_tool('/usr/bin/dig',lambda command_list: self.dig_commands_list.append(command_list) or '')
+
+    def tearDown(self):
+        (ad_status.AD_DNS_SRV_NATIVE,ad_status.DNS_RESOLV_CONF_PATH,ad_status.DNS_SERVER_PORT,
+         ad_status.DNS_QUERY_TIMEOUT_SECONDS,ad_status.DNS_QUERY_TRIES) = self.saved_settings
+        support.stop_stand_in(self.server)
+        shutil.rmtree(self.temp_dir)
+
+    def test_native_query_bounded_by_budget(self):
+        budget = support.conditions_common.RetryBudget(0.3)
+        start_time = time.time()
+        self.assertEqual(ad_status.lookup_dns_srv('example.org','domain.example.org',budget),(False,[]))
+        # Unbounded, the query alone would take 1 + 2 + 4 seconds:
+        self.assertTrue(time.time() - start_time < 0.6)
+        self.assertEqual(len(self.server.requests_list),1)
+        self.assertEqual(budget.steps_dict['dns-srv']['succeeded'],False)
+        # The budget is spent, so dig is not tried:
+        self.assertEqual(self.dig_commands_list,[])
+
+    def test_expired_budget_sends_nothing(self):
+        budget = support.conditions_common.RetryBudget(0)
+        self.assertEqual(ad_status.lookup_dns_srv('example.org','domain.example.org',budget),(False,[]))
+        self.assertEqual(ad_status.cldap_dc_hosts('domain.example.org',[],None,budget),[])
+        self.assertEqual(self.server.requests_list,[])
+        self.assertEqual(self.dig_commands_list,[])
+
+if __name__ == '__main__':
+    unittest.main()
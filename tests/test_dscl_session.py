@@ -0,0 +1,170 @@
+# Tests for conditions_common.DsclSession and dscl_check_output(), against
+# fixtures/dscl-stand-in.py: reads, plist and error output, a hung dscl
+# (timed out, then run one-shot), dscl exiting mid-run (restarted), and how
+# one-shot arguments become interactive command lines.
+
+import unittest, os, tempfile, shutil, time, subprocess, plistlib
+import support
+from support import conditions_common
+
+STAND_IN_PATH = support.fixture_path('dscl-stand-in.py')
+LAB_ADMINS_GUID = 'A5C2F7E0-1D3B-4E5F-8A9B-0C1D2E3F4A5B'
+OLD_ADMINS_GUID = 'D8F5CAB3-4A6E-4B82-9DCE-3F4A5B6C7D8E'
+AD_NODE = '/Active Directory/EXAMPLE/All Domains'
+RECORDS_DICT = {'/Local/Default/Groups/admin':{'dsAttrTypeStandard:RecordName':['admin'],
+                                               'dsAttrTypeStandard:NestedGroups':[LAB_ADMINS_GUID,OLD_ADMINS_GUID]},
+                AD_NODE + '/Groups/Lab Admins':{'dsAttrTypeStandard:RecordName':['Lab Admins'],
+                                                'dsAttrTypeStandard:GeneratedUID':[LAB_ADMINS_GUID]}}
+ADMIN_READ_ARGUMENTS = ['-plist','/Local/Default','read','Groups/admin','NestedGroups']
+
+class DsclSessionTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_settings = (os.environ.get('DSCL_STAND_IN_DIR'),conditions_common.DSCL_PATH,conditions_common.dscl_session)
+        os.environ['DSCL_STAND_IN_DIR'] = self.temp_dir
+        plistlib.writePlist(RECORDS_DICT,os.path.join(self.temp_dir,'records.plist'))
+        conditions_common.DSCL_PATH = STAND_IN_PATH
+        conditions_common.dscl_session = None
+        self.sessions_list = []
+
+    def tearDown(self):
+        for session in self.sessions_list + [conditions_common.dscl_session]:
+            if session is not None:
+                session.close()
+        saved_stand_in_dir, conditions_common.DSCL_PATH, conditions_common.dscl_session = self.saved_settings
+        if saved_stand_in_dir is None:
+            del os.environ['DSCL_STAND_IN_DIR']
+        else:
+            os.environ['DSCL_STAND_IN_DIR'] = saved_stand_in_dir
+        shutil.rmtree(self.temp_dir)
+
+    def session(self,given_timeout=None):
+        session = conditions_common.DsclSession(STAND_IN_PATH,given_timeout)
+        self.sessions_list.append(session)
+        return session
+
+    def commands_received(self):
+        '''Returns the commands the stand-in received (but not the session's
+            markers), as (process ID, words list) tuples.'''
+        commands_list = []
+        with open(os.path.join(self.temp_dir,'commands.log')) as log_file:
+            for line in log_file:
+                words_list = line.rstrip('\n').split('\t')
+                if not words_list[1].startswith('conditions-end-'):
+                    commands_list.append((words_list[0],words_list[1:]))
+        return commands_list
+
+    def test_read(self):
+        session = self.session()
+        output, messages = session.run(ADMIN_READ_ARGUMENTS)
+        self.assertEqual(plistlib.readPlistFromString(output),{'dsAttrTypeStandard:NestedGroups':[LAB_ADMINS_GUID,OLD_ADMINS_GUID]})
+        self.assertEqual(messages,'')
+        # Later commands go to the same dscl:
+        output, messages = session.run(['-plist',AD_NODE,'read','Groups/Lab Admins','GeneratedUID'])
+        self.assertEqual(plistlib.readPlistFromString(output),{'dsAttrTypeStandard:GeneratedUID':[LAB_ADMINS_GUID]})
+        self.assertEqual((session.starts,session.commands),(1,2))
+        self.assertEqual(len(set([pid for pid, words_list in self.commands_received()])),1)
+
+    def test_error_output(self):
+        session = self.session()
+        self.assertEqual(session.run(['-plist','/Local/Default','read','Groups/missing']),
+                         ('','DS Error: -14136 (eDSRecordNotFound)'))
+        # An error does not end the session:
+        self.assertEqual(session.run(['-plist','/Local/Default','read','Groups/admin','RecordName'])[0],
+                         plistlib.writePlistToString({'dsAttrTypeStandard:RecordName':['admin']}))
+        self.assertEqual(session.starts,1)
+
+    def test_dscl_check_output(self):
+        output = conditions_common.dscl_check_output(ADMIN_READ_ARGUMENTS,None,True)
+        self.assertEqual(plistlib.readPlistFromString(output)['dsAttrTypeStandard:NestedGroups'],[LAB_ADMINS_GUID,OLD_ADMINS_GUID])
+        # A DS Error line is a CalledProcessError, as from one-shot dscl:
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            conditions_common.dscl_check_output(['-plist','/Local/Default','read','Groups/missing'],None,True)
+        self.assertTrue('eDSRecordNotFound' in context.exception.output)
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            conditions_common.dscl_check_output(['-plist','/Local/Default','read','Groups/missing'],None,False)
+        self.assertEqual(context.exception.returncode,56)
+        self.assertTrue('eDSRecordNotFound' in context.exception.output)
+        self.assertEqual(conditions_common.dscl_session.starts,1)
+        self.assertFalse(conditions_common.dscl_session.disabled)
+
+    def test_hang_times_out_and_falls_back(self):
+        start_time = time.time()
+        with self.assertRaises(conditions_common.CommandTimeoutError):
+            self.session(0.5).run(['/Local/Default','hang'])
+        self.assertTrue(time.time() - start_time < 5)
+        # Through dscl_check_output(), the session is turned off and the
+        # command run one-shot (where the stand-in answers):
+        output = conditions_common.dscl_check_output(['-plist','/Local/Default','hang','Groups/admin'],None,True,0.5)
+        self.assertEqual(plistlib.readPlistFromString(output)['dsAttrTypeStandard:RecordName'],['admin'])
+        self.assertTrue(conditions_common.dscl_session.disabled)
+        self.assertEqual(conditions_common.dscl_session.process,None)
+        # Later commands are run one-shot too:
+        conditions_common.dscl_check_output(ADMIN_READ_ARGUMENTS,None,True)
+        self.assertEqual(conditions_common.dscl_session.starts,1)
+        # (Two hung sessions, then two one-shot dscls.)
+        self.assertEqual(len(set([pid for pid, words_list in self.commands_received()])),4)
+
+    def test_exit_mid_run_restarts(self):
+        session = self.session()
+        session.run(ADMIN_READ_ARGUMENTS)
+        open(os.path.join(self.temp_dir,'exit-once.flag'),'w').close()
+        output, messages = session.run(['-plist','/Local/Default','exit-once','Groups/admin','RecordName'])
+        self.assertEqual(plistlib.readPlistFromString(output),{'dsAttrTypeStandard:RecordName':['admin']})
+        self.assertEqual(session.starts,2)
+        commands_list = self.commands_received()
+        self.assertEqual([words_list[0] for pid, words_list in commands_list],['read','exit-once','exit-once'])
+        self.assertEqual(commands_list[0][0],commands_list[1][0])
+        self.assertNotEqual(commands_list[1][0],commands_list[2][0])
+        # The restarted dscl carries on:
+        self.assertEqual(session.run(ADMIN_READ_ARGUMENTS)[1],'')
+        self.assertEqual(session.starts,2)
+
+    def test_exits_again_after_restart(self):
+        session = self.session()
+        self.assertRaises(conditions_common.DsclSessionError,session.run,['/Local/Default','exit'])
+        self.assertEqual((session.starts,session.process),(2,None))
+        # The next command starts dscl again:
+        self.assertEqual(session.run(ADMIN_READ_ARGUMENTS)[1],'')
+        self.assertEqual(session.starts,3)
+
+    def test_command_line(self):
+        session = self.session()
+        self.assertEqual(session.command_line(['/Local/Default','delete','Groups/admin','NestedGroups',OLD_ADMINS_GUID]),
+                         'delete /Local/Default/Groups/admin NestedGroups %s' % OLD_ADMINS_GUID)
+        self.assertEqual(session.command_line(['-plist',AD_NODE,'read','Groups/Lab Admins','GeneratedUID']),
+                         'read /Active\\ Directory/EXAMPLE/All\\ Domains/Groups/Lab\\ Admins GeneratedUID')
+        self.assertEqual(session.command_line(['-plist','/Search/','read','Computers/a\\b']),
+                         'read /Search/Computers/a\\\\b')
+        self.assertEqual(session.command_line(['-plist','/Search','list']),'list /Search')
+
+    def test_command_forwarded(self):
+        session = self.session()
+        self.assertEqual(session.run(['/Local/Default','delete','Groups/admin','NestedGroups',OLD_ADMINS_GUID]),('',''))
+        session.run(['-plist',AD_NODE,'read','Groups/Lab Admins','GeneratedUID'])
+        self.assertEqual([words_list for pid, words_list in self.commands_received()],
+                         [['delete','/Local/Default/Groups/admin','NestedGroups',OLD_ADMINS_GUID],
+                          ['read',AD_NODE + '/Groups/Lab Admins','GeneratedUID']])
+        self.assertEqual(plistlib.readPlistFromString(session.run(ADMIN_READ_ARGUMENTS)[0])['dsAttrTypeStandard:NestedGroups'],
+                         [LAB_ADMINS_GUID])
+
+    def test_session_and_one_shot_timings(self):
+        commands = support.benchmark_size(10,200)
+        session = self.session()
+        session.run(ADMIN_READ_ARGUMENTS)
+        start_time = time.time()
+        for i in range(commands):
+            session.run(ADMIN_READ_ARGUMENTS)
+        session_seconds = time.time() - start_time
+        start_time = time.time()
+        for i in range(commands):
+            conditions_common.dscl_check_output(ADMIN_READ_ARGUMENTS,None,False)
+        one_shot_seconds = time.time() - start_time
+        self.assertTrue(session_seconds < one_shot_seconds)
+        support.benchmark_report('%d dscl reads with the stand-in dscl' % commands,
+                                 [('one session',session_seconds),
+                                  ('one dscl per read',one_shot_seconds),
+                                  ('speedup',one_shot_seconds / session_seconds,'x')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+# Tests for conditions_common.HistoryStore, its use by ad-status.py for
+# AD failure tracking (including migration of the legacy plist), and a
+# benchmark of the cost of recording into long histories.
+
+import unittest, os, datetime, tempfile, shutil, plistlib
+import support
+from support import conditions_common
+
+ad_status = support.load_condition('ad-status.py')
+
+def day(given_day):
+    return datetime.datetime(2017,3,given_day)
+
+class HistoryStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir,'history.plist')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def record_days(self,given_capacity,given_days_list):
+        history_store = conditions_common.HistoryStore(self.path,given_capacity)
+        for event_day in given_days_list:
+            history_store.record('failure_count',day(event_day))
+        return history_store
+
+    def test_ring_keeps_most_recent_events(self):
+        history_store = self.record_days(3,range(1,6))
+        self.assertEqual(history_store.events(),[day(3),day(4),day(5)])
+        self.assertEqual(history_store.count('failure_count'),5)
+        self.assertEqual((history_store.first_event,history_store.last_event),(day(1),day(5)))
+        reloaded_store = conditions_common.HistoryStore(self.path,3)
+        self.assertEqual(reloaded_store.events(),[day(3),day(4),day(5)])
+        self.assertEqual(reloaded_store.count('failure_count'),5)
+        self.assertEqual(plistlib.readPlist(self.path)['capacity'],3)
+
+    def test_grow_capacity(self):
+        self.record_days(3,range(1,5)) # wrapped: 4 2 3
+        history_store = self.record_days(5,range(5,8))
+        self.assertEqual(history_store.events(),[day(3),day(4),day(5),day(6),day(7)])
+        self.assertEqual(conditions_common.HistoryStore(self.path,5).events(),[day(3),day(4),day(5),day(6),day(7)])
+
+    def test_shrink_capacity(self):
+        self.record_days(5,range(1,8))
+        history_store = self.record_days(3,[8])
+        self.assertEqual(history_store.events(),[day(6),day(7),day(8)])
+        self.assertEqual(history_store.count('failure_count'),8)
+
+    def test_file_without_capacity(self):
+        # Written before the capacity was stored:
+        plistlib.writePlist({'history_version':conditions_common.HISTORY_STORE_VERSION,
+                             'counters':{'failure_count':4},
+                             'events':[day(4),day(2),day(3)],
+                             'next_index':1},self.path)
+        history_store = self.record_days(5,[5])
+        self.assertEqual(history_store.events(),[day(2),day(3),day(4),day(5)])
+
+    def test_unreadable_file(self):
+        with open(self.path,'w') as history_file:
+            history_file.write('<plist><dict><key>')
+        history_store = self.record_days(3,[1])
+        self.assertEqual(history_store.events(),[day(1)])
+        self.assertEqual(history_store.count('failure_count'),1)
+
+    def test_clear(self):
+        history_store = self.record_days(3,[1,2])
+        history_store.clear()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(history_store.events(),[])
+
+def write_legacy_failures(given_path,given_failure_count,given_timestamps_count):
+    '''Writes ActiveDirectoryFailures.plist as earlier versions of
+        ad-status.py did: a count and an ever-growing timestamps array.'''
+    start_time = datetime.datetime(2016,1,1)
+    plistlib.writePlist({'failure_count':given_failure_count,
+                         'failure_timestamps':[start_time + datetime.timedelta(hours=i) for i in range(given_timestamps_count)]},given_path)
+
+class ADFailureHistoryTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_settings = (ad_status.AD_FAILURES_HISTORY_FILE_PATH,ad_status.AD_FAILURES_HISTORY_CAPACITY)
+        ad_status.AD_FAILURES_HISTORY_FILE_PATH = os.path.join(self.temp_dir,'ActiveDirectoryFailures.plist')
+        ad_status.AD_FAILURES_HISTORY_CAPACITY = 32
+
+    def tearDown(self):
+        ad_status.AD_FAILURES_HISTORY_FILE_PATH, ad_status.AD_FAILURES_HISTORY_CAPACITY = self.saved_settings
+        shutil.rmtree(self.temp_dir)
+
+    def test_migrates_legacy_plist(self):
+        write_legacy_failures(ad_status.AD_FAILURES_HISTORY_FILE_PATH,500,500)
+        history_store = ad_status.dscl_failures_history()
+        self.assertEqual(history_store.count('failure_count'),500)
+        self.assertEqual(len(history_store.events()),32)
+        self.assertEqual(history_store.events()[-1],datetime.datetime(2016,1,1) + datetime.timedelta(hours=499))
+        self.assertEqual(history_store.first_event,datetime.datetime(2016,1,1))
+        self.assertEqual(ad_status.increment_dscl_failure_count(),501)
+        history_dict = plistlib.readPlist(ad_status.AD_FAILURES_HISTORY_FILE_PATH)
+        self.assertEqual(history_dict['history_version'],conditions_common.HISTORY_STORE_VERSION)
+        self.assertFalse('failure_timestamps' in history_dict)
+        self.assertEqual(len(history_dict['events']),32)
+
+    def test_migrates_legacy_plist_without_timestamps(self):
+        plistlib.writePlist({'failure_count':3},ad_status.AD_FAILURES_HISTORY_FILE_PATH)
+        self.assertEqual(ad_status.increment_dscl_failure_count(),4)
+        self.assertEqual(len(ad_status.dscl_failures_history().events()),1)
+
+    def test_first_failure_and_removal(self):
+        self.assertEqual(ad_status.increment_dscl_failure_count(),1)
+        self.assertEqual(ad_status.increment_dscl_failure_count(),2)
+        ad_status.remove_dscl_failure_data()
+        self.assertFalse(os.path.exists(ad_status.AD_FAILURES_HISTORY_FILE_PATH))
+        self.assertEqual(ad_status.increment_dscl_failure_count(),1)
+
+class HistoryStoreBenchmark(unittest.TestCase):
+    '''Recording an event should cost the same however long the history:
+        the file holds at most the ring's capacity of events.'''
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def record_cost(self,given_history_length,given_records=20):
+        '''Returns the time to record given_records events into a history
+            migrated from a legacy plist of given_history_length failures,
+            and the size of the file afterwards.'''
+        path = os.path.join(self.temp_dir,'history-%d.plist' % given_history_length)
+        write_legacy_failures(path,given_history_length,given_history_length)
+        history_store = conditions_common.HistoryStore(path,64,ad_status.dscl_failures_from_legacy_plist)
+        history_store.record('failure_count') # writes the current format
+        seconds = support.best_time(lambda: [history_store.record('failure_count') for i in range(given_records)])
+        return seconds / given_records, os.path.getsize(path)
+
+    def legacy_record_cost(self,given_history_length,given_records=20):
+        '''The same, for the read-append-rewrite of earlier versions.'''
+        path = os.path.join(self.temp_dir,'legacy-%d.plist' % given_history_length)
+        write_legacy_failures(path,given_history_length,given_history_length)
+        def record_legacy():
+            for i in range(given_records):
+                failures_dict = plistlib.readPlist(path)
+                failures_dict['failure_count'] += 1
+                failures_dict['failure_timestamps'].append(datetime.datetime.utcnow())
+                plistlib.writePlist(failures_dict,path)
+        return support.best_time(record_legacy) / given_records
+
+    def test_record_cost_is_flat(self):
+        lengths_list = [100,support.benchmark_size(2000,100000)]
+        costs_list = [self.record_cost(length) for length in lengths_list]
+        short_seconds, short_size = costs_list[0]
+        long_seconds, long_size = costs_list[-1]
+        # Same number of events on file (dates and counts differ only in digits):
+        self.assertTrue(abs(long_size - short_size) < 64)
+        self.assertTrue(long_seconds < short_seconds * 3 + 0.005)
+        rows_list = [('HistoryStore.record, %d-event history' % length,seconds) for length, (seconds, size) in zip(lengths_list,costs_list)]
+        if support.BENCHMARK:
+            rows_list += [('legacy rewrite, %d-event history' % length,self.legacy_record_cost(length,3)) for length in lengths_list]
+        support.benchmark_report('Cost per recorded AD failure',rows_list)
+
+if __name__ == '__main__':
+    unittest.main()
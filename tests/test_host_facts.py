@@ -0,0 +1,61 @@
+# Tests for conditions_common.HostFacts, driven by recorded
+# system_profiler -xml output in fixtures/.
+
+import unittest, plistlib
+import support
+from support import conditions_common
+
+class RecordedSystemProfiler(object):
+    '''Stand-in for system_profiler: answers from the recorded output of
+        each requested data type, and remembers the commands it was given.'''
+    def __init__(self):
+        self.commands_list = []
+
+    def __call__(self,given_command_list):
+        self.commands_list.append(given_command_list)
+        output_array = []
+        for data_type in given_command_list[2:]:
+            output_array.extend(plistlib.readPlistFromString(support.read_fixture('%s.xml' % data_type)))
+        return plistlib.writePlistToString(output_array)
+
+class HostFactsTests(unittest.TestCase):
+    def setUp(self):
+        self.system_profiler = RecordedSystemProfiler()
+        support.fresh_command_runner().substitute_tool('/usr/sbin/system_profiler',self.system_profiler)
+
+    def test_facts_from_recorded_output(self):
+        host_facts = conditions_common.HostFacts(given_profiler_output=support.read_fixture('SPHardwareDataType.xml'))
+        self.assertEqual(host_facts.serial_number,'C02LW0XXFH00')
+        self.assertEqual(host_facts.hardware_uuid,'5B1C2D3E-4F50-6172-8394-A5B6C7D8E9F0')
+        self.assertEqual(host_facts.model,'MacBookPro11,1')
+        self.assertEqual(self.system_profiler.commands_list,[])
+
+    def test_one_call_for_all_data_types(self):
+        host_facts = conditions_common.HostFacts()
+        self.assertEqual(host_facts.serial_number,'C02LW0XXFH00')
+        self.assertEqual([i['interface'] for i in host_facts.network_interfaces],['en0','en3','en4','bridge0'])
+        self.assertEqual(host_facts.model,'MacBookPro11,1')
+        self.assertEqual(self.system_profiler.commands_list,[['/usr/sbin/system_profiler','-xml','SPHardwareDataType','SPNetworkDataType']])
+
+    def test_stand_alone_fetches_only_what_is_read(self):
+        context = conditions_common.ConditionsContext([])
+        self.assertEqual(context.host_facts.serial_number,'C02LW0XXFH00')
+        self.assertEqual(context.host_facts.hardware_uuid,'5B1C2D3E-4F50-6172-8394-A5B6C7D8E9F0')
+        self.assertEqual(self.system_profiler.commands_list,[['/usr/sbin/system_profiler','-xml','SPHardwareDataType']])
+
+    def test_network_hw_condition(self):
+        network_hw = support.load_condition('network-hw.py')
+        context = conditions_common.ConditionsContext([])
+        interfaces_array = network_hw.system_profiler_get_ethernet_and_wifi_info(context.host_facts)
+        self.assertEqual(interfaces_array,[{'interface':'en0','name':'Wi-Fi','type':'AirPort','hw_address':'a0:99:9b:01:02:03'},
+                                           {'interface':'en3','name':'Thunderbolt Ethernet','type':'Ethernet','hw_address':'40:6c:8f:0a:0b:0c'}])
+        self.assertTrue(network_hw.system_has_wifi(interfaces_array))
+        self.assertEqual(self.system_profiler.commands_list,[['/usr/sbin/system_profiler','-xml','SPNetworkDataType']])
+
+    def test_unusable_output_gives_blank_facts(self):
+        host_facts = conditions_common.HostFacts(given_profiler_output='<plist><array><dict>')
+        self.assertEqual(host_facts.serial_number,'')
+        self.assertEqual(host_facts.network_interfaces,[])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+# Tests for the serial decoding in hw-bundle.py, checked against the
+# original list-walking decoder, a benchmark of bulk decoding, and the
+# hardware bundle cache, with ioreg and system_profiler replaced by stand-in
+# functions.
+
+import unittest, os, tempfile, shutil, datetime, StringIO, csv, plistlib
+import support
+from support import conditions_common
+
+hw_bundle = support.load_condition('hw-bundle.py')
+
+YEAR_LETTERS = "CDFGHJKLMNPQRSTVWXYZ"
+WEEK_CODES = "123456789CDFGHJKLMNPQRTVWXY"
+
+def legacy_manufacture_date_from_serial(given_serial):
+    '''The decoder hw-bundle.py used before the lookup tables: walks the
+        year and week code lists for each serial.'''
+    year_letters_array_1 = ["C","F","H","K","M","P","R","T","W","Y"]
+    year_letters_array_2 = ["D","G","J","L","N","Q","S","V","X","Z"]
+    week_codes_array = ["1","2","3","4","5","6","7","8","9","C",
+                        "D","F","G","H","J","K","L","M","N","P",
+                        "Q","R","T","V","W","X","Y"]
+    year_base = 2010
+    week_base = 0
+    year_index = -1
+    week_index = -1
+    if len(given_serial) != 12:
+        return None
+    year_letter = given_serial[3]
+    week_code = given_serial[4]
+    try:
+        year_index = year_letters_array_1.index(year_letter)
+    except ValueError:
+        pass
+    try:
+        year_index = year_letters_array_2.index(year_letter)
+        week_base = 27
+    except ValueError:
+        pass
+    try:
+        week_index = week_codes_array.index(week_code)
+    except ValueError:
+        pass
+    year = year_index + year_base
+    week = week_index + week_base
+    if (year < year_base) or (week < week_base):
+        return None
+    birthday_str = "%(y)s-W%(w)s-0" % {"y":year,"w":week}
+    return datetime.datetime.strptime(birthday_str,"%Y-W%W-%w")
+
+def serial(given_year_letter,given_week_code):
+    return 'C02%s%s0XXFH0Q' % (given_year_letter,given_week_code)
+
+def fleet_serials(given_count):
+    '''Returns given_count serials cycling through every year and week code.'''
+    return [serial(YEAR_LETTERS[i % len(YEAR_LETTERS)],WEEK_CODES[(i // len(YEAR_LETTERS)) % len(WEEK_CODES)]) for i in range(given_count)]
+
+class DecodeSerialTests(unittest.TestCase):
+    def test_matches_legacy_decoder(self):
+        for year_letter in YEAR_LETTERS:
+            for week_code in WEEK_CODES:
+                self.assertEqual(hw_bundle.manufacture_date_from_serial(serial(year_letter,week_code)),
+                                 legacy_manufacture_date_from_serial(serial(year_letter,week_code)))
+        # Codes the tables do not know:
+        for bad_serial in ['','C02','C02LW0XXFH00X',serial('A','W'),serial('B','1'),serial('L','0'),serial('L','A'),serial('D','Z')]:
+            self.assertEqual(hw_bundle.manufacture_date_from_serial(bad_serial),legacy_manufacture_date_from_serial(bad_serial))
+
+    def test_decoded_dates(self):
+        self.assertEqual(hw_bundle.decode_serial('C02LW0XXFH00'),{'serial':'C02LW0XXFH00','manufacture_date':datetime.datetime(2013,12,29),'error':None})
+        self.assertEqual(hw_bundle.decode_serial(serial('K','Y'))['manufacture_date'],datetime.datetime(2013,7,7))
+        self.assertEqual(hw_bundle.decode_serial(serial('C','1'))['manufacture_date'],datetime.datetime(2010,1,3))
+
+    def test_error_codes(self):
+        for bad_serial, error in [('','unsupported-serial-length'),
+                                  ('C02LW0XXFH0','unsupported-serial-length'),
+                                  ('W8812345ABC','unsupported-serial-length'),
+                                  (serial('A','W'),'unknown-year-code'),
+                                  (serial('1','W'),'unknown-year-code'),
+                                  (serial('l','W'),'unknown-year-code'),
+                                  (serial('L','0'),'unknown-week-code'),
+                                  (serial('L','A'),'unknown-week-code'),
+                                  (serial('L','Z'),'unknown-week-code')]:
+            self.assertEqual(hw_bundle.decode_serial(bad_serial),{'serial':bad_serial,'manufacture_date':None,'error':error})
+
+    def test_module_leaves_no_loop_variables(self):
+        for name in ['year_index','year_letter','week_index','week_code']:
+            self.assertFalse(hasattr(hw_bundle,name))
+
+class DecodeSerialsTests(unittest.TestCase):
+    def test_bulk_decoding(self):
+        results_list = list(hw_bundle.decode_serials(['  c02lw0xxfh00\n','',serial('C','1'),'   ',serial('Z','Y'),'short']))
+        self.assertEqual([(r['serial'],r['error'],r['hw_bundle_eligible']) for r in results_list],
+                         [('C02LW0XXFH00',None,True),
+                          (serial('C','1'),None,False),
+                          (serial('Z','Y'),None,True),
+                          ('SHORT','unsupported-serial-length',False)])
+
+    def test_csv_round_trip(self):
+        inventory_file = StringIO.StringIO('asset,serial\n'
+                                           '1001,%s\n'
+                                           '1002,\n'
+                                           '1003,%s\n'
+                                           '1004,C02\n'
+                                           '1005\n' % (serial('L','W'),serial('K','Y')))
+        output_file = StringIO.StringIO()
+        hw_bundle.write_decoded_serials_csv(hw_bundle.decode_serials_from_csv(inventory_file),output_file)
+        output_file.seek(0)
+        rows_list = list(csv.DictReader(output_file))
+        self.assertEqual(rows_list,[{'serial':serial('L','W'),'manufacture_date':'2013-12-29','hw_bundle_eligible':'True','error':''},
+                                    {'serial':serial('K','Y'),'manufacture_date':'2013-07-07','hw_bundle_eligible':'False','error':''},
+                                    {'serial':'C02','manufacture_date':'','hw_bundle_eligible':'False','error':'unsupported-serial-length'}])
+        # Reading the written dates back gives the decoded dates:
+        for row_dict in rows_list[:2]:
+            self.assertEqual(datetime.datetime.strptime(row_dict['manufacture_date'],'%Y-%m-%d'),
+                             hw_bundle.manufacture_date_from_serial(row_dict['serial']))
+
+    def test_csv_other_column(self):
+        inventory_file = StringIO.StringIO('Serial Number\n%s\n' % serial('L','W'))
+        results_list = list(hw_bundle.decode_serials_from_csv(inventory_file,'Serial Number'))
+        self.assertEqual([r['manufacture_date'] for r in results_list],[datetime.datetime(2013,12,29)])
+
+class DecodeSerialsBenchmark(unittest.TestCase):
+    def test_serials_per_second(self):
+        serials_list = fleet_serials(support.benchmark_size(20000,500000))
+        self.assertEqual([r['manufacture_date'] for r in hw_bundle.decode_serials(serials_list[:1000])],
+                         [legacy_manufacture_date_from_serial(s) for s in serials_list[:1000]])
+        tables_seconds = support.best_time(lambda: list(hw_bundle.decode_serials(serials_list)))
+        legacy_seconds = support.best_time(lambda: [legacy_manufacture_date_from_serial(s) for s in serials_list],1)
+        self.assertTrue(tables_seconds < legacy_seconds)
+        support.benchmark_report('Decoding %d serials' % len(serials_list),
+                                 [('decode_serials()',tables_seconds),
+                                  ('legacy decoder',legacy_seconds),
+                                  ('decode_serials()',len(serials_list) / tables_seconds,'serials/sec'),
+                                  ('legacy decoder',len(serials_list) / legacy_seconds,'serials/sec')])
+
+PLATFORM_UUID = '5B1C2D3E-4F50-6172-8394-A5B6C7D8E9F0'
+
+class StandInHardwareTools(object):
+    '''Stand-in for ioreg and system_profiler, reporting platform_uuid and
+        serial (in the recorded SPHardwareDataType output).  Keeps the
+        commands it is given in commands_list.'''
+    def __init__(self):
+        self.platform_uuid = PLATFORM_UUID
+        self.serial = 'C02LW0XXFH00'
+        self.commands_list = []
+
+    def __call__(self,given_command_list):
+        self.commands_list.append(given_command_list)
+        if given_command_list[0] == '/usr/sbin/ioreg':
+            return plistlib.writePlistToString([{'IOPlatformUUID':self.platform_uuid,'IOPlatformSerialNumber':self.serial}])
+        output_array = plistlib.readPlistFromString(support.read_fixture('SPHardwareDataType.xml'))
+        output_array[0]['_items'][0]['serial_number'] = self.serial
+        return plistlib.writePlistToString(output_array)
+
+    def spawns(self,given_tool_path):
+        return len([command_list for command_list in self.commands_list if command_list[0] == given_tool_path])
+
+class HWBundleCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_settings = (hw_bundle.HW_BUNDLE_CACHE_PATH,hw_bundle.HW_BUNDLE_MIN_DATE_STR)
+        hw_bundle.HW_BUNDLE_CACHE_PATH = os.path.join(self.temp_dir,'HardwareBundleCache.plist')
+        self.tools = StandInHardwareTools()
+
+    def tearDown(self):
+        hw_bundle.HW_BUNDLE_CACHE_PATH, hw_bundle.HW_BUNDLE_MIN_DATE_STR = self.saved_settings
+        shutil.rmtree(self.temp_dir)
+
+    def run_condition(self):
+        '''Runs hw-bundle as in a new Munki run (a fresh CommandRunner).
+            Returns the queued conditions.'''
+        runner = support.fresh_command_runner()
+        runner.substitute_tool('/usr/sbin/ioreg',self.tools)
+        runner.substitute_tool('/usr/sbin/system_profiler',self.tools)
+        context = conditions_common.ConditionsContext([])
+        hw_bundle.run_condition(context)
+        return context.conditions_writer.pending_dict
+
+    def test_cache_hit_runs_no_system_profiler(self):
+        expected_dict = {'system_hw_bundle_oct_2013':True,'system_manufacture_date':datetime.datetime(2013,12,29)}
+        self.assertEqual(self.run_condition(),expected_dict)
+        self.assertEqual((self.tools.spawns('/usr/sbin/ioreg'),self.tools.spawns('/usr/sbin/system_profiler')),(1,1))
+        cache_dict = plistlib.readPlist(hw_bundle.HW_BUNDLE_CACHE_PATH)
+        self.assertEqual((cache_dict['platform_uuid'],cache_dict['serial_number']),(PLATFORM_UUID,'C02LW0XXFH00'))
+        for run in range(3):
+            self.assertEqual(self.run_condition(),expected_dict)
+        # Only ioreg, once a run:
+        self.assertEqual((self.tools.spawns('/usr/sbin/ioreg'),self.tools.spawns('/usr/sbin/system_profiler')),(4,1))
+
+    def test_changed_platform_uuid_probes_again(self):
+        self.run_condition()
+        # The cache file came with a restored or migrated disk:
+        self.tools.platform_uuid = '6C2D3E4F-5061-7283-94A5-B6C7D8E9F0A1'
+        self.tools.serial = serial('C','1')
+        self.assertEqual(self.run_condition(),{'system_hw_bundle_oct_2013':False,'system_manufacture_date':datetime.datetime(2010,1,3)})
+        self.assertEqual(self.tools.spawns('/usr/sbin/system_profiler'),2)
+        self.assertEqual(plistlib.readPlist(hw_bundle.HW_BUNDLE_CACHE_PATH)['platform_uuid'],self.tools.platform_uuid)
+        self.run_condition()
+        self.assertEqual(self.tools.spawns('/usr/sbin/system_profiler'),2)
+
+    def test_changed_min_date_probes_again(self):
+        self.run_condition()
+        hw_bundle.HW_BUNDLE_MIN_DATE_STR = '2014-01-01'
+        self.assertEqual(self.run_condition()['system_hw_bundle_oct_2013'],False)
+        self.assertEqual(self.tools.spawns('/usr/sbin/system_profiler'),2)
+        self.assertEqual(plistlib.readPlist(hw_bundle.HW_BUNDLE_CACHE_PATH)['hw_bundle_min_date_str'],'2014-01-01')
+
+    def test_no_platform_uuid_no_cache(self):
+        self.tools.platform_uuid = ''
+        self.run_condition()
+        self.run_condition()
+        self.assertEqual(self.tools.spawns('/usr/sbin/system_profiler'),2)
+        self.assertFalse(os.path.exists(hw_bundle.HW_BUNDLE_CACHE_PATH))
+
+    def test_unreadable_cache_probes_again(self):
+        with open(hw_bundle.HW_BUNDLE_CACHE_PATH,'w') as cache_file:
+            cache_file.write('<plist><dict><key>cache_version')
+        self.assertEqual(self.run_condition()['system_hw_bundle_oct_2013'],True)
+        self.assertEqual(self.tools.spawns('/usr/sbin/system_profiler'),1)
+
+    def test_undecodable_serial(self):
+        self.tools.serial = 'W8812345ABC'
+        self.assertEqual(self.run_condition(),{'system_hw_bundle_oct_2013':False})
+        # Cached (without a manufacture date), like any serial that was read:
+        cache_dict = plistlib.readPlist(hw_bundle.HW_BUNDLE_CACHE_PATH)
+        self.assertEqual((cache_dict['serial_number'],cache_dict['system_hw_bundle_oct_2013']),('W8812345ABC',False))
+        self.assertFalse('system_manufacture_date' in cache_dict)
+        self.assertEqual(self.run_condition(),{'system_hw_bundle_oct_2013':False})
+        self.assertEqual(self.tools.spawns('/usr/sbin/system_profiler'),1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+# Tests for the IPP client in print-queues.py: request encoding, response
+# parsing, and requests to a stand-in CUPS scheduler (over TCP and over a
+# Unix domain socket).
+
+import unittest, struct, os, tempfile, shutil, SocketServer, BaseHTTPServer
+import support
+
+print_queues = support.load_condition('print-queues.py')
+
+def printer_group(given_name,given_device_uri):
+    return (0x04,[(0x42,'printer-name',[given_name]),
+                  (0x45,'device-uri',[given_device_uri]),
+                  (0x41,'printer-info',[given_name.replace('_',' ')]),
+                  (0x22,'printer-is-shared',[False]),
+                  (0x44,'auth-info-required',['none'])])
+
+def ipp_response(given_request_id,given_status_code,given_groups_list):
+    '''Builds an IPP response (a request with the status in place of the
+        operation).'''
+    response = print_queues.ipp_build_request(given_status_code,[(0x01,print_queues.ipp_operation_attributes()[:2])] + given_groups_list)
+    return response[:4] + struct.pack('!I',given_request_id) + response[8:]
+
+class StandInCUPS(object):
+    '''Answers CUPS-Get-Printers with the queues in printers_dict (name to
+        device URI) and CUPS-Add-Modify-Printer by adding to it.  Requests
+        are kept in requests_list as dicts (path, authorization, operation_id,
+        groups_list, document).'''
+    def __init__(self,given_printers_dict=None,given_http_status=200,given_ipp_status=0x0000):
+        self.printers_dict = dict(given_printers_dict or {})
+        self.http_status = given_http_status
+        self.ipp_status = given_ipp_status
+        self.requests_list = []
+
+    def handler_class(self):
+        cups = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                operation_id, groups_list = print_queues.ipp_parse_response(body)
+                # The document (a PPD, in these tests) follows the attributes:
+                document = body[body.find('*PPD-Adobe'):] if '*PPD-Adobe' in body else ''
+                request_id = struct.unpack('!I',body[4:8])[0]
+                cups.requests_list.append({'path':self.path,'authorization':self.headers.get('Authorization'),
+                                           'operation_id':operation_id,'groups_list':groups_list,'document':document})
+                response = ipp_response(request_id,cups.ipp_status,cups.reply_groups(operation_id,groups_list))
+                self.send_response(cups.http_status)
+                self.send_header('Content-Type','application/ipp')
+                self.send_header('Content-Length',str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def address_string(self):
+                return 'stand-in'
+
+            def log_message(self,given_format,*given_args):
+                pass
+        return Handler
+
+    def reply_groups(self,given_operation_id,given_groups_list):
+        if given_operation_id == 0x4002:
+            return [printer_group(name,device_uri) for name, device_uri in sorted(self.printers_dict.items())]
+        if given_operation_id == 0x4003:
+            name = given_groups_list[0][1]['printer-uri'][0].rsplit('/',1)[-1]
+            printer_dict = given_groups_list[1][1]
+            if 'device-uri' in printer_dict:
+                self.printers_dict[name] = printer_dict['device-uri'][0]
+        return []
+
+class StandInUnixHTTPServer(SocketServer.ThreadingMixIn,SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class IPPMessageTests(unittest.TestCase):
+    def test_encode_attribute(self):
+        self.assertEqual(print_queues.ipp_encode_attribute(0x44,'requested-attributes',['printer-name','device-uri']),
+                         '\x44\x00\x14requested-attributes\x00\x0cprinter-name'
+                         '\x44\x00\x00\x00\x0adevice-uri')
+        self.assertEqual(print_queues.ipp_encode_attribute(0x23,'printer-state',[3]),'\x23\x00\x0dprinter-state\x00\x04\x00\x00\x00\x03')
+        self.assertEqual(print_queues.ipp_encode_attribute(0x22,'printer-is-shared',[False]),'\x22\x00\x11printer-is-shared\x00\x01\x00')
+        self.assertEqual(print_queues.ipp_encode_attribute(0x41,'printer-info',[u'Caf\xe9']),'\x41\x00\x0cprinter-info\x00\x05Caf\xc3\xa9')
+
+    def test_round_trip(self):
+        request = print_queues.ipp_build_request(0x4002,[(0x01,print_queues.ipp_operation_attributes('ipp://localhost/printers/a')),
+                                                         printer_group('lab_printer','lpd://10.0.0.5/queue'),
+                                                         (0x04,[(0x21,'copies',[-2]),(0x44,'document-format-supported',['a','b','c'])])])
+        self.assertEqual(struct.unpack('!BBH',request[:4]),(2,0,0x4002))
+        self.assertEqual(request[-1],'\x03')
+        operation_id, groups_list = print_queues.ipp_parse_response(request)
+        self.assertEqual(operation_id,0x4002)
+        self.assertEqual([group_tag for group_tag, attributes_dict in groups_list],[0x01,0x04,0x04])
+        self.assertEqual(groups_list[0][1]['printer-uri'],['ipp://localhost/printers/a'])
+        self.assertEqual(groups_list[1][1]['printer-is-shared'],[False])
+        self.assertEqual(groups_list[2][1],{'copies':[-2],'document-format-supported':['a','b','c']})
+
+    def test_malformed(self):
+        response = ipp_response(1,0,[printer_group('lab_printer','lpd://10.0.0.5/queue')])
+        for data in [response[:-1],response[:30],response[:6],'\x02\x00\x00\x00\x00\x00\x00\x01\x44\x00\x01a\x00\x01b\x03']:
+            self.assertRaises(print_queues.IPPError,print_queues.ipp_parse_response,data)
+
+class CUPSRequestTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_settings = (print_queues.CUPS_DOMAIN_SOCKET_PATH,print_queues.CUPS_HOST,print_queues.CUPS_PORT,
+                               print_queues.CUPS_LOCAL_CERT_PATH,print_queues.IPP_TIMEOUT_SECONDS)
+        self.temp_dir = tempfile.mkdtemp()
+        print_queues.CUPS_DOMAIN_SOCKET_PATH = os.path.join(self.temp_dir,'cupsd')
+        print_queues.CUPS_HOST = '127.0.0.1'
+        print_queues.CUPS_LOCAL_CERT_PATH = os.path.join(self.temp_dir,'certs-0')
+        print_queues.IPP_TIMEOUT_SECONDS = 5
+        self.ppd_path = os.path.join(self.temp_dir,'printer.ppd')
+        with open(self.ppd_path,'wb') as ppd_file:
+            ppd_file.write('*PPD-Adobe: "4.3"\n*ModelName: "Stand-in"\n')
+        self.server = None
+
+    def tearDown(self):
+        (print_queues.CUPS_DOMAIN_SOCKET_PATH,print_queues.CUPS_HOST,print_queues.CUPS_PORT,
+         print_queues.CUPS_LOCAL_CERT_PATH,print_queues.IPP_TIMEOUT_SECONDS) = self.saved_settings
+        if self.server:
+            support.stop_stand_in(self.server)
+        shutil.rmtree(self.temp_dir)
+
+    def cupsd(self,given_cups,given_unix_socket=False):
+        '''Serves the given StandInCUPS on CUPS_HOST:CUPS_PORT, or on the
+            domain socket.'''
+        if given_unix_socket:
+            self.server = support.serve_in_thread(StandInUnixHTTPServer(print_queues.CUPS_DOMAIN_SOCKET_PATH,given_cups.handler_class()))
+        else:
+            self.server = support.serve_in_thread(support.StandInTCPServer(('127.0.0.1',0),given_cups.handler_class()))
+            print_queues.CUPS_PORT = self.server.port
+        return given_cups
+
+    def queue(self,given_name='lab_printer',given_device_uri='lpd://10.0.0.5/queue'):
+        return {'name':given_name,'display_name':'Lab Printer','device_uri':given_device_uri,'ppd_path':self.ppd_path}
+
+    def test_get_printers(self):
+        cups = self.cupsd(StandInCUPS({'lab_printer':'lpd://10.0.0.5/queue','office':'ipp://10.0.0.6/ipp/print'}))
+        printers_dict = print_queues.cups_get_printers()
+        self.assertEqual(sorted(printers_dict),['lab_printer','office'])
+        self.assertEqual(printers_dict['office']['device-uri'],['ipp://10.0.0.6/ipp/print'])
+        self.assertTrue(print_queues.ipp_print_queue_present(self.queue(),printers_dict))
+        self.assertTrue(print_queues.ipp_print_queue_present(self.queue(given_device_uri='LPD://10.0.0.5/queue'),printers_dict))
+        self.assertFalse(print_queues.ipp_print_queue_present(self.queue(given_device_uri='lpd://10.0.0.7/queue'),printers_dict))
+        self.assertFalse(print_queues.ipp_print_queue_present(self.queue('missing'),printers_dict))
+        request_dict = cups.requests_list[0]
+        self.assertEqual((request_dict['path'],request_dict['operation_id'],request_dict['authorization']),('/',0x4002,None))
+        self.assertEqual(request_dict['groups_list'][0][1]['requested-attributes'],
+                         ['printer-name','device-uri','printer-info','printer-is-shared','auth-info-required'])
+
+    def test_no_printers(self):
+        self.cupsd(StandInCUPS(given_ipp_status=0x0406)) # client-error-not-found
+        self.assertEqual(print_queues.cups_get_printers(),{})
+
+    def test_add_modify_printer(self):
+        with open(print_queues.CUPS_LOCAL_CERT_PATH,'w') as cert_file:
+            cert_file.write('0123456789ABCDEF\n')
+        cups = self.cupsd(StandInCUPS())
+        print_queue_dict = self.queue()
+        print_queue_dict['kerberos_auth_required'] = True
+        self.assertTrue(print_queues.cups_add_modify_printer(print_queue_dict,False))
+        self.assertEqual(cups.printers_dict,{'lab_printer':'lpd://10.0.0.5/queue'})
+        request_dict = cups.requests_list[0]
+        self.assertEqual((request_dict['path'],request_dict['operation_id'],request_dict['authorization']),('/admin/',0x4003,'Local 0123456789ABCDEF'))
+        self.assertEqual(request_dict['groups_list'][0][1]['printer-uri'],['ipp://localhost/printers/lab_printer'])
+        self.assertEqual(request_dict['groups_list'][1][1],{'printer-info':['Lab Printer'],
+                                                            'printer-is-shared':[False],
+                                                            'printer-is-accepting-jobs':[True],
+                                                            'printer-state':[3],
+                                                            'device-uri':['lpd://10.0.0.5/queue'],
+                                                            'auth-info-required':['negotiate']})
+        self.assertEqual(request_dict['document'],'*PPD-Adobe: "4.3"\n*ModelName: "Stand-in"\n')
+        # Setting attributes only leaves the device URI alone:
+        print_queues.cups_add_modify_printer(self.queue(given_device_uri='lpd://10.0.0.9/other'),True)
+        self.assertFalse('device-uri' in cups.requests_list[1]['groups_list'][1][1])
+
+    def test_over_domain_socket(self):
+        cups = self.cupsd(StandInCUPS({'lab_printer':'lpd://10.0.0.5/queue'}),True)
+        print_queues.CUPS_PORT = 1 # not used when the socket exists
+        self.assertEqual(list(print_queues.cups_get_printers()),['lab_printer'])
+        self.assertEqual(len(cups.requests_list),1)
+
+    def test_errors(self):
+        self.cupsd(StandInCUPS(given_http_status=403))
+        self.assertRaises(print_queues.IPPError,print_queues.cups_get_printers)
+        support.stop_stand_in(self.server)
+        self.cupsd(StandInCUPS(given_ipp_status=0x0401)) # client-error-forbidden
+        self.assertRaises(print_queues.IPPError,print_queues.cups_add_modify_printer,self.queue(),False)
+        support.stop_stand_in(self.server)
+        self.server = None
+        self.assertRaises(print_queues.IPPError,print_queues.cups_get_printers)
+        missing_ppd_dict = self.queue()
+        missing_ppd_dict['ppd_path'] = os.path.join(self.temp_dir,'missing.ppd')
+        self.assertRaises(print_queues.IPPError,print_queues.cups_add_modify_printer,missing_ppd_dict,False)
+
+    def test_falls_back_to_lpadmin(self):
+        lpadmin_commands_list = []
+        support.fresh_command_runner().substitute_tool('/usr/sbin/lpadmin',lambda command_list: lpadmin_commands_list.append(command_list) or '')
+        self.cupsd(StandInCUPS(given_ipp_status=0x0401))
+        self.assertTrue(print_queues.add_or_modify_print_queue(self.queue(),False,True))
+        self.assertEqual(lpadmin_commands_list[0][:3],['/usr/sbin/lpadmin','-p','lab_printer'])
+
+if __name__ == '__main__':
+    unittest.main()
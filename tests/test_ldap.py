@@ -0,0 +1,335 @@
+# Tests for the BER encoding and the LDAP client in conditions_common,
+# against a stand-in directory server on the loopback (plain and LDAPS,
+# with the self-signed localhost certificate in fixtures/), and for the
+# batched group GUID lookup in admin-groups.py.
+
+import unittest, socket, ssl, uuid, subprocess, plistlib
+import support
+from support import conditions_common
+
+admin_groups = support.load_condition('admin-groups.py')
+
+CERT_PATH = support.fixture_path('ldap-server-cert.pem')
+KEY_PATH = support.fixture_path('ldap-server-key.pem')
+BIND_DN = 'CN=svc-munki,OU=Service,DC=example,DC=org'
+BIND_PASSWORD = 'secret'
+ENTRIES_LIST = [('CN=Group %d,OU=Groups,DC=example,DC=org' % i,{'objectGUID':['guid-%d' % i],'cn':['Group %d' % i]}) for i in range(5)]
+
+def ldap_result(given_tag,given_result_code=0,given_diagnostic_message=''):
+    return conditions_common.ber_encode_sequence([conditions_common.ber_encode_integer(given_result_code,0x0A),
+                                                  conditions_common.ber_encode_string(''),
+                                                  conditions_common.ber_encode_string(given_diagnostic_message)],given_tag)
+
+class StandInDirectory(object):
+    '''Serves one LDAP connection: binds succeed for BIND_DN and
+        BIND_PASSWORD (or anonymously); searches return ENTRIES_LIST, in
+        pages if the paged results control asks.  Requests received are kept
+        in requests_list as (protocol op tag, value, controls) tuples.'''
+    def __init__(self,given_tls=False,given_search_result_code=0):
+        self.tls = given_tls
+        self.search_result_code = given_search_result_code
+        self.requests_list = []
+
+    def __call__(self,given_socket):
+        if self.tls:
+            try:
+                given_socket = ssl.wrap_socket(given_socket,server_side=True,certfile=CERT_PATH,keyfile=KEY_PATH)
+            except (ssl.SSLError,socket.error):
+                return
+        buffer = ''
+        while True:
+            try:
+                tag, ldap_message, offset = conditions_common.ber_decode(buffer)
+            except ValueError:
+                try:
+                    chunk = given_socket.recv(65536)
+                except (ssl.SSLError,socket.error):
+                    return
+                if not chunk:
+                    return
+                buffer += chunk
+                continue
+            buffer = buffer[offset:]
+            elements_list = conditions_common.ber_decode_all(ldap_message)
+            message_id = conditions_common.ber_decode_integer(elements_list[0][1])
+            protocol_tag, protocol_op = elements_list[1]
+            controls = elements_list[2][1] if len(elements_list) > 2 else ''
+            self.requests_list.append((protocol_tag,protocol_op,controls))
+            if protocol_tag == 0x42: # unbind
+                return
+            for reply in self.replies(protocol_tag,protocol_op,controls):
+                given_socket.sendall(conditions_common.ber_encode_sequence([conditions_common.ber_encode_integer(message_id)] + reply))
+
+    def replies(self,given_tag,given_op,given_controls):
+        '''Returns the replies to a request, each a list of encoded elements
+            (protocol op, and controls if any).'''
+        if given_tag == 0x60:
+            version, bind_dn, password = [value for tag, value in conditions_common.ber_decode_all(given_op)]
+            if (bind_dn, password) in [(BIND_DN,BIND_PASSWORD),('','')]:
+                return [[ldap_result(0x61)]]
+            return [[ldap_result(0x61,49,'invalid credentials')]]
+        if given_tag == 0x63:
+            if self.search_result_code:
+                return [[ldap_result(0x65,self.search_result_code,'no such object')]]
+            start, count = 0, len(ENTRIES_LIST)
+            paged = False
+            for tag, control in conditions_common.ber_decode_all(given_controls):
+                control_values_list = [value for value_tag, value in conditions_common.ber_decode_all(control)]
+                oid, control_value = control_values_list[0], control_values_list[-1]
+                if oid == conditions_common.LDAPConnection.PAGED_RESULTS_OID:
+                    size, cookie = [value for value_tag, value in conditions_common.ber_decode_all(conditions_common.ber_decode(control_value)[1])]
+                    paged = True
+                    count = conditions_common.ber_decode_integer(size)
+                    start = int(cookie or 0)
+            replies_list = []
+            for dn, attributes_dict in ENTRIES_LIST[start:start+count]:
+                attributes_list = [conditions_common.ber_encode_sequence([conditions_common.ber_encode_string(name),
+                                                                          conditions_common.ber_encode_sequence([conditions_common.ber_encode_string(value) for value in values_list],0x31)])
+                                   for name, values_list in sorted(attributes_dict.items())]
+                replies_list.append([conditions_common.ber_encode_sequence([conditions_common.ber_encode_string(dn),
+                                                                            conditions_common.ber_encode_sequence(attributes_list)],0x64)])
+            done = [ldap_result(0x65)]
+            if paged:
+                cookie = str(start + count) if start + count < len(ENTRIES_LIST) else ''
+                paged_value = conditions_common.ber_encode_sequence([conditions_common.ber_encode_integer(0),conditions_common.ber_encode_string(cookie)])
+                done.append(conditions_common.ber_encode_sequence([conditions_common.ber_encode_sequence([
+                    conditions_common.ber_encode_string(conditions_common.LDAPConnection.PAGED_RESULTS_OID),
+                    conditions_common.ber_encode_string(paged_value)])],0xA0))
+            return replies_list + [done]
+        return []
+
+class StandInGroupDirectory(StandInDirectory):
+    '''Answers searches for groups by sAMAccountName, as
+        ldap_lookup_group_guids() sends them, from groups_dict (name to
+        objectGUID bytes), matching names case-insensitively.  The names
+        asked for by each search are kept in searched_names_list.'''
+    def __init__(self,given_groups_dict):
+        StandInDirectory.__init__(self)
+        self.groups_dict = given_groups_dict
+        self.searched_names_list = []
+
+    def replies(self,given_tag,given_op,given_controls):
+        if given_tag != 0x63:
+            return StandInDirectory.replies(self,given_tag,given_op,given_controls)
+        ldap_filter = conditions_common.ber_decode_all(given_op)[6][1]
+        class_filter, names_filter = conditions_common.ber_decode_all(ldap_filter)
+        names_list = [conditions_common.ber_decode_all(name_filter)[1][1].decode('utf-8')
+                      for name_tag, name_filter in conditions_common.ber_decode_all(names_filter[1])]
+        self.searched_names_list.append(names_list)
+        wanted_names_set = set([name.lower() for name in names_list])
+        replies_list = []
+        for group_name, object_guid in sorted(self.groups_dict.items()):
+            if group_name.lower() not in wanted_names_set:
+                continue
+            attributes_list = [conditions_common.ber_encode_sequence([conditions_common.ber_encode_string(name),
+                                                                      conditions_common.ber_encode_sequence([conditions_common.ber_encode_string(value)],0x31)])
+                               for name, value in [('objectGUID',object_guid),('sAMAccountName',group_name)]]
+            replies_list.append([conditions_common.ber_encode_sequence([conditions_common.ber_encode_string('CN=%s,OU=Groups,DC=example,DC=org' % group_name),
+                                                                        conditions_common.ber_encode_sequence(attributes_list)],0x64)])
+        return replies_list + [[ldap_result(0x65)]]
+
+class BERTests(unittest.TestCase):
+    def test_integers(self):
+        for integer in [0,1,127,128,255,256,65535,2**31,-1,-128,-129,-2**31]:
+            tag, value, offset = conditions_common.ber_decode(conditions_common.ber_encode_integer(integer))
+            self.assertEqual(tag,0x02)
+            self.assertEqual(conditions_common.ber_decode_integer(value),integer)
+        self.assertEqual(conditions_common.ber_encode_integer(127),'\x02\x01\x7f')
+        self.assertEqual(conditions_common.ber_encode_integer(128),'\x02\x02\x00\x80')
+        self.assertEqual(conditions_common.ber_encode_integer(-129),'\x02\x02\xff\x7f')
+        self.assertEqual(conditions_common.ber_encode_integer(2,0x0A),'\x0a\x01\x02')
+
+    def test_long_lengths(self):
+        for length in [127,128,255,256,70000]:
+            element = conditions_common.ber_encode_string('x' * length)
+            tag, value, offset = conditions_common.ber_decode(element)
+            self.assertEqual((tag,len(value),offset),(0x04,length,len(element)))
+        self.assertEqual(conditions_common.ber_encode_string('x' * 200)[:3],'\x04\x81\xc8')
+        self.assertEqual(conditions_common.ber_encode_string(u'caf\xe9'),'\x04\x05caf\xc3\xa9')
+
+    def test_sequences_and_filters(self):
+        ldap_filter = conditions_common.ldap_filter_and([conditions_common.ldap_filter_equal('objectClass','group'),
+                                                         conditions_common.ldap_filter_or([conditions_common.ldap_filter_equal('cn','a'),
+                                                                                           conditions_common.ldap_filter_equal('cn','b')])])
+        self.assertEqual(ldap_filter,'\xa0\x2a\xa3\x14\x04\x0bobjectClass\x04\x05group'
+                                     '\xa1\x12\xa3\x07\x04\x02cn\x04\x01a\xa3\x07\x04\x02cn\x04\x01b')
+        self.assertEqual(conditions_common.ber_decode_all('\x01\x01\xff\x04\x00'),[(0x01,'\xff'),(0x04,'')])
+
+    def test_malformed(self):
+        for data in ['','\x04','\x04\x05abc','\x30\x80\x00\x00','\x04\x85\x01\x00\x00\x00\x00\x00','\x04\x82\x01']:
+            self.assertRaises(ValueError,conditions_common.ber_decode,data)
+
+class LDAPConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            support.stop_stand_in(self.server)
+
+    def directory(self,given_directory):
+        self.server = support.tcp_stand_in(given_directory)
+        return self.server.port
+
+    def test_bind(self):
+        directory = StandInDirectory()
+        connection = conditions_common.LDAPConnection('ldap://127.0.0.1:%d' % self.directory(directory),5)
+        self.assertFalse(connection.encrypted)
+        connection.simple_bind(BIND_DN,BIND_PASSWORD,True)
+        try:
+            connection.simple_bind(BIND_DN,'wrong',True)
+        except conditions_common.LDAPError, error:
+            self.assertEqual(error.result_code,49)
+        else:
+            self.fail('Bind with a wrong password succeeded')
+        connection.close()
+
+    def test_refuses_cleartext_password(self):
+        directory = StandInDirectory()
+        connection = conditions_common.LDAPConnection('ldap://127.0.0.1:%d' % self.directory(directory),5)
+        self.assertRaises(conditions_common.LDAPError,connection.simple_bind,BIND_DN,BIND_PASSWORD)
+        connection.simple_bind('','') # anonymous
+        connection.close()
+        # Only the anonymous bind reached the server:
+        binds_list = [request[1] for request in directory.requests_list if request[0] == 0x60]
+        self.assertEqual(binds_list,['\x02\x01\x03\x04\x00\x80\x00'])
+
+    def test_paged_search(self):
+        directory = StandInDirectory()
+        connection = conditions_common.LDAPConnection('ldap://127.0.0.1:%d' % self.directory(directory),5)
+        ldap_filter = conditions_common.ldap_filter_equal('objectClass','group')
+        results_list = list(connection.search('DC=example,DC=org',ldap_filter,['objectGUID','cn'],2))
+        connection.close()
+        self.assertEqual(results_list,[(dn,dict((name.lower(),values) for name, values in attributes_dict.items())) for dn, attributes_dict in ENTRIES_LIST])
+        # (The unbind sent by close() may not have arrived yet.)
+        self.assertEqual([request[0] for request in directory.requests_list][:3],[0x63,0x63,0x63])
+        request_list = conditions_common.ber_decode_all(directory.requests_list[0][1])
+        self.assertEqual(request_list[0][1],'DC=example,DC=org')
+        self.assertEqual(conditions_common.ber_encode(*request_list[6]),ldap_filter)
+
+    def test_search_without_paging(self):
+        directory = StandInDirectory()
+        connection = conditions_common.LDAPConnection('ldap://127.0.0.1:%d' % self.directory(directory),5)
+        self.assertEqual(len(list(connection.search('DC=example,DC=org',conditions_common.ldap_filter_equal('cn','x'),['cn']))),5)
+        connection.close()
+        self.assertEqual(directory.requests_list[0][2],'')
+
+    def test_search_error(self):
+        connection = conditions_common.LDAPConnection('ldap://127.0.0.1:%d' % self.directory(StandInDirectory(given_search_result_code=32)),5)
+        self.assertRaises(conditions_common.LDAPError,list,connection.search('DC=example,DC=org',conditions_common.ldap_filter_equal('cn','x'),['cn']))
+        connection.close()
+
+    def test_cannot_connect(self):
+        closed_socket = socket.socket()
+        closed_socket.bind(('127.0.0.1',0))
+        port = closed_socket.getsockname()[1]
+        closed_socket.close()
+        self.assertRaises(conditions_common.LDAPError,conditions_common.LDAPConnection,'ldap://127.0.0.1:%d' % port,1)
+
+    def test_ldaps(self):
+        port = self.directory(StandInDirectory(True))
+        connection = conditions_common.LDAPConnection('ldaps://localhost:%d' % port,5,CERT_PATH)
+        self.assertTrue(connection.encrypted)
+        connection.simple_bind(BIND_DN,BIND_PASSWORD)
+        self.assertEqual(len(list(connection.search('DC=example,DC=org',conditions_common.ldap_filter_equal('cn','x'),['cn'],3))),5)
+        connection.close()
+
+    def test_ldaps_verifies_the_certificate(self):
+        port = self.directory(StandInDirectory(True))
+        # Not signed by a CA the system trusts:
+        self.assertRaises(conditions_common.LDAPError,conditions_common.LDAPConnection,'ldaps://localhost:%d' % port,5)
+        # Trusted, but issued for another name:
+        self.assertRaises(conditions_common.LDAPError,conditions_common.LDAPConnection,'ldaps://127.0.0.1:%d' % port,5,CERT_PATH)
+
+def object_guid(given_index):
+    return uuid.UUID(int=(0x0123456789ABCDEF << 64) + given_index).bytes_le
+
+class GroupGUIDLookupTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_settings = (admin_groups.LDAP_GUID_RESOLVER,admin_groups.LDAP_URI,admin_groups.LDAP_BIND_DN,
+                               admin_groups.LDAP_GUID_BATCH_SIZE)
+        self.server = None
+        self.dscl_commands_list = []
+
+    def tearDown(self):
+        (admin_groups.LDAP_GUID_RESOLVER,admin_groups.LDAP_URI,admin_groups.LDAP_BIND_DN,
+         admin_groups.LDAP_GUID_BATCH_SIZE) = self.saved_settings
+        if self.server:
+            support.stop_stand_in(self.server)
+
+    def directory(self,given_groups_dict):
+        directory = StandInGroupDirectory(given_groups_dict)
+        self.server = support.tcp_stand_in(directory)
+        admin_groups.LDAP_URI = 'ldap://127.0.0.1:%d' % self.server.port
+        admin_groups.LDAP_BIND_DN = ''
+        return directory
+
+    def stand_in_dscl(self,given_command_list):
+        '''dscl knows one group, Printer Admins, that LDAP does not.'''
+        self.dscl_commands_list.append(given_command_list)
+        if given_command_list[4] == 'Groups/Printer Admins':
+            return plistlib.writePlistToString({'dsAttrTypeStandard:GeneratedUID':['C7E4B9A2-3F5D-4A71-8CBD-2E3F4A5B6C7D']})
+        raise subprocess.CalledProcessError(56,given_command_list,'DS Error: -14136 (eDSRecordNotFound)\n')
+
+    def test_generated_uid_byte_order(self):
+        # objectGUID stores the first three fields little-endian:
+        guid_bytes = '\x33\x22\x11\x00\x55\x44\x77\x66\x88\x99\xaa\xbb\xcc\xdd\xee\xff'
+        self.assertEqual(admin_groups.ldap_guid_to_generated_uid(guid_bytes),'00112233-4455-6677-8899-AABBCCDDEEFF')
+        self.assertEqual(admin_groups.ldap_guid_to_generated_uid(object_guid(5)),'01234567-89AB-CDEF-0000-000000000005')
+
+    def test_names_matched_case_insensitively(self):
+        self.directory({'Lab Admins':object_guid(1),u'Caf\xe9 Admins':object_guid(2)})
+        guids_dict = admin_groups.ldap_lookup_group_guids(['LAB ADMINS',u'caf\xe9 admins','Missing Group'])
+        self.assertEqual(guids_dict,{'lab admins':admin_groups.ldap_guid_to_generated_uid(object_guid(1)),
+                                     u'caf\xe9 admins':admin_groups.ldap_guid_to_generated_uid(object_guid(2))})
+
+    def test_batches(self):
+        directory = self.directory(dict(('Group %d' % i,object_guid(i)) for i in range(7)))
+        admin_groups.LDAP_GUID_BATCH_SIZE = 3
+        guids_dict = admin_groups.ldap_lookup_group_guids(['Group %d' % i for i in range(7)])
+        self.assertEqual(len(guids_dict),7)
+        self.assertEqual(directory.searched_names_list,[['Group 0','Group 1','Group 2'],['Group 3','Group 4','Group 5'],['Group 6']])
+
+    def test_prefetch_falls_back_to_dscl(self):
+        self.directory({'Lab Admins':object_guid(1)})
+        admin_groups.LDAP_GUID_RESOLVER = True
+        support.fresh_command_runner().substitute_tool(conditions_common.DSCL_PATH,self.stand_in_dscl)
+        resolver = admin_groups.GroupGUIDResolver()
+        resolver.prefetch(['lab admins','Printer Admins','Missing Group'])
+        self.assertEqual(resolver.ldap_resolved,1)
+        self.assertEqual(resolver.group_dict('lab admins')['guid'],admin_groups.ldap_guid_to_generated_uid(object_guid(1)))
+        self.assertEqual(self.dscl_commands_list,[])
+        # Names LDAP did not return are looked up with dscl:
+        self.assertEqual(resolver.group_dict('Printer Admins')['guid'],'C7E4B9A2-3F5D-4A71-8CBD-2E3F4A5B6C7D')
+        self.assertEqual(resolver.group_dict('Missing Group')['guid'],None)
+        self.assertEqual([command_list[4] for command_list in self.dscl_commands_list],['Groups/Printer Admins','Groups/Missing Group'])
+        self.assertEqual(resolver.dscl_lookups,2)
+
+    def test_prefetch_ldap_failure_leaves_all_to_dscl(self):
+        closed_socket = socket.socket()
+        closed_socket.bind(('127.0.0.1',0))
+        admin_groups.LDAP_URI = 'ldap://127.0.0.1:%d' % closed_socket.getsockname()[1]
+        closed_socket.close()
+        admin_groups.LDAP_GUID_RESOLVER = True
+        support.fresh_command_runner().substitute_tool(conditions_common.DSCL_PATH,self.stand_in_dscl)
+        resolver = admin_groups.GroupGUIDResolver()
+        resolver.prefetch(['Printer Admins'])
+        self.assertEqual((resolver.ldap_resolved,resolver.group_dicts_dict),(0,{}))
+        self.assertEqual(resolver.group_dict('Printer Admins')['guid'],'C7E4B9A2-3F5D-4A71-8CBD-2E3F4A5B6C7D')
+
+    def test_many_names(self):
+        names_count = 2000
+        directory = self.directory(dict(('Group %04d' % i,object_guid(i)) for i in range(names_count)))
+        admin_groups.LDAP_GUID_RESOLVER = True
+        support.fresh_command_runner().substitute_tool(conditions_common.DSCL_PATH,self.stand_in_dscl)
+        resolver = admin_groups.GroupGUIDResolver()
+        names_list = ['Group %04d' % i for i in range(names_count)]
+        resolver.prefetch(names_list + names_list[:10])
+        self.assertEqual(len(directory.searched_names_list),-(-names_count // admin_groups.LDAP_GUID_BATCH_SIZE))
+        self.assertEqual(sum([len(searched_list) for searched_list in directory.searched_names_list]),names_count)
+        self.assertEqual(resolver.ldap_resolved,names_count)
+        self.assertEqual(resolver.group_dict('Group 1234')['guid'],admin_groups.ldap_guid_to_generated_uid(object_guid(1234)))
+        self.assertEqual(self.dscl_commands_list,[])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+# Tests for conditions_common.ManifestIncludeGraph, and a benchmark of
+# resolving synthetic include trees (in memory and from manifest files).
+
+import unittest, os, tempfile, shutil, plistlib
+import support
+from support import conditions_common
+
+def synthetic_includes(given_manifest_count,given_fanout=3):
+    '''Returns a dict of manifest name to included manifest names: a tree of
+        given_manifest_count group manifests, each also including a shared
+        manifest, with every ninth one also including an earlier manifest
+        (which closes a cycle when it leads back to an ancestor).'''
+    includes_dict = {'shared/common':['shared/printers'],'shared/printers':[]}
+    for i in range(given_manifest_count):
+        children_list = ['groups/g%05d' % child for child in range(given_fanout * i + 1,min(given_fanout * i + given_fanout + 1,given_manifest_count))]
+        children_list.append('shared/common')
+        if i and i % 9 == 0:
+            children_list.append('groups/g%05d' % (i // 9))
+        includes_dict['groups/g%05d' % i] = children_list
+    return includes_dict
+
+def is_acyclic(given_edges_list):
+    '''Kahn\'s algorithm: True if the given (from, to) edges have no cycle.'''
+    in_degree_dict = {}
+    children_dict = {}
+    for from_name, to_name in given_edges_list:
+        in_degree_dict.setdefault(from_name,0)
+        in_degree_dict[to_name] = in_degree_dict.get(to_name,0) + 1
+        children_dict.setdefault(from_name,[]).append(to_name)
+    ready_list = [ name for name in in_degree_dict if not in_degree_dict[name] ]
+    removed_count = 0
+    while ready_list:
+        name = ready_list.pop()
+        removed_count += 1
+        for child_name in children_dict.get(name,[]):
+            in_degree_dict[child_name] -= 1
+            if not in_degree_dict[child_name]:
+                ready_list.append(child_name)
+    return removed_count == len(in_degree_dict)
+
+def legacy_manifest_names(given_root_manifest_name,given_includes_function):
+    '''The list-based walk make_list_of_applicable_manifests() used before
+        ManifestIncludeGraph, for comparison.'''
+    processed_manifest_names_list = []
+    queued_manifest_names_list = [given_root_manifest_name]
+    while True:
+        new_manifests_list = []
+        for manifest_name in queued_manifest_names_list:
+            new_manifests_list.extend(given_includes_function(manifest_name))
+            if manifest_name not in processed_manifest_names_list:
+                processed_manifest_names_list.append(manifest_name)
+        if not new_manifests_list:
+            break
+        for manifest_name in new_manifests_list:
+            if manifest_name not in queued_manifest_names_list:
+                queued_manifest_names_list.append(manifest_name)
+        for manifest_name in queued_manifest_names_list:
+            if manifest_name in processed_manifest_names_list:
+                queued_manifest_names_list.remove(manifest_name)
+    return processed_manifest_names_list
+
+class CountingIncludes(object):
+    def __init__(self,given_includes_dict):
+        self.includes_dict = given_includes_dict
+        self.reads_dict = {}
+
+    def __call__(self,given_manifest_name):
+        self.reads_dict[given_manifest_name] = self.reads_dict.get(given_manifest_name,0) + 1
+        return self.includes_dict.get(given_manifest_name,[])
+
+class ManifestIncludeGraphTests(unittest.TestCase):
+    def test_breadth_first_order_and_depths(self):
+        includes = CountingIncludes({'site':['a','b','a',7,''],'a':['c','b'],'b':['c'],'c':[]})
+        manifest_graph = conditions_common.ManifestIncludeGraph('site',given_includes_function=includes)
+        self.assertEqual(manifest_graph.manifest_names,['site','a','b','c'])
+        self.assertEqual(manifest_graph.depths,{'site':0,'a':1,'b':1,'c':2})
+        self.assertEqual(manifest_graph.edges,[('site','a'),('site','b'),('a','c'),('a','b'),('b','c')])
+        self.assertEqual(sorted(manifest_graph.included_by('c')),['a','b'])
+        self.assertEqual(manifest_graph.cycles,[])
+        self.assertEqual(set(includes.reads_dict.values()),set([1]))
+
+    def test_cycles(self):
+        includes = CountingIncludes({'site':['a'],'a':['b'],'b':['site','a'],'self':['self']})
+        manifest_graph = conditions_common.ManifestIncludeGraph('site',given_includes_function=includes)
+        self.assertEqual(manifest_graph.manifest_names,['site','a','b'])
+        self.assertEqual(sorted(manifest_graph.cycles),[('b','a'),('b','site')])
+        self.assertEqual(conditions_common.ManifestIncludeGraph('self',given_includes_function=includes).cycles,[('self','self')])
+
+    def test_max_depth(self):
+        includes = CountingIncludes(dict(('m%d' % i,['m%d' % (i + 1)]) for i in range(10)))
+        manifest_graph = conditions_common.ManifestIncludeGraph('m0',3,includes)
+        self.assertEqual(manifest_graph.manifest_names,['m0','m1','m2','m3'])
+        self.assertEqual(manifest_graph.truncated,['m3'])
+
+    def test_same_manifests_as_legacy_walk(self):
+        includes_dict = synthetic_includes(500)
+        manifest_graph = conditions_common.ManifestIncludeGraph('groups/g00000',given_includes_function=includes_dict.get)
+        self.assertEqual(manifest_graph.manifest_names,legacy_manifest_names('groups/g00000',includes_dict.get))
+        # Every cycle found closes on one of the back-references, and they
+        # are all found: without them the graph has no cycle.
+        back_references_list = [ ('groups/g%05d' % i,'groups/g%05d' % (i // 9)) for i in range(9,500,9) ]
+        self.assertTrue(manifest_graph.cycles)
+        self.assertTrue(set(manifest_graph.cycles) <= set(back_references_list))
+        self.assertTrue(is_acyclic([ edge for edge in manifest_graph.edges if edge not in manifest_graph.cycles ]))
+
+class ManifestIncludeGraphBenchmark(unittest.TestCase):
+    def resolve_seconds(self,given_includes_dict):
+        return support.best_time(lambda: conditions_common.ManifestIncludeGraph('groups/g00000',10000,given_includes_dict.get))
+
+    def test_resolve_scales_linearly(self):
+        small_count, large_count = support.benchmark_size((2500,10000),(10000,100000))
+        small_seconds = self.resolve_seconds(synthetic_includes(small_count))
+        large_seconds = self.resolve_seconds(synthetic_includes(large_count))
+        # Linear, with room for timing noise; the legacy walk is quadratic.
+        self.assertTrue(large_seconds < small_seconds * (large_count / small_count) * 3 + 0.05)
+        rows_list = [('ManifestIncludeGraph, %d manifests' % small_count,small_seconds),
+                     ('ManifestIncludeGraph, %d manifests' % large_count,large_seconds)]
+        if support.BENCHMARK:
+            includes_dict = synthetic_includes(small_count)
+            rows_list.append(('legacy list walk, %d manifests' % small_count,
+                              support.best_time(lambda: legacy_manifest_names('groups/g00000',includes_dict.get),1)))
+        support.benchmark_report('Resolving manifest includes (in memory)',rows_list)
+
+    def test_resolve_from_manifest_files(self):
+        manifest_count = support.benchmark_size(300,10000)
+        includes_dict = synthetic_includes(manifest_count)
+        temp_dir = tempfile.mkdtemp()
+        saved_manifests_path = conditions_common.MUNKI_MANIFESTS_PATH
+        conditions_common.MUNKI_MANIFESTS_PATH = temp_dir
+        try:
+            for manifest_name, included_list in includes_dict.items():
+                manifest_path = os.path.join(temp_dir,manifest_name)
+                if not os.path.isdir(os.path.dirname(manifest_path)):
+                    os.makedirs(os.path.dirname(manifest_path))
+                plistlib.writePlist({'catalogs':['production'],
+                                     'included_manifests':included_list,
+                                     'managed_installs':['item%03d' % i for i in range(50)],
+                                     '_metadata':{'nested_admin_groups':[]}},manifest_path)
+            seconds = support.best_time(lambda: conditions_common.ManifestIncludeGraph('groups/g00000',10000),1)
+            manifest_graph = conditions_common.ManifestIncludeGraph('groups/g00000',10000)
+            self.assertEqual(len(manifest_graph.manifest_names),manifest_count + 2)
+        finally:
+            conditions_common.MUNKI_MANIFESTS_PATH = saved_manifests_path
+            shutil.rmtree(temp_dir)
+        support.benchmark_report('Resolving manifest includes (manifest files)',
+                                 [('ManifestIncludeGraph, %d manifest files' % manifest_count,seconds)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# Tests for conditions_common.ManifestMetadataIndex and
+# get_effective_manifest_metadata(): manifests re-read only when their mtime
+# or size changes, deleted manifests dropped, the index kept between runs
+# (and rebuilt when unreadable), and how _metadata is merged across the
+# include graph.
+
+import unittest, os, tempfile, shutil, plistlib
+import support
+from support import conditions_common
+
+class ManifestMetadataIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.manifests_dir = os.path.join(self.temp_dir,'manifests')
+        os.makedirs(self.manifests_dir)
+        self.index_path = os.path.join(self.temp_dir,'ConditionsManifestIndex.plist')
+        self.saved_settings = (conditions_common.MUNKI_MANIFESTS_PATH,conditions_common.MANIFEST_METADATA_INDEX_PATH,
+                               conditions_common.read_manifest_keys)
+        conditions_common.MUNKI_MANIFESTS_PATH = self.manifests_dir
+        conditions_common.MANIFEST_METADATA_INDEX_PATH = self.index_path
+        # Count the manifests actually parsed:
+        self.parsed_list = []
+        read_manifest_keys = conditions_common.read_manifest_keys
+        def counting_read_manifest_keys(given_manifest_name,*args):
+            self.parsed_list.append(given_manifest_name)
+            return read_manifest_keys(given_manifest_name,*args)
+        conditions_common.read_manifest_keys = counting_read_manifest_keys
+        self.write_manifest('site',['groups/lab','shared/common'],{'nested_admin_groups':['Site Admins'],
+                                                                   'print_queues':[{'name':'Lobby','uri':'lpd://10.0.0.5/lobby'}]})
+        self.write_manifest('groups/lab',['shared/common'],{'nested_admin_groups':['Lab Admins','Site Admins'],
+                                                            'exclude_admins_from_dsconfigad':True,
+                                                            'print_queues':[{'name':'Lab','uri':'lpd://10.0.0.6/lab'},
+                                                                            {'name':'Lobby','uri':'lpd://10.0.0.7/other'}]})
+        self.write_manifest('shared/common',[],{'nested_admin_groups':['Help Desk'],
+                                                'exclude_admins_from_dsconfigad':False,
+                                                'print_queues':[{'uri':'lpd://10.0.0.8/unnamed'},'Lab']})
+
+    def tearDown(self):
+        (conditions_common.MUNKI_MANIFESTS_PATH,conditions_common.MANIFEST_METADATA_INDEX_PATH,
+         conditions_common.read_manifest_keys) = self.saved_settings
+        shutil.rmtree(self.temp_dir)
+
+    def write_manifest(self,given_manifest_name,given_included_list,given_metadata_dict):
+        manifest_path = os.path.join(self.manifests_dir,given_manifest_name)
+        if not os.path.isdir(os.path.dirname(manifest_path)):
+            os.makedirs(os.path.dirname(manifest_path))
+        plistlib.writePlist({'catalogs':['production'],
+                             'included_manifests':given_included_list,
+                             'managed_installs':['Firefox'],
+                             '_metadata':given_metadata_dict},manifest_path)
+        return manifest_path
+
+    def run_once(self):
+        '''One run, as a condition would: returns the effective metadata and
+            the index used.'''
+        manifest_index = conditions_common.ManifestMetadataIndex()
+        manifest_graph = conditions_common.resolve_manifest_include_graph('site',manifest_index)
+        effective_metadata_dict = manifest_index.effective_metadata(manifest_graph)
+        manifest_index.save()
+        return effective_metadata_dict, manifest_index
+
+    def test_merge(self):
+        effective_metadata_dict = conditions_common.get_effective_manifest_metadata('site')
+        # Breadth-first: site, groups/lab, shared/common.  Lists are
+        # joined without repeats; the first queue with a name wins and
+        # queues without one are skipped:
+        self.assertEqual(effective_metadata_dict,
+                         {'nested_admin_groups':['Site Admins','Lab Admins','Help Desk'],
+                          'exclude_admins_from_dsconfigad':True,
+                          'print_queues':[{'name':'Lobby','uri':'lpd://10.0.0.5/lobby'},
+                                          {'name':'Lab','uri':'lpd://10.0.0.6/lab'}]})
+        self.assertEqual(sorted(self.parsed_list),['groups/lab','shared/common','site'])
+
+    def test_exclude_admins_is_any_true(self):
+        self.write_manifest('groups/lab',['shared/common'],{'exclude_admins_from_dsconfigad':False})
+        self.assertFalse(self.run_once()[0]['exclude_admins_from_dsconfigad'])
+        # A later false does not undo an earlier true:
+        self.write_manifest('site',['groups/lab','shared/common'],{'exclude_admins_from_dsconfigad':True})
+        self.assertTrue(self.run_once()[0]['exclude_admins_from_dsconfigad'])
+
+    def test_only_changed_manifests_parsed(self):
+        self.run_once()
+        self.parsed_list = []
+        effective_metadata_dict, manifest_index = self.run_once()
+        self.assertEqual(self.parsed_list,[])
+        self.assertEqual(manifest_index.stats_dict,{'reused':3,'parsed':0,'missing':0})
+        self.assertFalse(manifest_index.changed)
+        # A new size:
+        self.write_manifest('shared/common',[],{'nested_admin_groups':['Help Desk','Printing']})
+        # The same size, but a new mtime:
+        lab_path = os.path.join(self.manifests_dir,'groups/lab')
+        lab_stat = os.stat(lab_path)
+        os.utime(lab_path,(lab_stat.st_atime,lab_stat.st_mtime + 10))
+        effective_metadata_dict, manifest_index = self.run_once()
+        self.assertEqual(sorted(self.parsed_list),['groups/lab','shared/common'])
+        self.assertEqual(manifest_index.stats_dict,{'reused':1,'parsed':2,'missing':0})
+        self.assertEqual(effective_metadata_dict['nested_admin_groups'],['Site Admins','Lab Admins','Help Desk','Printing'])
+
+    def test_deleted_manifest_dropped(self):
+        self.run_once()
+        os.remove(os.path.join(self.manifests_dir,'shared/common'))
+        effective_metadata_dict, manifest_index = self.run_once()
+        self.assertEqual(manifest_index.stats_dict,{'reused':2,'parsed':0,'missing':1})
+        self.assertEqual(effective_metadata_dict['nested_admin_groups'],['Site Admins','Lab Admins'])
+        self.assertEqual(sorted(plistlib.readPlist(self.index_path)['manifests']),['groups/lab','site'])
+        # As is one no longer included:
+        self.write_manifest('site',['shared/common'],{})
+        self.run_once()
+        self.assertEqual(sorted(plistlib.readPlist(self.index_path)['manifests']),['site'])
+
+    def test_index_kept_between_runs(self):
+        self.run_once()
+        index_dict = plistlib.readPlist(self.index_path)
+        self.assertEqual((index_dict['index_version'],index_dict['manifests_path']),
+                         (conditions_common.MANIFEST_METADATA_INDEX_VERSION,self.manifests_dir))
+        self.assertEqual(index_dict['manifests']['groups/lab']['included_manifests'],['shared/common'])
+        # Only the _metadata keys conditions use are indexed:
+        self.write_manifest('site',['groups/lab'],{'nested_admin_groups':['Site Admins'],'owner':'IT'})
+        self.run_once()
+        self.assertEqual(plistlib.readPlist(self.index_path)['manifests']['site']['_metadata'],
+                         {'nested_admin_groups':['Site Admins']})
+        # A new instance reads the entries back:
+        manifest_index = conditions_common.ManifestMetadataIndex()
+        self.assertEqual(sorted(manifest_index.entries_dict),['groups/lab','shared/common','site'])
+        self.assertEqual(manifest_index.get_included_manifest_names('site'),['groups/lab'])
+        self.assertEqual(manifest_index.stats_dict['reused'],1)
+
+    def test_unreadable_index_rebuilt(self):
+        for index_contents in ['not a plist',plistlib.writePlistToString(['a list']),
+                               plistlib.writePlistToString({'index_version':conditions_common.MANIFEST_METADATA_INDEX_VERSION + 1,
+                                                            'manifests_path':self.manifests_dir,
+                                                            'manifests':{}})]:
+            with open(self.index_path,'w') as index_file:
+                index_file.write(index_contents)
+            self.parsed_list = []
+            effective_metadata_dict, manifest_index = self.run_once()
+            self.assertEqual(manifest_index.stats_dict['parsed'],3)
+            self.assertEqual(effective_metadata_dict['nested_admin_groups'],['Site Admins','Lab Admins','Help Desk'])
+            self.assertEqual(sorted(plistlib.readPlist(self.index_path)['manifests']),['groups/lab','shared/common','site'])
+        # An index of another manifests folder is not used:
+        conditions_common.MUNKI_MANIFESTS_PATH = self.manifests_dir + '/'
+        self.assertEqual(conditions_common.ManifestMetadataIndex().entries_dict,{})
+
+if __name__ == '__main__':
+    unittest.main()
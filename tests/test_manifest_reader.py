@@ -0,0 +1,202 @@
+# Tests for conditions_common.StreamingPlistKeyReader and
+# read_manifest_keys(), and a benchmark of reading the keys conditions use
+# from a large manifest against parsing it whole with plistlib.
+
+import unittest, os, sys, datetime, plistlib, subprocess, tempfile, shutil, StringIO
+import xml.parsers.expat
+import support
+from support import conditions_common
+
+SHARED_SUPPORT_DIR = os.path.dirname(os.path.realpath(conditions_common.__file__))
+
+NESTED_VALUES_DICT = {'included_manifests':['groups/lab','shared/common'],
+                      '_metadata':{'nested_admin_groups':['Lab Admins',u'Caf\xe9 Admins'],
+                                   'exclude_admins_from_dsconfigad':True,
+                                   'print_queues':[{'name':'lab_printer',
+                                                    'device_uri':'lpd://10.0.0.5/queue',
+                                                    'kerberos_auth_required':False,
+                                                    'additional_cups_opts':[]}],
+                                   'created':datetime.datetime(2017,7,23,14,5,9),
+                                   'revision':42,
+                                   'negative':-7,
+                                   'weight':0.25,
+                                   'token':plistlib.Data('\x00\x01binary\xff'),
+                                   'empty_dict':{},
+                                   'empty_string':'',
+                                   'nested':[[1,[2,{'deep':[3.5]}]],{}]},
+                      'managed_installs':['item%d' % i for i in range(20)],
+                      'catalogs':['production']}
+
+def manifest_plist(given_included_count,given_installs_count,given_wanted_keys_last=False):
+    '''Returns a generated manifest (XML) with given_installs_count
+        managed_installs entries.  plistlib writes keys sorted, so
+        included_manifests and _metadata come before managed_installs,
+        unless given_wanted_keys_last.'''
+    manifest_dict = {'catalogs':['production','testing'],
+                     'managed_installs':['Vendor-Product-%05d' % i for i in range(given_installs_count)],
+                     'managed_uninstalls':['Legacy-%03d' % i for i in range(50)],
+                     'optional_installs':['Optional-%03d' % i for i in range(200)]}
+    wanted_dict = {'_metadata':{'nested_admin_groups':['Lab Admins'],'print_queues':[]},
+                   'included_manifests':['groups/g%03d' % i for i in range(given_included_count)]}
+    if not given_wanted_keys_last:
+        manifest_dict.update(wanted_dict)
+        return plistlib.writePlistToString(manifest_dict)
+    wanted_data = plistlib.writePlistToString(wanted_dict)
+    wanted_data = wanted_data[wanted_data.index('<dict>') + len('<dict>'):wanted_data.rindex('</dict>')]
+    manifest_data = plistlib.writePlistToString(manifest_dict)
+    end_index = manifest_data.rindex('</dict>')
+    return manifest_data[:end_index] + wanted_data + manifest_data[end_index:]
+
+class CountingFile(object):
+    '''File-like object over a string that counts the bytes read.'''
+    def __init__(self,given_data):
+        self.data_file = StringIO.StringIO(given_data)
+        self.bytes_read = 0
+
+    def read(self,given_size):
+        chunk = self.data_file.read(given_size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+def read_keys(given_data,given_keys_list,given_chunk_size=conditions_common.PLIST_STREAM_CHUNK_SIZE):
+    return conditions_common.StreamingPlistKeyReader(given_keys_list).read_file(StringIO.StringIO(given_data),given_chunk_size)
+
+class StreamingPlistKeyReaderTests(unittest.TestCase):
+    def test_values_match_plistlib(self):
+        data = plistlib.writePlistToString(NESTED_VALUES_DICT)
+        expected_dict = plistlib.readPlistFromString(data)
+        # Small chunks split elements and text across parser calls:
+        for chunk_size in [7,64,conditions_common.PLIST_STREAM_CHUNK_SIZE]:
+            found_dict = read_keys(data,['included_manifests','_metadata','catalogs'],chunk_size)
+            self.assertEqual(found_dict,dict((key,expected_dict[key]) for key in ['included_manifests','_metadata','catalogs']))
+        metadata_dict = found_dict['_metadata']
+        self.assertTrue(isinstance(metadata_dict['token'],plistlib.Data))
+        self.assertEqual(metadata_dict['token'].data,'\x00\x01binary\xff')
+        self.assertEqual(type(metadata_dict['created']),datetime.datetime)
+        self.assertEqual(type(metadata_dict['weight']),float)
+        self.assertEqual(metadata_dict['nested_admin_groups'][1],u'Caf\xe9 Admins')
+
+    def test_skipped_keys_are_not_built(self):
+        # Values plistlib would reject, under keys that are not wanted:
+        data = ('<?xml version="1.0" encoding="UTF-8"?><plist version="1.0"><dict>'
+                '<key>managed_installs</key><array><integer>not a number</integer><date>never</date></array>'
+                '<key>optional_installs</key><dict><key>included_manifests</key><array><string>inner</string></array></dict>'
+                '<key>included_manifests</key><array><string>groups/lab</string></array>'
+                '</dict></plist>')
+        self.assertRaises(ValueError,plistlib.readPlistFromString,data)
+        # (The included_manifests key nested in optional_installs is not top level.)
+        self.assertEqual(read_keys(data,['included_manifests','_metadata']),{'included_manifests':['groups/lab']})
+
+    def test_stops_once_keys_are_found(self):
+        data = manifest_plist(3,5000)
+        # Anything after the wanted keys is never parsed, even if malformed:
+        truncated_data = data[:data.index('<key>managed_installs</key>')] + '<key>managed_installs</key><array><bad'
+        for manifest_data in [data,truncated_data]:
+            counting_file = CountingFile(manifest_data)
+            found_dict = conditions_common.StreamingPlistKeyReader(['included_manifests','_metadata']).read_file(counting_file,1024)
+            self.assertEqual(found_dict['included_manifests'],['groups/g000','groups/g001','groups/g002'])
+            self.assertTrue(counting_file.bytes_read <= data.index('<key>managed_installs</key>') + 1024)
+        self.assertTrue(counting_file.bytes_read < len(data) / 10)
+
+    def test_missing_keys_read_to_the_end(self):
+        data = manifest_plist(2,100)
+        counting_file = CountingFile(data)
+        found_dict = conditions_common.StreamingPlistKeyReader(['included_manifests','no_such_key']).read_file(counting_file,1024)
+        self.assertEqual(found_dict,{'included_manifests':['groups/g000','groups/g001']})
+        self.assertEqual(counting_file.bytes_read,len(data))
+
+    def test_non_dict_roots(self):
+        for root_object in [['included_manifests',['a']],'included_manifests',7]:
+            self.assertEqual(read_keys(plistlib.writePlistToString(root_object),['included_manifests']),{})
+
+    def test_malformed_xml(self):
+        for data in ['<plist><dict><key>included_manifests</key><array><string>a</array></dict></plist>',
+                     '<plist><dict><key>catalogs</key>',
+                     'not a plist at all <']:
+            self.assertRaises(xml.parsers.expat.ExpatError,read_keys,data,['included_manifests'])
+
+class ReadManifestKeysTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_manifests_path = conditions_common.MUNKI_MANIFESTS_PATH
+        conditions_common.MUNKI_MANIFESTS_PATH = self.temp_dir
+
+    def tearDown(self):
+        conditions_common.MUNKI_MANIFESTS_PATH = self.saved_manifests_path
+        shutil.rmtree(self.temp_dir)
+
+    def write_manifest(self,given_name,given_data):
+        with open(os.path.join(self.temp_dir,given_name),'wb') as manifest_file:
+            manifest_file.write(given_data)
+
+    def test_reads_indexed_keys(self):
+        self.write_manifest('site_default',plistlib.writePlistToString(NESTED_VALUES_DICT))
+        manifest_keys_dict = conditions_common.read_manifest_keys('site_default')
+        self.assertEqual(sorted(manifest_keys_dict),['_metadata','included_manifests'])
+        self.assertEqual(conditions_common.get_included_manifest_names_from_manifest('site_default'),['groups/lab','shared/common'])
+
+    def test_unreadable_manifests(self):
+        self.write_manifest('malformed','<plist><dict><key>included_manifests</key>')
+        self.write_manifest('bad_integer','<plist><dict><key>_metadata</key><dict><key>n</key><integer>x</integer></dict></dict></plist>')
+        os.mkdir(os.path.join(self.temp_dir,'groups'))
+        for manifest_name in ['malformed','bad_integer','missing','groups']:
+            self.assertEqual(conditions_common.read_manifest_keys(manifest_name),{})
+        self.assertEqual(conditions_common.get_included_manifest_names_from_manifest('malformed'),[])
+
+def peak_memory_growth_kb(given_statements):
+    '''Runs the given statements in a fresh interpreter with
+        conditions_common imported.  Returns how far they raised its peak
+        resident memory, in KB.  On Linux, ru_maxrss starts out at the peak of
+        the process that started the interpreter (here, the test run), so
+        VmHWM is read from /proc instead.'''
+    script = '\n'.join(['import sys, os, resource, plistlib',
+                        'sys.path.insert(0,%r)' % SHARED_SUPPORT_DIR,
+                        'import conditions_common',
+                        'def peak_kb():',
+                        '    if os.path.exists("/proc/self/status"):',
+                        '        for line in open("/proc/self/status"):',
+                        '            if line.startswith("VmHWM:"):',
+                        '                return int(line.split()[1])',
+                        '    if sys.platform == "darwin": # ru_maxrss is in bytes',
+                        '        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024',
+                        '    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss',
+                        'before = peak_kb()',
+                        given_statements,
+                        'print peak_kb() - before'])
+    return int(subprocess.check_output([sys.executable,'-c',script]).strip())
+
+class ManifestReaderBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_manifests_path = conditions_common.MUNKI_MANIFESTS_PATH
+        conditions_common.MUNKI_MANIFESTS_PATH = self.temp_dir
+
+    def tearDown(self):
+        conditions_common.MUNKI_MANIFESTS_PATH = self.saved_manifests_path
+        shutil.rmtree(self.temp_dir)
+
+    def test_reader_against_plistlib(self):
+        installs_count = support.benchmark_size(20000,200000)
+        rows_list = []
+        for manifest_name, wanted_keys_last in [('keys_first',False),('keys_last',True)]:
+            with open(os.path.join(self.temp_dir,manifest_name),'wb') as manifest_file:
+                manifest_file.write(manifest_plist(5,installs_count,wanted_keys_last))
+            manifest_path = os.path.join(self.temp_dir,manifest_name)
+            self.assertEqual(conditions_common.read_manifest_keys(manifest_name)['included_manifests'],plistlib.readPlist(manifest_path)['included_manifests'])
+            reader_seconds = support.best_time(lambda: conditions_common.read_manifest_keys(manifest_name))
+            plistlib_seconds = support.best_time(lambda: plistlib.readPlist(manifest_path),2)
+            reader_kb = peak_memory_growth_kb('conditions_common.MUNKI_MANIFESTS_PATH = %r\nkeys_dict = conditions_common.read_manifest_keys(%r)' % (self.temp_dir,manifest_name))
+            plistlib_kb = peak_memory_growth_kb('manifest_dict = plistlib.readPlist(%r)' % manifest_path)
+            # The reader builds only the wanted values:
+            self.assertTrue(reader_kb < plistlib_kb)
+            if not wanted_keys_last:
+                self.assertTrue(reader_seconds < plistlib_seconds)
+            label = manifest_name.replace('_',' ')
+            rows_list += [('read_manifest_keys, %s' % label,reader_seconds),
+                          ('plistlib.readPlist, %s' % label,plistlib_seconds),
+                          ('read_manifest_keys, %s, peak memory' % label,reader_kb,'KB'),
+                          ('plistlib.readPlist, %s, peak memory' % label,plistlib_kb,'KB')]
+        support.benchmark_report('Reading included_manifests and _metadata from a manifest with %d managed_installs' % installs_count,rows_list)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Conformance tests for conditions_common.read_plist() and
+# BinaryPlistReader: each case in fixtures/plists is stored as a binary and
+# as an XML plist (see make_corpus.py); the binary reader must give the same
+# values plistlib reads from the XML.
+
+import unittest, os, glob, datetime, plistlib, struct, tempfile, shutil
+import support
+from support import conditions_common
+
+CORPUS_DIR = support.fixture_path('plists')
+
+def comparable(given_value):
+    '''Returns the given value with plistlib.Data replaced by its bytes, so
+        values read different ways compare equal.'''
+    if isinstance(given_value,plistlib.Data):
+        return ('data',given_value.data)
+    if isinstance(given_value,dict):
+        return dict((key,comparable(value)) for key, value in given_value.items())
+    if isinstance(given_value,list):
+        return [comparable(value) for value in given_value]
+    return given_value
+
+def binary_plist(given_objects_list,given_top_object=0,given_ref_size=1):
+    '''Assembles a binary plist from encoded objects (for malformed cases).'''
+    data = 'bplist00'
+    offsets_list = []
+    for encoded_object in given_objects_list:
+        offsets_list.append(len(data))
+        data += encoded_object
+    offset_table_offset = len(data)
+    data += ''.join([struct.pack('>H',offset) for offset in offsets_list])
+    return data + struct.pack('>6xBBQQQ',2,given_ref_size,len(given_objects_list),given_top_object,offset_table_offset)
+
+class PlistCorpusTests(unittest.TestCase):
+    def test_corpus_is_present(self):
+        self.assertTrue(len(glob.glob(os.path.join(CORPUS_DIR,'*.bplist'))) >= 7)
+
+    def test_binary_matches_xml(self):
+        for binary_path in sorted(glob.glob(os.path.join(CORPUS_DIR,'*.bplist'))):
+            xml_path = binary_path[:-len('.bplist')] + '.xml'
+            expected = comparable(plistlib.readPlist(xml_path))
+            self.assertEqual(comparable(conditions_common.read_plist(binary_path)),expected,os.path.basename(binary_path))
+            # XML files go through plistlib:
+            self.assertEqual(comparable(conditions_common.read_plist(xml_path)),expected,os.path.basename(xml_path))
+
+    def test_value_types(self):
+        scalars_dict = conditions_common.read_plist(os.path.join(CORPUS_DIR,'scalars.bplist'))
+        self.assertTrue(scalars_dict['true'] is True)
+        self.assertTrue(scalars_dict['false'] is False)
+        self.assertEqual(scalars_dict['unicode'],u'café ☃ 日本')
+        self.assertEqual(scalars_dict['date'],datetime.datetime(1999,12,31,23,59,59))
+        self.assertTrue(isinstance(scalars_dict['data'],plistlib.Data))
+        self.assertEqual(scalars_dict['data'].data,'\x00\x01\x02binary\xff')
+        integers_list = conditions_common.read_plist(os.path.join(CORPUS_DIR,'integers.bplist'))['values']
+        self.assertEqual(integers_list[-4:],[2**63 - 1,-2**63,2**63,2**64 - 1])
+
+    def test_munki_prefs(self):
+        prefs_dict = conditions_common.read_plist(os.path.join(CORPUS_DIR,'managed_installs.bplist'))
+        self.assertEqual(prefs_dict['ClientIdentifier'],'lab-mac-042')
+
+class MalformedPlistTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self,given_data):
+        path = os.path.join(self.temp_dir,'test.plist')
+        with open(path,'wb') as plist_file:
+            plist_file.write(given_data)
+        return path
+
+    def test_truncated(self):
+        with open(os.path.join(CORPUS_DIR,'managed_installs.bplist'),'rb') as plist_file:
+            data = plist_file.read()
+        for length in [8,20,40,len(data) - 1]:
+            self.assertRaises(conditions_common.PlistFormatError,conditions_common.read_plist,self.write(data[:length]))
+
+    def test_well_formed_by_hand(self):
+        # ['hi'], built the way the malformed cases are:
+        path = self.write(binary_plist(['\xa1\x01','\x52hi']))
+        self.assertEqual(conditions_common.read_plist(path),['hi'])
+
+    def test_bad_trailer(self):
+        self.assertRaises(conditions_common.PlistFormatError,conditions_common.read_plist,self.write('bplist00' + '\x00' * 32))
+        # Top object past the object count:
+        path = self.write(binary_plist(['\x08'],given_top_object=3))
+        self.assertRaises(conditions_common.PlistFormatError,conditions_common.read_plist,path)
+
+    def test_cycle(self):
+        # An array containing itself:
+        path = self.write(binary_plist(['\xa1\x00']))
+        self.assertRaises(conditions_common.PlistFormatError,conditions_common.read_plist,path)
+
+    def test_bad_reference(self):
+        path = self.write(binary_plist(['\xa1\x05']))
+        self.assertRaises(conditions_common.PlistFormatError,conditions_common.read_plist,path)
+
+    def test_unknown_marker(self):
+        path = self.write(binary_plist(['\x70']))
+        self.assertRaises(conditions_common.PlistFormatError,conditions_common.read_plist,path)
+
+    def test_bad_xml(self):
+        path = self.write('<?xml version="1.0"?><plist><dict><key>a</key>')
+        self.assertRaises(Exception,conditions_common.read_plist,path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+# Tests for print-queues.py's queue state: print_queue_fingerprint(),
+# print_queue_state_current(), and queues skipped (or added and updated)
+# by provision_print_queue() and run_condition(), with lpoptions and
+# lpadmin replaced by a stand-in function; and queues provisioned several
+# at a time, with a slow stand-in lpadmin.
+
+import unittest, os, tempfile, shutil, time, subprocess, plistlib
+from datetime import datetime, timedelta
+import support
+from support import conditions_common
+
+print_queues = support.load_condition('print-queues.py')
+
+class StandInLpadmin(object):
+    '''Stand-in for lpoptions and lpadmin: lpadmin -v adds a queue's device
+        URI to device_uris_dict, which lpoptions -p reports.  Keeps the
+        lpadmin commands in lpadmin_list.'''
+    def __init__(self):
+        self.device_uris_dict = {}
+        self.lpadmin_list = []
+
+    def __call__(self,given_command_list):
+        queue_name = given_command_list[2]
+        if given_command_list[0] == '/usr/bin/lpoptions':
+            if queue_name not in self.device_uris_dict:
+                return ''
+            return 'device-uri=%s printer-is-shared=false\n' % self.device_uris_dict[queue_name]
+        self.lpadmin_list.append(given_command_list)
+        if '-v' in given_command_list:
+            self.device_uris_dict[queue_name] = given_command_list[given_command_list.index('-v') + 1]
+        return ''
+
+class PrintQueueStateTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_settings = (print_queues.PRINT_QUEUES_STATE_PATH,print_queues.PRINT_QUEUES_FORCE_REFRESH_SECONDS,
+                               print_queues.PRINT_QUEUES_USE_IPP)
+        print_queues.PRINT_QUEUES_STATE_PATH = os.path.join(self.temp_dir,'PrintQueuesState.plist')
+        print_queues.PRINT_QUEUES_FORCE_REFRESH_SECONDS = 604800
+        print_queues.PRINT_QUEUES_USE_IPP = False
+        self.ppd_path = os.path.join(self.temp_dir,'lab_printer.ppd')
+        with open(self.ppd_path,'w') as ppd_file:
+            ppd_file.write('*PPD-Adobe: "4.3"\n')
+        self.lpadmin = StandInLpadmin()
+        runner = support.fresh_command_runner()
+        runner.substitute_tool('/usr/bin/lpoptions',self.lpadmin)
+        runner.substitute_tool('/usr/sbin/lpadmin',self.lpadmin)
+
+    def tearDown(self):
+        (print_queues.PRINT_QUEUES_STATE_PATH,print_queues.PRINT_QUEUES_FORCE_REFRESH_SECONDS,
+         print_queues.PRINT_QUEUES_USE_IPP) = self.saved_settings
+        shutil.rmtree(self.temp_dir)
+
+    def queue(self,**given_settings):
+        queue_dict = {'name':'lab_printer','ppd_path':self.ppd_path,'device_uri':'lpd://10.0.0.5/queue'}
+        queue_dict.update(given_settings)
+        return queue_dict
+
+    def test_fingerprint(self):
+        fingerprint = print_queues.print_queue_fingerprint(self.queue())
+        self.assertEqual(print_queues.print_queue_fingerprint(self.queue()),fingerprint)
+        # Defaults and results do not change it:
+        self.assertEqual(print_queues.print_queue_fingerprint(self.queue(display_name='lab_printer',kerberos_auth_required=False,
+                                                                         additional_cups_opts=[],queue_action='skipped')),
+                         fingerprint)
+        # Every applied setting does:
+        other_ppd_path = os.path.join(self.temp_dir,'other.ppd')
+        shutil.copy(self.ppd_path,other_ppd_path)
+        fingerprints_list = [fingerprint]
+        for settings_dict in [{'name':'lab_printer_2'},{'display_name':'Lab Printer'},
+                              {'device_uri':'lpd://10.0.0.6/queue'},{'ppd_path':other_ppd_path},
+                              {'kerberos_auth_required':True},{'additional_cups_opts':['Duplex=None']},
+                              {'additional_cups_opts':['Duplex=None','PageSize=Letter']},
+                              {'additional_cups_opts':['PageSize=Letter','Duplex=None']}]:
+            fingerprints_list.append(print_queues.print_queue_fingerprint(self.queue(**settings_dict)))
+        self.assertEqual(len(set(fingerprints_list)),len(fingerprints_list))
+
+    def test_fingerprint_follows_ppd(self):
+        fingerprint = print_queues.print_queue_fingerprint(self.queue())
+        os.utime(self.ppd_path,(time.time() - 3600,time.time() - 3600))
+        self.assertNotEqual(print_queues.print_queue_fingerprint(self.queue()),fingerprint)
+        # A missing PPD gives a fingerprint of its own:
+        missing_fingerprint = print_queues.print_queue_fingerprint(self.queue(ppd_path=os.path.join(self.temp_dir,'missing.ppd')))
+        self.assertFalse(missing_fingerprint in [fingerprint,print_queues.print_queue_fingerprint(self.queue())])
+
+    def test_state_current(self):
+        state_dict = {'fingerprint':'abc','applied':datetime.utcnow() - timedelta(days=1)}
+        self.assertTrue(print_queues.print_queue_state_current(state_dict,'abc'))
+        self.assertFalse(print_queues.print_queue_state_current(state_dict,'abd'))
+        # Due for a forced refresh:
+        state_dict['applied'] = datetime.utcnow() - timedelta(days=8)
+        self.assertFalse(print_queues.print_queue_state_current(state_dict,'abc'))
+        print_queues.PRINT_QUEUES_FORCE_REFRESH_SECONDS = 0
+        self.assertTrue(print_queues.print_queue_state_current(state_dict,'abc'))
+        # No (or an unusable) recorded state:
+        for queue_state_dict in [None,{},{'fingerprint':'abc'},{'fingerprint':'abc','applied':'yesterday'}]:
+            print_queues.PRINT_QUEUES_FORCE_REFRESH_SECONDS = 604800
+            self.assertFalse(print_queues.print_queue_state_current(queue_state_dict,'abc'))
+
+    def test_skipped_queue_keeps_result_keys(self):
+        queue_dict = self.queue()
+        applied_date = datetime(2017,7,23,12,0,0)
+        print_queues.PRINT_QUEUES_FORCE_REFRESH_SECONDS = 0
+        queue_state_dict = {'fingerprint':print_queues.print_queue_fingerprint(queue_dict),'applied':applied_date}
+        printers_dict = {'lab_printer':{'device-uri':['LPD://10.0.0.5/queue']}}
+        result_dict, new_state_dict = print_queues.provision_print_queue((queue_dict,printers_dict,queue_state_dict))
+        self.assertEqual((result_dict['queue_action'],result_dict['queue_attributes_set'],result_dict['queue_attributes_set_timestamp']),
+                         ('skipped',True,applied_date))
+        self.assertFalse('queue_added' in result_dict)
+        self.assertTrue(new_state_dict is queue_state_dict)
+        self.assertEqual(self.lpadmin.lpadmin_list,[])
+
+    def run_condition(self,given_print_queue_dicts_list):
+        context = conditions_common.ConditionsContext([])
+        context.computed_dict['effective_manifest_metadata'] = {'print_queues':given_print_queue_dicts_list}
+        print_queues.run_condition(context)
+        return context.conditions_writer.pending_dict['managed_print_queues']
+
+    def test_added_updated_and_skipped(self):
+        queue_dicts_list = self.run_condition([self.queue()])
+        self.assertEqual((queue_dicts_list[0]['queue_action'],queue_dicts_list[0]['queue_added']),('added',True))
+        state_dict = plistlib.readPlist(print_queues.PRINT_QUEUES_STATE_PATH)['queues']['lab_printer']
+        self.assertEqual(state_dict['fingerprint'],print_queues.print_queue_fingerprint(self.queue()))
+        # Next run: skipped, reporting when the settings were applied.
+        support.fresh_command_runner().substitute_tool('/usr/bin/lpoptions',self.lpadmin)
+        queue_dicts_list = self.run_condition([self.queue()])
+        self.assertEqual(queue_dicts_list[0]['queue_action'],'skipped')
+        self.assertEqual(queue_dicts_list[0]['queue_attributes_set'],True)
+        self.assertEqual(queue_dicts_list[0]['queue_attributes_set_timestamp'],state_dict['applied'])
+        self.assertEqual(len(self.lpadmin.lpadmin_list),1)
+        # A changed display name updates the queue (without -v):
+        runner = support.fresh_command_runner()
+        runner.substitute_tool('/usr/bin/lpoptions',self.lpadmin)
+        runner.substitute_tool('/usr/sbin/lpadmin',self.lpadmin)
+        queue_dicts_list = self.run_condition([self.queue(display_name='Lab Printer')])
+        self.assertEqual((queue_dicts_list[0]['queue_action'],queue_dicts_list[0]['queue_attributes_set']),('updated',True))
+        self.assertFalse('-v' in self.lpadmin.lpadmin_list[-1])
+        self.assertTrue(queue_dicts_list[0]['queue_attributes_set_timestamp'] > state_dict['applied'])
+
+# lpadmin latency: small with the other tests, closer to cupsd handling a
+# real PPD with CONDITIONS_BENCHMARK.
+LPADMIN_DELAY_SECONDS = support.benchmark_size(0.05,0.5)
+
+class PrintQueuePoolTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.saved_settings = (print_queues.PRINT_QUEUES_STATE_PATH,print_queues.PRINT_QUEUES_USE_IPP,
+                               print_queues.PRINT_QUEUES_MAX_WORKERS)
+        print_queues.PRINT_QUEUES_STATE_PATH = os.path.join(self.temp_dir,'PrintQueuesState.plist')
+        print_queues.PRINT_QUEUES_USE_IPP = False
+        self.ppd_path = os.path.join(self.temp_dir,'lab_printer.ppd')
+        with open(self.ppd_path,'w') as ppd_file:
+            ppd_file.write('*PPD-Adobe: "4.3"\n')
+
+    def tearDown(self):
+        (print_queues.PRINT_QUEUES_STATE_PATH,print_queues.PRINT_QUEUES_USE_IPP,
+         print_queues.PRINT_QUEUES_MAX_WORKERS) = self.saved_settings
+        shutil.rmtree(self.temp_dir)
+
+    def queues(self,given_count):
+        return [{'name':'lab_printer_%02d' % i,'ppd_path':self.ppd_path,'device_uri':'lpd://10.0.0.%d/queue' % i}
+                for i in range(given_count)]
+
+    def run_condition(self,given_print_queue_dicts_list,given_max_workers,given_lpadmin):
+        '''Runs print-queues with given_max_workers, given_lpadmin (a
+            path or function) and an lpoptions that finds no queues.
+            Returns the managed_print_queues condition and the seconds
+            taken.'''
+        print_queues.PRINT_QUEUES_MAX_WORKERS = given_max_workers
+        if os.path.exists(print_queues.PRINT_QUEUES_STATE_PATH):
+            os.remove(print_queues.PRINT_QUEUES_STATE_PATH)
+        runner = support.fresh_command_runner()
+        runner.substitute_tool('/usr/bin/lpoptions',lambda given_command_list: '')
+        runner.substitute_tool('/usr/sbin/lpadmin',given_lpadmin)
+        context = conditions_common.ConditionsContext([])
+        context.computed_dict['effective_manifest_metadata'] = {'print_queues':given_print_queue_dicts_list}
+        start_time = time.time()
+        print_queues.run_condition(context)
+        return context.conditions_writer.pending_dict['managed_print_queues'], time.time() - start_time
+
+    def test_failing_queue_does_not_block_others(self):
+        def lpadmin(given_command_list):
+            if given_command_list[2] == 'lab_printer_01':
+                raise OSError(13,'Permission denied')
+            if given_command_list[2] == 'lab_printer_02':
+                raise subprocess.CalledProcessError(1,given_command_list,'lpadmin: Unable to copy PPD file.\n')
+            time.sleep(0.01)
+            return ''
+        queue_dicts_list, seconds = self.run_condition(self.queues(6),4,lpadmin)
+        self.assertEqual([(q['name'],q['queue_added']) for q in queue_dicts_list],
+                         [('lab_printer_00',True),('lab_printer_01',False),('lab_printer_02',False),
+                          ('lab_printer_03',True),('lab_printer_04',True),('lab_printer_05',True)])
+        # The failed queues are tried again next run:
+        self.assertEqual(sorted(plistlib.readPlist(print_queues.PRINT_QUEUES_STATE_PATH)['queues']),
+                         ['lab_printer_00','lab_printer_03','lab_printer_04','lab_printer_05'])
+
+    def test_results_in_metadata_order(self):
+        # Later queues finish first:
+        def lpadmin(given_command_list):
+            time.sleep(0.005 * (8 - int(given_command_list[2][-2:])))
+            return ''
+        queue_dicts_list = self.queues(8)
+        for max_workers in [1,4,8]:
+            for run in range(3):
+                results_list, seconds = self.run_condition([dict(q) for q in queue_dicts_list],max_workers,lpadmin)
+                self.assertEqual([q['name'] for q in results_list],[q['name'] for q in queue_dicts_list])
+                self.assertEqual(set([q['queue_action'] for q in results_list]),set(['added']))
+
+    def test_worker_timings(self):
+        queue_count = support.benchmark_size(8,32)
+        lpadmin_path = support.stand_in_tool(self.temp_dir,'lpadmin','',LPADMIN_DELAY_SECONDS)
+        rows_list = []
+        seconds_dict = {}
+        for max_workers in [1,4,8]:
+            queue_dicts_list, seconds = self.run_condition(self.queues(queue_count),max_workers,lpadmin_path)
+            self.assertEqual([q['queue_added'] for q in queue_dicts_list],[True] * queue_count)
+            seconds_dict[max_workers] = seconds
+            rows_list.append(('%d worker(s)' % max_workers,seconds))
+        self.assertTrue(seconds_dict[1] >= queue_count * LPADMIN_DELAY_SECONDS)
+        self.assertTrue(seconds_dict[4] < seconds_dict[1])
+        support.benchmark_report('print-queues adding %d queues, lpadmin taking %ss each' % (queue_count,LPADMIN_DELAY_SECONDS),
+                                 rows_list)
+
+if __name__ == '__main__':
+    unittest.main()
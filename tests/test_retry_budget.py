@@ -0,0 +1,132 @@
+# Tests for conditions_common.RetryBudget: backoff and jitter, the budget
+# bounding waits and attempts, and the per-step accounting.  Waits go to a
+# recording event, so most tests take no time.
+
+import unittest, threading, time
+import support
+from support import conditions_common
+
+class RecordingEvent(object):
+    '''Stand-in for the cancel event: remembers the waits asked of it
+        instead of waiting.'''
+    def __init__(self):
+        self.waits_list = []
+
+    def is_set(self):
+        return False
+
+    def wait(self,given_seconds):
+        self.waits_list.append(given_seconds)
+        return False
+
+class CountingProbe(object):
+    '''A probe that fails until its succeed_on'th call.'''
+    def __init__(self,given_succeed_on=None):
+        self.succeed_on = given_succeed_on
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls == self.succeed_on:
+            return 'answer'
+        return ''
+
+class RetryBudgetTests(unittest.TestCase):
+    def test_exponential_backoff(self):
+        budget = conditions_common.RetryBudget(100,1.0,8.0,2.0,0.0)
+        event = RecordingEvent()
+        probe = CountingProbe()
+        self.assertEqual(budget.run('dig',probe,6,event),'')
+        self.assertEqual(probe.calls,6)
+        # No wait after the last attempt; waits are capped at max_delay:
+        self.assertEqual(event.waits_list,[1.0,2.0,4.0,8.0,8.0])
+
+    def test_jitter_bounds(self):
+        budget = conditions_common.RetryBudget(100,1.0,8.0,2.0,0.25)
+        waits_by_attempt_list = [[] for i in range(4)]
+        for r in range(200):
+            event = RecordingEvent()
+            budget.run('dscl',CountingProbe(),5,event)
+            for i, wait_seconds in enumerate(event.waits_list):
+                waits_by_attempt_list[i].append(wait_seconds)
+        for i, delay in enumerate([1.0,2.0,4.0,8.0]):
+            waits_list = waits_by_attempt_list[i]
+            self.assertEqual(len(waits_list),200)
+            self.assertTrue(min(waits_list) >= delay * 0.75)
+            self.assertTrue(max(waits_list) <= min(delay * 1.25,8.0))
+            # Jittered (below the cap), so concurrent clients do not retry in step:
+            if delay * 1.25 <= 8.0:
+                self.assertTrue(len(set(waits_list)) > 100)
+
+    def test_stops_on_success(self):
+        budget = conditions_common.RetryBudget(100,1.0,8.0,2.0,0.0)
+        event = RecordingEvent()
+        probe = CountingProbe(3)
+        self.assertEqual(budget.run('dscl',probe,5,event),'answer')
+        self.assertEqual(probe.calls,3)
+        self.assertEqual(event.waits_list,[1.0,2.0])
+        self.assertEqual(budget.steps_dict['dscl']['attempts'],3)
+        self.assertEqual(budget.steps_dict['dscl']['succeeded'],True)
+
+    def test_waits_cut_to_the_budget(self):
+        budget = conditions_common.RetryBudget(0.5,1.0,8.0,2.0,0.25)
+        event = RecordingEvent()
+        budget.run('dig',CountingProbe(),4,event)
+        self.assertEqual(len(event.waits_list),3)
+        for wait_seconds in event.waits_list:
+            self.assertTrue(0 < wait_seconds <= 0.5)
+        self.assertTrue(budget.timeout(30) <= 0.5)
+        self.assertEqual(budget.timeout(0.1),0.1)
+
+    def test_expired_budget(self):
+        budget = conditions_common.RetryBudget(0)
+        self.assertTrue(budget.expired())
+        self.assertEqual(budget.remaining(),0.0)
+        # Never zero, which would mean no timeout:
+        self.assertEqual(budget.timeout(30),0.001)
+        probe = CountingProbe(1)
+        self.assertEqual(budget.run('dig',probe,5,RecordingEvent()),None)
+        self.assertEqual(probe.calls,0)
+        self.assertEqual(budget.steps_dict['dig']['attempts'],0)
+        event = RecordingEvent()
+        budget.wait('settle',5,event)
+        self.assertEqual(event.waits_list,[])
+
+    def test_cancelled(self):
+        budget = conditions_common.RetryBudget(100)
+        cancel_event = threading.Event()
+        cancel_event.set()
+        probe = CountingProbe(1)
+        self.assertEqual(budget.run('dscl',probe,5,cancel_event),None)
+        self.assertEqual(probe.calls,0)
+
+    def test_real_waits_end_with_the_budget(self):
+        budget = conditions_common.RetryBudget(0.3,0.05,0.1)
+        start_time = time.time()
+        probe = CountingProbe()
+        budget.run('dig',probe)
+        self.assertTrue(0.3 <= time.time() - start_time < 0.5)
+        self.assertTrue(budget.expired())
+        self.assertTrue(probe.calls >= 3)
+
+    def test_accounting(self):
+        budget = conditions_common.RetryBudget(100,1.0,8.0,2.0,0.0)
+        budget.run('dscl',CountingProbe(),2,RecordingEvent())
+        budget.run('sntp',CountingProbe(1),2,RecordingEvent())
+        budget.run('dscl',CountingProbe(2),2,RecordingEvent())
+        event = RecordingEvent()
+        budget.wait('ntp-settle',5,event)
+        budget.record('dns-srv',0.25,1,False)
+        self.assertEqual(event.waits_list,[5])
+        self.assertEqual(list(budget.steps_dict),['dscl','sntp','ntp-settle','dns-srv'])
+        self.assertEqual([(step['attempts'],step['succeeded']) for step in budget.steps_dict.values()],
+                         [(4,True),(1,True),(0,True),(1,False)])
+        self.assertEqual(budget.steps_dict['dns-srv']['seconds'],0.25)
+        report = budget.report()
+        self.assertTrue(report.startswith('Used '))
+        self.assertTrue('of 100.00s budget: dscl ' in report)
+        self.assertTrue('dns-srv 0.25s/1 tries (failed)' in report)
+        self.assertEqual(conditions_common.RetryBudget(5).report()[-len('no steps'):],'no steps')
+
+if __name__ == '__main__':
+    unittest.main()
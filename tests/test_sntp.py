@@ -0,0 +1,86 @@
+# Tests for the SNTP clock check in ad-status.py, against a stand-in NTP
+# server on the loopback whose clock is set off from ours.
+
+import unittest, struct, time
+import support
+from support import conditions_common
+
+ad_status = support.load_condition('ad-status.py')
+
+def ntp_timestamp(given_unix_time):
+    return int((given_unix_time + 2208988800) * 2**32)
+
+def ntp_reply(given_request,given_offset_seconds,given_flags=0x24,given_stratum=2,given_origin=None):
+    '''Builds a server reply (by default LI 0, version 4, mode 4) echoing the
+        request's transmit timestamp as its origin, from a clock
+        given_offset_seconds ahead of ours.'''
+    if given_origin is None:
+        given_origin = struct.unpack('!Q',given_request[40:48])[0]
+    server_time = ntp_timestamp(time.time() + given_offset_seconds)
+    return struct.pack('!BBbb12xQQQQ',given_flags,given_stratum,6,-20,0,given_origin,server_time,server_time)
+
+class SNTPTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_settings = (ad_status.NTP_PORT,ad_status.NTP_QUERY_TIMEOUT_SECONDS,ad_status.NTP_QUERY_TRIES)
+        ad_status.NTP_QUERY_TIMEOUT_SECONDS = 0.2
+        ad_status.NTP_QUERY_TRIES = 2
+        self.server = None
+
+    def tearDown(self):
+        ad_status.NTP_PORT, ad_status.NTP_QUERY_TIMEOUT_SECONDS, ad_status.NTP_QUERY_TRIES = self.saved_settings
+        if self.server:
+            support.stop_stand_in(self.server)
+
+    def ntp_server(self,given_reply_function):
+        if self.server:
+            support.stop_stand_in(self.server)
+        self.server = support.udp_stand_in(given_reply_function)
+        ad_status.NTP_PORT = self.server.port
+        return self.server
+
+    def test_request(self):
+        self.ntp_server(lambda request: None)
+        ad_status.sntp_query_once('127.0.0.1',0.05)
+        request = self.server.requests_list[0]
+        self.assertEqual(len(request),48)
+        self.assertEqual(ord(request[0]),0x23) # LI 0, version 4, mode 3 (client)
+
+    def test_offset(self):
+        self.ntp_server(lambda request: [ntp_reply(request,120.0)])
+        self.assertAlmostEqual(ad_status.sntp_query_once('127.0.0.1',1.0),120.0,delta=0.1)
+        self.ntp_server(lambda request: [ntp_reply(request,-3600.0)])
+        self.assertAlmostEqual(ad_status.sntp_query_once('127.0.0.1',1.0),-3600.0,delta=0.1)
+
+    def test_reply_must_echo_the_request(self):
+        self.ntp_server(lambda request: [ntp_reply(request,900.0,given_origin=12345),ntp_reply(request,60.0)])
+        self.assertAlmostEqual(ad_status.sntp_query_once('127.0.0.1',1.0),60.0,delta=0.1)
+
+    def test_ignored_replies(self):
+        for reply_function in [lambda request: [ntp_reply(request,60.0,given_stratum=0)], # kiss-o'-death
+                               lambda request: [ntp_reply(request,60.0,0xE4)],           # unsynchronized (LI 3)
+                               lambda request: [ntp_reply(request,60.0,0x23)],           # not server mode
+                               lambda request: [ntp_reply(request,60.0)[:40]]]:          # short
+            self.ntp_server(reply_function)
+            start_time = time.time()
+            self.assertEqual(ad_status.sntp_query_once('127.0.0.1',0.2),None)
+            self.assertTrue(time.time() - start_time < 1.0)
+
+    def test_measure_offset_retries(self):
+        server = self.ntp_server(lambda request: len(server.requests_list) > 1 and [ntp_reply(request,30.0)] or None)
+        budget = conditions_common.RetryBudget(10)
+        self.assertAlmostEqual(ad_status.sntp_measure_offset('127.0.0.1',budget),30.0,delta=0.1)
+        self.assertEqual(budget.steps_dict['sntp']['attempts'],2)
+        self.assertTrue(budget.steps_dict['sntp']['succeeded'])
+
+    def test_measure_offset_within_budget(self):
+        self.ntp_server(lambda request: None)
+        budget = conditions_common.RetryBudget(0.1)
+        start_time = time.time()
+        self.assertEqual(ad_status.sntp_measure_offset('127.0.0.1',budget),None)
+        self.assertTrue(time.time() - start_time < 0.3)
+        self.assertFalse(budget.steps_dict['sntp']['succeeded'])
+        self.assertEqual(ad_status.sntp_measure_offset('127.0.0.1',budget),None)
+        self.assertEqual(budget.steps_dict['sntp']['attempts'],len(self.server.requests_list))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# Tests for conditions_common.PlistTTLCache: expiry, negative and stale
+# entries, discarding the file on a version or signature change, and
+# pruning when saved.
+
+import unittest, os, tempfile, shutil, time, plistlib
+import support
+from support import conditions_common
+
+class PlistTTLCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir,'Cache.plist')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def cache(self,given_version=1,given_signature='network-a',given_max_stale_seconds=0):
+        return conditions_common.PlistTTLCache(self.path,given_version,given_signature,given_max_stale_seconds)
+
+    def expire(self,given_cache,given_key,given_seconds_ago=1):
+        given_cache.entries_dict[given_key]['expires'] = time.time() - given_seconds_ago
+
+    def test_put_and_get(self):
+        cache = self.cache()
+        self.assertEqual(cache.get('a'),None)
+        cache.put('a',['x','y'],60,0.5)
+        entry_dict = cache.get('a')
+        self.assertEqual((entry_dict['value'],entry_dict['negative'],entry_dict['stale']),(['x','y'],False,False))
+        self.assertTrue(time.time() + 55 < entry_dict['expires'] <= time.time() + 60)
+        # get() returns a copy:
+        entry_dict['value'] = 'changed'
+        self.assertEqual(cache.get('a')['value'],['x','y'])
+        self.assertEqual((cache.stats_dict['hits'],cache.stats_dict['misses'],cache.stats_dict['seconds_saved']),(2,1,1.0))
+        self.assertEqual(cache.hit_rate(),2.0 / 3)
+
+    def test_expiry(self):
+        cache = self.cache()
+        cache.put('a','x',60)
+        self.expire(cache,'a')
+        self.assertEqual(cache.get('a'),None)
+        entry_dict = cache.get('a',True)
+        self.assertEqual((entry_dict['value'],entry_dict['stale']),('x',True))
+        self.assertEqual((cache.stats_dict['misses'],cache.stats_dict['stale_hits']),(1,1))
+        # A zero TTL is already expired:
+        cache.put('b','y',0)
+        self.assertEqual(cache.get('b'),None)
+
+    def test_negative_entries(self):
+        cache = self.cache()
+        cache.put_negative('missing',30,0.25)
+        entry_dict = cache.get('missing')
+        self.assertEqual(entry_dict['negative'],True)
+        self.assertFalse('value' in entry_dict)
+        self.assertEqual((cache.stats_dict['hits'],cache.stats_dict['negative_hits'],cache.stats_dict['seconds_saved']),(0,1,0.25))
+        cache.put_negative('off-network',30,0,'details')
+        self.assertEqual(cache.get('off-network')['value'],'details')
+
+    def test_uncounted_lookups(self):
+        cache = self.cache()
+        cache.put('a','x',60)
+        cache.get('a',False,False)
+        cache.get('b',False,False)
+        self.assertEqual((cache.stats_dict['hits'],cache.stats_dict['misses']),(0,0))
+
+    def test_saved_and_loaded(self):
+        cache = self.cache()
+        cache.put('a','x',60)
+        cache.put_negative('b',60)
+        cache.save()
+        cache = self.cache()
+        self.assertEqual(cache.get('a')['value'],'x')
+        self.assertEqual(cache.get('b')['negative'],True)
+        self.assertFalse(cache.stats_dict['invalidated'])
+
+    def test_unchanged_cache_not_written(self):
+        cache = self.cache()
+        cache.put('a','x',60)
+        cache.save()
+        os.utime(self.path,(1000000000,1000000000))
+        cache = self.cache()
+        cache.get('a')
+        cache.save()
+        self.assertEqual(os.stat(self.path).st_mtime,1000000000)
+
+    def test_version_or_signature_change_discards(self):
+        cache = self.cache()
+        cache.put('a','x',60)
+        cache.save()
+        for version, signature in [(2,'network-a'),(1,'network-b')]:
+            cache = self.cache(version,signature)
+            self.assertEqual(cache.get('a'),None)
+            self.assertTrue(cache.stats_dict['invalidated'])
+            self.assertTrue('discarded' in cache.report())
+        # The discarded file is replaced when saved:
+        cache.save()
+        self.assertEqual(plistlib.readPlist(self.path),{'cache_version':1,'signature':'network-b','entries':{}})
+        self.assertEqual(self.cache(1,'network-a').get('a'),None)
+
+    def test_unreadable_file(self):
+        for data in ['<plist><dict><key>cache_version</key>',plistlib.writePlistToString(['not','a','dict']),'']:
+            with open(self.path,'wb') as cache_file:
+                cache_file.write(data)
+            cache = self.cache()
+            self.assertEqual(cache.get('a'),None)
+            cache.put('a','x',60)
+            cache.save()
+            self.assertEqual(self.cache().get('a')['value'],'x')
+
+    def test_save_prunes_past_max_stale(self):
+        cache = self.cache(given_max_stale_seconds=100)
+        cache.put('fresh','x',60)
+        cache.put('stale','y',60)
+        cache.put('too-stale','z',60)
+        self.expire(cache,'stale',50)
+        self.expire(cache,'too-stale',150)
+        cache.entries_dict['malformed'] = {'value':'no expiry'}
+        cache.save()
+        self.assertEqual(sorted(plistlib.readPlist(self.path)['entries']),['fresh','stale'])
+        cache = self.cache(given_max_stale_seconds=100)
+        self.assertEqual(cache.get('stale',True)['value'],'y')
+        # Without max_stale_seconds, expired entries are dropped when saved:
+        cache = self.cache()
+        cache.save()
+        self.assertEqual(sorted(plistlib.readPlist(self.path)['entries']),['fresh'])
+
+    def test_invalidate(self):
+        cache = self.cache()
+        cache.put('a','x',60)
+        cache.put('b','y',60)
+        cache.invalidate('a')
+        cache.invalidate('no-such-key')
+        self.assertEqual(sorted(cache.entries_dict),['b'])
+        cache.invalidate()
+        self.assertEqual(cache.entries_dict,{})
+
+if __name__ == '__main__':
+    unittest.main()